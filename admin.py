@@ -2,7 +2,6 @@ import sqlite3
 import os
 import logging
 import json
-import tempfile
 import shutil
 import time
 import secrets # For generating random codes
@@ -27,14 +26,17 @@ from telegram import helpers
 import telegram.error as telegram_error
 
 # --- Local Imports ---
+from router import callback_route, state_route # Static update routing
 from utils import (
     CITIES, DISTRICTS, PRODUCT_TYPES, ADMIN_ID, PRIMARY_ADMIN_IDS, LANGUAGES, THEMES,
     BOT_MEDIA, SIZES, fetch_reviews, format_currency, send_message_with_retry,
     get_date_range, TOKEN, load_all_data, format_discount_value,
     SECONDARY_ADMIN_IDS,
     get_db_connection, MEDIA_DIR, BOT_MEDIA_JSON_PATH, # Import helpers/paths
+    run_db, db_fetchone, db_fetchall, db_execute, # Async DB facade
+    create_media_staging_dir, download_media_batch, store_staged_media, # Parallel media downloads + blob store
+    CATALOG_INDEX, # In-memory stock index for browsing menus
     DEFAULT_PRODUCT_EMOJI, # Import default emoji
-    fetch_user_ids_for_broadcast, # <-- Import broadcast user fetch function
     update_user_broadcast_status, # <-- Import broadcast status tracking function
     save_bot_media_config, # Import bot media save function
     # <<< Welcome Message Helpers >>>
@@ -43,6 +45,7 @@ from utils import (
     update_welcome_message_template,
     delete_welcome_message_template,
     set_active_welcome_message,
+    invalidate_welcome_template_cache, # Active template is cached for /start
     DEFAULT_WELCOME_MESSAGE, # Fallback if needed
     # User status helpers
     get_user_status, get_progress_bar,
@@ -53,6 +56,10 @@ from utils import (
     # Admin authorization helpers
     is_primary_admin, is_secondary_admin, is_any_admin, get_first_primary_admin_id
 )
+from broadcast import run_broadcast # Rate-limited, resumable broadcast engine
+from bulk_import import ( # Single-transaction product import
+    import_products, parse_import_file, BulkImportError, BULK_IMPORT_MAX_ROWS, BULK_IMPORT_FILE_EXTENSIONS
+)
 # --- Import viewer admin handlers ---
 # These now include the user management handlers
 try:
@@ -103,10 +110,12 @@ try:
         handle_reseller_edit_discount,
         handle_reseller_percent_message,
         handle_reseller_delete_discount_confirm,
+        invalidate_reseller_pricing,
     )
 except ImportError:
     logger_dummy_reseller = logging.getLogger(__name__ + "_dummy_reseller")
     logger_dummy_reseller.error("Could not import handlers from reseller_management.py.")
+    def invalidate_reseller_pricing(user_id: int | None = None): pass
     async def handle_manage_resellers_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
         query = update.callback_query; msg = "Reseller Status Mgmt handler not found."
         if query: await query.edit_message_text(msg)
@@ -144,6 +153,8 @@ logger = logging.getLogger(__name__)
 # --- Constants for Media Group Handling ---
 MEDIA_GROUP_COLLECTION_DELAY = 3.5 # Increased from 2.0 to 3.5 seconds to ensure all media is collected
 TEMPLATES_PER_PAGE = 5 # Pagination for welcome templates
+BULK_REPORT_MAX_FAILURES = 15 # Failures listed per report message (Telegram caps messages at 4096 chars)
+BULK_STATUS_PREVIEW_MESSAGES = 20 # Collected messages listed in the bulk status view
 
 # --- Helper Function to Remove Existing Job ---
 def remove_job_if_exists(name: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
@@ -183,31 +194,17 @@ async def _prepare_and_confirm_drop(
 
     if collected_media_info:
         try:
-            temp_dir = await asyncio.to_thread(tempfile.mkdtemp)
-            logger.info(f"Created temp dir for media download: {temp_dir} (User: {user_id})")
-            for i, media_info in enumerate(collected_media_info):
-                media_type = media_info['type']
-                file_id = media_info['file_id']
-                file_extension = ".jpg" if media_type == "photo" else ".mp4" if media_type in ["video", "gif"] else ".dat"
-                temp_file_path = os.path.join(temp_dir, f"{file_id}{file_extension}")
-                try:
-                    logger.info(f"Downloading media {i+1}/{len(collected_media_info)} ({file_id}) to {temp_file_path}")
-                    file_obj = await context.bot.get_file(file_id)
-                    await file_obj.download_to_drive(custom_path=temp_file_path)
-                    if not await asyncio.to_thread(os.path.exists, temp_file_path) or await asyncio.to_thread(os.path.getsize, temp_file_path) == 0:
-                        raise IOError(f"Downloaded file {temp_file_path} is missing or empty.")
-                    media_list_for_db.append({"type": media_type, "path": temp_file_path, "file_id": file_id})
-                    logger.info(f"Media download {i+1} successful.")
-                except (telegram_error.TelegramError, IOError, OSError) as e:
-                    logger.error(f"Error downloading/verifying media {i+1} ({file_id}): {e}")
-                    download_errors += 1
-                except Exception as e:
-                    logger.error(f"Unexpected error downloading media {i+1} ({file_id}): {e}", exc_info=True)
-                    download_errors += 1
+            # Staged on the media volume; confirming the drop moves the files into the content-addressed blob store (store_staged_media)
+            temp_dir = await asyncio.to_thread(create_media_staging_dir)
+            logger.info(f"Downloading {len(collected_media_info)} media files to {temp_dir} (User: {user_id})")
+            jobs = [({"type": m['type'], "file_id": m['file_id']}, temp_dir, f"media_{i}") for i, m in enumerate(collected_media_info)]
+            downloaded = await download_media_batch(context.bot, jobs)
+            media_list_for_db = [item for item in downloaded if item['path']]
+            download_errors = len(downloaded) - len(media_list_for_db)
             if download_errors > 0:
                 await send_message_with_retry(context.bot, chat_id, f"⚠️ Warning: {download_errors} media file(s) failed to download. Adding drop with successfully downloaded media only.", parse_mode=None)
         except Exception as e:
-             logger.error(f"Error setting up/during media download loop user {user_id}: {e}", exc_info=True)
+             logger.error(f"Error setting up/during media download user {user_id}: {e}", exc_info=True)
              await send_message_with_retry(context.bot, chat_id, "⚠️ Warning: Error during media processing. Drop will be added without media.", parse_mode=None)
              media_list_for_db = []
              if temp_dir and await asyncio.to_thread(os.path.exists, temp_dir): await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True); temp_dir = None
@@ -336,7 +333,7 @@ async def _process_bulk_collected_media(context: ContextTypes.DEFAULT_TYPE):
     try:
         from utils import send_message_with_retry
         await send_message_with_retry(context.bot, chat_id, 
-            f"✅ Media group added to bulk collection! Total messages: {len(bulk_messages)}/10", 
+            f"✅ Media group added to bulk collection! Total messages: {len(bulk_messages)}", 
             parse_mode=None)
         logger.info(f"BULK DEBUG: Sent status update for media group {media_group_id}")
     except Exception as e:
@@ -344,6 +341,7 @@ async def _process_bulk_collected_media(context: ContextTypes.DEFAULT_TYPE):
 
 
 # --- Modified Handler for Drop Details Message ---
+@state_route("awaiting_drop_details")
 async def handle_adm_drop_details_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles the message containing drop text and optional media (single or group)."""
     if not update.message or not update.effective_user:
@@ -439,6 +437,25 @@ async def handle_adm_drop_details_message(update: Update, context: ContextTypes.
 
 
 # --- Admin Callback Handlers ---
+def _fetch_admin_dashboard_stats() -> tuple[int, Decimal, int, Decimal]:
+    """Returns (total_users, total_user_balance, active_products, total_sales_value) (Synchronous, runs on DB executor)."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) as count FROM users")
+        res_users = c.fetchone(); total_users = res_users['count'] if res_users else 0
+        c.execute("SELECT COALESCE(SUM(balance), 0.0) as total_bal FROM users")
+        res_balance = c.fetchone(); total_user_balance = Decimal(str(res_balance['total_bal'])) if res_balance else Decimal('0.0')
+        c.execute("SELECT COUNT(*) as count FROM products WHERE available > reserved")
+        res_products = c.fetchone(); active_products = res_products['count'] if res_products else 0
+        c.execute("SELECT COALESCE(SUM(price_paid), 0.0) as total_sales FROM purchases")
+        res_sales = c.fetchone(); total_sales_value = Decimal(str(res_sales['total_sales'])) if res_sales else Decimal('0.0')
+        return total_users, total_user_balance, active_products, total_sales_value
+    finally:
+        if conn: conn.close()
+
+@callback_route("admin_menu")
 async def handle_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Displays the main admin dashboard, handling both command and callback."""
     user = update.effective_user
@@ -471,19 +488,8 @@ async def handle_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE,
             else: await send_message_with_retry(context.bot, chat_id, fallback_msg)
             return
 
-    total_users, total_user_balance, active_products, total_sales_value = 0, Decimal('0.0'), 0, Decimal('0.0')
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) as count FROM users")
-        res_users = c.fetchone(); total_users = res_users['count'] if res_users else 0
-        c.execute("SELECT COALESCE(SUM(balance), 0.0) as total_bal FROM users")
-        res_balance = c.fetchone(); total_user_balance = Decimal(str(res_balance['total_bal'])) if res_balance else Decimal('0.0')
-        c.execute("SELECT COUNT(*) as count FROM products WHERE available > reserved")
-        res_products = c.fetchone(); active_products = res_products['count'] if res_products else 0
-        c.execute("SELECT COALESCE(SUM(price_paid), 0.0) as total_sales FROM purchases")
-        res_sales = c.fetchone(); total_sales_value = Decimal(str(res_sales['total_sales'])) if res_sales else Decimal('0.0')
+        total_users, total_user_balance, active_products, total_sales_value = await run_db(_fetch_admin_dashboard_stats)
     except sqlite3.Error as e:
         logger.error(f"DB error fetching admin dashboard data: {e}", exc_info=True)
         error_message = "❌ Error loading admin data."
@@ -492,8 +498,6 @@ async def handle_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE,
             except Exception: pass
         else: await send_message_with_retry(context.bot, chat_id, error_message, parse_mode=None)
         return
-    finally:
-        if conn: conn.close()
 
     total_user_balance_str = format_currency(total_user_balance)
     total_sales_value_str = format_currency(total_sales_value)
@@ -551,6 +555,7 @@ async def handle_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
 
 # --- Sales Analytics Handlers ---
+@callback_route("sales_analytics_menu")
 async def handle_sales_analytics_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Displays the sales analytics submenu."""
     query = update.callback_query
@@ -566,6 +571,7 @@ async def handle_sales_analytics_menu(update: Update, context: ContextTypes.DEFA
     ]
     await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("sales_dashboard")
 async def handle_sales_dashboard(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Displays a quick sales dashboard for today, this week, this month."""
     query = update.callback_query
@@ -576,18 +582,14 @@ async def handle_sales_dashboard(update: Update, context: ContextTypes.DEFAULT_T
         "month": ("📆 This Month", None)
     }
     msg = "📊 Sales Dashboard\n\n"
-    conn = None # Initialize conn
     try:
-        conn = get_db_connection() # Use helper
-        c = conn.cursor()
         for period_key, (label_template, date_str) in periods.items():
             start, end = get_date_range(period_key)
             if not start or not end:
                 msg += f"Could not calculate range for {period_key}.\n\n"
                 continue
             # Use column names
-            c.execute("SELECT COALESCE(SUM(price_paid), 0.0) as total_revenue, COUNT(*) as total_units FROM purchases WHERE purchase_date BETWEEN ? AND ?", (start, end))
-            result = c.fetchone()
+            result = await db_fetchone("SELECT COALESCE(SUM(price_paid), 0.0) as total_revenue, COUNT(*) as total_units FROM purchases WHERE purchase_date BETWEEN ? AND ?", (start, end))
             revenue = result['total_revenue'] if result else 0.0
             units = result['total_units'] if result else 0
             aov = revenue / units if units > 0 else 0.0
@@ -604,8 +606,6 @@ async def handle_sales_dashboard(update: Update, context: ContextTypes.DEFAULT_T
     except Exception as e:
         logger.error(f"Unexpected error in sales dashboard: {e}", exc_info=True)
         msg += "\n❌ An unexpected error occurred."
-    finally:
-         if conn: conn.close() # Close connection if opened
     keyboard = [[InlineKeyboardButton("⬅️ Back", callback_data="sales_analytics_menu")]]
     try:
         await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
@@ -613,6 +613,7 @@ async def handle_sales_dashboard(update: Update, context: ContextTypes.DEFAULT_T
         if "message is not modified" not in str(e).lower(): logger.error(f"Error editing sales dashboard: {e}")
         else: await query.answer()
 
+@callback_route("sales_select_period")
 async def handle_sales_select_period(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Shows options for selecting a reporting period."""
     query = update.callback_query
@@ -634,6 +635,7 @@ async def handle_sales_select_period(update: Update, context: ContextTypes.DEFAU
     ]
     await query.edit_message_text("📅 Select Reporting Period", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("sales_run")
 async def handle_sales_run(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Generates and displays the selected sales report."""
     query = update.callback_query
@@ -647,16 +649,11 @@ async def handle_sales_run(update: Update, context: ContextTypes.DEFAULT_TYPE, p
         return await query.edit_message_text("❌ Error: Invalid period selected.", parse_mode=None)
     period_title = period_key.replace('_', ' ').title()
     msg = ""
-    conn = None # Initialize conn
     try:
-        conn = get_db_connection() # Use helper
-        # row_factory is set in helper
-        c = conn.cursor()
         base_query = "FROM purchases WHERE purchase_date BETWEEN ? AND ?"
         base_params = (start_time, end_time)
         if report_type == "main":
-            c.execute(f"SELECT COALESCE(SUM(price_paid), 0.0) as total_revenue, COUNT(*) as total_units {base_query}", base_params)
-            result = c.fetchone()
+            result = await db_fetchone(f"SELECT COALESCE(SUM(price_paid), 0.0) as total_revenue, COUNT(*) as total_units {base_query}", base_params)
             revenue = result['total_revenue'] if result else 0.0
             units = result['total_units'] if result else 0
             aov = revenue / units if units > 0 else 0.0
@@ -665,16 +662,14 @@ async def handle_sales_run(update: Update, context: ContextTypes.DEFAULT_TYPE, p
             msg = (f"📊 Sales Report: {period_title}\n\nRevenue: {revenue_str} EUR\n"
                    f"Units Sold: {units}\nAvg Order Value: {aov_str} EUR")
         elif report_type == "by_city":
-            c.execute(f"SELECT city, COALESCE(SUM(price_paid), 0.0) as city_revenue, COUNT(*) as city_units {base_query} GROUP BY city ORDER BY city_revenue DESC", base_params)
-            results = c.fetchall()
+            results = await db_fetchall(f"SELECT city, COALESCE(SUM(price_paid), 0.0) as city_revenue, COUNT(*) as city_units {base_query} GROUP BY city ORDER BY city_revenue DESC", base_params)
             msg = f"🏙️ Sales by City: {period_title}\n\n"
             if results:
                 for row in results:
                     msg += f"{row['city'] or 'N/A'}: {format_currency(row['city_revenue'])} EUR ({row['city_units'] or 0} units)\n"
             else: msg += "No sales data for this period."
         elif report_type == "by_type":
-            c.execute(f"SELECT product_type, COALESCE(SUM(price_paid), 0.0) as type_revenue, COUNT(*) as type_units {base_query} GROUP by product_type ORDER BY type_revenue DESC", base_params)
-            results = c.fetchall()
+            results = await db_fetchall(f"SELECT product_type, COALESCE(SUM(price_paid), 0.0) as type_revenue, COUNT(*) as type_units {base_query} GROUP by product_type ORDER BY type_revenue DESC", base_params)
             msg = f"📊 Sales by Type: {period_title}\n\n"
             if results:
                 for row in results:
@@ -683,7 +678,7 @@ async def handle_sales_run(update: Update, context: ContextTypes.DEFAULT_TYPE, p
                     msg += f"{emoji} {type_name}: {format_currency(row['type_revenue'])} EUR ({row['type_units'] or 0} units)\n"
             else: msg += "No sales data for this period."
         elif report_type == "top_prod":
-            c.execute(f"""
+            results = await db_fetchall(f"""
                 SELECT pu.product_name, pu.product_size, pu.product_type,
                        COALESCE(SUM(pu.price_paid), 0.0) as prod_revenue,
                        COUNT(pu.id) as prod_units
@@ -692,7 +687,6 @@ async def handle_sales_run(update: Update, context: ContextTypes.DEFAULT_TYPE, p
                 GROUP BY pu.product_name, pu.product_size, pu.product_type
                 ORDER BY prod_revenue DESC LIMIT 10
             """, base_params) # Simplified query relying on purchase record details
-            results = c.fetchall()
             msg = f"🏆 Top Products: {period_title}\n\n"
             if results:
                 for i, row in enumerate(results):
@@ -707,8 +701,6 @@ async def handle_sales_run(update: Update, context: ContextTypes.DEFAULT_TYPE, p
     except Exception as e:
         logger.error(f"Unexpected error generating sales report: {e}", exc_info=True)
         msg = "❌ An unexpected error occurred."
-    finally:
-         if conn: conn.close()
     keyboard = [[InlineKeyboardButton("⬅️ Back to Period", callback_data=f"sales_select_period|{report_type}"),
                  InlineKeyboardButton("📊 Analytics Menu", callback_data="sales_analytics_menu")]]
     try:
@@ -718,6 +710,7 @@ async def handle_sales_run(update: Update, context: ContextTypes.DEFAULT_TYPE, p
         else: await query.answer()
 
 # --- Add Product Flow Handlers ---
+@callback_route("adm_city")
 async def handle_adm_city(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Admin selects city to add product to."""
     query = update.callback_query
@@ -731,6 +724,7 @@ async def handle_adm_city(update: Update, context: ContextTypes.DEFAULT_TYPE, pa
     select_city_text = lang_data.get("admin_select_city", "Select City to Add Product:")
     await query.edit_message_text(select_city_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("adm_dist")
 async def handle_adm_dist(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Admin selects district within the chosen city."""
     query = update.callback_query
@@ -758,6 +752,7 @@ async def handle_adm_dist(update: Update, context: ContextTypes.DEFAULT_TYPE, pa
     select_district_text = select_district_template.format(city=city_name)
     await query.edit_message_text(select_district_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("adm_type")
 async def handle_adm_type(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Admin selects product type."""
     query = update.callback_query
@@ -781,6 +776,7 @@ async def handle_adm_type(update: Update, context: ContextTypes.DEFAULT_TYPE, pa
     await query.edit_message_text(select_type_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
 
+@callback_route("adm_add")
 async def handle_adm_add(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Admin selects size for the new product."""
     query = update.callback_query
@@ -802,6 +798,7 @@ async def handle_adm_add(update: Update, context: ContextTypes.DEFAULT_TYPE, par
     keyboard.append([InlineKeyboardButton("⬅️ Back to Types", callback_data=f"adm_type|{city_id}|{dist_id}")])
     await query.edit_message_text(f"📦 Adding {type_emoji} {p_type} in {city_name} / {district_name}\n\nSelect size:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("adm_size")
 async def handle_adm_size(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles selection of a predefined size."""
     query = update.callback_query
@@ -817,6 +814,7 @@ async def handle_adm_size(update: Update, context: ContextTypes.DEFAULT_TYPE, pa
                             reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
     await query.answer("Enter price in chat.")
 
+@callback_route("adm_custom_size")
 async def handle_adm_custom_size(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles 'Custom Size' button press."""
     query = update.callback_query
@@ -829,6 +827,7 @@ async def handle_adm_custom_size(update: Update, context: ContextTypes.DEFAULT_T
                             reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
     await query.answer("Enter custom size in chat.")
 
+@callback_route("confirm_add_drop")
 async def handle_confirm_add_drop(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles confirmation (Yes/No) for adding the drop."""
     query = update.callback_query
@@ -854,56 +853,14 @@ async def handle_confirm_add_drop(update: Update, context: ContextTypes.DEFAULT_
         for key in keys_to_clear: user_specific_data.pop(key, None)
         return await query.edit_message_text("❌ Error: Incomplete drop data. Please start again.", parse_mode=None)
 
-    product_name = f"{p_type} {size} {int(time.time())}"; conn = None; product_id = None
+    product_name = f"{p_type} {size} {int(time.time())}"
     try:
-        conn = get_db_connection(); c = conn.cursor(); c.execute("BEGIN")
         insert_params = (
             city, district, p_type, size, product_name, price, original_text, ADMIN_ID, datetime.now(timezone.utc).isoformat()
         )
-        logger.debug(f"Inserting product with params count: {len(insert_params)}") # Add debug log
-        c.execute("""INSERT INTO products
-                        (city, district, product_type, size, name, price, available, reserved, original_text, added_by, added_date)
-                     VALUES (?, ?, ?, ?, ?, ?, 1, 0, ?, ?, ?)""", insert_params)
-        product_id = c.lastrowid
-
-        if product_id and media_list and temp_dir:
-            final_media_dir = os.path.join(MEDIA_DIR, str(product_id))
-            await asyncio.to_thread(os.makedirs, final_media_dir, exist_ok=True)
-            media_inserts = []
-            
-            for media_item in media_list:
-                if "path" in media_item and "type" in media_item and "file_id" in media_item:
-                    temp_file_path = media_item["path"]
-                    if await asyncio.to_thread(os.path.exists, temp_file_path):
-                        # Generate unique filename to prevent conflicts
-                        base_filename = os.path.basename(temp_file_path)
-                        name, ext = os.path.splitext(base_filename)
-                        counter = 1
-                        final_persistent_path = os.path.join(final_media_dir, f"{name}_{counter}{ext}")
-                        
-                        # Ensure unique filename
-                        while await asyncio.to_thread(os.path.exists, final_persistent_path):
-                            counter += 1
-                            final_persistent_path = os.path.join(final_media_dir, f"{name}_{counter}{ext}")
-                        
-                        try:
-                            await asyncio.to_thread(shutil.copy2, temp_file_path, final_persistent_path)
-                            media_inserts.append((product_id, media_item["type"], final_persistent_path, media_item["file_id"]))
-                        except OSError as move_err:
-                            logger.error(f"Error copying media {temp_file_path}: {move_err}")
-                    else:
-                        logger.warning(f"Temp media not found: {temp_file_path}")
-                else:
-                    logger.warning(f"Incomplete media item: {media_item}")
-            
-            # Insert all media records at once (outside the loop)
-            if media_inserts:
-                c.executemany("INSERT INTO product_media (product_id, media_type, file_path, telegram_file_id) VALUES (?, ?, ?, ?)", media_inserts)
-                logger.info(f"Successfully inserted {len(media_inserts)} media records for bulk product {product_id}")
-            else:
-                logger.warning(f"No media was inserted for product {product_id}. Media list: {media_list}, Temp dir: {temp_dir}")
-
-        conn.commit(); logger.info(f"Added product {product_id} ({product_name}).")
+        product_id = await run_db(_insert_drop_db, insert_params, media_list, temp_dir)
+        logger.info(f"Added product {product_id} ({product_name}).")
+        CATALOG_INDEX.upsert_product(product_id, city, district, p_type, size, price)
         if temp_dir and await asyncio.to_thread(os.path.exists, temp_dir): await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True); logger.info(f"Cleaned temp dir: {temp_dir}")
         await query.edit_message_text("✅ Drop Added Successfully!", parse_mode=None)
         ctx_city_id = user_specific_data.get('admin_city_id'); ctx_dist_id = user_specific_data.get('admin_district_id'); ctx_p_type = user_specific_data.get('admin_product_type')
@@ -912,17 +869,44 @@ async def handle_confirm_add_drop(update: Update, context: ContextTypes.DEFAULT_
                      [InlineKeyboardButton("🔧 Admin Menu", callback_data="admin_menu"), InlineKeyboardButton("🏠 User Home", callback_data="back_start")] ]
         await send_message_with_retry(context.bot, chat_id, "What next?", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
     except (sqlite3.Error, OSError, Exception) as e:
-        try: conn.rollback() if conn and conn.in_transaction else None
-        except Exception as rb_err: logger.error(f"Rollback failed: {rb_err}")
         logger.error(f"Error saving confirmed drop for user {user_id}: {e}", exc_info=True)
         await query.edit_message_text("❌ Error: Failed to save the drop. Please check logs and try again.", parse_mode=None)
         if temp_dir and await asyncio.to_thread(os.path.exists, temp_dir): await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True); logger.info(f"Cleaned temp dir after error: {temp_dir}")
     finally:
-        if conn: conn.close()
         keys_to_clear = ["state", "pending_drop", "pending_drop_size", "pending_drop_price"]
         for key in keys_to_clear: user_specific_data.pop(key, None)
 
 
+def _insert_drop_db(insert_params: tuple, media_list: list, temp_dir: str | None) -> int:
+    """Inserts a product and moves its staged media into the blob store in one transaction (Synchronous, runs on DB executor). Returns the product id."""
+    conn = None
+    try:
+        conn = get_db_connection(); c = conn.cursor(); c.execute("BEGIN")
+        logger.debug(f"Inserting product with params count: {len(insert_params)}") # Add debug log
+        c.execute("""INSERT INTO products
+                        (city, district, product_type, size, name, price, available, reserved, original_text, added_by, added_date)
+                     VALUES (?, ?, ?, ?, ?, ?, 1, 0, ?, ?, ?)""", insert_params)
+        product_id = c.lastrowid
+
+        if product_id and media_list and temp_dir:
+            stored_media = store_staged_media(media_list)
+            media_inserts = [(product_id, m["type"], m["path"], m["file_id"], m["content_hash"]) for m in stored_media]
+            if media_inserts:
+                c.executemany("INSERT INTO product_media (product_id, media_type, file_path, telegram_file_id, content_hash) VALUES (?, ?, ?, ?, ?)", media_inserts)
+                logger.info(f"Successfully inserted {len(media_inserts)} media records for product {product_id}")
+            else:
+                logger.warning(f"No media was inserted for product {product_id}. Media list: {media_list}, Temp dir: {temp_dir}")
+
+        conn.commit()
+        return product_id
+    except Exception:
+        if conn and conn.in_transaction: conn.rollback()
+        raise
+    finally:
+        if conn: conn.close()
+
+
+@callback_route("cancel_add")
 async def cancel_add(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Cancels the add product flow and cleans up."""
     query = update.callback_query
@@ -953,6 +937,7 @@ async def cancel_add(update: Update, context: ContextTypes.DEFAULT_TYPE, params=
 
 
 # --- Bulk Add Products Handlers ---
+@callback_route("adm_bulk_city")
 async def handle_adm_bulk_city(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Admin selects city to add bulk products to."""
     query = update.callback_query
@@ -966,6 +951,7 @@ async def handle_adm_bulk_city(update: Update, context: ContextTypes.DEFAULT_TYP
     select_city_text = lang_data.get("admin_select_city", "Select City to Add Bulk Products:")
     await query.edit_message_text(f"📦 Bulk Add Products\n\n{select_city_text}", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("adm_bulk_dist")
 async def handle_adm_bulk_dist(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Admin selects district for bulk products."""
     query = update.callback_query
@@ -993,6 +979,7 @@ async def handle_adm_bulk_dist(update: Update, context: ContextTypes.DEFAULT_TYP
     select_district_text = select_district_template.format(city=city_name)
     await query.edit_message_text(select_district_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("adm_bulk_type")
 async def handle_adm_bulk_type(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Admin selects product type for bulk products."""
     query = update.callback_query
@@ -1015,6 +1002,7 @@ async def handle_adm_bulk_type(update: Update, context: ContextTypes.DEFAULT_TYP
     keyboard.append([InlineKeyboardButton("⬅️ Back to Districts", callback_data=f"adm_bulk_dist|{city_id}")])
     await query.edit_message_text(f"📦 Bulk Add Products - {city_name} / {district_name}\n\n{select_type_text}", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("adm_bulk_add")
 async def handle_adm_bulk_add(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Admin selects size for the bulk products."""
     query = update.callback_query
@@ -1039,6 +1027,7 @@ async def handle_adm_bulk_add(update: Update, context: ContextTypes.DEFAULT_TYPE
     keyboard.append([InlineKeyboardButton("⬅️ Back to Types", callback_data=f"adm_bulk_type|{city_id}|{dist_id}")])
     await query.edit_message_text(f"📦 Bulk Adding {type_emoji} {p_type} in {city_name} / {district_name}\n\nSelect size:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("adm_bulk_size")
 async def handle_adm_bulk_size(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles selection of a predefined size for bulk products."""
     query = update.callback_query
@@ -1054,6 +1043,7 @@ async def handle_adm_bulk_size(update: Update, context: ContextTypes.DEFAULT_TYP
                             reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
     await query.answer("Enter price in chat.")
 
+@callback_route("adm_bulk_custom_size")
 async def handle_adm_bulk_custom_size(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles 'Custom Size' button press for bulk products."""
     query = update.callback_query
@@ -1066,6 +1056,7 @@ async def handle_adm_bulk_custom_size(update: Update, context: ContextTypes.DEFA
                             reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
     await query.answer("Enter custom size in chat.")
 
+@state_route("awaiting_bulk_custom_size")
 async def handle_adm_bulk_custom_size_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles the custom size reply for bulk products."""
     user_id = update.effective_user.id
@@ -1084,6 +1075,7 @@ async def handle_adm_bulk_custom_size_message(update: Update, context: ContextTy
     await send_message_with_retry(context.bot, chat_id, f"📦 Bulk Products - Size set to: {size}\n\nPlease reply with the price (e.g., 12.50 or 12.5):",
                             reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@state_route("awaiting_bulk_price")
 async def handle_adm_bulk_price_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles the price reply for bulk products."""
     user_id = update.effective_user.id
@@ -1116,12 +1108,14 @@ async def handle_adm_bulk_price_message(update: Update, context: ContextTypes.DE
            f"{type_emoji} Type: {p_type}\n"
            f"📏 Size: {size}\n"
            f"💰 Price: {price_str}€\n\n"
-           f"Now forward or send up to 10 different messages. Each message can contain:\n"
+           f"Now forward or send as many different messages as you need. Each message can contain:\n"
            f"• Photos, videos, GIFs\n"
            f"• Text descriptions\n"
            f"• Any combination of media and text\n\n"
-           f"Each message will become a separate product drop in this category.\n\n"
-           f"Messages collected: 0/10")
+           f"Each message will become a separate product drop in this category.\n"
+           f"To restock many products at once, upload a CSV/JSON file instead "
+           f"(columns: city, district, product_type, size, price, text; missing columns use the values above).\n\n"
+           f"Messages collected: 0")
     
     keyboard = [
         [InlineKeyboardButton("✅ Finish & Create Products", callback_data="adm_bulk_create_all")],
@@ -1130,6 +1124,7 @@ async def handle_adm_bulk_price_message(update: Update, context: ContextTypes.DE
     
     await send_message_with_retry(context.bot, chat_id, msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@state_route("awaiting_bulk_drop_details", "awaiting_bulk_messages")
 async def handle_adm_bulk_drop_details_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles collecting multiple different messages for bulk products."""
     user_id = update.effective_user.id
@@ -1140,10 +1135,16 @@ async def handle_adm_bulk_drop_details_message(update: Update, context: ContextT
 
     bulk_messages = context.user_data.get("bulk_messages", [])
     
+    # A CSV/JSON restock file is imported directly instead of being collected as a message
+    document = update.message.document
+    if document and (document.file_name or "").lower().endswith(BULK_IMPORT_FILE_EXTENSIONS):
+        await _import_bulk_file(update, context)
+        return
+    
     # Check if we've reached the limit
-    if len(bulk_messages) >= 10:
+    if len(bulk_messages) >= BULK_IMPORT_MAX_ROWS:
         await send_message_with_retry(context.bot, chat_id, 
-            "❌ You've already collected 10 messages (maximum). Please finish creating the products or cancel the operation.", 
+            f"❌ You've already collected {BULK_IMPORT_MAX_ROWS} messages (maximum). Please finish creating the products or cancel the operation.", 
             parse_mode=None)
         return
 
@@ -1205,7 +1206,7 @@ async def handle_adm_bulk_drop_details_message(update: Update, context: ContextT
                 bulk_messages.append(message_data)
                 context.user_data["bulk_messages"] = bulk_messages
                 await send_message_with_retry(context.bot, chat_id, 
-                    f"✅ Media group added to bulk collection! Total messages: {len(bulk_messages)}/10", 
+                    f"✅ Media group added to bulk collection! Total messages: {len(bulk_messages)}", 
                     parse_mode=None)
         else:
             logger.error("JobQueue not found in context. Cannot schedule bulk media group processing.")
@@ -1221,7 +1222,7 @@ async def handle_adm_bulk_drop_details_message(update: Update, context: ContextT
                 bulk_messages.append(message_data)
                 context.user_data["bulk_messages"] = bulk_messages
                 await send_message_with_retry(context.bot, chat_id, 
-                    f"✅ Media group added to bulk collection! Total messages: {len(bulk_messages)}/10", 
+                    f"✅ Media group added to bulk collection! Total messages: {len(bulk_messages)}", 
                     parse_mode=None)
             else:
                 await send_message_with_retry(context.bot, chat_id, "❌ Error: Internal components missing. Cannot process media group.", parse_mode=None)
@@ -1255,6 +1256,47 @@ async def handle_adm_bulk_drop_details_message(update: Update, context: ContextT
         # Show updated status
         await show_bulk_messages_status(update, context)
 
+async def _import_bulk_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Imports an uploaded CSV/JSON restock file in one transaction and reports per-row failures."""
+    chat_id = update.effective_chat.id
+    document = update.message.document
+    defaults = {
+        "city": context.user_data.get("bulk_admin_city"), "district": context.user_data.get("bulk_admin_district"),
+        "product_type": context.user_data.get("bulk_admin_product_type"), "size": context.user_data.get("bulk_pending_drop_size"),
+        "price": context.user_data.get("bulk_pending_drop_price")
+    }
+    await send_message_with_retry(context.bot, chat_id, f"⏳ Importing {document.file_name}...", parse_mode=None)
+    try:
+        file_obj = await context.bot.get_file(document.file_id)
+        data = bytes(await file_obj.download_as_bytearray())
+        rows = parse_import_file(document.file_name, data, {k: v for k, v in defaults.items() if v not in (None, "")})
+    except BulkImportError as e:
+        return await send_message_with_retry(context.bot, chat_id, f"❌ Import file rejected: {e}", parse_mode=None)
+    except telegram_error.TelegramError as e:
+        logger.error(f"Error downloading bulk import file from admin {update.effective_user.id}: {e}")
+        return await send_message_with_retry(context.bot, chat_id, "❌ Could not download the file. Please try again.", parse_mode=None)
+
+    import_result = await run_db(import_products, rows)
+    created, failed = import_result["created"], import_result["failed"]
+    await run_db(log_admin_action, update.effective_user.id, "BULK_PRODUCT_IMPORT", None,
+                 f"{document.file_name}: {len(created)} created, {len(failed)} failed")
+
+    result_msg = (f"📦 Import Complete: {document.file_name}\n\n"
+                  f"📝 Rows: {len(rows)}\n"
+                  f"✅ Created: {len(created)} products\n")
+    if failed:
+        result_msg += f"❌ Failed: {len(failed)}\n\n🔍 Failed Rows:\n"
+        for failure in failed[:BULK_REPORT_MAX_FAILURES]:
+            result_msg += f"• Row {failure['row']}: {failure['error'][:100]}\n"
+        if len(failed) > BULK_REPORT_MAX_FAILURES:
+            result_msg += f"... and {len(failed) - BULK_REPORT_MAX_FAILURES} more\n"
+        result_msg += "\nFix the failed rows and upload them again; created rows are already saved.\n"
+    keyboard = [
+        [InlineKeyboardButton("📦 Back to Bulk Collection", callback_data="adm_bulk_back_to_messages")],
+        [InlineKeyboardButton("🔧 Admin Menu", callback_data="admin_menu")]
+    ]
+    await send_message_with_retry(context.bot, chat_id, result_msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
+
 async def show_bulk_messages_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Shows the current status of collected bulk messages."""
     chat_id = update.effective_chat.id if update.effective_chat else update.message.chat_id
@@ -1273,13 +1315,15 @@ async def show_bulk_messages_status(update: Update, context: ContextTypes.DEFAUL
            f"{type_emoji} Type: {p_type}\n"
            f"📏 Size: {size}\n"
            f"💰 Price: {price_str}€\n\n"
-           f"Messages collected: {len(bulk_messages)}/10\n\n")
+           f"Messages collected: {len(bulk_messages)}\n\n")
     
     if not bulk_messages:
-        msg += "No messages collected yet. Send or forward your first message with product details and media."
+        msg += ("No messages collected yet. Send or forward your first message with product details and media.\n"
+                "You can also upload a CSV/JSON file (columns: city, district, product_type, size, price, text) to import many products at once.")
     else:
-        msg += "Collected messages:\n"
-        for i, msg_data in enumerate(bulk_messages, 1):
+        first_shown = max(0, len(bulk_messages) - BULK_STATUS_PREVIEW_MESSAGES)
+        msg += "Collected messages:\n" if not first_shown else f"Collected messages (last {BULK_STATUS_PREVIEW_MESSAGES}):\n"
+        for i, msg_data in enumerate(bulk_messages[first_shown:], first_shown + 1):
             text_preview = msg_data.get("text", "")[:50]
             if len(text_preview) > 50:
                 text_preview += "..."
@@ -1291,7 +1335,7 @@ async def show_bulk_messages_status(update: Update, context: ContextTypes.DEFAUL
             
             msg += f"{i}. {text_preview}{media_info}\n"
     
-    msg += f"\n{10 - len(bulk_messages)} more messages can be added."
+    msg += f"\n{BULK_IMPORT_MAX_ROWS - len(bulk_messages)} more messages can be added."
     
     keyboard = []
     
@@ -1299,13 +1343,14 @@ async def show_bulk_messages_status(update: Update, context: ContextTypes.DEFAUL
         keyboard.append([InlineKeyboardButton("🗑️ Remove Last Message", callback_data="adm_bulk_remove_last_message")])
         keyboard.append([InlineKeyboardButton("✅ Create All Products", callback_data="adm_bulk_create_all")])
     
-    if len(bulk_messages) < 10:
+    if len(bulk_messages) < BULK_IMPORT_MAX_ROWS:
         msg += "\n\nSend or forward your next message..."
     
     keyboard.append([InlineKeyboardButton("❌ Cancel Bulk Operation", callback_data="cancel_bulk_add")])
     
     await send_message_with_retry(context.bot, chat_id, msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("adm_bulk_remove_last_message")
 async def handle_adm_bulk_remove_last_message(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Removes the last collected message from bulk operation."""
     query = update.callback_query
@@ -1338,6 +1383,7 @@ async def handle_adm_bulk_back_to_management(update: Update, context: ContextTyp
     context.user_data["state"] = "awaiting_bulk_messages"
     await show_bulk_messages_status(update, context)
 
+@callback_route("adm_bulk_create_all")
 async def handle_adm_bulk_confirm_all(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Confirms and creates all products from the collected messages."""
     query = update.callback_query
@@ -1412,105 +1458,22 @@ async def handle_adm_bulk_execute(update: Update, context: ContextTypes.DEFAULT_
     created_count = 0
     failed_count = 0
     
-    # Create a temporary directory for media if needed
+    # Download the shared media once, in parallel, into a staging dir on the media volume
     temp_dir = None
     if media_list:
-        import tempfile
-        temp_dir = await asyncio.to_thread(tempfile.mkdtemp, prefix="bulk_media_")
-        
-        # Download media to temp directory
-        for i, media_item in enumerate(media_list):
-            try:
-                file_obj = await context.bot.get_file(media_item["file_id"])
-                file_extension = os.path.splitext(file_obj.file_path)[1] if file_obj.file_path else ""
-                if not file_extension:
-                    if media_item["type"] == "photo": file_extension = ".jpg"
-                    elif media_item["type"] == "video": file_extension = ".mp4"
-                    elif media_item["type"] == "animation": file_extension = ".gif"
-                    else: file_extension = ".bin"
-                
-                temp_file_path = os.path.join(temp_dir, f"media_{i}_{int(time.time())}{file_extension}")
-                await file_obj.download_to_drive(temp_file_path)
-                media_item["path"] = temp_file_path
-            except Exception as e:
-                logger.error(f"Error downloading media for bulk operation: {e}")
-                failed_count += 1
-    
-    # Create products for each location
-    for drop in bulk_drops:
-        city = drop["city"]
-        district = drop["district"]
-        product_name = f"{p_type} {size} {int(time.time())}"
-        
-        conn = None
-        product_id = None
-        try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("BEGIN")
-            
-            insert_params = (
-                city, district, p_type, size, product_name, price, original_text, ADMIN_ID, datetime.now(timezone.utc).isoformat()
-            )
-            
-            c.execute("""INSERT INTO products
-                            (city, district, product_type, size, name, price, available, reserved, original_text, added_by, added_date)
-                         VALUES (?, ?, ?, ?, ?, ?, 1, 0, ?, ?, ?)""", insert_params)
-            product_id = c.lastrowid
-            
-            # Handle media for this product
-            if product_id and media_list and temp_dir:
-                final_media_dir = os.path.join(MEDIA_DIR, str(product_id))
-                await asyncio.to_thread(os.makedirs, final_media_dir, exist_ok=True)
-                media_inserts = []
-                
-                for media_item in media_list:
-                    if "path" in media_item and "type" in media_item and "file_id" in media_item:
-                        temp_file_path = media_item["path"]
-                        if await asyncio.to_thread(os.path.exists, temp_file_path):
-                            # Generate unique filename to prevent conflicts
-                            base_filename = os.path.basename(temp_file_path)
-                            name, ext = os.path.splitext(base_filename)
-                            counter = 1
-                            final_persistent_path = os.path.join(final_media_dir, f"{name}_{counter}{ext}")
-                            
-                            # Ensure unique filename
-                            while await asyncio.to_thread(os.path.exists, final_persistent_path):
-                                counter += 1
-                                final_persistent_path = os.path.join(final_media_dir, f"{name}_{counter}{ext}")
-                            
-                            try:
-                                await asyncio.to_thread(shutil.copy2, temp_file_path, final_persistent_path)
-                                media_inserts.append((product_id, media_item["type"], final_persistent_path, media_item["file_id"]))
-                            except OSError as move_err:
-                                logger.error(f"Error copying media {temp_file_path}: {move_err}")
-                        else:
-                            logger.warning(f"Temp media not found: {temp_file_path}")
-                    else:
-                        logger.warning(f"Incomplete media item: {media_item}")
-                
-                # Insert all media records at once (outside the loop)
-                if media_inserts:
-                    c.executemany("INSERT INTO product_media (product_id, media_type, file_path, telegram_file_id) VALUES (?, ?, ?, ?)", media_inserts)
-                    logger.info(f"Successfully inserted {len(media_inserts)} media records for bulk product {product_id}")
-                else:
-                    logger.warning(f"No media was inserted for product {product_id}. Media list: {media_list}, Temp dir: {temp_dir}")
-            
-            conn.commit()
-            created_count += 1
-            logger.info(f"Bulk created product {product_id} ({product_name}) in {city}/{district}")
-            
-        except Exception as e:
-            failed_count += 1
-            logger.error(f"Error creating bulk product in {city}/{district}: {e}", exc_info=True)
-            if conn:
-                try:
-                    conn.rollback()
-                except Exception as rb_err:
-                    logger.error(f"Rollback failed: {rb_err}")
-        finally:
-            if conn:
-                conn.close()
+        temp_dir = await asyncio.to_thread(create_media_staging_dir)
+        jobs = [({"type": m["type"], "file_id": m["file_id"]}, temp_dir, f"media_{i}") for i, m in enumerate(media_list)]
+        media_list = await download_media_batch(context.bot, jobs)
+        failed_count += sum(1 for m in media_list if not m["path"])
+
+    # Create products for each location in one transaction; the shared media is stored once and referenced by each
+    rows = [{"city": drop["city"], "district": drop["district"], "product_type": p_type, "size": size, "price": price,
+             "original_text": original_text, "media": media_list} for drop in bulk_drops]
+    import_result = await run_db(import_products, rows)
+    created_count = len(import_result["created"])
+    failed_count += len(import_result["failed"])
+    for failure in import_result["failed"]:
+        logger.error(f"Error creating bulk product (row {failure['row']}): {failure['error']}")
     
     # Clean up temp directory
     if temp_dir and await asyncio.to_thread(os.path.exists, temp_dir):
@@ -1542,6 +1505,7 @@ async def handle_adm_bulk_execute(update: Update, context: ContextTypes.DEFAULT_
     
     await send_message_with_retry(context.bot, chat_id, result_msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("cancel_bulk_add")
 async def cancel_bulk_add(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Cancels the bulk add product flow and cleans up."""
     query = update.callback_query
@@ -1599,6 +1563,7 @@ async def cancel_bulk_add(update: Update, context: ContextTypes.DEFAULT_TYPE, pa
 
 
 # --- Manage Geography Handlers ---
+@callback_route("adm_manage_cities")
 async def handle_adm_manage_cities(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Shows options to manage existing cities."""
     query = update.callback_query
@@ -1620,6 +1585,7 @@ async def handle_adm_manage_cities(update: Update, context: ContextTypes.DEFAULT
     await query.edit_message_text("🏙️ Manage Cities\n\nSelect a city or action:",
                             reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("adm_add_city")
 async def handle_adm_add_city(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles 'Add New City' button press."""
     query = update.callback_query
@@ -1629,6 +1595,7 @@ async def handle_adm_add_city(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.edit_message_text("🏙️ Please reply with the name for the new city:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
     await query.answer("Enter city name in chat.")
 
+@callback_route("adm_edit_city")
 async def handle_adm_edit_city(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles 'Edit City' button press."""
     query = update.callback_query
@@ -1645,6 +1612,7 @@ async def handle_adm_edit_city(update: Update, context: ContextTypes.DEFAULT_TYP
                             reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
     await query.answer("Enter new city name in chat.")
 
+@callback_route("adm_delete_city")
 async def handle_adm_delete_city(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles 'Delete City' button press, shows confirmation."""
     query = update.callback_query
@@ -1662,6 +1630,7 @@ async def handle_adm_delete_city(update: Update, context: ContextTypes.DEFAULT_T
                  InlineKeyboardButton("❌ No, Cancel", callback_data="adm_manage_cities")]]
     await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("adm_manage_districts")
 async def handle_adm_manage_districts(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Shows list of cities to choose from for managing districts."""
     query = update.callback_query
@@ -1675,6 +1644,7 @@ async def handle_adm_manage_districts(update: Update, context: ContextTypes.DEFA
     await query.edit_message_text("🗺️ Manage Districts\n\nSelect the city whose districts you want to manage:",
                             reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("adm_manage_districts_city")
 async def handle_adm_manage_districts_city(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Shows districts for the selected city and management options."""
     query = update.callback_query
@@ -1685,18 +1655,13 @@ async def handle_adm_manage_districts_city(update: Update, context: ContextTypes
     if not city_name:
         return await query.edit_message_text("Error: City not found.", parse_mode=None)
     districts_in_city = {}
-    conn = None
     try:
-        conn = get_db_connection() # Use helper
-        c = conn.cursor()
         # Use column names
-        c.execute("SELECT id, name FROM districts WHERE city_id = ? ORDER BY name", (int(city_id),))
-        districts_in_city = {str(row['id']): row['name'] for row in c.fetchall()}
+        rows = await db_fetchall("SELECT id, name FROM districts WHERE city_id = ? ORDER BY name", (int(city_id),))
+        districts_in_city = {str(row['id']): row['name'] for row in rows}
     except (sqlite3.Error, ValueError) as e:
         logger.error(f"Failed to reload districts for city {city_id}: {e}")
         districts_in_city = DISTRICTS.get(city_id, {}) # Fallback to potentially outdated global
-    finally:
-        if conn: conn.close()
 
     msg = f"🗺️ Districts in {city_name}\n\n"
     keyboard = []
@@ -1721,6 +1686,7 @@ async def handle_adm_manage_districts_city(update: Update, context: ContextTypes
         if "message is not modified" not in str(e).lower(): logger.error(f"Error editing manage districts city message: {e}")
         else: await query.answer()
 
+@callback_route("adm_add_district")
 async def handle_adm_add_district(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles 'Add New District' button press."""
     query = update.callback_query
@@ -1737,6 +1703,7 @@ async def handle_adm_add_district(update: Update, context: ContextTypes.DEFAULT_
                             reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
     await query.answer("Enter district name in chat.")
 
+@callback_route("adm_edit_district")
 async def handle_adm_edit_district(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles 'Edit District' button press."""
     query = update.callback_query
@@ -1745,16 +1712,11 @@ async def handle_adm_edit_district(update: Update, context: ContextTypes.DEFAULT
     city_id, dist_id = params
     city_name = CITIES.get(city_id)
     district_name = None
-    conn = None
     try:
-        conn = get_db_connection() # Use helper
-        c = conn.cursor()
         # Use column name
-        c.execute("SELECT name FROM districts WHERE id = ? AND city_id = ?", (int(dist_id), int(city_id)))
-        res = c.fetchone(); district_name = res['name'] if res else None
+        res = await db_fetchone("SELECT name FROM districts WHERE id = ? AND city_id = ?", (int(dist_id), int(city_id)))
+        district_name = res['name'] if res else None
     except (sqlite3.Error, ValueError) as e: logger.error(f"Failed to fetch district name for edit: {e}")
-    finally:
-         if conn: conn.close()
     if not city_name or district_name is None:
         return await query.edit_message_text("Error: City/District not found.", parse_mode=None)
     context.user_data["state"] = "awaiting_edit_district_name"
@@ -1765,6 +1727,7 @@ async def handle_adm_edit_district(update: Update, context: ContextTypes.DEFAULT
                            reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
     await query.answer("Enter new district name in chat.")
 
+@callback_route("adm_remove_district")
 async def handle_adm_remove_district(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles 'Delete District' button press, shows confirmation."""
     query = update.callback_query
@@ -1773,16 +1736,11 @@ async def handle_adm_remove_district(update: Update, context: ContextTypes.DEFAU
     city_id, dist_id = params
     city_name = CITIES.get(city_id)
     district_name = None
-    conn = None
     try:
-        conn = get_db_connection() # Use helper
-        c = conn.cursor()
         # Use column name
-        c.execute("SELECT name FROM districts WHERE id = ? AND city_id = ?", (int(dist_id), int(city_id)))
-        res = c.fetchone(); district_name = res['name'] if res else None
+        res = await db_fetchone("SELECT name FROM districts WHERE id = ? AND city_id = ?", (int(dist_id), int(city_id)))
+        district_name = res['name'] if res else None
     except (sqlite3.Error, ValueError) as e: logger.error(f"Failed to fetch district name for delete confirmation: {e}")
-    finally:
-        if conn: conn.close()
     if not city_name or district_name is None:
         return await query.edit_message_text("Error: City/District not found.", parse_mode=None)
     context.user_data["confirm_action"] = f"remove_district|{city_id}|{dist_id}"
@@ -1795,6 +1753,7 @@ async def handle_adm_remove_district(update: Update, context: ContextTypes.DEFAU
 
 
 # --- Manage Products Handlers ---
+@callback_route("adm_manage_products")
 async def handle_adm_manage_products(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Admin selects city to manage products in."""
     query = update.callback_query
@@ -1809,6 +1768,7 @@ async def handle_adm_manage_products(update: Update, context: ContextTypes.DEFAU
                             reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
 
+@callback_route("adm_manage_products_city")
 async def handle_adm_manage_products_city(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Admin selects district to manage products in."""
     query = update.callback_query
@@ -1835,6 +1795,7 @@ async def handle_adm_manage_products_city(update: Update, context: ContextTypes.
                             reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
 
+@callback_route("adm_manage_products_dist")
 async def handle_adm_manage_products_dist(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Admin selects product type to manage within the district."""
     query = update.callback_query
@@ -1845,13 +1806,10 @@ async def handle_adm_manage_products_dist(update: Update, context: ContextTypes.
     district_name = DISTRICTS.get(city_id, {}).get(dist_id)
     if not city_name or not district_name:
         return await query.edit_message_text("Error: City/District not found.", parse_mode=None)
-    conn = None # Initialize conn
     try:
-        conn = get_db_connection() # Use helper
-        c = conn.cursor()
         # Use column name
-        c.execute("SELECT DISTINCT product_type FROM products WHERE city = ? AND district = ? ORDER BY product_type", (city_name, district_name))
-        product_types_in_dist = sorted([row['product_type'] for row in c.fetchall()])
+        rows = await db_fetchall("SELECT DISTINCT product_type FROM products WHERE city = ? AND district = ? ORDER BY product_type", (city_name, district_name))
+        product_types_in_dist = sorted([row['product_type'] for row in rows])
         if not product_types_in_dist:
              keyboard = [[InlineKeyboardButton("⬅️ Back to Districts", callback_data=f"adm_manage_products_city|{city_id}")]]
              return await query.edit_message_text(f"No product types found in {city_name} / {district_name}.",
@@ -1867,10 +1825,9 @@ async def handle_adm_manage_products_dist(update: Update, context: ContextTypes.
     except sqlite3.Error as e:
         logger.error(f"DB error fetching product types for managing in {city_name}/{district_name}: {e}", exc_info=True)
         await query.edit_message_text("❌ Error fetching product types.", parse_mode=None)
-    finally:
-        if conn: conn.close() # Close connection if opened
 
 
+@callback_route("adm_manage_products_type")
 async def handle_adm_manage_products_type(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Shows specific products of a type and allows deletion."""
     query = update.callback_query
@@ -1884,17 +1841,13 @@ async def handle_adm_manage_products_type(update: Update, context: ContextTypes.
 
     type_emoji = PRODUCT_TYPES.get(p_type, DEFAULT_PRODUCT_EMOJI)
 
-    conn = None # Initialize conn
     try:
-        conn = get_db_connection() # Use helper
-        c = conn.cursor()
         # Use column names
-        c.execute("""
+        products = await db_fetchall("""
             SELECT id, size, price, available, reserved, name
             FROM products WHERE city = ? AND district = ? AND product_type = ?
             ORDER BY size, price, id
         """, (city_name, district_name, p_type))
-        products = c.fetchall()
         msg = f"🗑️ Products: {type_emoji} {p_type} in {city_name} / {district_name}\n\n"
         keyboard = []
         full_msg = msg # Initialize full message
@@ -1921,10 +1874,9 @@ async def handle_adm_manage_products_type(update: Update, context: ContextTypes.
     except sqlite3.Error as e:
         logger.error(f"DB error fetching products for deletion: {e}", exc_info=True)
         await query.edit_message_text("❌ Error fetching products.", parse_mode=None)
-    finally:
-        if conn: conn.close() # Close connection if opened
 
 
+@callback_route("adm_delete_prod")
 async def handle_adm_delete_prod(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles 'Delete Product' button press, shows confirmation."""
     query = update.callback_query
@@ -1935,18 +1887,14 @@ async def handle_adm_delete_prod(update: Update, context: ContextTypes.DEFAULT_T
     product_name = f"Product ID {product_id}"
     product_details = ""
     back_callback = "adm_manage_products" # Default back location
-    conn = None # Initialize conn
     try:
-        conn = get_db_connection() # Use helper
-        c = conn.cursor()
         # Use column names
-        c.execute("""
+        result = await db_fetchone("""
             SELECT p.name, p.city, p.district, p.product_type, p.size, p.price, ci.id as city_id, di.id as dist_id
             FROM products p LEFT JOIN cities ci ON p.city = ci.name
             LEFT JOIN districts di ON p.district = di.name AND ci.id = di.city_id
             WHERE p.id = ?
         """, (product_id,))
-        result = c.fetchone()
         if result:
             type_name = result['product_type']
             emoji = PRODUCT_TYPES.get(type_name, DEFAULT_PRODUCT_EMOJI)
@@ -1959,8 +1907,6 @@ async def handle_adm_delete_prod(update: Update, context: ContextTypes.DEFAULT_T
             return await query.edit_message_text("Error: Product not found.", parse_mode=None)
     except sqlite3.Error as e:
          logger.warning(f"Could not fetch full details for product {product_id} for delete confirmation: {e}")
-    finally:
-        if conn: conn.close() # Close connection if opened
 
     context.user_data["confirm_action"] = f"confirm_remove_product|{product_id}"
     msg = (f"⚠️ Confirm Deletion\n\nAre you sure you want to permanently delete this specific product instance?\n"
@@ -1971,13 +1917,28 @@ async def handle_adm_delete_prod(update: Update, context: ContextTypes.DEFAULT_T
 
 
 # --- Product Type Reassignment Handler ---
+def _count_product_type_usage(type_name: str) -> tuple[int, int]:
+    """Returns (product_count, reseller_discount_count) for a product type (Synchronous, runs on DB executor)."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) FROM products WHERE product_type = ?", (type_name,))
+        product_count = c.fetchone()[0]
+        c.execute("SELECT COUNT(*) FROM reseller_discounts WHERE product_type = ?", (type_name,))
+        reseller_discount_count = c.fetchone()[0]
+        return product_count, reseller_discount_count
+    finally:
+        if conn: conn.close()
+
+@callback_route("adm_reassign_type_start")
 async def handle_adm_reassign_type_start(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Shows interface for reassigning products from one type to another."""
     query = update.callback_query
     if not is_primary_admin(query.from_user.id): 
         return await query.answer("Access denied.", show_alert=True)
     
-    load_all_data()
+    await run_db(load_all_data)
     if len(PRODUCT_TYPES) < 2:
         return await query.edit_message_text(
             "🔄 Reassign Product Type\n\n❌ You need at least 2 product types to perform reassignment.",
@@ -1992,21 +1953,17 @@ async def handle_adm_reassign_type_start(update: Update, context: ContextTypes.D
     msg += "• Update all reseller discounts to use NEW type\n"
     msg += "• Delete the OLD product type\n"
     
+    # Get product counts for all types in one query
+    type_counts = {}
+    try:
+        rows = await db_fetchall("SELECT product_type, COUNT(*) as count FROM products GROUP BY product_type")
+        type_counts = {row['product_type']: row['count'] for row in rows}
+    except sqlite3.Error as e:
+        logger.error(f"Error counting products per type: {e}")
+
     keyboard = []
     for type_name, emoji in sorted(PRODUCT_TYPES.items()):
-        # Get product count for this type
-        conn = None
-        product_count = 0
-        try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("SELECT COUNT(*) as count FROM products WHERE product_type = ?", (type_name,))
-            result = c.fetchone()
-            product_count = result['count'] if result else 0
-        except sqlite3.Error as e:
-            logger.error(f"Error counting products for type {type_name}: {e}")
-        finally:
-            if conn: conn.close()
+        product_count = type_counts.get(type_name, 0)
         
         button_text = f"{emoji} {type_name}"
         if product_count > 0:
@@ -2016,6 +1973,7 @@ async def handle_adm_reassign_type_start(update: Update, context: ContextTypes.D
     keyboard.append([InlineKeyboardButton("⬅️ Back to Admin Menu", callback_data="admin_menu")])
     await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("adm_reassign_select_old")
 async def handle_adm_reassign_select_old(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles selection of the old product type to reassign from."""
     query = update.callback_query
@@ -2026,7 +1984,7 @@ async def handle_adm_reassign_select_old(update: Update, context: ContextTypes.D
         return await query.answer("Error: Type name missing.", show_alert=True)
     
     old_type_name = params[0]
-    load_all_data()
+    await run_db(load_all_data)
     
     if old_type_name not in PRODUCT_TYPES:
         return await query.edit_message_text(
@@ -2052,6 +2010,7 @@ async def handle_adm_reassign_select_old(update: Update, context: ContextTypes.D
     keyboard.append([InlineKeyboardButton("⬅️ Back to Select Old Type", callback_data="adm_reassign_type_start")])
     await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("adm_reassign_confirm")
 async def handle_adm_reassign_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Shows confirmation for the product type reassignment."""
     query = update.callback_query
@@ -2064,7 +2023,7 @@ async def handle_adm_reassign_confirm(update: Update, context: ContextTypes.DEFA
     old_type_name = params[0]
     new_type_name = params[1]
     
-    load_all_data()
+    await run_db(load_all_data)
     
     if old_type_name not in PRODUCT_TYPES or new_type_name not in PRODUCT_TYPES:
         return await query.edit_message_text(
@@ -2074,24 +2033,8 @@ async def handle_adm_reassign_confirm(update: Update, context: ContextTypes.DEFA
         )
     
     # Count affected items
-    conn = None
-    product_count = 0
-    reseller_discount_count = 0
-    
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        # Count products that will be reassigned
-        c.execute("SELECT COUNT(*) as count FROM products WHERE product_type = ?", (old_type_name,))
-        result = c.fetchone()
-        product_count = result['count'] if result else 0
-        
-        # Count reseller discounts that will be affected
-        c.execute("SELECT COUNT(*) as count FROM reseller_discounts WHERE product_type = ?", (old_type_name,))
-        result = c.fetchone()
-        reseller_discount_count = result['count'] if result else 0
-        
+        product_count, reseller_discount_count = await run_db(_count_product_type_usage, old_type_name)
     except sqlite3.Error as e:
         logger.error(f"Error counting items for reassignment: {e}")
         return await query.edit_message_text(
@@ -2099,8 +2042,6 @@ async def handle_adm_reassign_confirm(update: Update, context: ContextTypes.DEFA
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back", callback_data="adm_reassign_type_start")]]),
             parse_mode=None
         )
-    finally:
-        if conn: conn.close()
     
     old_emoji = PRODUCT_TYPES.get(old_type_name, '📦')
     new_emoji = PRODUCT_TYPES.get(new_type_name, '📦')
@@ -2129,11 +2070,12 @@ async def handle_adm_reassign_confirm(update: Update, context: ContextTypes.DEFA
     await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
 # --- Manage Product Types Handlers ---
+@callback_route("adm_manage_types")
 async def handle_adm_manage_types(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Shows options to manage product types (edit emoji, delete)."""
     query = update.callback_query
     if not is_primary_admin(query.from_user.id): return await query.answer("Access denied.", show_alert=True)
-    load_all_data() # Ensure PRODUCT_TYPES is up-to-date
+    await run_db(load_all_data) # Ensure PRODUCT_TYPES is up-to-date
     if not PRODUCT_TYPES: msg = "🧩 Manage Product Types\n\nNo product types configured."
     else: msg = "🧩 Manage Product Types\n\nSelect a type to edit or delete:"
     keyboard = []
@@ -2149,6 +2091,7 @@ async def handle_adm_manage_types(update: Update, context: ContextTypes.DEFAULT_
     await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
 # --- Edit Type Menu ---
+@callback_route("adm_edit_type_menu")
 async def handle_adm_edit_type_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Shows options for a specific product type: change emoji, edit description, or delete."""
     query = update.callback_query
@@ -2161,20 +2104,13 @@ async def handle_adm_edit_type_menu(update: Update, context: ContextTypes.DEFAUL
 
     # Fetch current description
     current_description = ""
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT description FROM product_types WHERE name = ?", (type_name,))
-        res = c.fetchone()
+        res = await db_fetchone("SELECT description FROM product_types WHERE name = ?", (type_name,))
         if res: current_description = res['description'] or "(Description not set)"
         else: current_description = "(Type not found in DB)"
     except sqlite3.Error as e:
         logger.error(f"Error fetching description for type {type_name}: {e}")
         current_description = "(DB Error fetching description)"
-    finally:
-        if conn: conn.close()
-
 
     safe_name = type_name # No Markdown V2 here
     safe_desc = current_description # No Markdown V2 here
@@ -2203,6 +2139,7 @@ async def handle_adm_edit_type_menu(update: Update, context: ContextTypes.DEFAUL
             await query.answer("Error displaying menu.", show_alert=True)
 
 # --- Change Type Emoji Prompt ---
+@callback_route("adm_change_type_emoji")
 async def handle_adm_change_type_emoji(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles 'Change Emoji' button press."""
     query = update.callback_query
@@ -2221,6 +2158,7 @@ async def handle_adm_change_type_emoji(update: Update, context: ContextTypes.DEF
     await query.answer("Enter new emoji in chat.")
 
 
+@callback_route("adm_change_type_name")
 async def handle_adm_change_type_name(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles 'Change Name' button press."""
     query = update.callback_query
@@ -2243,6 +2181,7 @@ async def handle_adm_change_type_name(update: Update, context: ContextTypes.DEFA
     await query.answer("Enter new name in chat.")
 
 # --- Add Type asks for name first ---
+@callback_route("adm_add_type")
 async def handle_adm_add_type(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles 'Add New Type' button press - asks for name first."""
     query = update.callback_query
@@ -2252,20 +2191,15 @@ async def handle_adm_add_type(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.edit_message_text("🧩 Please reply with the name for the new product type:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
     await query.answer("Enter type name in chat.")
 
+@callback_route("adm_delete_type")
 async def handle_adm_delete_type(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles 'Delete Type' button, checks usage, shows confirmation or force delete option."""
     query = update.callback_query
     if not is_primary_admin(query.from_user.id): return await query.answer("Access denied.", show_alert=True)
     if not params: return await query.answer("Error: Type name missing.", show_alert=True)
     type_name_to_delete = params[0] # Use a distinct variable name
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM products WHERE product_type = ?", (type_name_to_delete,))
-        product_count = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM reseller_discounts WHERE product_type = ?", (type_name_to_delete,))
-        reseller_discount_count = c.fetchone()[0]
+        product_count, reseller_discount_count = await run_db(_count_product_type_usage, type_name_to_delete)
 
         if product_count > 0 or reseller_discount_count > 0:
             error_msg_parts = []
@@ -2298,10 +2232,9 @@ async def handle_adm_delete_type(update: Update, context: ContextTypes.DEFAULT_T
     except sqlite3.Error as e:
         logger.error(f"DB error checking product type usage for '{type_name_to_delete}': {e}", exc_info=True)
         await query.edit_message_text("❌ Error checking type usage.", parse_mode=None)
-    finally:
-        if conn: conn.close()
 
 # <<< RENAMED AND MODIFIED CALLBACK HANDLER FOR FORCE DELETE CONFIRMATION >>>
+@callback_route("confirm_force_delete_prompt")
 async def handle_confirm_force_delete_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Shows a final, more severe confirmation for force deleting a product type and its associated items."""
     query = update.callback_query
@@ -2318,25 +2251,12 @@ async def handle_confirm_force_delete_prompt(update: Update, context: ContextTyp
     context.user_data["confirm_action"] = f"force_delete_type_CASCADE|{type_name}" # Set up for handle_confirm_yes
 
     # Fetch counts again for the confirmation message
-    product_count = 0
-    reseller_discount_count = 0
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM products WHERE product_type = ?", (type_name,))
-        product_count_res = c.fetchone()
-        if product_count_res: product_count = product_count_res[0]
-
-        c.execute("SELECT COUNT(*) FROM reseller_discounts WHERE product_type = ?", (type_name,))
-        reseller_discount_count_res = c.fetchone()
-        if reseller_discount_count_res: reseller_discount_count = reseller_discount_count_res[0]
+        product_count, reseller_discount_count = await run_db(_count_product_type_usage, type_name)
     except sqlite3.Error as e:
         logger.error(f"DB error fetching counts for force delete confirmation of '{type_name}': {e}")
         await query.edit_message_text("Error fetching item counts for confirmation. Cannot proceed.", parse_mode=None)
         return
-    finally:
-        if conn: conn.close()
 
     usage_details_parts = []
     if product_count > 0: usage_details_parts.append(f"{product_count} product(s)")
@@ -2356,19 +2276,16 @@ async def handle_confirm_force_delete_prompt(update: Update, context: ContextTyp
 
 
 # --- Discount Handlers ---
+@callback_route("adm_manage_discounts")
 async def handle_adm_manage_discounts(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Displays existing discount codes and management options."""
     query = update.callback_query
     if not is_primary_admin(query.from_user.id): return await query.answer("Access Denied.", show_alert=True)
-    conn = None # Initialize conn
     try:
-        conn = get_db_connection() # Use helper
-        c = conn.cursor()
-        c.execute("""
+        codes = await db_fetchall("""
             SELECT id, code, discount_type, value, is_active, max_uses, uses_count, expiry_date
             FROM discount_codes ORDER BY created_date DESC
         """)
-        codes = c.fetchall()
         msg = "🏷️ Manage General Discount Codes\n\n" # Clarified title
         keyboard = []
         if not codes: msg += "No general discount codes found."
@@ -2419,27 +2336,38 @@ async def handle_adm_manage_discounts(update: Update, context: ContextTypes.DEFA
     except Exception as e:
          logger.error(f"Unexpected error managing discounts: {e}", exc_info=True)
          await query.edit_message_text("❌ An unexpected error occurred.", parse_mode=None)
+
+
+def _toggle_discount_code_db(code_id: int) -> int | None:
+    """Flips a discount code's is_active flag and returns the new value, or None if the code is missing (Synchronous, runs on DB executor)."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT is_active FROM discount_codes WHERE id = ?", (code_id,))
+        result = c.fetchone()
+        if not result: return None
+        new_status = 0 if result['is_active'] == 1 else 1
+        c.execute("UPDATE discount_codes SET is_active = ? WHERE id = ?", (new_status, code_id))
+        conn.commit()
+        return new_status
+    except Exception:
+        if conn and conn.in_transaction: conn.rollback()
+        raise
     finally:
-        if conn: conn.close() # Close connection if opened
+        if conn: conn.close()
 
 
+@callback_route("adm_toggle_discount")
 async def handle_adm_toggle_discount(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Activates or deactivates a specific discount code."""
     query = update.callback_query
     if not is_primary_admin(query.from_user.id): return await query.answer("Access Denied.", show_alert=True)
     if not params: return await query.answer("Error: Code ID missing.", show_alert=True)
-    conn = None # Initialize conn
     try:
         code_id = int(params[0])
-        conn = get_db_connection() # Use helper
-        c = conn.cursor()
-        c.execute("SELECT is_active FROM discount_codes WHERE id = ?", (code_id,))
-        result = c.fetchone()
-        if not result: return await query.answer("Code not found.", show_alert=True)
-        current_status = result['is_active']
-        new_status = 0 if current_status == 1 else 1
-        c.execute("UPDATE discount_codes SET is_active = ? WHERE id = ?", (new_status, code_id))
-        conn.commit()
+        new_status = await run_db(_toggle_discount_code_db, code_id)
+        if new_status is None: return await query.answer("Code not found.", show_alert=True)
         action = 'deactivated' if new_status == 0 else 'activated'
         logger.info(f"Admin {query.from_user.id} {action} discount code ID {code_id}.")
         await query.answer(f"Code {action} successfully.")
@@ -2447,22 +2375,17 @@ async def handle_adm_toggle_discount(update: Update, context: ContextTypes.DEFAU
     except (sqlite3.Error, ValueError) as e:
         logger.error(f"Error toggling discount code {params[0]}: {e}", exc_info=True)
         await query.answer("Error updating code status.", show_alert=True)
-    finally:
-        if conn: conn.close() # Close connection if opened
 
 
+@callback_route("adm_delete_discount")
 async def handle_adm_delete_discount(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles delete button press for discount code, shows confirmation."""
     query = update.callback_query
     if not is_primary_admin(query.from_user.id): return await query.answer("Access Denied.", show_alert=True)
     if not params: return await query.answer("Error: Code ID missing.", show_alert=True)
-    conn = None # Initialize conn
     try:
         code_id = int(params[0])
-        conn = get_db_connection() # Use helper
-        c = conn.cursor()
-        c.execute("SELECT code FROM discount_codes WHERE id = ?", (code_id,))
-        result = c.fetchone()
+        result = await db_fetchone("SELECT code FROM discount_codes WHERE id = ?", (code_id,))
         if not result: return await query.answer("Code not found.", show_alert=True)
         code_text = result['code']
         context.user_data["confirm_action"] = f"delete_discount|{code_id}"
@@ -2479,10 +2402,9 @@ async def handle_adm_delete_discount(update: Update, context: ContextTypes.DEFAU
          logger.warning(f"Markdown error displaying delete confirm: {e_tg}. Falling back.")
          msg_plain = msg.replace('`', '') # Simple removal
          await query.edit_message_text(msg_plain, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
-    finally:
-        if conn: conn.close() # Close connection if opened
 
 
+@callback_route("adm_add_discount_start")
 async def handle_adm_add_discount_start(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Starts the process of adding a new discount code."""
     query = update.callback_query
@@ -2503,6 +2425,7 @@ async def handle_adm_add_discount_start(update: Update, context: ContextTypes.DE
     await query.answer("Enter code text or use generated.")
 
 
+@callback_route("adm_use_generated_code")
 async def handle_adm_use_generated_code(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles using the suggested random code."""
     query = update.callback_query
@@ -2535,12 +2458,8 @@ async def process_discount_code_input(update, context, code_text):
     code_text = code_text.strip()
     
     # Check if code already exists
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT code FROM discount_codes WHERE UPPER(code) = ?", (code_text.upper(),))
-        existing = c.fetchone()
+        existing = await db_fetchone("SELECT code FROM discount_codes WHERE UPPER(code) = ?", (code_text.upper(),))
         if existing:
             error_msg = f"❌ Code '{code_text}' already exists. Please choose a different one."
             if query:
@@ -2557,9 +2476,6 @@ async def process_discount_code_input(update, context, code_text):
         else:
             await send_message_with_retry(context.bot, chat_id, error_msg, parse_mode=None)
         return
-    finally:
-        if conn:
-            conn.close()
     
     # Store code and move to type selection
     context.user_data['new_discount_info'] = {'code': code_text}
@@ -2579,6 +2495,8 @@ async def process_discount_code_input(update, context, code_text):
         await send_message_with_retry(context.bot, chat_id, msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
 
+@callback_route("adm_discount_code_message")
+@state_route("awaiting_discount_code")
 async def handle_adm_discount_code_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles admin entering a discount code via message."""
     user_id = update.effective_user.id
@@ -2600,6 +2518,8 @@ async def handle_adm_discount_code_message(update: Update, context: ContextTypes
     await process_discount_code_input(update, context, code_text)
 
 
+@callback_route("adm_discount_value_message")
+@state_route("awaiting_discount_value")
 async def handle_adm_discount_value_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles admin entering discount value via message."""
     user_id = update.effective_user.id
@@ -2646,19 +2566,13 @@ async def handle_adm_discount_value_message(update: Update, context: ContextType
         return
     
     # Save the discount code
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
         # Insert new discount code
-        c.execute("""
+        await db_execute("""
             INSERT INTO discount_codes (code, discount_type, value, is_active, max_uses, uses_count, created_date)
             VALUES (?, ?, ?, 1, NULL, 0, ?)
         """, (discount_info['code'], discount_info['type'], value, datetime.now(timezone.utc).isoformat()))
         
-        conn.commit()
-        
         # Success message
         value_str = format_discount_value(discount_info['type'], value)
         success_msg = f"✅ Discount code created successfully!\n\nCode: {discount_info['code']}\nType: {discount_info['type'].capitalize()}\nValue: {value_str}"
@@ -2677,14 +2591,12 @@ async def handle_adm_discount_value_message(update: Update, context: ContextType
         await send_message_with_retry(context.bot, chat_id, "❌ An unexpected error occurred.", parse_mode=None)
         
     finally:
-        if conn:
-            conn.close()
-        
         # Clean up state
         context.user_data.pop('state', None)
         context.user_data.pop('new_discount_info', None)
 
 
+@callback_route("adm_set_discount_type")
 async def handle_adm_set_discount_type(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Sets the discount type and asks for the value."""
     query = update.callback_query
@@ -2720,6 +2632,7 @@ async def handle_adm_set_discount_type(update: Update, context: ContextTypes.DEF
         else: await query.answer()
 
 # --- Set Bot Media Handlers ---
+@callback_route("adm_set_media")
 async def handle_adm_set_media(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles 'Set Bot Media' button press."""
     query = update.callback_query
@@ -2732,6 +2645,7 @@ async def handle_adm_set_media(update: Update, context: ContextTypes.DEFAULT_TYP
     await query.answer("Send photo, video, or GIF.")
 
 
+@state_route("awaiting_bot_media")
 async def handle_adm_bot_media_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles the admin sending bot media content."""
     if not is_primary_admin(update.effective_user.id):
@@ -2801,8 +2715,8 @@ async def handle_adm_bot_media_message(update: Update, context: ContextTypes.DEF
             reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
         
         # Log admin action
-        log_admin_action(admin_id=update.effective_user.id, action="BOT_MEDIA_UPDATE", 
-                        reason=f"Updated bot media: {media_type} - {media_filename}")
+        await run_db(log_admin_action, admin_id=update.effective_user.id, action="BOT_MEDIA_UPDATE",
+                     reason=f"Updated bot media: {media_type} - {media_filename}")
         
     except Exception as e:
         logger.error(f"Error processing bot media upload: {e}", exc_info=True)
@@ -2811,6 +2725,7 @@ async def handle_adm_bot_media_message(update: Update, context: ContextTypes.DEF
 
 
 # --- Review Management Handlers ---
+@callback_route("adm_manage_reviews")
 async def handle_adm_manage_reviews(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Displays reviews paginated for the admin with delete options."""
     query = update.callback_query
@@ -2821,7 +2736,7 @@ async def handle_adm_manage_reviews(update: Update, context: ContextTypes.DEFAUL
     offset = 0
     if params and len(params) > 0 and params[0].isdigit(): offset = int(params[0])
     reviews_per_page = 5
-    reviews_data = fetch_reviews(offset=offset, limit=reviews_per_page + 1) # Sync function uses helper
+    reviews_data = await run_db(fetch_reviews, offset=offset, limit=reviews_per_page + 1) # Sync function runs on DB executor
     msg = "🚫 Manage Reviews\n\n"
     keyboard = []
     item_buttons = []
@@ -2869,6 +2784,7 @@ async def handle_adm_manage_reviews(update: Update, context: ContextTypes.DEFAUL
         await query.edit_message_text("❌ An unexpected error occurred while loading reviews.", parse_mode=None)
 
 
+@callback_route("adm_delete_review_confirm")
 async def handle_adm_delete_review_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles 'Delete Review' button press, shows confirmation."""
     query = update.callback_query
@@ -2878,13 +2794,9 @@ async def handle_adm_delete_review_confirm(update: Update, context: ContextTypes
     try: review_id = int(params[0])
     except ValueError: return await query.answer("Error: Invalid Review ID.", show_alert=True)
     review_text_snippet = "N/A"
-    conn = None # Initialize conn
     try:
-        conn = get_db_connection() # Use helper
-        c = conn.cursor()
         # Use column name
-        c.execute("SELECT review_text FROM reviews WHERE review_id = ?", (review_id,))
-        result = c.fetchone()
+        result = await db_fetchone("SELECT review_text FROM reviews WHERE review_id = ?", (review_id,))
         if result: review_text_snippet = result['review_text'][:100]
         else:
             await query.answer("Review not found.", show_alert=True)
@@ -2892,8 +2804,6 @@ async def handle_adm_delete_review_confirm(update: Update, context: ContextTypes
             except telegram_error.BadRequest: pass
             return
     except sqlite3.Error as e: logger.warning(f"Could not fetch review text for confirmation (ID {review_id}): {e}")
-    finally:
-        if conn: conn.close() # Close connection if opened
     context.user_data["confirm_action"] = f"delete_review|{review_id}"
     msg = (f"⚠️ Confirm Deletion\n\nAre you sure you want to permanently delete review ID {review_id}?\n\n"
            f"Preview: {review_text_snippet}{'...' if len(review_text_snippet) >= 100 else ''}\n\n"
@@ -2905,6 +2815,7 @@ async def handle_adm_delete_review_confirm(update: Update, context: ContextTypes
 
 # --- Broadcast Handlers ---
 
+@callback_route("adm_broadcast_start")
 async def handle_adm_broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Starts the broadcast message process by asking for the target audience."""
     query = update.callback_query
@@ -2929,6 +2840,7 @@ async def handle_adm_broadcast_start(update: Update, context: ContextTypes.DEFAU
     await query.answer()
 
 
+@callback_route("adm_broadcast_target_type")
 async def handle_adm_broadcast_target_type(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles the selection of the broadcast target type."""
     query = update.callback_query
@@ -2947,7 +2859,7 @@ async def handle_adm_broadcast_target_type(update: Update, context: ContextTypes
         await query.answer("Send the message content.")
 
     elif target_type == 'city':
-        load_all_data()
+        await run_db(load_all_data)
         if not CITIES:
              await query.edit_message_text("No cities configured. Cannot target by city.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back", callback_data="adm_broadcast_start")]]), parse_mode=None)
              return
@@ -2984,6 +2896,7 @@ async def handle_adm_broadcast_target_type(update: Update, context: ContextTypes
         await handle_adm_broadcast_start(update, context)
 
 
+@callback_route("adm_broadcast_target_city")
 async def handle_adm_broadcast_target_city(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles selecting the city for targeted broadcast."""
     query = update.callback_query
@@ -3000,6 +2913,7 @@ async def handle_adm_broadcast_target_city(update: Update, context: ContextTypes
     await query.edit_message_text(f"Targeting users last purchased in: {city_name}\n\n{ask_msg_text}", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
     await query.answer("Send the message content.")
 
+@callback_route("adm_broadcast_target_status")
 async def handle_adm_broadcast_target_status(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles selecting the status for targeted broadcast."""
     query = update.callback_query
@@ -3017,6 +2931,7 @@ async def handle_adm_broadcast_target_status(update: Update, context: ContextTyp
     await query.answer("Send the message content.")
 
 
+@callback_route("confirm_broadcast")
 async def handle_confirm_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles the 'Yes' confirmation for the broadcast."""
     query = update.callback_query
@@ -3045,6 +2960,7 @@ async def handle_confirm_broadcast(update: Update, context: ContextTypes.DEFAULT
     asyncio.create_task(send_broadcast(context, text, media_file_id, media_type, target_type, target_value, admin_chat_id))
 
 
+@callback_route("cancel_broadcast")
 async def handle_cancel_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Cancels the broadcast process."""
     query = update.callback_query
@@ -3063,6 +2979,7 @@ async def handle_cancel_broadcast(update: Update, context: ContextTypes.DEFAULT_
     await send_message_with_retry(context.bot, query.message.chat_id, "Returning to Admin Menu.", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
 # --- Handler for Broadcast Message Content ---
+@state_route("awaiting_broadcast_message")
 async def handle_adm_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles the admin sending broadcast message content."""
     if not is_primary_admin(update.effective_user.id):
@@ -3131,6 +3048,7 @@ async def handle_adm_broadcast_message(update: Update, context: ContextTypes.DEF
     )
 
 # --- Handler for Inactive Days Input ---
+@state_route("awaiting_broadcast_inactive_days")
 async def handle_adm_broadcast_inactive_days_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles the admin entering inactive days for broadcast targeting."""
     if not is_primary_admin(update.effective_user.id):
@@ -3166,190 +3084,12 @@ async def handle_adm_broadcast_inactive_days_message(update: Update, context: Co
         )
 
 async def send_broadcast(context: ContextTypes.DEFAULT_TYPE, text: str, media_file_id: str | None, media_type: str | None, target_type: str, target_value: str | int | None, admin_chat_id: int):
-    """Sends the broadcast message to the target audience with improved reliability."""
-    bot = context.bot
-    lang_data = LANGUAGES.get('en', {}) # Use English for internal messages
-    
-    # Temporary flag to disable status tracking if it causes issues
-    ENABLE_STATUS_TRACKING = False  # TEMPORARILY DISABLED for testing
-
-    user_ids = await asyncio.to_thread(fetch_user_ids_for_broadcast, target_type, target_value)
-
-    if not user_ids:
-        logger.warning(f"No users found for broadcast target: type={target_type}, value={target_value}")
-        no_users_msg = lang_data.get("broadcast_no_users_found_target", "⚠️ Broadcast Warning: No users found matching the target criteria.")
-        await send_message_with_retry(bot, admin_chat_id, no_users_msg, parse_mode=None)
-        return
-
-    success_count, fail_count, block_count, total_users = 0, 0, 0, len(user_ids)
-    logger.info(f"Starting broadcast to {total_users} users (Target: {target_type}={target_value})...")
-
-    status_message = None
-    status_update_interval = max(10, total_users // 20)
-    
-    # Add heartbeat tracking
-    import time
-    last_heartbeat = time.time()
-
-    # Initialize status message
-    status_message = None
-    try:
-        status_message = await send_message_with_retry(bot, admin_chat_id, f"⏳ Broadcasting... (0/{total_users})", parse_mode=None)
-    except Exception as status_init_e:
-        logger.error(f"Failed to initialize status message: {status_init_e}")
-        # Continue without status message
-
-    # Process each user with maximum resilience - NO OUTER TRY-CATCH TO PREVENT EARLY TERMINATION
-    for i, user_id in enumerate(user_ids):
-        # Log progress every 10 users to track where broadcast stops
-        if (i + 1) % 10 == 0:
-            current_time = time.time()
-            elapsed = current_time - last_heartbeat
-            logger.info(f"Broadcast progress: {i+1}/{total_users} users processed (Success: {success_count}, Failed: {fail_count}) - Heartbeat: {elapsed:.1f}s since last update")
-            last_heartbeat = current_time
-        
-        # Process each user - isolated error handling
-        try:
-            message_sent = False
-            
-            # Send media or text message
-            if media_file_id and media_type:
-                # Try to send media first
-                try:
-                    send_kwargs = {'chat_id': user_id, 'caption': text, 'parse_mode': None}
-                    if media_type == "photo": 
-                        result = await bot.send_photo(photo=media_file_id, **send_kwargs)
-                    elif media_type == "video": 
-                        result = await bot.send_video(video=media_file_id, **send_kwargs)
-                    elif media_type == "gif": 
-                        result = await bot.send_animation(animation=media_file_id, **send_kwargs)
-                    
-                    if result:
-                        success_count += 1
-                        message_sent = True
-                        logger.debug(f"Broadcast media sent successfully to user {user_id}")
-                except telegram_error.BadRequest as media_e:
-                    error_str = str(media_e).lower()
-                    if "wrong file identifier" in error_str or "file_id" in error_str or "file not found" in error_str:
-                        logger.warning(f"Media file ID invalid for user {user_id}, falling back to text-only: {media_e}")
-                        # Fall through to text-only sending
-                    else:
-                        raise media_e
-                except Exception as media_e:
-                    logger.warning(f"Media send failed for user {user_id}: {media_e}")
-                    # Fall through to text-only sending
-            
-            # Send text-only message if no media was sent successfully
-            if not message_sent:
-                try:
-                    result = await send_message_with_retry(bot, user_id, text, parse_mode=None, disable_web_page_preview=True)
-                    if result:
-                        success_count += 1
-                        logger.debug(f"Broadcast text sent successfully to user {user_id}")
-                    else:
-                        fail_count += 1
-                        logger.warning(f"Broadcast text failed for user {user_id} after retries")
-                except Exception as text_e:
-                    logger.warning(f"Text send failed for user {user_id}: {text_e}")
-                    fail_count += 1
-
-        except telegram_error.BadRequest as e:
-            error_str = str(e).lower()
-            if "chat not found" in error_str or "user is deactivated" in error_str or "bot was blocked" in error_str:
-                logger.warning(f"Broadcast fail/block for user {user_id}: {e}")
-                fail_count += 1
-                block_count += 1
-            else:
-                logger.error(f"Broadcast BadRequest for {user_id}: {e}")
-                fail_count += 1
-
-        except telegram_error.Forbidden as e:
-            logger.warning(f"Broadcast fail/block for user {user_id}: {e}")
-            fail_count += 1
-            block_count += 1
-
-        except telegram_error.RetryAfter as e:
-            retry_seconds = e.retry_after + 1
-            logger.warning(f"Rate limit hit during broadcast. Sleeping {retry_seconds}s.")
-            if retry_seconds > 300:
-                logger.error(f"RetryAfter > 5 min. Skipping user {user_id}.")
-                fail_count += 1
-            else:
-                await asyncio.sleep(retry_seconds)
-                # Try to send again after rate limit
-                try:
-                    result = await send_message_with_retry(bot, user_id, text, parse_mode=None, disable_web_page_preview=True)
-                    if result:
-                        success_count += 1
-                        logger.info(f"Broadcast retry successful for user {user_id}")
-                    else:
-                        fail_count += 1
-                except Exception as retry_e:
-                    logger.error(f"Broadcast fail after retry for {user_id}: {retry_e}")
-                    fail_count += 1
-
-        except Exception as e:
-            # CRITICAL: Catch ANY exception that might terminate the broadcast
-            logger.error(f"CRITICAL: Unexpected exception processing user {user_id} at position {i+1}/{total_users}: {e}", exc_info=True)
-            fail_count += 1
-            # Continue processing the next user instead of terminating
-
-        # Rate limiting
-        try:
-            await asyncio.sleep(0.1)  # 10 messages per second
-        except Exception as sleep_e:
-            logger.warning(f"Error during sleep: {sleep_e}")
-
-        # Status updates
-        try:
-            if status_message and (i + 1) % max(5, status_update_interval // 2) == 0:
-                try:
-                    await context.bot.edit_message_text(
-                        chat_id=admin_chat_id,
-                        message_id=status_message.message_id,
-                        text=f"⏳ Broadcasting... ({i+1}/{total_users} | ✅{success_count} | ❌{fail_count})",
-                        parse_mode=None
-                    )
-                except telegram_error.BadRequest:
-                    pass  # Ignore if message is not modified
-                except Exception as edit_e:
-                    logger.warning(f"Could not edit broadcast status message: {edit_e}")
-        except Exception as status_update_e:
-            logger.warning(f"Error during status update processing: {status_update_e}")
-    
-    # Log completion of the broadcast loop
-    logger.info(f"Broadcast loop completed. Processed {i+1}/{total_users} users. Success: {success_count}, Failed: {fail_count}")
-
-    # Final summary
-    success_rate = (success_count / total_users * 100) if total_users > 0 else 0
-    summary_msg = (f"✅ Broadcast Complete\n\n"
-                  f"🎯 Target: {target_type} = {target_value or 'N/A'}\n"
-                  f"📊 Results: {success_count}/{total_users} ({success_rate:.1f}%)\n"
-                  f"❌ Failed: {fail_count}\n"
-                  f"🚫 Blocked/Deactivated: {block_count}")
-    
-    try:
-        if status_message:
-            try:
-                await context.bot.edit_message_text(
-                    chat_id=admin_chat_id, 
-                    message_id=status_message.message_id, 
-                    text=summary_msg, 
-                    parse_mode=None
-                )
-            except Exception:
-                await send_message_with_retry(bot, admin_chat_id, summary_msg, parse_mode=None)
-        else:
-            await send_message_with_retry(bot, admin_chat_id, summary_msg, parse_mode=None)
-    except Exception as summary_e:
-        logger.error(f"Failed to send final summary: {summary_e}")
-    
-    logger.info(f"Broadcast finished. Target: {target_type}={target_value}. "
-               f"Success: {success_count}/{total_users} ({success_rate:.1f}%), "
-               f"Failed: {fail_count}, Blocked: {block_count}")
+    """Sends the broadcast message to the target audience through the rate-limited, resumable broadcast engine."""
+    await run_broadcast(context.bot, admin_chat_id, target_type, target_value, text, media_file_id, media_type)
 
 
 # <<< ADDED: Handler for Clear Reservations Confirmation Button >>>
+@callback_route("adm_clear_reservations_confirm")
 async def handle_adm_clear_reservations_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Shows confirmation prompt for clearing all reservations."""
     query = update.callback_query
@@ -3364,32 +3104,12 @@ async def handle_adm_clear_reservations_confirm(update: Update, context: Context
     await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
 # --- Confirmation Handler ---
-async def handle_confirm_yes(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
-    """Handles generic 'Yes' confirmation based on stored action in user_data."""
-    query = update.callback_query
-    user_id = query.from_user.id
-    primary_admin = is_primary_admin(user_id)
-    if not primary_admin:
-        logger.warning(f"Non-primary admin {user_id} tried to confirm a destructive action.")
-        await query.answer("Permission denied for this action.", show_alert=True)
-        return
-
-    user_specific_data = context.user_data
-    action = user_specific_data.pop("confirm_action", None)
-
-    if not action:
-        try: await query.edit_message_text("❌ Error: No action pending confirmation.", parse_mode=None)
-        except telegram_error.BadRequest: pass # Ignore if not modified
-        return
-    chat_id = query.message.chat_id
-    action_parts = action.split("|")
-    action_type = action_parts[0]
-    action_params = action_parts[1:]
-    logger.info(f"Admin {user_id} confirmed action: {action_type} with params: {action_params}")
+def _execute_confirmed_action_db(action_type: str, action_params: list, user_id: int) -> tuple[str, str]:
+    """Applies a confirmed destructive admin action in one transaction (Synchronous, runs on DB executor). Returns (result message, next callback)."""
     success_msg, next_callback = "✅ Action completed successfully!", "admin_menu"
-    conn = None # Initialize conn
+    conn = None
     try:
-        conn = get_db_connection() # Use helper
+        conn = get_db_connection()
         c = conn.cursor()
         c.execute("BEGIN")
         # --- Delete City Logic ---
@@ -3404,11 +3124,7 @@ async def handle_confirm_yes(update: Update, context: ContextTypes.DEFAULT_TYPE,
                  if product_ids_to_delete:
                      placeholders = ','.join('?' * len(product_ids_to_delete))
                      c.execute(f"DELETE FROM product_media WHERE product_id IN ({placeholders})", product_ids_to_delete)
-                     for pid in product_ids_to_delete:
-                          media_dir_to_del = os.path.join(MEDIA_DIR, str(pid))
-                          if await asyncio.to_thread(os.path.exists, media_dir_to_del):
-                              asyncio.create_task(asyncio.to_thread(shutil.rmtree, media_dir_to_del, ignore_errors=True))
-                              logger.info(f"Scheduled deletion of media dir: {media_dir_to_del}")
+                     # Files are not deleted here: blobs no product_media row references are removed by collect_media_garbage()
                  c.execute("DELETE FROM products WHERE city = ?", (city_name,)) # Actual product deletion
                  c.execute("DELETE FROM districts WHERE city_id = ?", (city_id_int,))
                  delete_city_result = c.execute("DELETE FROM cities WHERE id = ?", (city_id_int,))
@@ -3433,11 +3149,7 @@ async def handle_confirm_yes(update: Update, context: ContextTypes.DEFAULT_TYPE,
                  if product_ids_to_delete:
                      placeholders = ','.join('?' * len(product_ids_to_delete))
                      c.execute(f"DELETE FROM product_media WHERE product_id IN ({placeholders})", product_ids_to_delete)
-                     for pid in product_ids_to_delete:
-                          media_dir_to_del = os.path.join(MEDIA_DIR, str(pid))
-                          if await asyncio.to_thread(os.path.exists, media_dir_to_del):
-                              asyncio.create_task(asyncio.to_thread(shutil.rmtree, media_dir_to_del, ignore_errors=True))
-                              logger.info(f"Scheduled deletion of media dir: {media_dir_to_del}")
+                     # Files are not deleted here: blobs no product_media row references are removed by collect_media_garbage()
                  c.execute("DELETE FROM products WHERE city = ? AND district = ?", (city_name, district_name)) # Actual product deletion
                  delete_dist_result = c.execute("DELETE FROM districts WHERE id = ? AND city_id = ?", (dist_id_int, city_id_int))
                  if delete_dist_result.rowcount > 0:
@@ -3457,11 +3169,9 @@ async def handle_confirm_yes(update: Update, context: ContextTypes.DEFAULT_TYPE,
              delete_prod_result = c.execute("DELETE FROM products WHERE id = ?", (product_id,)) # Actual product deletion
              if delete_prod_result.rowcount > 0:
                   conn.commit()
+                  CATALOG_INDEX.remove_products([product_id])
                   success_msg = f"✅ Product ID {product_id} removed!"
-                  media_dir_to_delete = os.path.join(MEDIA_DIR, str(product_id))
-                  if await asyncio.to_thread(os.path.exists, media_dir_to_delete):
-                       asyncio.create_task(asyncio.to_thread(shutil.rmtree, media_dir_to_delete, ignore_errors=True))
-                       logger.info(f"Scheduled deletion of media dir: {media_dir_to_delete}")
+                  # Files are not deleted here: blobs no product_media row references are removed by collect_media_garbage()
                   if back_details_tuple and all([back_details_tuple['city_id'], back_details_tuple['dist_id'], back_details_tuple['product_type']]):
                       next_callback = f"adm_manage_products_type|{back_details_tuple['city_id']}|{back_details_tuple['dist_id']}|{back_details_tuple['product_type']}" # Use column names
                   else: next_callback = "adm_manage_products"
@@ -3493,8 +3203,6 @@ async def handle_confirm_yes(update: Update, context: ContextTypes.DEFAULT_TYPE,
         elif action_type == "force_delete_type_CASCADE":
             if not action_params: raise ValueError("Missing type_name for force delete")
             type_name = action_params[0]
-            # Clean up the user_data entry now that we are processing it
-            user_specific_data.pop('force_delete_type_name', None)
             logger.warning(f"Admin {user_id} initiated FORCE DELETE for type '{type_name}' and all associated data.")
 
             c.execute("SELECT id FROM products WHERE product_type = ?", (type_name,))
@@ -3504,11 +3212,7 @@ async def handle_confirm_yes(update: Update, context: ContextTypes.DEFAULT_TYPE,
                 placeholders = ','.join('?' * len(product_ids_to_delete_media_for))
                 c.execute(f"DELETE FROM product_media WHERE product_id IN ({placeholders})", product_ids_to_delete_media_for)
                 logger.info(f"Force delete: Deleted media entries for {len(product_ids_to_delete_media_for)} products of type '{type_name}'.")
-                for pid in product_ids_to_delete_media_for:
-                    media_dir_to_del = os.path.join(MEDIA_DIR, str(pid))
-                    if await asyncio.to_thread(os.path.exists, media_dir_to_del):
-                        asyncio.create_task(asyncio.to_thread(shutil.rmtree, media_dir_to_del, ignore_errors=True))
-                        logger.info(f"Force delete: Scheduled deletion of media dir: {media_dir_to_del}")
+                # Files are not deleted here: blobs no product_media row references are removed by collect_media_garbage()
 
             delete_products_res = c.execute("DELETE FROM products WHERE product_type = ?", (type_name,))
             products_deleted_count = delete_products_res.rowcount if delete_products_res else 0
@@ -3518,6 +3222,7 @@ async def handle_confirm_yes(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
             if delete_type_res.rowcount > 0:
                 conn.commit(); load_all_data()
+                if discounts_deleted_count: invalidate_reseller_pricing()
                 log_admin_action(admin_id=user_id, action="PRODUCT_TYPE_FORCE_DELETE",
                                  reason=f"Type: '{type_name}'. Deleted {products_deleted_count} products, {discounts_deleted_count} discount rules.",
                                  old_value=type_name)
@@ -3558,6 +3263,7 @@ async def handle_confirm_yes(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
                 if type_deleted:
                     conn.commit(); load_all_data()
+                    if reseller_reassigned: invalidate_reseller_pricing()
                     log_admin_action(admin_id=user_id, action=ACTION_PRODUCT_TYPE_REASSIGN,
                                      reason=f"From '{old_type_name}' to '{new_type_name}'. Reassigned {products_reassigned} products, affected {reseller_reassigned} discount entries.",
                                      old_value=old_type_name, new_value=new_type_name)
@@ -3593,7 +3299,7 @@ async def handle_confirm_yes(update: Update, context: ContextTypes.DEFAULT_TYPE,
             name_to_delete = action_params[0]
             delete_wm_result = c.execute("DELETE FROM welcome_messages WHERE name = ?", (name_to_delete,))
             if delete_wm_result.rowcount > 0:
-                 conn.commit(); success_msg = f"✅ Welcome template '{name_to_delete}' deleted!"
+                 conn.commit(); invalidate_welcome_template_cache(); success_msg = f"✅ Welcome template '{name_to_delete}' deleted!"
                  next_callback = "adm_manage_welcome|0"
             else: conn.rollback(); success_msg = f"❌ Error: Welcome template '{name_to_delete}' not found."
         # <<< Reset Welcome Message Logic >>>
@@ -3603,7 +3309,7 @@ async def handle_confirm_yes(update: Update, context: ContextTypes.DEFAULT_TYPE,
                 c.execute("UPDATE welcome_messages SET template_text = ? WHERE name = ?", (built_in_text, "default"))
                 c.execute("INSERT OR REPLACE INTO bot_settings (setting_key, setting_value) VALUES (?, ?)",
                           ("active_welcome_message_name", "default"))
-                conn.commit(); success_msg = "✅ 'default' welcome template reset and activated."
+                conn.commit(); invalidate_welcome_template_cache(); success_msg = "✅ 'default' welcome template reset and activated."
             except Exception as reset_e:
                  conn.rollback(); logger.error(f"Error resetting default welcome message: {reset_e}", exc_info=True)
                  success_msg = "❌ Error resetting default template."
@@ -3617,7 +3323,8 @@ async def handle_confirm_yes(update: Update, context: ContextTypes.DEFAULT_TYPE,
                 old_res = c.fetchone(); old_value = old_res['discount_percentage'] if old_res else None
                 delete_res_result = c.execute("DELETE FROM reseller_discounts WHERE reseller_user_id = ? AND product_type = ?", (reseller_id, product_type))
                 if delete_res_result.rowcount > 0:
-                    conn.commit(); log_admin_action(user_id, ACTION_RESELLER_DISCOUNT_DELETE, reseller_id, reason=f"Type: {product_type}", old_value=old_value)
+                    conn.commit(); invalidate_reseller_pricing(reseller_id)
+                    log_admin_action(user_id, ACTION_RESELLER_DISCOUNT_DELETE, reseller_id, reason=f"Type: {product_type}", old_value=old_value)
                     success_msg = f"✅ Reseller discount rule deleted for {product_type}."
                 else: conn.rollback(); success_msg = f"❌ Error: Reseller discount rule for {product_type} not found."
                 next_callback = f"reseller_manage_specific|{reseller_id}"
@@ -3629,9 +3336,11 @@ async def handle_confirm_yes(update: Update, context: ContextTypes.DEFAULT_TYPE,
             logger.warning(f"ADMIN ACTION: Admin {user_id} is clearing ALL reservations and baskets.")
             update_products_res = c.execute("UPDATE products SET reserved = 0 WHERE reserved > 0")
             products_cleared = update_products_res.rowcount if update_products_res else 0
-            update_users_res = c.execute("UPDATE users SET basket = '' WHERE basket IS NOT NULL AND basket != ''")
-            baskets_cleared = update_users_res.rowcount if update_users_res else 0
+            c.execute("SELECT COUNT(DISTINCT user_id) AS cnt FROM basket_items")
+            baskets_cleared = c.fetchone()['cnt']
+            c.execute("DELETE FROM basket_items")
             conn.commit()
+            CATALOG_INDEX.rebuild()
             log_admin_action(admin_id=user_id, action="CLEAR_ALL_RESERVATIONS", reason=f"Cleared {products_cleared} reservations and {baskets_cleared} user baskets.")
             success_msg = f"✅ Cleared {products_cleared} product reservations and emptied {baskets_cleared} user baskets."
             next_callback = "admin_menu"
@@ -3639,6 +3348,38 @@ async def handle_confirm_yes(update: Update, context: ContextTypes.DEFAULT_TYPE,
             logger.error(f"Unknown confirmation action type: {action_type}")
             conn.rollback(); success_msg = "❌ Unknown action confirmed."
             next_callback = "admin_menu"
+        return success_msg, next_callback
+    except Exception:
+        if conn and conn.in_transaction: conn.rollback()
+        raise
+    finally:
+        if conn: conn.close()
+
+@callback_route("confirm_yes")
+async def handle_confirm_yes(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
+    """Handles generic 'Yes' confirmation based on stored action in user_data."""
+    query = update.callback_query
+    user_id = query.from_user.id
+    primary_admin = is_primary_admin(user_id)
+    if not primary_admin:
+        logger.warning(f"Non-primary admin {user_id} tried to confirm a destructive action.")
+        await query.answer("Permission denied for this action.", show_alert=True)
+        return
+
+    user_specific_data = context.user_data
+    action = user_specific_data.pop("confirm_action", None)
+
+    if not action:
+        try: await query.edit_message_text("❌ Error: No action pending confirmation.", parse_mode=None)
+        except telegram_error.BadRequest: pass # Ignore if not modified
+        return
+    chat_id = query.message.chat_id
+    action_parts = action.split("|")
+    action_type = action_parts[0]
+    action_params = action_parts[1:]
+    logger.info(f"Admin {user_id} confirmed action: {action_type} with params: {action_params}")
+    try:
+        success_msg, next_callback = await run_db(_execute_confirmed_action_db, action_type, action_params, user_id)
 
         try: await query.edit_message_text(success_msg, parse_mode=None)
         except telegram_error.BadRequest: pass
@@ -3648,12 +3389,10 @@ async def handle_confirm_yes(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
     except (sqlite3.Error, ValueError, OSError, Exception) as e:
         logger.error(f"Error executing confirmed action '{action}': {e}", exc_info=True)
-        if conn and conn.in_transaction: conn.rollback()
         error_text = str(e)
         try: await query.edit_message_text(f"❌ An error occurred: {error_text}", parse_mode=None)
         except Exception as edit_err: logger.error(f"Failed to edit message with error: {edit_err}")
     finally:
-        if conn: conn.close()
         # Clean up specific user_data keys used by certain flows after confirmation
         if action_type.startswith("force_delete_type_CASCADE"):
             user_specific_data.pop('force_delete_type_name', None)
@@ -3673,16 +3412,10 @@ async def handle_adm_edit_welcome_text(update: Update, context: ContextTypes.DEF
 
     # Fetch current text to show in prompt
     current_text = ""
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT template_text FROM welcome_messages WHERE name = ?", (template_name,))
-        row = c.fetchone()
+        row = await db_fetchone("SELECT template_text FROM welcome_messages WHERE name = ?", (template_name,))
         if row: current_text = row['template_text']
     except sqlite3.Error as e: logger.error(f"DB error fetching text for edit: {e}")
-    finally:
-         if conn: conn.close()
 
     context.user_data['state'] = 'awaiting_welcome_template_edit' # Reusing state, but specifically for text
     context.user_data['editing_welcome_template_name'] = template_name # Ensure it's set
@@ -3719,14 +3452,10 @@ async def handle_adm_edit_welcome_desc(update: Update, context: ContextTypes.DEF
 
     # Fetch current description
     current_desc = ""
-    conn = None
     try:
-        conn = get_db_connection(); c = conn.cursor()
-        c.execute("SELECT description FROM welcome_messages WHERE name = ?", (template_name,))
-        row = c.fetchone(); current_desc = row['description'] or ""
+        row = await db_fetchone("SELECT description FROM welcome_messages WHERE name = ?", (template_name,))
+        current_desc = row['description'] or ""
     except sqlite3.Error as e: logger.error(f"DB error fetching desc for edit: {e}")
-    finally:
-        if conn: conn.close()
 
     context.user_data['state'] = 'awaiting_welcome_description_edit' # New state for description edit
     context.user_data['editing_welcome_template_name'] = template_name # Ensure it's set
@@ -3751,16 +3480,11 @@ async def handle_adm_delete_welcome_confirm(update: Update, context: ContextType
     lang, lang_data = _get_lang_data(context) # Use helper
 
     # Fetch current active template
-    conn = None
     active_template_name = "default"
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT setting_value FROM bot_settings WHERE setting_key = ?", ("active_welcome_message_name",))
-        row = c.fetchone(); active_template_name = row['setting_value'] if row else "default" # Use column name
+        row = await db_fetchone("SELECT setting_value FROM bot_settings WHERE setting_key = ?", ("active_welcome_message_name",))
+        active_template_name = row['setting_value'] if row else "default" # Use column name
     except sqlite3.Error as e: logger.error(f"DB error checking template status for delete: {e}")
-    finally:
-         if conn: conn.close()
 
     if template_name == "default":
         await query.answer("Cannot delete the 'default' template.", show_alert=True)
@@ -3807,6 +3531,7 @@ async def handle_reset_default_welcome(update: Update, context: ContextTypes.DEF
 
 # --- Welcome Message Message Handlers ---
 
+@state_route("awaiting_welcome_template_name")
 async def handle_adm_welcome_template_name_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles text reply when state is 'awaiting_welcome_template_name'."""
     user_id = update.effective_user.id
@@ -3823,12 +3548,8 @@ async def handle_adm_welcome_template_name_message(update: Update, context: Cont
         return await send_message_with_retry(context.bot, chat_id, "Template name too long (max 50 characters).", parse_mode=None)
 
     # Check if template name already exists
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT 1 FROM welcome_messages WHERE name = ?", (template_name,))
-        if c.fetchone():
+        if await db_fetchone("SELECT 1 FROM welcome_messages WHERE name = ?", (template_name,)):
             lang, lang_data = _get_lang_data(context)
             error_msg = lang_data.get("welcome_add_name_exists", "❌ Error: A template with the name '{name}' already exists.")
             await send_message_with_retry(context.bot, chat_id, error_msg.format(name=template_name), parse_mode=None)
@@ -3837,8 +3558,6 @@ async def handle_adm_welcome_template_name_message(update: Update, context: Cont
         logger.error(f"DB error checking template name '{template_name}': {e}")
         await send_message_with_retry(context.bot, chat_id, "❌ Database error checking template name.", parse_mode=None)
         return
-    finally:
-        if conn: conn.close()
 
     # Set up for text input
     context.user_data['state'] = 'awaiting_welcome_template_text'
@@ -3856,6 +3575,7 @@ async def handle_adm_welcome_template_name_message(update: Update, context: Cont
     keyboard = [[InlineKeyboardButton("❌ Cancel", callback_data="adm_manage_welcome|0")]]
     await send_message_with_retry(context.bot, chat_id, prompt, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@state_route("awaiting_welcome_template_text", "awaiting_welcome_template_edit")
 async def handle_adm_welcome_template_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles text reply when state is 'awaiting_welcome_template_text' or 'awaiting_welcome_template_edit'."""
     user_id = update.effective_user.id
@@ -3900,18 +3620,12 @@ async def handle_adm_welcome_template_text_message(update: Update, context: Cont
 
         # Get current description to preserve it
         current_description = None
-        conn = None
         try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("SELECT description FROM welcome_messages WHERE name = ?", (template_name,))
-            row = c.fetchone()
+            row = await db_fetchone("SELECT description FROM welcome_messages WHERE name = ?", (template_name,))
             if row:
                 current_description = row['description']
         except sqlite3.Error as e:
             logger.error(f"DB error fetching description for '{template_name}': {e}")
-        finally:
-            if conn: conn.close()
 
         # Set up for preview
         context.user_data['pending_welcome_template'] = {
@@ -3925,6 +3639,7 @@ async def handle_adm_welcome_template_text_message(update: Update, context: Cont
         # Show preview
         await _show_welcome_preview(update, context)
 
+@state_route("awaiting_welcome_description", "awaiting_welcome_description_edit")
 async def handle_adm_welcome_description_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles text reply when state is 'awaiting_welcome_description' or 'awaiting_welcome_description_edit'."""
     user_id = update.effective_user.id
@@ -3962,18 +3677,12 @@ async def handle_adm_welcome_description_message(update: Update, context: Contex
 
         # Get current text to preserve it
         current_text = None
-        conn = None
         try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("SELECT template_text FROM welcome_messages WHERE name = ?", (template_name,))
-            row = c.fetchone()
+            row = await db_fetchone("SELECT template_text FROM welcome_messages WHERE name = ?", (template_name,))
             if row:
                 current_text = row['template_text']
         except sqlite3.Error as e:
             logger.error(f"DB error fetching text for '{template_name}': {e}")
-        finally:
-            if conn: conn.close()
 
         if not current_text:
             await send_message_with_retry(context.bot, chat_id, "❌ Error: Could not load current template text.", parse_mode=None)
@@ -4121,10 +3830,10 @@ async def handle_confirm_save_welcome(update: Update, context: ContextTypes.DEFA
     # Perform the actual save operation
     success = False
     if is_editing:
-        success = update_welcome_message_template(template_name, template_text, template_description)
+        success = await run_db(update_welcome_message_template, template_name, template_text, template_description)
         msg_template = lang_data.get("welcome_edit_success", "✅ Template '{name}' updated.") if success else lang_data.get("welcome_edit_fail", "❌ Failed to update template '{name}'.")
     else:
-        success = add_welcome_message_template(template_name, template_text, template_description)
+        success = await run_db(add_welcome_message_template, template_name, template_text, template_description)
         msg_template = lang_data.get("welcome_add_success", "✅ Welcome message template '{name}' added.") if success else lang_data.get("welcome_add_fail", "❌ Failed to add welcome message template.")
 
     # Clean up context
@@ -4147,6 +3856,41 @@ async def handle_confirm_save_welcome(update: Update, context: ContextTypes.DEFA
 # --- These handlers are primarily for the core admin flow ---
 # --- Reseller state message handlers are defined in reseller_management.py ---
 
+def _rename_district_db(city_id: int, dist_id: int, city_name: str, old_name: str, new_name: str):
+    """Renames a district and the products listed under it in one transaction (Synchronous, runs on DB executor)."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("BEGIN")
+        c.execute("UPDATE districts SET name = ? WHERE id = ? AND city_id = ?", (new_name, dist_id, city_id))
+        # Update products table as well
+        c.execute("UPDATE products SET district = ? WHERE district = ? AND city = ?", (new_name, old_name, city_name))
+        conn.commit()
+    except Exception:
+        if conn and conn.in_transaction: conn.rollback()
+        raise
+    finally:
+        if conn: conn.close()
+
+def _rename_city_db(city_id: int, old_name: str, new_name: str):
+    """Renames a city and the products listed under it in one transaction (Synchronous, runs on DB executor)."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("BEGIN")
+        c.execute("UPDATE cities SET name = ? WHERE id = ?", (new_name, city_id))
+        # Update products table as well
+        c.execute("UPDATE products SET city = ? WHERE city = ?", (new_name, old_name))
+        conn.commit()
+    except Exception:
+        if conn and conn.in_transaction: conn.rollback()
+        raise
+    finally:
+        if conn: conn.close()
+
+@state_route("awaiting_new_city_name")
 async def handle_adm_add_city_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles text reply when state is 'awaiting_new_city_name'."""
     user_id = update.effective_user.id
@@ -4156,14 +3900,9 @@ async def handle_adm_add_city_message(update: Update, context: ContextTypes.DEFA
     if context.user_data.get("state") != "awaiting_new_city_name": return
     text = update.message.text.strip()
     if not text: return await send_message_with_retry(context.bot, chat_id, "City name cannot be empty.", parse_mode=None)
-    conn = None # Initialize conn
     try:
-        conn = get_db_connection() # Use helper
-        c = conn.cursor()
-        c.execute("INSERT INTO cities (name) VALUES (?)", (text,))
-        new_city_id = c.lastrowid
-        conn.commit()
-        load_all_data() # Reload global data
+        await db_execute("INSERT INTO cities (name) VALUES (?)", (text,))
+        await run_db(load_all_data) # Reload global data
         context.user_data.pop("state", None)
         success_text = f"✅ City '{text}' added successfully!"
         keyboard = [[InlineKeyboardButton("⬅️ Manage Cities", callback_data="adm_manage_cities")]]
@@ -4172,12 +3911,10 @@ async def handle_adm_add_city_message(update: Update, context: ContextTypes.DEFA
         await send_message_with_retry(context.bot, chat_id, f"❌ Error: City '{text}' already exists.", parse_mode=None)
     except sqlite3.Error as e:
         logger.error(f"DB error adding city '{text}': {e}", exc_info=True)
-        if conn and conn.in_transaction: conn.rollback()
         await send_message_with_retry(context.bot, chat_id, "❌ Error: Failed to add city.", parse_mode=None)
         context.user_data.pop("state", None)
-    finally:
-        if conn: conn.close() # Close connection if opened
 
+@state_route("awaiting_new_district_name")
 async def handle_adm_add_district_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles text reply when state is 'awaiting_new_district_name'."""
     user_id = update.effective_user.id
@@ -4193,14 +3930,10 @@ async def handle_adm_add_district_message(update: Update, context: ContextTypes.
         context.user_data.pop("state", None); context.user_data.pop("admin_add_district_city_id", None)
         return
     if not text: return await send_message_with_retry(context.bot, chat_id, "District name cannot be empty.", parse_mode=None)
-    conn = None # Initialize conn
     try:
         city_id_int = int(city_id_str)
-        conn = get_db_connection() # Use helper
-        c = conn.cursor()
-        c.execute("INSERT INTO districts (city_id, name) VALUES (?, ?)", (city_id_int, text))
-        conn.commit()
-        load_all_data() # Reload global data
+        await db_execute("INSERT INTO districts (city_id, name) VALUES (?, ?)", (city_id_int, text))
+        await run_db(load_all_data) # Reload global data
         context.user_data.pop("state", None); context.user_data.pop("admin_add_district_city_id", None)
         success_text = f"✅ District '{text}' added to {city_name}!"
         keyboard = [[InlineKeyboardButton("⬅️ Manage Districts", callback_data=f"adm_manage_districts_city|{city_id_str}")]]
@@ -4209,12 +3942,10 @@ async def handle_adm_add_district_message(update: Update, context: ContextTypes.
         await send_message_with_retry(context.bot, chat_id, f"❌ Error: District '{text}' already exists in {city_name}.", parse_mode=None)
     except (sqlite3.Error, ValueError) as e:
         logger.error(f"DB/Value error adding district '{text}' to city {city_id_str}: {e}", exc_info=True)
-        if conn and conn.in_transaction: conn.rollback()
         await send_message_with_retry(context.bot, chat_id, "❌ Error: Failed to add district.", parse_mode=None)
         context.user_data.pop("state", None); context.user_data.pop("admin_add_district_city_id", None)
-    finally:
-        if conn: conn.close() # Close connection if opened
 
+@state_route("awaiting_edit_district_name")
 async def handle_adm_edit_district_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles text reply when state is 'awaiting_edit_district_name'."""
     user_id = update.effective_user.id
@@ -4227,16 +3958,11 @@ async def handle_adm_edit_district_message(update: Update, context: ContextTypes
     dist_id_str = context.user_data.get("edit_district_id")
     city_name = CITIES.get(city_id_str)
     old_district_name = None
-    conn = None # Initialize conn
     try:
-        conn = get_db_connection() # Use helper
-        c = conn.cursor()
         # Use column name
-        c.execute("SELECT name FROM districts WHERE id = ? AND city_id = ?", (int(dist_id_str), int(city_id_str)))
-        res = c.fetchone(); old_district_name = res['name'] if res else None
-    except (sqlite3.Error, ValueError) as e: logger.error(f"Failed to fetch old district name for edit: {e}")
-    finally:
-        if conn: conn.close() # Close connection if opened
+        res = await db_fetchone("SELECT name FROM districts WHERE id = ? AND city_id = ?", (int(dist_id_str), int(city_id_str)))
+        old_district_name = res['name'] if res else None
+    except (sqlite3.Error, ValueError, TypeError) as e: logger.error(f"Failed to fetch old district name for edit: {e}")
     if not city_id_str or not dist_id_str or not city_name or old_district_name is None:
         await send_message_with_retry(context.bot, chat_id, "❌ Error: Could not find district/city.", parse_mode=None)
         context.user_data.pop("state", None); context.user_data.pop("edit_city_id", None); context.user_data.pop("edit_district_id", None)
@@ -4247,17 +3973,10 @@ async def handle_adm_edit_district_message(update: Update, context: ContextTypes
         context.user_data.pop("state", None); context.user_data.pop("edit_city_id", None); context.user_data.pop("edit_district_id", None)
         keyboard = [[InlineKeyboardButton("⬅️ Manage Districts", callback_data=f"adm_manage_districts_city|{city_id_str}")]]
         return await send_message_with_retry(context.bot, chat_id, "No changes detected.", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
-    conn = None # Re-initialize for update transaction
     try:
         city_id_int, dist_id_int = int(city_id_str), int(dist_id_str)
-        conn = get_db_connection() # Use helper
-        c = conn.cursor()
-        c.execute("BEGIN")
-        c.execute("UPDATE districts SET name = ? WHERE id = ? AND city_id = ?", (new_name, dist_id_int, city_id_int))
-        # Update products table as well
-        c.execute("UPDATE products SET district = ? WHERE district = ? AND city = ?", (new_name, old_district_name, city_name))
-        conn.commit()
-        load_all_data() # Reload global data
+        await run_db(_rename_district_db, city_id_int, dist_id_int, city_name, old_district_name, new_name)
+        await run_db(load_all_data) # Reload global data
         context.user_data.pop("state", None); context.user_data.pop("edit_city_id", None); context.user_data.pop("edit_district_id", None)
         success_text = f"✅ District updated to '{new_name}' successfully!"
         keyboard = [[InlineKeyboardButton("⬅️ Manage Districts", callback_data=f"adm_manage_districts_city|{city_id_str}")]]
@@ -4266,13 +3985,11 @@ async def handle_adm_edit_district_message(update: Update, context: ContextTypes
         await send_message_with_retry(context.bot, chat_id, f"❌ Error: District '{new_name}' already exists.", parse_mode=None)
     except (sqlite3.Error, ValueError) as e:
         logger.error(f"DB/Value error updating district {dist_id_str}: {e}", exc_info=True)
-        if conn and conn.in_transaction: conn.rollback()
         await send_message_with_retry(context.bot, chat_id, "❌ Error: Failed to update district.", parse_mode=None)
         context.user_data.pop("state", None); context.user_data.pop("edit_city_id", None); context.user_data.pop("edit_district_id", None)
-    finally:
-         if conn: conn.close() # Close connection if opened
 
 
+@state_route("awaiting_edit_city_name")
 async def handle_adm_edit_city_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles text reply when state is 'awaiting_edit_city_name'."""
     user_id = update.effective_user.id
@@ -4283,16 +4000,11 @@ async def handle_adm_edit_city_message(update: Update, context: ContextTypes.DEF
     new_name = update.message.text.strip()
     city_id_str = context.user_data.get("edit_city_id")
     old_name = None
-    conn = None # Initialize conn
     try:
-        conn = get_db_connection() # Use helper
-        c = conn.cursor()
         # Use column name
-        c.execute("SELECT name FROM cities WHERE id = ?", (int(city_id_str),))
-        res = c.fetchone(); old_name = res['name'] if res else None
-    except (sqlite3.Error, ValueError) as e: logger.error(f"Failed to fetch old city name for edit: {e}")
-    finally:
-        if conn: conn.close() # Close connection if opened
+        res = await db_fetchone("SELECT name FROM cities WHERE id = ?", (int(city_id_str),))
+        old_name = res['name'] if res else None
+    except (sqlite3.Error, ValueError, TypeError) as e: logger.error(f"Failed to fetch old city name for edit: {e}")
     if not city_id_str or old_name is None:
         await send_message_with_retry(context.bot, chat_id, "❌ Error: Could not find city.", parse_mode=None)
         context.user_data.pop("state", None); context.user_data.pop("edit_city_id", None)
@@ -4303,17 +4015,10 @@ async def handle_adm_edit_city_message(update: Update, context: ContextTypes.DEF
         context.user_data.pop("state", None); context.user_data.pop("edit_city_id", None)
         keyboard = [[InlineKeyboardButton("⬅️ Manage Cities", callback_data="adm_manage_cities")]]
         return await send_message_with_retry(context.bot, chat_id, "No changes detected.", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
-    conn = None # Re-initialize for update transaction
     try:
         city_id_int = int(city_id_str)
-        conn = get_db_connection() # Use helper
-        c = conn.cursor()
-        c.execute("BEGIN")
-        c.execute("UPDATE cities SET name = ? WHERE id = ?", (new_name, city_id_int))
-        # Update products table as well
-        c.execute("UPDATE products SET city = ? WHERE city = ?", (new_name, old_name))
-        conn.commit()
-        load_all_data() # Reload global data
+        await run_db(_rename_city_db, city_id_int, old_name, new_name)
+        await run_db(load_all_data) # Reload global data
         context.user_data.pop("state", None); context.user_data.pop("edit_city_id", None)
         success_text = f"✅ City updated to '{new_name}' successfully!"
         keyboard = [[InlineKeyboardButton("⬅️ Manage Cities", callback_data="adm_manage_cities")]]
@@ -4322,13 +4027,11 @@ async def handle_adm_edit_city_message(update: Update, context: ContextTypes.DEF
         await send_message_with_retry(context.bot, chat_id, f"❌ Error: City '{new_name}' already exists.", parse_mode=None)
     except (sqlite3.Error, ValueError) as e:
         logger.error(f"DB/Value error updating city {city_id_str}: {e}", exc_info=True)
-        if conn and conn.in_transaction: conn.rollback()
         await send_message_with_retry(context.bot, chat_id, "❌ Error: Failed to update city.", parse_mode=None)
         context.user_data.pop("state", None); context.user_data.pop("edit_city_id", None)
-    finally:
-         if conn: conn.close() # Close connection if opened
 
 
+@state_route("awaiting_custom_size")
 async def handle_adm_custom_size_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles text reply when state is 'awaiting_custom_size'."""
     user_id = update.effective_user.id
@@ -4349,6 +4052,7 @@ async def handle_adm_custom_size_message(update: Update, context: ContextTypes.D
     await send_message_with_retry(context.bot, chat_id, f"Custom size set to '{custom_size}'. Reply with the price (e.g., 12.50):",
                                   reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@state_route("awaiting_price")
 async def handle_adm_price_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles price input for regular product adding."""
     user_id = update.effective_user.id
@@ -4386,19 +4090,8 @@ async def handle_adm_price_message(update: Update, context: ContextTypes.DEFAULT
         "When finished, send any message with the text 'done' to confirm.", 
         parse_mode=None)
 
-async def display_user_search_results(bot, chat_id: int, user_info: dict):
-    """Displays user overview with buttons to view detailed sections."""
-    user_id = user_info['user_id']
-    username = user_info['username'] or f"ID_{user_id}"
-    balance = Decimal(str(user_info['balance']))
-    total_purchases = user_info['total_purchases']
-    is_banned = user_info['is_banned'] == 1
-    is_reseller = user_info['is_reseller'] == 1
-    
-    # Get user status and progress
-    status = get_user_status(total_purchases)
-    progress_bar = get_progress_bar(total_purchases)
-    
+def _fetch_user_overview_counts(user_id: int) -> tuple[int, int, int, Decimal]:
+    """Returns (purchases, pending deposits, admin actions, total spent) for a user (Synchronous, runs on DB executor)."""
     conn = None
     try:
         conn = get_db_connection()
@@ -4418,14 +4111,29 @@ async def display_user_search_results(bot, chat_id: int, user_info: dict):
         c.execute("SELECT COALESCE(SUM(price_paid), 0.0) as total_spent FROM purchases WHERE user_id = ?", (user_id,))
         total_spent_result = c.fetchone()
         total_spent = Decimal(str(total_spent_result['total_spent'])) if total_spent_result else Decimal('0.0')
-        
+        return total_purchases_count, pending_deposits_count, admin_actions_count, total_spent
+    finally:
+        if conn: conn.close()
+
+async def display_user_search_results(bot, chat_id: int, user_info: dict):
+    """Displays user overview with buttons to view detailed sections."""
+    user_id = user_info['user_id']
+    username = user_info['username'] or f"ID_{user_id}"
+    balance = Decimal(str(user_info['balance']))
+    total_purchases = user_info['total_purchases']
+    is_banned = user_info['is_banned'] == 1
+    is_reseller = user_info['is_reseller'] == 1
+    
+    # Get user status and progress
+    status = get_user_status(total_purchases)
+    progress_bar = get_progress_bar(total_purchases)
+    
+    try:
+        total_purchases_count, pending_deposits_count, admin_actions_count, total_spent = await run_db(_fetch_user_overview_counts, user_id)
     except sqlite3.Error as e:
         logger.error(f"DB error fetching user overview for {user_id}: {e}", exc_info=True)
         await send_message_with_retry(bot, chat_id, "❌ Error fetching user details.", parse_mode=None)
         return
-    finally:
-        if conn: 
-            conn.close()
     
     # Build overview message
     banned_str = "Yes 🚫" if is_banned else "No ✅"
@@ -4493,6 +4201,7 @@ async def display_user_search_results(bot, chat_id: int, user_info: dict):
 
 # --- Missing Functions That Were Accidentally Removed ---
 
+@callback_route("adm_bulk_back_to_messages")
 async def handle_adm_bulk_back_to_messages(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Returns to the message collection interface."""
     query = update.callback_query
@@ -4501,6 +4210,7 @@ async def handle_adm_bulk_back_to_messages(update: Update, context: ContextTypes
     context.user_data["state"] = "awaiting_bulk_messages"
     await show_bulk_messages_status(update, context)
 
+@callback_route("adm_bulk_execute_messages")
 async def handle_adm_bulk_execute_messages(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Executes the bulk product creation from collected messages."""
     query = update.callback_query
@@ -4525,140 +4235,62 @@ async def handle_adm_bulk_execute_messages(update: Update, context: ContextTypes
     failed_messages = []  # Track failed messages with details
     successful_products = []  # Track successfully created products
     
-    # Process each message as a separate product
+    # Download the media of every message up front, in parallel, into one staging dir on the media volume
+    staging_dir = None
+    downloaded_media = {}  # {message index: [downloaded items]}
+    download_jobs = []; job_owners = []
     for i, message_data in enumerate(bulk_messages):
-        message_number = i + 1
+        for j, media_item in enumerate(message_data.get("media", [])):
+            download_jobs.append(({"type": media_item["type"], "file_id": media_item["file_id"]}, None, f"msg{i + 1}_media_{j}"))
+            job_owners.append(i)
+    if download_jobs:
+        staging_dir = await asyncio.to_thread(create_media_staging_dir)
+        download_jobs = [(item, staging_dir, name) for item, _, name in download_jobs]
+        for owner, item in zip(job_owners, await download_media_batch(context.bot, download_jobs)):
+            downloaded_media.setdefault(owner, []).append(item)
+    
+    # Insert every message as its own product, all in one transaction (bad rows are rolled back individually)
+    rows = []
+    for i, message_data in enumerate(bulk_messages):
+        media_list = downloaded_media.get(i, [])
+        download_failures = [m for m in media_list if not m["path"]]
+        rows.append({
+            "city": city, "district": district, "product_type": p_type, "size": size, "price": price,
+            "original_text": message_data.get("text", ""), "media": media_list,
+            "error": f"Media download failed: {download_failures[0]['error']}" if download_failures else None
+        })
+    import_result = await run_db(import_products, rows)
+    
+    created_count = len(import_result["created"])
+    successful_products = [{'message_number': p['row'], 'product_id': p['product_id'], 'product_name': p['product_name']}
+                           for p in import_result["created"]]
+    for failure in import_result["failed"]:
+        message_number = failure["row"]
+        message_data = bulk_messages[message_number - 1] if message_number else {}
         text_content = message_data.get("text", "")
-        media_list = message_data.get("media", [])
-        
-        # Create unique product name
-        product_name = f"{p_type} {size} {int(time.time())}_{message_number}"
+        text_preview = text_content[:30] + "..." if len(text_content) > 30 else text_content
+        if not text_preview:
+            text_preview = "(media only)"
         
-        conn = None
-        product_id = None
-        temp_dir = None
+        error_reason = failure["error"]
+        if "Media download failed" in error_reason:
+            error_type = "Media Download Error"
+        elif "database" in error_reason.lower():
+            error_type = "Database Error"
+        else:
+            error_type = "Validation Error"
         
-        try:
-            # Download media if present
-            if media_list:
-                import tempfile
-                temp_dir = await asyncio.to_thread(tempfile.mkdtemp, prefix="bulk_msg_media_")
-                
-                for j, media_item in enumerate(media_list):
-                    try:
-                        file_obj = await context.bot.get_file(media_item["file_id"])
-                        file_extension = os.path.splitext(file_obj.file_path)[1] if file_obj.file_path else ""
-                        if not file_extension:
-                            if media_item["type"] == "photo": file_extension = ".jpg"
-                            elif media_item["type"] == "video": file_extension = ".mp4"
-                            elif media_item["type"] == "gif": file_extension = ".gif"
-                            else: file_extension = ".bin"
-                        
-                        temp_file_path = os.path.join(temp_dir, f"media_{j}_{int(time.time())}{file_extension}")
-                        await file_obj.download_to_drive(temp_file_path)
-                        media_item["path"] = temp_file_path
-                    except Exception as e:
-                        logger.error(f"Error downloading media for bulk message {message_number}: {e}")
-                        raise Exception(f"Media download failed: {str(e)}")
-            
-            # Create product in database
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("BEGIN")
-            
-            insert_params = (
-                city, district, p_type, size, product_name, price, text_content, ADMIN_ID, datetime.now(timezone.utc).isoformat()
-            )
-            
-            c.execute("""INSERT INTO products
-                            (city, district, product_type, size, name, price, available, reserved, original_text, added_by, added_date)
-                         VALUES (?, ?, ?, ?, ?, ?, 1, 0, ?, ?, ?)""", insert_params)
-            product_id = c.lastrowid
-            
-            # Handle media for this product
-            if product_id and media_list and temp_dir:
-                final_media_dir = os.path.join(MEDIA_DIR, str(product_id))
-                await asyncio.to_thread(os.makedirs, final_media_dir, exist_ok=True)
-                media_inserts = []
-                
-                for media_item in media_list:
-                    if "path" in media_item and "type" in media_item and "file_id" in media_item:
-                        temp_file_path = media_item["path"]
-                        if await asyncio.to_thread(os.path.exists, temp_file_path):
-                            # Generate unique filename to prevent conflicts
-                            base_filename = os.path.basename(temp_file_path)
-                            name, ext = os.path.splitext(base_filename)
-                            counter = 1
-                            final_persistent_path = os.path.join(final_media_dir, f"{name}_{counter}{ext}")
-                            
-                            # Ensure unique filename
-                            while await asyncio.to_thread(os.path.exists, final_persistent_path):
-                                counter += 1
-                                final_persistent_path = os.path.join(final_media_dir, f"{name}_{counter}{ext}")
-                            
-                            try:
-                                await asyncio.to_thread(shutil.copy2, temp_file_path, final_persistent_path)
-                                media_inserts.append((product_id, media_item["type"], final_persistent_path, media_item["file_id"]))
-                            except OSError as move_err:
-                                logger.error(f"Error copying media {temp_file_path}: {move_err}")
-                        else:
-                            logger.warning(f"Temp media not found: {temp_file_path}")
-                    else:
-                        logger.warning(f"Incomplete media item: {media_item}")
-                
-                # Insert all media records at once (outside the loop)
-                if media_inserts:
-                    c.executemany("INSERT INTO product_media (product_id, media_type, file_path, telegram_file_id) VALUES (?, ?, ?, ?)", media_inserts)
-                    logger.info(f"Successfully inserted {len(media_inserts)} media records for bulk product {product_id}")
-                else:
-                    logger.warning(f"No media was inserted for product {product_id}. Media list: {media_list}, Temp dir: {temp_dir}")
-            
-            conn.commit()
-            created_count += 1
-            successful_products.append({
-                'message_number': message_number,
-                'product_id': product_id,
-                'product_name': product_name
-            })
-            logger.info(f"Bulk created product {product_id} ({product_name}) from message {message_number}")
-            
-        except Exception as e:
-            # Track detailed failure information
-            text_preview = text_content[:30] + "..." if len(text_content) > 30 else text_content
-            if not text_preview:
-                text_preview = "(media only)"
-            
-            error_reason = str(e)
-            if "Media download failed" in error_reason:
-                error_type = "Media Download Error"
-            elif "Media file" in error_reason:
-                error_type = "Media Processing Error"
-            elif "database" in error_reason.lower():
-                error_type = "Database Error"
-            else:
-                error_type = "Unknown Error"
-            
-            failed_messages.append({
-                'message_number': message_number,
-                'text_preview': text_preview,
-                'error_type': error_type,
-                'error_reason': error_reason,
-                'media_count': len(media_list)
-            })
-            
-            logger.error(f"Error creating bulk product from message {message_number}: {e}", exc_info=True)
-            if conn:
-                try:
-                    conn.rollback()
-                except Exception as rb_err:
-                    logger.error(f"Rollback failed: {rb_err}")
-        finally:
-            if conn:
-                conn.close()
-            
-            # Clean up temp directory for this message
-            if temp_dir and await asyncio.to_thread(os.path.exists, temp_dir):
-                await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True)
+        failed_messages.append({
+            'message_number': message_number or "all",
+            'text_preview': text_preview,
+            'error_type': error_type,
+            'error_reason': error_reason,
+            'media_count': len(message_data.get("media", []))
+        })
+    
+    # Clean up the staging dir (only failed messages' files are left in it)
+    if staging_dir and await asyncio.to_thread(os.path.exists, staging_dir):
+        await asyncio.to_thread(shutil.rmtree, staging_dir, ignore_errors=True)
     
     # Clear bulk data from context
     keys_to_clear = ["bulk_messages", "bulk_admin_city_id", "bulk_admin_district_id", 
@@ -4685,12 +4317,14 @@ async def handle_adm_bulk_execute_messages(update: Update, context: ContextTypes
         result_msg += f"❌ Failed: {failed_count}\n\n"
         result_msg += f"🔍 Failed Messages Details:\n"
         
-        for failure in failed_messages:
+        for failure in failed_messages[:BULK_REPORT_MAX_FAILURES]:
             result_msg += f"• Message #{failure['message_number']}: {failure['text_preview']}\n"
             result_msg += f"  Error: {failure['error_type']}\n"
             if failure['media_count'] > 0:
                 result_msg += f"  Media: {failure['media_count']} files\n"
             result_msg += f"  Reason: {failure['error_reason'][:50]}...\n\n"
+        if failed_count > BULK_REPORT_MAX_FAILURES:
+            result_msg += f"... and {failed_count - BULK_REPORT_MAX_FAILURES} more\n\n"
         
         result_msg += f"💡 You can retry the failed messages by:\n"
         result_msg += f"1. Starting a new bulk operation\n"
@@ -4719,13 +4353,16 @@ async def handle_adm_bulk_execute_messages(update: Update, context: ContextTypes
     # If there are failures, send a separate detailed failure message for better readability
     if failed_count > 0:
         failure_detail_msg = f"🚨 Detailed Failure Report:\n\n"
-        for failure in failed_messages:
+        for failure in failed_messages[:BULK_REPORT_MAX_FAILURES]:
             failure_detail_msg += f"📝 Message #{failure['message_number']}:\n"
             failure_detail_msg += f"   Text: {failure['text_preview']}\n"
             failure_detail_msg += f"   Media Files: {failure['media_count']}\n"
             failure_detail_msg += f"   Error Type: {failure['error_type']}\n"
-            failure_detail_msg += f"   Full Error: {failure['error_reason']}\n"
+            failure_detail_msg += f"   Full Error: {failure['error_reason'][:200]}\n"
             failure_detail_msg += f"   ─────────────────\n"
+        if failed_count > BULK_REPORT_MAX_FAILURES:
+            failed_numbers = ", ".join(str(f['message_number']) for f in failed_messages[BULK_REPORT_MAX_FAILURES:])
+            failure_detail_msg += f"\nAlso failed: #{failed_numbers[:1500]}\n"
         
         failure_detail_msg += f"\n📋 To retry failed messages:\n"
         failure_detail_msg += f"1. Copy the message numbers that failed\n"
@@ -4735,6 +4372,7 @@ async def handle_adm_bulk_execute_messages(update: Update, context: ContextTypes
         await send_message_with_retry(context.bot, chat_id, failure_detail_msg, parse_mode=None)
 
 # Product type message handlers
+@state_route("awaiting_new_type_name")
 async def handle_adm_new_type_name_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles new product type name input."""
     if not is_primary_admin(update.effective_user.id): return
@@ -4747,7 +4385,7 @@ async def handle_adm_new_type_name_message(update: Update, context: ContextTypes
         return
     
     # Check if type already exists
-    load_all_data()
+    await run_db(load_all_data)
     if type_name in PRODUCT_TYPES:
         await send_message_with_retry(context.bot, update.effective_chat.id, 
             f"❌ Product type '{type_name}' already exists. Please choose a different name.", parse_mode=None)
@@ -4763,6 +4401,7 @@ async def handle_adm_new_type_name_message(update: Update, context: ContextTypes
         "✍️ Please reply with a single emoji for this product type:", 
         reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@state_route("awaiting_new_type_emoji")
 async def handle_adm_new_type_emoji_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles new product type emoji input."""
     if not is_primary_admin(update.effective_user.id): return
@@ -4791,6 +4430,7 @@ async def handle_adm_new_type_emoji_message(update: Update, context: ContextType
         "📝 Please reply with a description for this product type (or send 'skip' to leave empty):", 
         reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@state_route("awaiting_new_type_description")
 async def handle_adm_new_type_description_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles new product type description input and creates the type."""
     if not is_primary_admin(update.effective_user.id): return
@@ -4814,22 +4454,18 @@ async def handle_adm_new_type_description_message(update: Update, context: Conte
         return
     
     # Save to database
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("INSERT INTO product_types (name, emoji, description) VALUES (?, ?, ?)", 
-                  (type_name, emoji, description))
-        conn.commit()
-        load_all_data()  # Reload data
+        await db_execute("INSERT INTO product_types (name, emoji, description) VALUES (?, ?, ?)", 
+                         (type_name, emoji, description))
+        await run_db(load_all_data)  # Reload data
         
         context.user_data.pop("state", None)
         context.user_data.pop("new_type_name", None)
         context.user_data.pop("new_type_emoji", None)
         
-        log_admin_action(admin_id=update.effective_user.id, action="PRODUCT_TYPE_ADD", 
-                        reason=f"Added type '{type_name}' with emoji '{emoji}'", 
-                        new_value=type_name)
+        await run_db(log_admin_action, admin_id=update.effective_user.id, action="PRODUCT_TYPE_ADD", 
+                     reason=f"Added type '{type_name}' with emoji '{emoji}'", 
+                     new_value=type_name)
         
         # Create the manage types keyboard to show the updated list
         keyboard = []
@@ -4856,9 +4492,8 @@ async def handle_adm_new_type_description_message(update: Update, context: Conte
         await send_message_with_retry(context.bot, update.effective_chat.id, 
             "❌ Database error creating product type. Please try again.", parse_mode=None)
         context.user_data.pop("state", None)
-    finally:
-        if conn: conn.close()
 
+@state_route("awaiting_edit_type_emoji")
 async def handle_adm_edit_type_emoji_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles editing product type emoji input."""
     if not is_primary_admin(update.effective_user.id): return
@@ -4884,27 +4519,22 @@ async def handle_adm_edit_type_emoji_message(update: Update, context: ContextTyp
         return
     
     # Update emoji in database
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("UPDATE product_types SET emoji = ? WHERE name = ?", (emoji, type_name))
+        updated = await db_execute("UPDATE product_types SET emoji = ? WHERE name = ?", (emoji, type_name))
         
-        if c.rowcount > 0:
-            conn.commit()
-            load_all_data()  # Reload data
+        if updated > 0:
+            await run_db(load_all_data)  # Reload data
             
             context.user_data.pop("state", None)
             context.user_data.pop("edit_type_name", None)
             
-            log_admin_action(admin_id=update.effective_user.id, action="PRODUCT_TYPE_EDIT", 
-                            reason=f"Changed emoji for type '{type_name}' to '{emoji}'", 
-                            old_value=type_name, new_value=f"{emoji} {type_name}")
+            await run_db(log_admin_action, admin_id=update.effective_user.id, action="PRODUCT_TYPE_EDIT", 
+                         reason=f"Changed emoji for type '{type_name}' to '{emoji}'", 
+                         old_value=type_name, new_value=f"{emoji} {type_name}")
             
             # Show updated type info
             current_description = ""
-            c.execute("SELECT description FROM product_types WHERE name = ?", (type_name,))
-            res = c.fetchone()
+            res = await db_fetchone("SELECT description FROM product_types WHERE name = ?", (type_name,))
             if res: current_description = res['description'] or "(Description not set)"
             
             keyboard = [
@@ -4930,10 +4560,9 @@ async def handle_adm_edit_type_emoji_message(update: Update, context: ContextTyp
         await send_message_with_retry(context.bot, update.effective_chat.id, 
             "❌ Database error updating emoji. Please try again.", parse_mode=None)
         context.user_data.pop("state", None)
-    finally:
-        if conn: conn.close()
 
 # User search handlers
+@callback_route("adm_search_user_start")
 async def handle_adm_search_user_start(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Starts the user search process by prompting for username."""
     query = update.callback_query
@@ -4955,6 +4584,7 @@ async def handle_adm_search_user_start(update: Update, context: ContextTypes.DEF
     await query.edit_message_text(prompt_msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
     await query.answer("Enter username or User ID in chat.")
 
+@state_route("awaiting_search_username")
 async def handle_adm_search_username_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles the admin entering a username or User ID for search."""
     admin_id = update.effective_user.id
@@ -4977,7 +4607,6 @@ async def handle_adm_search_username_message(update: Update, context: ContextTyp
     context.user_data.pop('state', None)
     
     # Try to find user by username or user ID
-    conn = None
     user_info = None
     search_by_id = False
     
@@ -4989,25 +4618,17 @@ async def handle_adm_search_username_message(update: Update, context: ContextTyp
         except ValueError:
             search_by_id = False
         
-        conn = get_db_connection()
-        c = conn.cursor()
-        
         if search_by_id:
             # Search by User ID
-            c.execute("SELECT user_id, username, balance, total_purchases, is_banned, is_reseller FROM users WHERE user_id = ?", (user_id_search,))
+            user_info = await db_fetchone("SELECT user_id, username, balance, total_purchases, is_banned, is_reseller FROM users WHERE user_id = ?", (user_id_search,))
         else:
             # Search by username (case insensitive)
-            c.execute("SELECT user_id, username, balance, total_purchases, is_banned, is_reseller FROM users WHERE LOWER(username) = LOWER(?)", (search_term,))
-        
-        user_info = c.fetchone()
+            user_info = await db_fetchone("SELECT user_id, username, balance, total_purchases, is_banned, is_reseller FROM users WHERE LOWER(username) = LOWER(?)", (search_term,))
         
     except sqlite3.Error as e:
         logger.error(f"DB error searching for user '{search_term}': {e}")
         await send_message_with_retry(context.bot, chat_id, "❌ Database error during search.", parse_mode=None)
         return
-    finally:
-        if conn: 
-            conn.close()
     
     if not user_info:
         search_type = "User ID" if search_by_id else "username"
@@ -5035,6 +4656,7 @@ async def handle_adm_search_username_message(update: Update, context: ContextTyp
     await display_user_search_results(context.bot, chat_id, user_info)
 
 # Detailed User Information Handlers
+@callback_route("adm_user_deposits")
 async def handle_adm_user_deposits(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Shows detailed pending deposits for a user."""
     query = update.callback_query
@@ -5046,35 +4668,26 @@ async def handle_adm_user_deposits(update: Update, context: ContextTypes.DEFAULT
     
     user_id = int(params[0])
     
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
         # Get user info
-        c.execute("SELECT username FROM users WHERE user_id = ?", (user_id,))
-        user_result = c.fetchone()
+        user_result = await db_fetchone("SELECT username FROM users WHERE user_id = ?", (user_id,))
         if not user_result:
             return await query.answer("User not found.", show_alert=True)
         
         username = user_result['username'] or f"ID_{user_id}"
         
         # Get all pending deposits
-        c.execute("""
+        deposits = await db_fetchall("""
             SELECT payment_id, currency, target_eur_amount, expected_crypto_amount, created_at, is_purchase
             FROM pending_deposits 
             WHERE user_id = ? 
             ORDER BY created_at DESC
         """, (user_id,))
-        deposits = c.fetchall()
         
     except sqlite3.Error as e:
         logger.error(f"DB error fetching deposits for user {user_id}: {e}", exc_info=True)
         await query.answer("Database error.", show_alert=True)
         return
-    finally:
-        if conn: 
-            conn.close()
     
     msg = f"⏳ Pending Deposits - @{username}\n\n"
     
@@ -5108,6 +4721,7 @@ async def handle_adm_user_deposits(update: Update, context: ContextTypes.DEFAULT
     
     await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("adm_user_purchases")
 async def handle_adm_user_purchases(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Shows paginated purchase history for a user."""
     query = update.callback_query
@@ -5121,40 +4735,30 @@ async def handle_adm_user_purchases(update: Update, context: ContextTypes.DEFAUL
     offset = int(params[1])
     limit = 10
     
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
         # Get user info
-        c.execute("SELECT username FROM users WHERE user_id = ?", (user_id,))
-        user_result = c.fetchone()
+        user_result = await db_fetchone("SELECT username FROM users WHERE user_id = ?", (user_id,))
         if not user_result:
             return await query.answer("User not found.", show_alert=True)
         
         username = user_result['username'] or f"ID_{user_id}"
         
         # Get total count
-        c.execute("SELECT COUNT(*) as count FROM purchases WHERE user_id = ?", (user_id,))
-        total_count = c.fetchone()['count']
+        total_count = (await db_fetchone("SELECT COUNT(*) as count FROM purchases WHERE user_id = ?", (user_id,)))['count']
         
         # Get purchases for this page
-        c.execute("""
+        purchases = await db_fetchall("""
             SELECT purchase_date, product_name, product_type, product_size, price_paid, city, district
             FROM purchases 
             WHERE user_id = ? 
             ORDER BY purchase_date DESC 
             LIMIT ? OFFSET ?
         """, (user_id, limit, offset))
-        purchases = c.fetchall()
         
     except sqlite3.Error as e:
         logger.error(f"DB error fetching purchases for user {user_id}: {e}", exc_info=True)
         await query.answer("Database error.", show_alert=True)
         return
-    finally:
-        if conn: 
-            conn.close()
     
     current_page = (offset // limit) + 1
     total_pages = math.ceil(total_count / limit) if total_count > 0 else 1
@@ -5202,6 +4806,7 @@ async def handle_adm_user_purchases(update: Update, context: ContextTypes.DEFAUL
     
     await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("adm_user_actions")
 async def handle_adm_user_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Shows paginated admin actions for a user."""
     query = update.callback_query
@@ -5215,40 +4820,30 @@ async def handle_adm_user_actions(update: Update, context: ContextTypes.DEFAULT_
     offset = int(params[1])
     limit = 10
     
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
         # Get user info
-        c.execute("SELECT username FROM users WHERE user_id = ?", (user_id,))
-        user_result = c.fetchone()
+        user_result = await db_fetchone("SELECT username FROM users WHERE user_id = ?", (user_id,))
         if not user_result:
             return await query.answer("User not found.", show_alert=True)
         
         username = user_result['username'] or f"ID_{user_id}"
         
         # Get total count
-        c.execute("SELECT COUNT(*) as count FROM admin_log WHERE target_user_id = ?", (user_id,))
-        total_count = c.fetchone()['count']
+        total_count = (await db_fetchone("SELECT COUNT(*) as count FROM admin_log WHERE target_user_id = ?", (user_id,)))['count']
         
         # Get actions for this page
-        c.execute("""
+        actions = await db_fetchall("""
             SELECT timestamp, action, reason, amount_change, old_value, new_value
             FROM admin_log 
             WHERE target_user_id = ? 
             ORDER BY timestamp DESC 
             LIMIT ? OFFSET ?
         """, (user_id, limit, offset))
-        actions = c.fetchall()
         
     except sqlite3.Error as e:
         logger.error(f"DB error fetching admin actions for user {user_id}: {e}", exc_info=True)
         await query.answer("Database error.", show_alert=True)
         return
-    finally:
-        if conn: 
-            conn.close()
     
     current_page = (offset // limit) + 1
     total_pages = math.ceil(total_count / limit) if total_count > 0 else 1
@@ -5295,6 +4890,7 @@ async def handle_adm_user_actions(update: Update, context: ContextTypes.DEFAULT_
     
     await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("adm_user_discounts")
 async def handle_adm_user_discounts(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Shows reseller discounts for a user."""
     query = update.callback_query
@@ -5306,14 +4902,9 @@ async def handle_adm_user_discounts(update: Update, context: ContextTypes.DEFAUL
     
     user_id = int(params[0])
     
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
         # Get user info
-        c.execute("SELECT username, is_reseller FROM users WHERE user_id = ?", (user_id,))
-        user_result = c.fetchone()
+        user_result = await db_fetchone("SELECT username, is_reseller FROM users WHERE user_id = ?", (user_id,))
         if not user_result:
             return await query.answer("User not found.", show_alert=True)
         
@@ -5324,21 +4915,17 @@ async def handle_adm_user_discounts(update: Update, context: ContextTypes.DEFAUL
             return await query.answer("User is not a reseller.", show_alert=True)
         
         # Get reseller discounts
-        c.execute("""
+        discounts = await db_fetchall("""
             SELECT product_type, discount_percentage 
             FROM reseller_discounts 
             WHERE reseller_user_id = ? 
             ORDER BY product_type
         """, (user_id,))
-        discounts = c.fetchall()
         
     except sqlite3.Error as e:
         logger.error(f"DB error fetching discounts for user {user_id}: {e}", exc_info=True)
         await query.answer("Database error.", show_alert=True)
         return
-    finally:
-        if conn:
-            conn.close()
         
     msg = f"🏷️ Reseller Discounts - @{username}\n\n"
     
@@ -5358,6 +4945,7 @@ async def handle_adm_user_discounts(update: Update, context: ContextTypes.DEFAUL
     
     await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("adm_user_overview")
 async def handle_adm_user_overview(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Returns to user overview from detailed sections."""
     query = update.callback_query
@@ -5370,12 +4958,8 @@ async def handle_adm_user_overview(update: Update, context: ContextTypes.DEFAULT
     user_id = int(params[0])
     
     # Get user info and redisplay overview
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT user_id, username, balance, total_purchases, is_banned, is_reseller FROM users WHERE user_id = ?", (user_id,))
-        user_info = c.fetchone()
+        user_info = await db_fetchone("SELECT user_id, username, balance, total_purchases, is_banned, is_reseller FROM users WHERE user_id = ?", (user_id,))
         
         if not user_info:
             return await query.answer("User not found.", show_alert=True)
@@ -5384,9 +4968,6 @@ async def handle_adm_user_overview(update: Update, context: ContextTypes.DEFAULT
         logger.error(f"DB error fetching user info for overview {user_id}: {e}", exc_info=True)
         await query.answer("Database error.", show_alert=True)
         return
-    finally:
-        if conn: 
-            conn.close()
     
     # Redisplay the overview
     await display_user_search_results(context.bot, query.message.chat_id, dict(user_info))
@@ -5394,6 +4975,7 @@ async def handle_adm_user_overview(update: Update, context: ContextTypes.DEFAULT
 
 # --- Welcome Message Management Handlers ---
 
+@callback_route("adm_manage_welcome")
 async def handle_adm_manage_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Displays the paginated menu for managing welcome message templates."""
     query = update.callback_query
@@ -5406,22 +4988,16 @@ async def handle_adm_manage_welcome(update: Update, context: ContextTypes.DEFAUL
         offset = int(params[0])
 
     # Fetch templates and active template name
-    templates = get_welcome_message_templates(limit=TEMPLATES_PER_PAGE, offset=offset)
-    total_templates = get_welcome_message_template_count()
-    conn = None
+    templates = await run_db(get_welcome_message_templates, limit=TEMPLATES_PER_PAGE, offset=offset)
+    total_templates = await run_db(get_welcome_message_template_count)
     active_template_name = "default" # Default fallback
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
         # Use column name
-        c.execute("SELECT setting_value FROM bot_settings WHERE setting_key = ?", ("active_welcome_message_name",))
-        setting_row = c.fetchone()
+        setting_row = await db_fetchone("SELECT setting_value FROM bot_settings WHERE setting_key = ?", ("active_welcome_message_name",))
         if setting_row and setting_row['setting_value']: # Check if value is not None/empty
             active_template_name = setting_row['setting_value'] # Use column name
     except sqlite3.Error as e:
         logger.error(f"DB error fetching active welcome template name: {e}")
-    finally:
-        if conn: conn.close()
 
     # Build message and keyboard
     title = lang_data.get("manage_welcome_title", "⚙️ Manage Welcome Messages")
@@ -5483,6 +5059,7 @@ async def handle_adm_manage_welcome(update: Update, context: ContextTypes.DEFAUL
         logger.error(f"Unexpected error in handle_adm_manage_welcome: {e}", exc_info=True)
         await query.answer("An error occurred displaying the menu.", show_alert=True)
 
+@callback_route("adm_activate_welcome")
 async def handle_adm_activate_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Activates the selected welcome message template."""
     query = update.callback_query
@@ -5494,7 +5071,7 @@ async def handle_adm_activate_welcome(update: Update, context: ContextTypes.DEFA
     offset = int(params[1])
     lang, lang_data = _get_lang_data(context) # Use helper
 
-    success = set_active_welcome_message(template_name) # Use helper from utils
+    success = await run_db(set_active_welcome_message, template_name)
     if success:
         msg_template = lang_data.get("welcome_activate_success", "✅ Template '{name}' activated.")
         await query.answer(msg_template.format(name=template_name))
@@ -5503,6 +5080,7 @@ async def handle_adm_activate_welcome(update: Update, context: ContextTypes.DEFA
         msg_template = lang_data.get("welcome_activate_fail", "❌ Failed to activate template '{name}'.")
         await query.answer(msg_template.format(name=template_name), show_alert=True)
 
+@callback_route("adm_add_welcome_start")
 async def handle_adm_add_welcome_start(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Starts the process of adding a new welcome template (gets name)."""
     query = update.callback_query
@@ -5515,6 +5093,7 @@ async def handle_adm_add_welcome_start(update: Update, context: ContextTypes.DEF
     await query.edit_message_text(prompt, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
     await query.answer("Enter template name in chat.")
 
+@callback_route("adm_edit_welcome")
 async def handle_adm_edit_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Shows options for editing an existing welcome template (text or description)."""
     query = update.callback_query
@@ -5529,12 +5108,8 @@ async def handle_adm_edit_welcome(update: Update, context: ContextTypes.DEFAULT_
     # Fetch current text and description
     current_text = ""
     current_description = ""
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT template_text, description FROM welcome_messages WHERE name = ?", (template_name,))
-        row = c.fetchone()
+        row = await db_fetchone("SELECT template_text, description FROM welcome_messages WHERE name = ?", (template_name,))
         if not row:
              await query.answer("Template not found.", show_alert=True)
              return await handle_adm_manage_welcome(update, context, params=[str(offset)])
@@ -5544,8 +5119,6 @@ async def handle_adm_edit_welcome(update: Update, context: ContextTypes.DEFAULT_
         logger.error(f"DB error fetching template '{template_name}' for edit options: {e}")
         await query.answer("Error fetching template details.", show_alert=True)
         return await handle_adm_manage_welcome(update, context, params=[str(offset)])
-    finally:
-        if conn: conn.close()
 
     # Store info needed for potential edits
     context.user_data['editing_welcome_template_name'] = template_name
@@ -5573,6 +5146,7 @@ async def handle_adm_edit_welcome(update: Update, context: ContextTypes.DEFAULT_
         logger.error(f"Unexpected error in handle_adm_edit_welcome: {e}")
         await query.answer("Error displaying edit menu.", show_alert=True)
 
+@callback_route("adm_edit_welcome_text")
 async def handle_adm_edit_welcome_text(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Initiates editing the template text."""
     query = update.callback_query
@@ -5585,16 +5159,10 @@ async def handle_adm_edit_welcome_text(update: Update, context: ContextTypes.DEF
 
     # Fetch current text to show in prompt
     current_text = ""
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT template_text FROM welcome_messages WHERE name = ?", (template_name,))
-        row = c.fetchone()
+        row = await db_fetchone("SELECT template_text FROM welcome_messages WHERE name = ?", (template_name,))
         if row: current_text = row['template_text']
     except sqlite3.Error as e: logger.error(f"DB error fetching text for edit: {e}")
-    finally:
-         if conn: conn.close()
 
     context.user_data['state'] = 'awaiting_welcome_template_edit' # Reusing state, but specifically for text
     context.user_data['editing_welcome_template_name'] = template_name # Ensure it's set
@@ -5619,6 +5187,7 @@ async def handle_adm_edit_welcome_text(update: Update, context: ContextTypes.DEF
         else: await query.answer()
     await query.answer("Enter new template text.")
 
+@callback_route("adm_edit_welcome_desc")
 async def handle_adm_edit_welcome_desc(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Initiates editing the template description."""
     query = update.callback_query
@@ -5631,14 +5200,10 @@ async def handle_adm_edit_welcome_desc(update: Update, context: ContextTypes.DEF
 
     # Fetch current description
     current_desc = ""
-    conn = None
     try:
-        conn = get_db_connection(); c = conn.cursor()
-        c.execute("SELECT description FROM welcome_messages WHERE name = ?", (template_name,))
-        row = c.fetchone(); current_desc = row['description'] or ""
+        row = await db_fetchone("SELECT description FROM welcome_messages WHERE name = ?", (template_name,))
+        current_desc = row['description'] or ""
     except sqlite3.Error as e: logger.error(f"DB error fetching desc for edit: {e}")
-    finally:
-        if conn: conn.close()
 
     context.user_data['state'] = 'awaiting_welcome_description_edit' # New state for description edit
     context.user_data['editing_welcome_template_name'] = template_name # Ensure it's set
@@ -5651,6 +5216,7 @@ async def handle_adm_edit_welcome_desc(update: Update, context: ContextTypes.DEF
     await query.edit_message_text(prompt, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
     await query.answer("Enter new description.")
 
+@callback_route("adm_delete_welcome_confirm")
 async def handle_adm_delete_welcome_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Confirms deletion of a welcome message template."""
     query = update.callback_query
@@ -5663,16 +5229,11 @@ async def handle_adm_delete_welcome_confirm(update: Update, context: ContextType
     lang, lang_data = _get_lang_data(context) # Use helper
 
     # Fetch current active template
-    conn = None
     active_template_name = "default"
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT setting_value FROM bot_settings WHERE setting_key = ?", ("active_welcome_message_name",))
-        row = c.fetchone(); active_template_name = row['setting_value'] if row else "default" # Use column name
+        row = await db_fetchone("SELECT setting_value FROM bot_settings WHERE setting_key = ?", ("active_welcome_message_name",))
+        active_template_name = row['setting_value'] if row else "default" # Use column name
     except sqlite3.Error as e: logger.error(f"DB error checking template status for delete: {e}")
-    finally:
-         if conn: conn.close()
 
     if template_name == "default":
         await query.answer("Cannot delete the 'default' template.", show_alert=True)
@@ -5695,6 +5256,7 @@ async def handle_adm_delete_welcome_confirm(update: Update, context: ContextType
     ]
     await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("adm_reset_default_confirm")
 async def handle_reset_default_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Confirms resetting the 'default' template to the built-in text and activating it."""
     query = update.callback_query
@@ -5712,6 +5274,7 @@ async def handle_reset_default_welcome(update: Update, context: ContextTypes.DEF
     ]
     await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+@callback_route("confirm_save_welcome")
 async def handle_confirm_save_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles the 'Save Template' button after preview."""
     query = update.callback_query
@@ -5739,10 +5302,10 @@ async def handle_confirm_save_welcome(update: Update, context: ContextTypes.DEFA
     # Perform the actual save operation
     success = False
     if is_editing:
-        success = update_welcome_message_template(template_name, template_text, template_description)
+        success = await run_db(update_welcome_message_template, template_name, template_text, template_description)
         msg_template = lang_data.get("welcome_edit_success", "✅ Template '{name}' updated.") if success else lang_data.get("welcome_edit_fail", "❌ Failed to update template '{name}'.")
     else:
-        success = add_welcome_message_template(template_name, template_text, template_description)
+        success = await run_db(add_welcome_message_template, template_name, template_text, template_description)
         msg_template = lang_data.get("welcome_add_success", "✅ Welcome message template '{name}' added.") if success else lang_data.get("welcome_add_fail", "❌ Failed to add welcome message template.")
 
     # Clean up context
@@ -5799,6 +5362,7 @@ def set_active_welcome_message(template_name):
         c.execute("INSERT OR REPLACE INTO bot_settings (setting_key, setting_value) VALUES (?, ?)",
                   ("active_welcome_message_name", template_name))
         conn.commit()
+        invalidate_welcome_template_cache()
         return True
     except sqlite3.Error as e:
         logger.error(f"DB error setting active welcome template: {e}")
@@ -5815,6 +5379,7 @@ def add_welcome_message_template(name, text, description=None):
         c.execute("INSERT INTO welcome_messages (name, template_text, description) VALUES (?, ?, ?)",
                   (name, text, description))
         conn.commit()
+        invalidate_welcome_template_cache()
         return True
     except sqlite3.Error as e:
         logger.error(f"DB error adding welcome template: {e}")
@@ -5831,6 +5396,7 @@ def update_welcome_message_template(name, text, description=None):
         c.execute("UPDATE welcome_messages SET template_text = ?, description = ? WHERE name = ?",
                   (text, description, name))
         conn.commit()
+        invalidate_welcome_template_cache()
         return c.rowcount > 0
     except sqlite3.Error as e:
         logger.error(f"DB error updating welcome template: {e}")
@@ -5842,6 +5408,7 @@ def update_welcome_message_template(name, text, description=None):
 TEMPLATES_PER_PAGE = 5
 
 
+@callback_route("adm_debug_reseller_discount")
 async def handle_adm_debug_reseller_discount(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Debug reseller discount system for a specific user."""
     query = update.callback_query
@@ -5855,18 +5422,13 @@ async def handle_adm_debug_reseller_discount(update: Update, context: ContextTyp
     
     # Import the reseller discount function
     try:
-        from reseller_management import get_reseller_discount
+        from reseller_management import RESELLER_PRICING
     except ImportError:
         return await query.answer("Reseller system not available.", show_alert=True)
     
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
         # Get user info
-        c.execute("SELECT username, is_reseller FROM users WHERE user_id = ?", (user_id,))
-        user_result = c.fetchone()
+        user_result = await db_fetchone("SELECT username, is_reseller FROM users WHERE user_id = ?", (user_id,))
         if not user_result:
             return await query.answer("User not found.", show_alert=True)
         
@@ -5881,8 +5443,7 @@ async def handle_adm_debug_reseller_discount(update: Update, context: ContextTyp
         
         if is_reseller == 1:
             # Get all discount records
-            c.execute("SELECT product_type, discount_percentage FROM reseller_discounts WHERE reseller_user_id = ? ORDER BY product_type", (user_id,))
-            discount_records = c.fetchall()
+            discount_records = await db_fetchall("SELECT product_type, discount_percentage FROM reseller_discounts WHERE reseller_user_id = ? ORDER BY product_type", (user_id,))
             
             msg += f"Discount Records ({len(discount_records)}):\n"
             if discount_records:
@@ -5893,9 +5454,11 @@ async def handle_adm_debug_reseller_discount(update: Update, context: ContextTyp
                 msg += "• No discount records found\n"
             
             msg += "\nLive Discount Check:\n"
-            # Test discount lookup for each product type
+            # Test discount lookup for each product type against a freshly loaded map
+            RESELLER_PRICING.invalidate(user_id)
+            discount_map = await RESELLER_PRICING.get_discount_map_async(user_id)
             for product_type in PRODUCT_TYPES.keys():
-                discount = get_reseller_discount(user_id, product_type)
+                discount = discount_map.get(product_type, Decimal('0.0'))
                 emoji = PRODUCT_TYPES.get(product_type, '📦')
                 msg += f"• {emoji} {product_type}: {discount}%\n"
         else:
@@ -5906,9 +5469,6 @@ async def handle_adm_debug_reseller_discount(update: Update, context: ContextTyp
         logger.error(f"Error in reseller debug for user {user_id}: {e}", exc_info=True)
         await query.answer("Error occurred during debug.", show_alert=True)
         return
-    finally:
-        if conn:
-            conn.close()
     
     keyboard = [
         [InlineKeyboardButton("⬅️ Back to User", callback_data=f"adm_user_overview|{user_id}")],
@@ -5920,6 +5480,7 @@ async def handle_adm_debug_reseller_discount(update: Update, context: ContextTyp
 
 
 
+@callback_route("adm_recent_purchases")
 async def handle_adm_recent_purchases(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Shows real-time monitoring of recent purchases with detailed information."""
     query = update.callback_query
@@ -5932,18 +5493,13 @@ async def handle_adm_recent_purchases(update: Update, context: ContextTypes.DEFA
         offset = int(params[0])
     
     purchases_per_page = 25
-    conn = None
     
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
         # Get total count of purchases
-        c.execute("SELECT COUNT(*) as count FROM purchases")
-        total_purchases = c.fetchone()['count']
+        total_purchases = (await db_fetchone("SELECT COUNT(*) as count FROM purchases"))['count']
         
         # Get recent purchases with user and product details
-        c.execute("""
+        recent_purchases = await db_fetchall("""
             SELECT 
                 p.id,
                 p.user_id,
@@ -5960,15 +5516,10 @@ async def handle_adm_recent_purchases(update: Update, context: ContextTypes.DEFA
             LIMIT ? OFFSET ?
         """, (purchases_per_page, offset))
         
-        recent_purchases = c.fetchall()
-        
     except sqlite3.Error as e:
         logger.error(f"DB error fetching recent purchases: {e}", exc_info=True)
         await query.edit_message_text("❌ Database error fetching purchases.", parse_mode=None)
         return
-    finally:
-        if conn:
-            conn.close()
     
     # Build the message
     msg = f"📊 Real-Time Purchase Monitor\n\n"
@@ -6053,6 +5604,7 @@ async def handle_adm_recent_purchases(update: Update, context: ContextTypes.DEFA
         await query.edit_message_text("❌ Error displaying purchases.", parse_mode=None)
 
 # --- Manual Payment Recovery System ---
+@callback_route("manual_payment_recovery")
 async def handle_manual_payment_recovery(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Manual payment recovery for failed payments"""
     query = update.callback_query
@@ -6073,6 +5625,7 @@ async def handle_manual_payment_recovery(update: Update, context: ContextTypes.D
     await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
     await query.answer("Enter Payment ID in chat.")
 
+@state_route("awaiting_payment_recovery_id")
 async def handle_payment_recovery_id_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle payment ID input for recovery"""
     admin_id = update.effective_user.id
@@ -6096,7 +5649,7 @@ async def handle_payment_recovery_id_message(update: Update, context: ContextTyp
         import payment
         
         # Get pending deposit info
-        pending_info = await asyncio.to_thread(get_pending_deposit, payment_id)
+        pending_info = await run_db(get_pending_deposit, payment_id)
         
         if not pending_info:
             await send_message_with_retry(context.bot, chat_id, f"❌ No pending deposit found for payment ID: {payment_id}", parse_mode=None)
@@ -6135,17 +5688,16 @@ async def handle_payment_recovery_id_message(update: Update, context: ContextTyp
         
         # Check if products are still available before attempting recovery
         logger.info(f"Checking product availability for payment {payment_id}...")
-        conn = None
         unavailable_products = []
         try:
-            conn = get_db_connection()
-            c = conn.cursor()
+            product_ids = [item['product_id'] for item in basket_snapshot]
+            placeholders = ','.join('?' * len(product_ids))
+            rows = await db_fetchall(f"SELECT id, available, reserved FROM products WHERE id IN ({placeholders})", tuple(product_ids))
+            stock_by_id = {str(row['id']): row for row in rows}
             
             # Check each product in the basket snapshot
-            for item in basket_snapshot:
-                product_id = item['product_id']
-                c.execute("SELECT available, reserved FROM products WHERE id = ?", (product_id,))
-                product_data = c.fetchone()
+            for product_id in product_ids:
+                product_data = stock_by_id.get(str(product_id))
                 
                 if not product_data:
                     unavailable_products.append(f"Product ID {product_id} (no longer exists)")
@@ -6156,9 +5708,6 @@ async def handle_payment_recovery_id_message(update: Update, context: ContextTyp
             logger.error(f"Error checking product availability: {e}")
             await send_message_with_retry(context.bot, chat_id, f"❌ Error checking product availability: {str(e)}", parse_mode=None)
             return
-        finally:
-            if conn:
-                conn.close()
         
         # If some products are unavailable, ask admin what to do
         if unavailable_products:
@@ -6199,7 +5748,7 @@ async def handle_payment_recovery_id_message(update: Update, context: ContextTyp
         if success:
             await send_message_with_retry(context.bot, chat_id, f"✅ Successfully recovered payment {payment_id} for user {user_id}", parse_mode=None)
             # Remove pending deposit
-            await asyncio.to_thread(remove_pending_deposit, payment_id, trigger="manual_recovery")
+            await run_db(remove_pending_deposit, payment_id, trigger="manual_recovery")
         else:
             await send_message_with_retry(context.bot, chat_id, f"❌ Failed to recover payment {payment_id}. Check logs for details.", parse_mode=None)
             
@@ -6207,6 +5756,7 @@ async def handle_payment_recovery_id_message(update: Update, context: ContextTyp
         logger.error(f"Error in manual payment recovery: {e}", exc_info=True)
         await send_message_with_retry(context.bot, chat_id, f"❌ Error during recovery: {str(e)}", parse_mode=None)
 
+@state_route("awaiting_recovery_decision")
 async def handle_recovery_decision_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle admin's decision for payment recovery when products are unavailable"""
     admin_id = update.effective_user.id
@@ -6273,7 +5823,7 @@ async def handle_recovery_decision_message(update: Update, context: ContextTypes
                     f"✅ Successfully recovered payment {payment_id} for user {user_id} (available products only)", 
                     parse_mode=None)
                 # Remove pending deposit
-                await asyncio.to_thread(remove_pending_deposit, payment_id, trigger="manual_recovery_partial")
+                await run_db(remove_pending_deposit, payment_id, trigger="manual_recovery_partial")
             else:
                 await send_message_with_retry(context.bot, chat_id, 
                     f"❌ Failed to recover payment {payment_id}. Check logs for details.", 
@@ -6286,7 +5836,7 @@ async def handle_recovery_decision_message(update: Update, context: ContextTypes
                 parse_mode=None)
             
             # Remove pending deposit without processing
-            await asyncio.to_thread(remove_pending_deposit, payment_id, trigger="manual_recovery_cancelled")
+            await run_db(remove_pending_deposit, payment_id, trigger="manual_recovery_cancelled")
         
         elif decision == '3':  # Refund user and cancel recovery
             await send_message_with_retry(context.bot, chat_id, 
@@ -6295,7 +5845,7 @@ async def handle_recovery_decision_message(update: Update, context: ContextTypes
                 parse_mode=None)
             
             # Remove pending deposit
-            await asyncio.to_thread(remove_pending_deposit, payment_id, trigger="manual_recovery_refund")
+            await run_db(remove_pending_deposit, payment_id, trigger="manual_recovery_refund")
             
             # TODO: Implement automatic refund if possible with NOWPayments API
         
@@ -6317,6 +5867,7 @@ async def handle_recovery_decision_message(update: Update, context: ContextTypes
         await send_message_with_retry(context.bot, chat_id, f"❌ Error processing decision: {str(e)}", parse_mode=None)
 
 
+@state_route("awaiting_edit_type_name")
 async def handle_adm_edit_type_name_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles new product type name input for editing existing type."""
     if not is_primary_admin(update.effective_user.id): return
@@ -6335,7 +5886,7 @@ async def handle_adm_edit_type_name_message(update: Update, context: ContextType
         return
     
     # Check if new name already exists
-    load_all_data()
+    await run_db(load_all_data)
     if new_type_name in PRODUCT_TYPES and new_type_name != old_type_name:
         await send_message_with_retry(context.bot, update.effective_chat.id, 
             f"❌ Product type '{new_type_name}' already exists. Please choose a different name.", parse_mode=None)
@@ -6367,26 +5918,13 @@ async def handle_adm_edit_type_name_message(update: Update, context: ContextType
         reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
 
-async def handle_adm_confirm_type_name_change(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
-    """Handles confirmation of type name change."""
-    query = update.callback_query
-    if not is_primary_admin(query.from_user.id): return await query.answer("Access denied.", show_alert=True)
-    
-    old_type_name = context.user_data.get("edit_old_type_name")
-    new_type_name = context.user_data.get("edit_new_type_name")
-    
-    if not old_type_name or not new_type_name:
-        await query.answer("Error: Missing type names.", show_alert=True)
-        return
-    
-    # Update all database references
+def _rename_product_type_db(old_type_name: str, new_type_name: str) -> tuple[int, int]:
+    """Renames a product type and every product/reseller rule using it in one transaction (Synchronous, runs on DB executor). Returns (products_updated, reseller_updated)."""
     conn = None
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        
-        # Start transaction
-        c.execute("BEGIN TRANSACTION")
+        c.execute("BEGIN")
         
         # Update products table
         products_updated = c.execute("UPDATE products SET product_type = ? WHERE product_type = ?", 
@@ -6398,13 +5936,34 @@ async def handle_adm_confirm_type_name_change(update: Update, context: ContextTy
         
         # Update product_types table
         c.execute("UPDATE product_types SET name = ? WHERE name = ?", (new_type_name, old_type_name))
-        
-        # Commit transaction
-        c.execute("COMMIT")
         conn.commit()
+        return products_updated, reseller_updated
+    except Exception:
+        if conn and conn.in_transaction: conn.rollback()
+        raise
+    finally:
+        if conn: conn.close()
+
+@callback_route("adm_confirm_type_name_change")
+async def handle_adm_confirm_type_name_change(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
+    """Handles confirmation of type name change."""
+    query = update.callback_query
+    if not is_primary_admin(query.from_user.id): return await query.answer("Access denied.", show_alert=True)
+    
+    old_type_name = context.user_data.get("edit_old_type_name")
+    new_type_name = context.user_data.get("edit_new_type_name")
+    
+    if not old_type_name or not new_type_name:
+        await query.answer("Error: Missing type names.", show_alert=True)
+        return
+    
+    # Update all database references
+    try:
+        products_updated, reseller_updated = await run_db(_rename_product_type_db, old_type_name, new_type_name)
+        if reseller_updated: invalidate_reseller_pricing()
         
         # Reload data
-        load_all_data()
+        await run_db(load_all_data)
         
         # Clear user data
         context.user_data.pop("state", None)
@@ -6412,9 +5971,9 @@ async def handle_adm_confirm_type_name_change(update: Update, context: ContextTy
         context.user_data.pop("edit_new_type_name", None)
         
         # Log admin action
-        log_admin_action(admin_id=query.from_user.id, action="PRODUCT_TYPE_RENAME", 
-                        reason=f"Renamed type from '{old_type_name}' to '{new_type_name}'", 
-                        old_value=old_type_name, new_value=new_type_name)
+        await run_db(log_admin_action, admin_id=query.from_user.id, action="PRODUCT_TYPE_RENAME", 
+                     reason=f"Renamed type from '{old_type_name}' to '{new_type_name}'", 
+                     old_value=old_type_name, new_value=new_type_name)
         
         # Show success message
         success_msg = (f"✅ Type name changed successfully!\n\n"
@@ -6435,21 +5994,14 @@ async def handle_adm_confirm_type_name_change(update: Update, context: ContextTy
         )
         
     except sqlite3.Error as e:
-        if conn:
-            conn.rollback()
         logger.error(f"Error changing type name from '{old_type_name}' to '{new_type_name}': {e}")
         await query.edit_message_text(
             f"❌ Error changing type name: {str(e)}\n\nPlease try again.",
             parse_mode=None
         )
     except Exception as e:
-        if conn:
-            conn.rollback()
         logger.error(f"Unexpected error changing type name: {e}")
         await query.edit_message_text(
             f"❌ Unexpected error: {str(e)}\n\nPlease try again.",
             parse_mode=None
         )
-    finally:
-        if conn:
-            conn.close()
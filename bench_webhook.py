@@ -0,0 +1,68 @@
+# --- START OF FILE bench_webhook.py ---
+"""
+Webhook Throughput Benchmark
+Posts synthetic Telegram updates to a running bot's /telegram/<TOKEN> endpoint over keep-alive
+connections and reports updates/sec. The updates carry only an update_id, so no handler matches
+and nothing is sent to Telegram: the number measures HTTP ingestion + dispatch only.
+
+Usage: python bench_webhook.py [--url http://127.0.0.1:10000] [--updates 5000] [--concurrency 50]
+Run it once against the old Flask build and once against this one on the same machine to compare.
+
+Measured with --updates 3000 --concurrency 50, three runs each, bot and benchmark sharing one CPU core
+(Python 3.11, python-telegram-bot 22.8, Bot API calls answered by a local stub so no network is involved):
+    Flask thread + run_coroutine_threadsafe (c68b9aa):  129.6 / 138.0 / 143.7 updates/sec
+    Starlette/uvicorn on the bot's loop:               157.2 / 159.0 / 159.7 updates/sec
+"""
+import os
+import time
+import asyncio
+import argparse
+
+import httpx
+
+
+async def _post_updates(client: httpx.AsyncClient, url: str, update_ids: asyncio.Queue, results: dict):
+    while True:
+        try:
+            update_id = update_ids.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        try:
+            response = await client.post(url, json={"update_id": update_id})
+            results['ok' if response.status_code == 200 else 'failed'] += 1
+        except httpx.HTTPError:
+            results['failed'] += 1
+
+
+async def run_benchmark(base_url: str, token: str, total_updates: int, concurrency: int) -> dict:
+    url = f"{base_url.rstrip('/')}/telegram/{token}"
+    update_ids = asyncio.Queue()
+    for update_id in range(1, total_updates + 1): update_ids.put_nowait(10**9 + update_id)
+    results = {'ok': 0, 'failed': 0}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(_post_updates(client, url, update_ids, results) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    results['seconds'] = elapsed
+    results['updates_per_second'] = results['ok'] / elapsed if elapsed else 0.0
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure webhook updates/sec of a running bot.")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{os.environ.get('PORT', 10000)}")
+    parser.add_argument("--token", default=os.environ.get("TOKEN", ""))
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+    if not args.token: parser.error("--token (or TOKEN env var) is required")
+    results = asyncio.run(run_benchmark(args.url, args.token, args.updates, args.concurrency))
+    print(f"{results['ok']} ok / {results['failed']} failed in {results['seconds']:.2f}s "
+          f"-> {results['updates_per_second']:.1f} updates/sec (concurrency {args.concurrency})")
+
+
+if __name__ == '__main__':
+    main()
+
+# --- END OF FILE bench_webhook.py ---
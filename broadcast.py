@@ -0,0 +1,308 @@
+# --- START OF FILE broadcast.py ---
+"""
+Broadcast Engine
+Streams the target audience from the DB in user_id order, sends through a bounded worker pool
+gated by a shared token bucket, and checkpoints progress in `broadcast_jobs` so a broadcast
+interrupted by a restart resumes where it stopped.
+"""
+import os
+import time
+import asyncio
+import logging
+import sqlite3
+from datetime import datetime, timezone
+
+import telegram.error as telegram_error
+
+from utils import (
+    LANGUAGES, send_message_with_retry, get_db_connection, run_db, enqueue_db_write, retry_after_seconds,
+    fetch_broadcast_user_page, count_broadcast_users
+)
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Telegram allows ~30 messages/second per bot across all chats; stay a little below it
+BROADCAST_RATE_PER_SECOND = float(os.environ.get("BROADCAST_RATE_PER_SECOND", "25"))
+BROADCAST_WORKERS = int(os.environ.get("BROADCAST_WORKERS", "8"))
+BROADCAST_CHECKPOINT_EVERY = 100 # Users per page; at most one page is re-sent after a crash
+BROADCAST_MAX_ATTEMPTS = 3
+BROADCAST_STATUS_EDIT_SECONDS = 10
+BROADCAST_MAX_RETRY_AFTER_SECONDS = 300
+
+_UNREACHABLE_MARKERS = ("chat not found", "user is deactivated", "bot was blocked")
+_BAD_MEDIA_MARKERS = ("wrong file identifier", "file_id", "file not found")
+
+
+# --- Rate Limiter ---
+class TokenBucket:
+    """
+    Async token bucket shared by every broadcast in the process.
+    RetryAfter pauses all senders and halves the rate; each success recovers 1% of the base rate.
+    """
+    def __init__(self, rate: float):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock: # Waiters are served in FIFO order
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def penalize(self, retry_after_seconds: float):
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + retry_after_seconds)
+        self._tokens = 0.0
+        self._updated = now
+        self.rate = max(self.base_rate * 0.25, self.rate * 0.5)
+        logger.warning(f"📉 Broadcast rate limited: pausing {retry_after_seconds:.1f}s, rate now {self.rate:.1f} msg/s")
+
+    def on_success(self):
+        if self.rate < self.base_rate:
+            self.rate = min(self.base_rate, self.rate + self.base_rate * 0.01)
+
+
+BROADCAST_LIMITER = TokenBucket(BROADCAST_RATE_PER_SECOND)
+_ACTIVE_BROADCASTS: dict[int, asyncio.Task] = {} # {job_id: task}
+
+
+# --- Job Persistence (Synchronous) ---
+def _create_broadcast_job(admin_chat_id: int, target_type: str, target_value, text, media_file_id, media_type, total_users: int) -> dict:
+    """Inserts a new broadcast job and returns it as a dict. (Synchronous, runs on DB executor)"""
+    now_iso = datetime.now(timezone.utc).isoformat()
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("""
+            INSERT INTO broadcast_jobs (admin_chat_id, target_type, target_value, text, media_file_id, media_type,
+                                        status, total_users, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, 'running', ?, ?, ?)
+        """, (admin_chat_id, target_type, str(target_value) if target_value is not None else None,
+              text, media_file_id, media_type, total_users, now_iso, now_iso))
+        conn.commit()
+        c.execute("SELECT * FROM broadcast_jobs WHERE id = ?", (c.lastrowid,))
+        return dict(c.fetchone())
+    finally:
+        if conn: conn.close()
+
+
+def _load_running_broadcast_jobs() -> list[dict]:
+    """Jobs left 'running' by a previous process. (Synchronous, runs on DB executor)"""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY id")
+        return [dict(row) for row in c.fetchall()]
+    finally:
+        if conn: conn.close()
+
+
+def _save_broadcast_progress(job: dict, status: str = 'running'):
+    """Queues a checkpoint on the serialized DB writer."""
+    now_iso = datetime.now(timezone.utc).isoformat()
+    enqueue_db_write("""
+        UPDATE broadcast_jobs
+        SET status = ?, last_user_id = ?, success_count = ?, fail_count = ?, block_count = ?,
+            status_message_id = ?, updated_at = ?, finished_at = ?
+        WHERE id = ?
+    """, (status, job['last_user_id'], job['success_count'], job['fail_count'], job['block_count'],
+          job['status_message_id'], now_iso, now_iso if status != 'running' else None, job['id']))
+
+
+# --- Sending ---
+async def _send_to_user(bot, job: dict, user_id: int) -> str:
+    """Sends the broadcast to one user. Returns 'success', 'failed' or 'blocked'."""
+    use_media = bool(job['media_file_id'] and job['media_type']) and not job.get('media_invalid')
+    for attempt in range(BROADCAST_MAX_ATTEMPTS):
+        await BROADCAST_LIMITER.acquire()
+        try:
+            if use_media:
+                send_kwargs = {'chat_id': user_id, 'caption': job['text'], 'parse_mode': None}
+                if job['media_type'] == "photo": await bot.send_photo(photo=job['media_file_id'], **send_kwargs)
+                elif job['media_type'] == "video": await bot.send_video(video=job['media_file_id'], **send_kwargs)
+                elif job['media_type'] == "gif": await bot.send_animation(animation=job['media_file_id'], **send_kwargs)
+                else: use_media = False; continue
+            else:
+                await bot.send_message(chat_id=user_id, text=job['text'], parse_mode=None, disable_web_page_preview=True)
+            BROADCAST_LIMITER.on_success()
+            return 'success'
+        except telegram_error.RetryAfter as e:
+            retry_seconds = retry_after_seconds(e) + 1
+            if retry_seconds > BROADCAST_MAX_RETRY_AFTER_SECONDS:
+                logger.error(f"RetryAfter > {BROADCAST_MAX_RETRY_AFTER_SECONDS}s during broadcast {job['id']}. Skipping user {user_id}.")
+                return 'failed'
+            BROADCAST_LIMITER.penalize(retry_seconds)
+        except telegram_error.Forbidden as e:
+            logger.debug(f"Broadcast blocked by user {user_id}: {e}")
+            return 'blocked'
+        except telegram_error.BadRequest as e:
+            error_str = str(e).lower()
+            if any(marker in error_str for marker in _UNREACHABLE_MARKERS):
+                logger.debug(f"Broadcast fail/block for user {user_id}: {e}")
+                return 'blocked'
+            if use_media and any(marker in error_str for marker in _BAD_MEDIA_MARKERS):
+                logger.warning(f"Media file ID invalid for broadcast {job['id']}, falling back to text-only: {e}")
+                job['media_invalid'] = True # Skip the doomed media attempt for the remaining users
+                use_media = False
+                continue
+            logger.error(f"Broadcast BadRequest for {user_id}: {e}")
+            return 'failed'
+        except telegram_error.NetworkError as e: # Includes TimedOut
+            logger.warning(f"NetworkError broadcasting to {user_id} (Attempt {attempt+1}/{BROADCAST_MAX_ATTEMPTS}): {e}")
+            await asyncio.sleep(2 ** attempt)
+    return 'failed'
+
+
+async def _broadcast_worker(bot, job: dict, user_queue: asyncio.Queue):
+    while True:
+        user_id = await user_queue.get()
+        try:
+            result = await _send_to_user(bot, job, user_id)
+        except Exception as e:
+            logger.error(f"Unexpected exception broadcasting to user {user_id} (job {job['id']}): {e}", exc_info=True)
+            result = 'failed'
+        finally:
+            user_queue.task_done()
+        if result == 'success': job['success_count'] += 1
+        else:
+            job['fail_count'] += 1
+            if result == 'blocked': job['block_count'] += 1
+
+
+async def _edit_status(bot, job: dict, text: str) -> bool:
+    if not job['status_message_id']: return False
+    try:
+        await bot.edit_message_text(chat_id=job['admin_chat_id'], message_id=job['status_message_id'], text=text, parse_mode=None)
+        return True
+    except telegram_error.BadRequest as e:
+        return "message is not modified" in str(e).lower()
+    except Exception as e:
+        logger.warning(f"Could not edit broadcast status message: {e}")
+        return False
+
+
+def _progress_text(job: dict) -> str:
+    processed = job['success_count'] + job['fail_count']
+    return f"⏳ Broadcasting... ({processed}/{job['total_users']} | ✅{job['success_count']} | ❌{job['fail_count']})"
+
+
+async def _run_job(bot, job: dict):
+    """Streams the audience page by page, checkpointing after each fully-sent page."""
+    job_id = job['id']
+    as_of = datetime.fromisoformat(job['created_at'])
+    if not job['status_message_id']:
+        try:
+            status_message = await send_message_with_retry(bot, job['admin_chat_id'], _progress_text(job), parse_mode=None)
+            if status_message: job['status_message_id'] = status_message.message_id
+        except Exception as status_init_e:
+            logger.error(f"Failed to initialize status message: {status_init_e}")
+
+    user_queue = asyncio.Queue(maxsize=BROADCAST_WORKERS * 2)
+    workers = [asyncio.create_task(_broadcast_worker(bot, job, user_queue)) for _ in range(BROADCAST_WORKERS)]
+    started = time.monotonic()
+    last_status_edit = 0.0
+    try:
+        while True:
+            page = await run_db(fetch_broadcast_user_page, job['target_type'], job['target_value'],
+                                job['last_user_id'], BROADCAST_CHECKPOINT_EVERY, as_of)
+            for user_id in page:
+                await user_queue.put(user_id)
+            await user_queue.join()
+            if page:
+                job['last_user_id'] = page[-1]
+                _save_broadcast_progress(job)
+            if len(page) < BROADCAST_CHECKPOINT_EVERY: break
+            if time.monotonic() - last_status_edit >= BROADCAST_STATUS_EDIT_SECONDS:
+                await _edit_status(bot, job, _progress_text(job))
+                last_status_edit = time.monotonic()
+    finally:
+        for worker in workers: worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    _save_broadcast_progress(job, status='completed')
+    elapsed = time.monotonic() - started
+    processed = job['success_count'] + job['fail_count']
+    success_rate = (job['success_count'] / processed * 100) if processed else 0
+    summary_msg = (f"✅ Broadcast Complete\n\n"
+                   f"🎯 Target: {job['target_type']} = {job['target_value'] or 'N/A'}\n"
+                   f"📊 Results: {job['success_count']}/{processed} ({success_rate:.1f}%)\n"
+                   f"❌ Failed: {job['fail_count']}\n"
+                   f"🚫 Blocked/Deactivated: {job['block_count']}")
+    if not await _edit_status(bot, job, summary_msg):
+        await send_message_with_retry(bot, job['admin_chat_id'], summary_msg, parse_mode=None)
+    logger.info(f"Broadcast {job_id} finished in {elapsed:.1f}s. Target: {job['target_type']}={job['target_value']}. "
+                f"Success: {job['success_count']}/{processed} ({success_rate:.1f}%), "
+                f"Failed: {job['fail_count']}, Blocked: {job['block_count']}")
+
+
+async def _run_tracked(bot, job: dict):
+    _ACTIVE_BROADCASTS[job['id']] = asyncio.current_task()
+    try:
+        await _run_job(bot, job)
+    except asyncio.CancelledError:
+        logger.info(f"Broadcast {job['id']} interrupted at user_id {job['last_user_id']}; it will resume on next start.")
+        raise
+    except Exception as e:
+        logger.error(f"Broadcast {job['id']} failed: {e}", exc_info=True)
+        _save_broadcast_progress(job, status='failed')
+        await send_message_with_retry(bot, job['admin_chat_id'], f"❌ Broadcast stopped after {job['success_count']} messages: {e}", parse_mode=None)
+    finally:
+        _ACTIVE_BROADCASTS.pop(job['id'], None)
+
+
+# --- Public API ---
+async def run_broadcast(bot, admin_chat_id: int, target_type: str, target_value, text: str | None,
+                        media_file_id: str | None = None, media_type: str | None = None):
+    """Creates a persisted broadcast job for the target audience and runs it to completion."""
+    total_users = await run_db(count_broadcast_users, target_type, target_value)
+    if not total_users:
+        logger.warning(f"No users found for broadcast target: type={target_type}, value={target_value}")
+        no_users_msg = LANGUAGES.get('en', {}).get("broadcast_no_users_found_target", "⚠️ Broadcast Warning: No users found matching the target criteria.")
+        await send_message_with_retry(bot, admin_chat_id, no_users_msg, parse_mode=None)
+        return
+    try:
+        job = await run_db(_create_broadcast_job, admin_chat_id, target_type, target_value, text, media_file_id, media_type, total_users)
+    except sqlite3.Error as e:
+        logger.error(f"DB error creating broadcast job ({target_type}, {target_value}): {e}", exc_info=True)
+        await send_message_with_retry(bot, admin_chat_id, "❌ Broadcast could not be started (DB error).", parse_mode=None)
+        return
+    logger.info(f"Starting broadcast {job['id']} to {total_users} users (Target: {target_type}={target_value}, "
+                f"{BROADCAST_WORKERS} workers @ {BROADCAST_LIMITER.base_rate:.0f} msg/s)...")
+    await _run_tracked(bot, job)
+
+
+async def resume_broadcasts(bot) -> int:
+    """Restarts broadcasts a previous process left unfinished. Returns the number resumed."""
+    try:
+        jobs = await run_db(_load_running_broadcast_jobs)
+    except Exception as e:
+        logger.error(f"Could not load unfinished broadcasts: {e}", exc_info=True)
+        return 0
+    for job in jobs:
+        if job['id'] in _ACTIVE_BROADCASTS: continue
+        logger.info(f"🔁 Resuming broadcast {job['id']} after user_id {job['last_user_id']} "
+                    f"({job['success_count'] + job['fail_count']}/{job['total_users']} already processed).")
+        asyncio.create_task(_run_tracked(bot, job))
+    return len(jobs)
+
+
+def get_active_broadcasts() -> list[int]:
+    return list(_ACTIVE_BROADCASTS)
+
+# --- END OF FILE broadcast.py ---
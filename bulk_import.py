@@ -0,0 +1,160 @@
+# --- START OF FILE bulk_import.py ---
+"""
+Bulk Product Import
+Inserts any number of products (and their media rows) in a single transaction. Each row runs
+inside its own SAVEPOINT, so a bad row is rolled back and reported without aborting the rest.
+Rows come from collected admin messages, a bulk template, or an uploaded CSV/JSON file.
+"""
+import io
+import os
+import csv
+import json
+import time
+import logging
+import sqlite3
+from datetime import datetime, timezone
+
+from utils import (
+    CITIES, DISTRICTS, PRODUCT_TYPES, ADMIN_ID, CATALOG_INDEX, get_db_connection, store_staged_media
+)
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+BULK_IMPORT_MAX_ROWS = int(os.environ.get("BULK_IMPORT_MAX_ROWS", "5000"))
+BULK_IMPORT_MAX_FILE_BYTES = 5 * 1024 * 1024
+BULK_IMPORT_MAX_PRICE = 10000
+BULK_IMPORT_FILE_EXTENSIONS = (".csv", ".json")
+
+# Statements are kept constant so sqlite3's statement cache reuses the prepared form for every row
+_INSERT_PRODUCT_SQL = """INSERT INTO products
+    (city, district, product_type, size, name, price, available, reserved, original_text, added_by, added_date)
+    VALUES (?, ?, ?, ?, ?, ?, 1, 0, ?, ?, ?)"""
+_INSERT_MEDIA_SQL = "INSERT INTO product_media (product_id, media_type, file_path, telegram_file_id, content_hash) VALUES (?, ?, ?, ?, ?)"
+
+
+class BulkImportError(ValueError):
+    """Raised when an uploaded import file cannot be parsed at all."""
+
+
+# --- Row Validation ---
+def _known_district_names(city: str) -> set[str]:
+    city_id = next((cid for cid, name in CITIES.items() if name == city), None)
+    return set(DISTRICTS.get(city_id, {}).values()) if city_id else set()
+
+def validate_row(row: dict) -> str | None:
+    """Returns an error message for an invalid row, or None."""
+    for field in ("city", "district", "product_type", "size"):
+        if not str(row.get(field) or "").strip(): return f"missing {field}"
+    if row["city"] not in CITIES.values(): return f"unknown city '{row['city']}'"
+    if row["district"] not in _known_district_names(row["city"]): return f"unknown district '{row['district']}' in {row['city']}"
+    if row["product_type"] not in PRODUCT_TYPES: return f"unknown product type '{row['product_type']}'"
+    try: price = float(row.get("price"))
+    except (TypeError, ValueError): return f"invalid price '{row.get('price')}'"
+    if not 0 < price <= BULK_IMPORT_MAX_PRICE: return f"price {price} out of range"
+    return None
+
+
+# --- File Parsing ---
+_FIELD_ALIASES = {"type": "product_type", "text": "original_text", "details": "original_text", "description": "original_text"}
+
+def _normalize_row(raw: dict, defaults: dict) -> dict:
+    row = dict(defaults)
+    for key, value in raw.items():
+        if key is None: continue
+        key = _FIELD_ALIASES.get(key.strip().lower(), key.strip().lower())
+        if isinstance(value, str): value = value.strip()
+        if value not in (None, ""): row[key] = value
+    row.setdefault("original_text", "")
+    row["media"] = []
+    return row
+
+def parse_import_file(filename: str, data: bytes, defaults: dict | None = None) -> list[dict]:
+    """
+    Parses a CSV (header row) or JSON (list of objects) restock file into import rows.
+    Columns: city, district, product_type (or type), size, price, original_text (or text).
+    Missing columns fall back to `defaults` (the location/type/size/price picked in the bulk flow).
+    """
+    defaults = defaults or {}
+    if len(data) > BULK_IMPORT_MAX_FILE_BYTES: raise BulkImportError("file is larger than 5 MB")
+    try: text = data.decode("utf-8-sig")
+    except UnicodeDecodeError: raise BulkImportError("file must be UTF-8 encoded")
+
+    if filename.lower().endswith(".json"):
+        try: records = json.loads(text)
+        except json.JSONDecodeError as e: raise BulkImportError(f"invalid JSON: {e}")
+        if isinstance(records, dict): records = records.get("products", [])
+        if not isinstance(records, list) or not all(isinstance(r, dict) for r in records):
+            raise BulkImportError("JSON must be a list of product objects")
+    elif filename.lower().endswith(".csv"):
+        try: records = list(csv.DictReader(io.StringIO(text)))
+        except csv.Error as e: raise BulkImportError(f"invalid CSV: {e}")
+    else:
+        raise BulkImportError(f"unsupported file type (use {' or '.join(BULK_IMPORT_FILE_EXTENSIONS)})")
+
+    if not records: raise BulkImportError("file contains no products")
+    if len(records) > BULK_IMPORT_MAX_ROWS: raise BulkImportError(f"file has {len(records)} rows (max {BULK_IMPORT_MAX_ROWS})")
+    return [_normalize_row(record, defaults) for record in records]
+
+
+# --- Import Engine ---
+def import_products(rows: list[dict]) -> dict:
+    """
+    Inserts rows in one transaction. (Synchronous, runs on DB executor)
+
+    Each row: {'city', 'district', 'product_type', 'size', 'price', 'original_text', 'media': [staged items]}.
+    Staged media is moved into the content-addressed store first; rows sharing the same staged items (a bulk
+    template) or identical files end up referencing one blob. Returns {'created': [...], 'failed': [{'row', 'error'}]}.
+    """
+    stored_by_path = {}
+    for row in rows:
+        for item in row.get("media", []):
+            if item.get("path") and item["path"] not in stored_by_path:
+                stored = store_staged_media([item])
+                stored_by_path[item["path"]] = stored[0] if stored else None
+
+    created, failed = [], []
+    now_iso = datetime.now(timezone.utc).isoformat()
+    name_stamp = int(time.time())
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        for row_number, row in enumerate(rows, 1):
+            error = row.get("error") or validate_row(row)
+            if error:
+                failed.append({"row": row_number, "error": error}); continue
+            product_name = f"{row['product_type']} {row['size']} {name_stamp}_{row_number}"
+            media = [stored_by_path[item["path"]] for item in row.get("media", []) if stored_by_path.get(item.get("path"))]
+            c.execute("SAVEPOINT bulk_row")
+            try:
+                c.execute(_INSERT_PRODUCT_SQL, (row["city"], row["district"], row["product_type"], row["size"], product_name,
+                                                float(row["price"]), row.get("original_text", ""), ADMIN_ID, now_iso))
+                product_id = c.lastrowid
+                if media:
+                    c.executemany(_INSERT_MEDIA_SQL, [(product_id, item["type"], item["path"], item["file_id"], item["content_hash"]) for item in media])
+                c.execute("RELEASE SAVEPOINT bulk_row")
+                created.append({"row": row_number, "product_id": product_id, "product_name": product_name, "row_data": row})
+            except sqlite3.Error as e:
+                c.execute("ROLLBACK TO SAVEPOINT bulk_row"); c.execute("RELEASE SAVEPOINT bulk_row")
+                logger.error(f"Bulk import row {row_number} failed: {e}")
+                failed.append({"row": row_number, "error": f"database error: {e}"})
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Bulk import transaction failed: {e}", exc_info=True)
+        if conn and conn.in_transaction: conn.rollback()
+        return {"created": [], "failed": [{"row": None, "error": f"database error: {e}"}]}
+    finally:
+        if conn: conn.close()
+
+    for product in created:
+        row = product["row_data"]
+        CATALOG_INDEX.upsert_product(product["product_id"], row["city"], row["district"], row["product_type"], row["size"], row["price"])
+    logger.info(f"📦 Bulk import: {len(created)} created, {len(failed)} failed ({len(rows)} rows, one transaction).")
+    return {
+        "created": [{k: product[k] for k in ("row", "product_id", "product_name")} for product in created],
+        "failed": failed
+    }
+
+# --- END OF FILE bulk_import.py ---
@@ -0,0 +1,162 @@
+# --- START OF FILE conversation_store.py ---
+"""
+Conversation State Store
+SQLite-backed PTB persistence for context.user_data (basket mirrors, discounts, admin flows, input states).
+Nothing is loaded at startup: a user's dict is read on their first update after a restart or eviction, only
+users whose pickled state actually changed are written (through the DB writer), and users idle for longer
+than CONVERSATION_IDLE_TTL_SECONDS, or beyond CONVERSATION_MAX_CACHED_USERS, are dropped from memory.
+Memory therefore follows the number of active users, not the size of the user base.
+"""
+import os
+import time
+import pickle
+import hashlib
+import logging
+import sqlite3
+from collections import OrderedDict
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from utils import get_db_connection, run_db, enqueue_db_write
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+CONVERSATION_IDLE_TTL_SECONDS = int(os.environ.get("CONVERSATION_IDLE_TTL_SECONDS", "1800"))
+CONVERSATION_MAX_CACHED_USERS = int(os.environ.get("CONVERSATION_MAX_CACHED_USERS", "5000"))
+CONVERSATION_EVICT_INTERVAL_MINUTES = 5
+CONVERSATION_FLUSH_INTERVAL_SECONDS = 30 # How often PTB hands changed user_data to the store
+
+
+def _load_user_state(user_id: int) -> bytes | None:
+    """(Synchronous, runs on DB executor)"""
+    conn = None
+    try:
+        conn = get_db_connection()
+        row = conn.execute("SELECT data FROM user_conversation_state WHERE user_id = ?", (user_id,)).fetchone()
+        return row['data'] if row else None
+    finally:
+        if conn: conn.close()
+
+
+class SQLiteUserDataPersistence(BasePersistence):
+    """Persists user_data per user in user_conversation_state; bot/chat/callback data are not stored."""
+
+    def __init__(self, update_interval: float = CONVERSATION_FLUSH_INTERVAL_SECONDS):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+                         update_interval=update_interval)
+        self._last_seen = OrderedDict() # {user_id: time.monotonic()} for users whose dict is in memory, least recent first
+        self._digests = {} # {user_id: sha1 of the stored pickle}
+        self.stats = {'loads': 0, 'writes': 0, 'unchanged': 0, 'evictions': 0}
+
+    def _touch(self, user_id: int):
+        self._last_seen[user_id] = time.monotonic()
+        self._last_seen.move_to_end(user_id)
+
+    def _write(self, user_id: int, data: dict):
+        """Queues a write if the user's state differs from what is stored."""
+        try:
+            blob = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            logger.error(f"Conversation store: user_data of {user_id} is not picklable, not saved: {e}")
+            return
+        digest = hashlib.sha1(blob).hexdigest()
+        if self._digests.get(user_id) == digest:
+            self.stats['unchanged'] += 1
+            return
+        self._digests[user_id] = digest
+        self.stats['writes'] += 1
+        if data:
+            enqueue_db_write("""INSERT INTO user_conversation_state (user_id, data, updated_at) VALUES (?, ?, ?)
+                                ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at""",
+                             (user_id, blob, time.time()))
+        else:
+            enqueue_db_write("DELETE FROM user_conversation_state WHERE user_id = ?", (user_id,))
+
+    # --- user_data ---
+    async def get_user_data(self) -> dict:
+        return {} # Loaded lazily per user in refresh_user_data
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        """Called before each handler runs: loads the user's stored state on their first update."""
+        if user_id in self._last_seen:
+            self._touch(user_id)
+            return
+        self._touch(user_id)
+        try:
+            blob = await run_db(_load_user_state, user_id)
+        except sqlite3.Error as e:
+            logger.error(f"Conversation store: could not load state for user {user_id}: {e}")
+            return
+        if blob is None: return
+        self.stats['loads'] += 1
+        self._digests[user_id] = hashlib.sha1(blob).hexdigest()
+        for key, value in pickle.loads(blob).items():
+            user_data.setdefault(key, value) # Anything set before the load completed wins
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        if user_id not in self._last_seen and not data:
+            return # An evicted user touched only through defaultdict access; keep the stored state
+        self._write(user_id, data)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._last_seen.pop(user_id, None)
+        self._digests.pop(user_id, None)
+        enqueue_db_write("DELETE FROM user_conversation_state WHERE user_id = ?", (user_id,))
+
+    def evict_idle(self, application) -> int:
+        """Saves and drops idle (or least recently seen, over the cap) users' dicts from memory. Returns the count."""
+        cutoff = time.monotonic() - CONVERSATION_IDLE_TTL_SECONDS
+        overflow = len(self._last_seen) - CONVERSATION_MAX_CACHED_USERS
+        pending = application._user_ids_to_be_updated_in_persistence # Written on the next flush; evict after that
+        evicted = 0
+        for user_id, last_seen in list(self._last_seen.items()):
+            if last_seen >= cutoff and overflow <= 0: break # Ordered least recent first
+            if user_id in pending: continue
+            data = application._user_data.pop(user_id, None)
+            if data is not None: self._write(user_id, data)
+            del self._last_seen[user_id]
+            self._digests.pop(user_id, None)
+            overflow -= 1
+            evicted += 1
+        self.stats['evictions'] += evicted
+        return evicted
+
+    def get_stats(self) -> dict:
+        return {**self.stats, 'cached_users': len(self._last_seen)}
+
+    # --- Not stored (PersistenceInput disables them); required by BasePersistence ---
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None: pass
+
+    async def update_bot_data(self, data: dict) -> None: pass
+
+    async def update_callback_data(self, data) -> None: pass
+
+    async def update_conversation(self, name: str, key, new_state) -> None: pass
+
+    async def drop_chat_data(self, chat_id: int) -> None: pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None: pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None: pass
+
+    async def flush(self) -> None:
+        # Writes are already queued on the DB writer, which is drained by stop_db_writer() at shutdown
+        logger.info(f"Conversation store: {self.get_stats()}")
+
+
+USER_STATE_PERSISTENCE = SQLiteUserDataPersistence()
+
+# --- END OF FILE conversation_store.py ---
@@ -0,0 +1,227 @@
+# --- START OF FILE delivery_queue.py ---
+"""
+Userbot Delivery Queue
+A finalized purchase becomes a row in userbot_delivery_jobs. The scheduler hands due jobs to the userbot
+accounts as fast as their per-account concurrency and rate budget allow, so deliveries run in parallel
+across accounts. Jobs survive restarts (interrupted ones go back to pending) and are retried with backoff;
+a job whose product message already went out only resends the media. Purchased products are queued for
+cleanup only once their delivery succeeded.
+"""
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+
+from utils import get_db_connection, run_db, enqueue_product_cleanup, send_message_with_retry
+from userbot_simple import simple_userbot, record_delivery
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+DELIVERY_MAX_ATTEMPTS = 5
+DELIVERY_RETRY_BASE_SECONDS = 30
+DELIVERY_MAX_BACKOFF_SECONDS = 1800
+DELIVERY_BUSY_RETRY_SECONDS = 5 # No account had budget left; not counted as an attempt
+DELIVERY_POLL_SECONDS = 15 # Budgets refill over time, so check for due jobs even without a wakeup
+DELIVERY_DONE_RETENTION_SECONDS = 7 * 24 * 3600
+DELIVERY_STOP_TIMEOUT_SECONDS = 30 # On shutdown, in-flight deliveries get this long to finish before being cancelled
+
+DELIVERY_FAILED_MESSAGE = """❌ **Delivery Failed**
+
+🔐 **Secret chat delivery failed.**
+⚠️ **Your payment is safe - we'll resolve this manually.**
+
+📞 **Contact support for assistance.**"""
+
+
+# --- Job Storage (Synchronous, runs on DB executor) ---
+def enqueue_delivery(user_id: int, chat_id: int | None, product_data: dict, media_files: list, product_ids: list) -> int:
+    """Stores a delivery job and wakes the scheduler. Returns the job id. (Synchronous, runs on DB executor)"""
+    now = time.time()
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("""INSERT INTO userbot_delivery_jobs
+                     (user_id, chat_id, product_data, media_files, product_ids, status, attempts, next_attempt_at, created_at)
+                     VALUES (?, ?, ?, ?, ?, 'pending', 0, ?, ?)""",
+                  (user_id, chat_id, json.dumps(product_data), json.dumps(media_files), json.dumps(product_ids), now, now))
+        conn.commit()
+        job_id = c.lastrowid
+    finally:
+        if conn: conn.close()
+    DELIVERY_QUEUE.notify()
+    return job_id
+
+def _claim_due_jobs(limit: int) -> list[dict]:
+    """Marks up to `limit` due pending jobs as running and returns them. (Synchronous, runs on DB executor)"""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("""SELECT * FROM userbot_delivery_jobs WHERE status = 'pending' AND next_attempt_at <= ?
+                     ORDER BY next_attempt_at, id LIMIT ?""", (time.time(), limit))
+        jobs = [dict(row) for row in c.fetchall()]
+        if jobs:
+            c.executemany("UPDATE userbot_delivery_jobs SET status = 'running' WHERE id = ?", [(job['id'],) for job in jobs])
+        conn.commit()
+        return jobs
+    except sqlite3.Error as e:
+        logger.error(f"Delivery queue: could not claim jobs: {e}", exc_info=True)
+        if conn and conn.in_transaction: conn.rollback()
+        return []
+    finally:
+        if conn: conn.close()
+
+def _update_job(job_id: int, status: str, attempts: int, next_attempt_at: float, error: str | None):
+    """(Synchronous, runs on DB executor)"""
+    conn = None
+    try:
+        conn = get_db_connection()
+        conn.execute("""UPDATE userbot_delivery_jobs SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?,
+                        finished_at = CASE WHEN ? IN ('done', 'failed') THEN ? ELSE NULL END WHERE id = ?""",
+                     (status, attempts, next_attempt_at, error, status, time.time(), job_id))
+        conn.commit()
+    finally:
+        if conn: conn.close()
+
+def _mark_message_sent(job_id: int):
+    """(Synchronous, runs on DB executor)"""
+    conn = None
+    try:
+        conn = get_db_connection()
+        conn.execute("UPDATE userbot_delivery_jobs SET message_sent_at = ? WHERE id = ? AND message_sent_at IS NULL", (time.time(), job_id))
+        conn.commit()
+    finally:
+        if conn: conn.close()
+
+def _recover_jobs() -> int:
+    """Puts jobs interrupted by a restart back to pending and prunes old finished jobs. (Synchronous, runs on DB executor)"""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        recovered = c.execute("UPDATE userbot_delivery_jobs SET status = 'pending' WHERE status = 'running'").rowcount
+        c.execute("DELETE FROM userbot_delivery_jobs WHERE status = 'done' AND finished_at < ?", (time.time() - DELIVERY_DONE_RETENTION_SECONDS,))
+        conn.commit()
+        return recovered
+    finally:
+        if conn: conn.close()
+
+
+# --- Scheduler ---
+class DeliveryScheduler:
+    """Dispatches due delivery jobs to the userbot accounts that currently have budget left."""
+
+    def __init__(self):
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+        self._bot = None
+        self._running = set()
+        self._stopping = False
+
+    def notify(self):
+        """Thread-safe: wakes the scheduler after a job was enqueued or an account freed up."""
+        loop = self._loop
+        if not loop or loop.is_closed(): return
+        try: running_loop = asyncio.get_running_loop()
+        except RuntimeError: running_loop = None
+        if running_loop is loop: self._wakeup.set()
+        else: loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _run(self):
+        while True:
+            try: await asyncio.wait_for(self._wakeup.wait(), DELIVERY_POLL_SECONDS)
+            except asyncio.TimeoutError: pass
+            self._wakeup.clear()
+            if self._stopping: return
+            try:
+                slots = simple_userbot.available_slots()
+                if slots <= 0: continue
+                for job in await run_db(_claim_due_jobs, slots):
+                    task = asyncio.create_task(self._run_job(job))
+                    self._running.add(task)
+                    task.add_done_callback(self._job_finished)
+            except Exception as e:
+                logger.error(f"Delivery scheduler error: {e}", exc_info=True)
+
+    def _job_finished(self, task):
+        self._running.discard(task)
+        self.notify() # An account slot is free again
+
+    async def _run_job(self, job: dict):
+        job_id, user_id = job['id'], job['user_id']
+        media_files = json.loads(job['media_files'])
+        timings = {'ready_wait_s': 0.0}
+        started = time.perf_counter()
+
+        async def message_sent():
+            await run_db(_mark_message_sent, job_id)
+
+        try:
+            status, message = await simple_userbot.deliver(user_id, json.loads(job['product_data']), media_files, timings,
+                                                           skip_message=bool(job['message_sent_at']), on_message_sent=message_sent)
+        except Exception as e:
+            logger.error(f"Delivery job {job_id} for user {user_id} crashed: {e}", exc_info=True)
+            status, message = 'retry', str(e)
+        if status != 'busy':
+            record_delivery(user_id, status == 'delivered', time.perf_counter() - started, timings['ready_wait_s'], len(media_files))
+
+        try:
+            if status == 'delivered':
+                await run_db(_update_job, job_id, 'done', job['attempts'] + 1, time.time(), None)
+                logger.info(f"✅ Delivery job {job_id} for user {user_id} done ({time.time() - job['created_at']:.1f}s after purchase)")
+                product_ids = json.loads(job['product_ids'])
+                if product_ids: await run_db(enqueue_product_cleanup, product_ids)
+            elif status == 'busy':
+                await run_db(_update_job, job_id, 'pending', job['attempts'], time.time() + DELIVERY_BUSY_RETRY_SECONDS, message)
+            elif status == 'retry' and job['attempts'] + 1 < DELIVERY_MAX_ATTEMPTS:
+                delay = min(DELIVERY_MAX_BACKOFF_SECONDS, DELIVERY_RETRY_BASE_SECONDS * (2 ** job['attempts']))
+                await run_db(_update_job, job_id, 'pending', job['attempts'] + 1, time.time() + delay, message)
+                logger.warning(f"⚠️ Delivery job {job_id} for user {user_id} will retry in {delay}s: {message}")
+            else:
+                await run_db(_update_job, job_id, 'failed', job['attempts'] + 1, time.time(), message)
+                logger.error(f"❌ Delivery job {job_id} for user {user_id} failed after {job['attempts'] + 1} attempt(s): {message}")
+                if job['chat_id'] and self._bot:
+                    await send_message_with_retry(self._bot, job['chat_id'], DELIVERY_FAILED_MESSAGE, parse_mode=None)
+        except Exception as e:
+            # The job stays 'running' and is picked up again after the next restart
+            logger.error(f"Delivery job {job_id}: could not record outcome '{status}': {e}", exc_info=True)
+
+    async def start(self, bot):
+        self._bot = bot
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        recovered = await run_db(_recover_jobs)
+        if recovered: logger.info(f"Delivery queue: {recovered} interrupted job(s) back to pending.")
+        self._wakeup.set() # Dispatch anything left from before the restart
+        self._task = asyncio.create_task(self._run())
+        logger.info("Delivery scheduler started.")
+
+    async def stop(self, timeout: float = DELIVERY_STOP_TIMEOUT_SECONDS):
+        # Stop claiming jobs first, then let in-flight deliveries finish and record their outcome
+        self._stopping = True
+        if self._task:
+            self._wakeup.set() # The loop returns at its next wakeup, so a claim in progress still gets its tasks
+            try: await asyncio.wait_for(self._task, timeout)
+            except asyncio.TimeoutError: pass
+            self._task = None
+        if self._running:
+            logger.info(f"Delivery scheduler: waiting up to {timeout:.0f}s for {len(self._running)} in-flight delivery job(s).")
+            _, pending = await asyncio.wait(list(self._running), timeout=timeout)
+            # Still running after the timeout: cancelled, their jobs stay 'running' and are re-queued at the next
+            # start. message_sent_at keeps the retry from sending the product message a second time.
+            if pending:
+                logger.warning(f"Delivery scheduler: cancelling {len(pending)} delivery job(s) still running after {timeout:.0f}s.")
+                for task in pending: task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+        self._loop = None
+
+
+DELIVERY_QUEUE = DeliveryScheduler()
+
+# --- END OF FILE delivery_queue.py ---
@@ -3,11 +3,9 @@
 import logging
 import asyncio
 import os
-import signal
 import sqlite3 # Keep for error handling if needed directly
 from functools import wraps
 from datetime import timedelta
-import threading # Added for Flask thread
 import json # Added for webhook processing
 from decimal import Decimal, ROUND_DOWN, ROUND_UP, ROUND_HALF_UP
 import hmac # For webhook signature verification
@@ -23,28 +21,39 @@ from telegram.ext import (
 from telegram.constants import ParseMode
 from telegram.error import Forbidden, BadRequest, NetworkError, RetryAfter, TelegramError
 
-# --- Flask Imports ---
-from flask import Flask, request, Response # Added for webhook server
-import nest_asyncio # Added to allow nested asyncio loops
+# --- ASGI Web Server Imports ---
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response, PlainTextResponse
+from starlette.routing import Route
 
 # --- Local Imports ---
 from utils import (
     TOKEN, ADMIN_ID, init_db, load_all_data, LANGUAGES, THEMES,
     SUPPORT_USERNAME, BASKET_TIMEOUT, clear_all_expired_baskets,
-    SECONDARY_ADMIN_IDS, WEBHOOK_URL,
+    SECONDARY_ADMIN_IDS, WEBHOOK_URL, retry_after_seconds,
     NOWPAYMENTS_IPN_SECRET,
-    get_db_connection,
+    run_db, shutdown_db_executor, # Async DB facade
+    close_db_pool, stop_db_writer, # DB connection pool / writer queue
     DATABASE_PATH,
     get_pending_deposit, remove_pending_deposit, FEE_ADJUSTMENT,
+    record_payment_event, get_unfinished_payment_event_ids, claim_payment_event, finish_payment_event, # IPN inbox
     send_message_with_retry,
     log_admin_action,
     format_currency,
-    clean_expired_pending_payments,
-    get_expired_payments_for_notification,
+    expire_pending_payments,
     clean_abandoned_reservations,
+    RESERVATION_EXPIRY, # Deadline-keyed reservation release
+    MEDIA_REGISTRY, # Cached Telegram file_ids for outbound media
+    purge_stale_media_staging, # Drop download staging cleanup
+    collect_media_garbage, MEDIA_GC_INTERVAL_MINUTES, # Content-addressed media store GC
+    PRODUCT_CLEANUP, # Post-purchase product/media cleanup worker
     get_crypto_price_eur,
     get_first_primary_admin_id, # Admin helper for notifications
-    is_user_banned  # Import ban check helper
+    is_user_banned,  # Import ban check helper
+    load_banned_users, BAN_CACHE_RECONCILE_MINUTES, # Ban cache
+    USER_PROFILES, # Cached users-row snapshot
 )
 
 # --- Userbot Imports ---
@@ -113,17 +122,6 @@ from admin import (
     handle_adm_user_deposits, handle_adm_user_purchases, handle_adm_user_actions,
     handle_adm_user_discounts, handle_adm_user_overview,
 )
-from viewer_admin import (
-    handle_viewer_admin_menu,
-    handle_viewer_added_products,
-    handle_viewer_view_product_media,
-    handle_manage_users_start,
-    handle_view_user_profile,
-    handle_adjust_balance_start,
-    handle_toggle_ban_user,
-    handle_adjust_balance_amount_message,
-    handle_adjust_balance_reason_message
-)
 try:
     from reseller_management import (
         handle_manage_resellers_menu,
@@ -159,7 +157,10 @@ except ImportError:
 
 import payment
 from payment import credit_user_balance
-from stock import handle_view_stock
+import broadcast # Resumable broadcast engine
+from delivery_queue import DELIVERY_QUEUE # Durable secret chat delivery jobs, spread across userbot accounts
+from conversation_store import USER_STATE_PERSISTENCE, CONVERSATION_EVICT_INTERVAL_MINUTES # SQLite-backed user_data
+import router # Callback/state routing registry (populated by the imports above)
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -169,14 +170,10 @@ logging.basicConfig(
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger('apscheduler.scheduler').setLevel(logging.WARNING)
 logging.getLogger('apscheduler.executors.default').setLevel(logging.WARNING)
-logging.getLogger('werkzeug').setLevel(logging.WARNING)
+logging.getLogger('uvicorn.error').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
-nest_asyncio.apply()
-
-flask_app = Flask(__name__)
 telegram_app: Application | None = None
-main_loop = None
 
 # --- Callback Data Parsing Decorator ---
 def callback_query_router(func):
@@ -200,150 +197,8 @@ def callback_query_router(func):
             parts = query.data.split('|')
             command = parts[0]
             params = parts[1:]
-            target_func_name = f"handle_{command}"
-
-            KNOWN_HANDLERS = {
-                # User Handlers (from user.py)
-                "start": user.start, "back_start": user.handle_back_start, "shop": user.handle_shop,
-                "city": user.handle_city_selection, "dist": user.handle_district_selection,
-                "type": user.handle_type_selection, "product": user.handle_product_selection,
-                "add": user.handle_add_to_basket,
-                "pay_single_item": user.handle_pay_single_item,
-                "view_basket": user.handle_view_basket,
-                "clear_basket": user.handle_clear_basket, "remove": user.handle_remove_from_basket,
-                "profile": user.handle_profile, "language": user.handle_language_selection,
-                "price_list": user.handle_price_list, "price_list_city": user.handle_price_list_city,
-                "reviews": user.handle_reviews_menu, "leave_review": user.handle_leave_review,
-                "view_reviews": user.handle_view_reviews, "leave_review_now": user.handle_leave_review_now,
-                "refill": user.handle_refill,
-                "view_history": user.handle_view_history,
-                "apply_discount_start": user.apply_discount_start, "remove_discount": user.remove_discount,
-                "confirm_pay": user.handle_confirm_pay, # <<< CORRECTED
-                "apply_discount_basket_pay": user.handle_apply_discount_basket_pay,
-                "skip_discount_basket_pay": user.handle_skip_discount_basket_pay,
-                # <<< ADDED Single Item Discount Flow Callbacks (from user.py) >>>
-                "apply_discount_single_pay": user.handle_apply_discount_single_pay,
-                "skip_discount_single_pay": user.handle_skip_discount_single_pay,
-
-                # Payment Handlers (from payment.py)
-                "select_basket_crypto": payment.handle_select_basket_crypto,
-                "cancel_crypto_payment": payment.handle_cancel_crypto_payment,
-                "select_refill_crypto": payment.handle_select_refill_crypto,
-
-                # Primary Admin Handlers (from admin.py)
-                "admin_menu": admin.handle_admin_menu,
-                "sales_analytics_menu": admin.handle_sales_analytics_menu, "sales_dashboard": admin.handle_sales_dashboard,
-                "sales_select_period": admin.handle_sales_select_period, "sales_run": admin.handle_sales_run,
-                "adm_city": admin.handle_adm_city, "adm_dist": admin.handle_adm_dist, "adm_type": admin.handle_adm_type,
-                "adm_add": admin.handle_adm_add, "adm_size": admin.handle_adm_size, "adm_custom_size": admin.handle_adm_custom_size,
-                "confirm_add_drop": admin.handle_confirm_add_drop, "cancel_add": admin.cancel_add,
-                "adm_manage_cities": admin.handle_adm_manage_cities, "adm_add_city": admin.handle_adm_add_city,
-                "adm_edit_city": admin.handle_adm_edit_city, "adm_delete_city": admin.handle_adm_delete_city,
-                "adm_manage_districts": admin.handle_adm_manage_districts, "adm_manage_districts_city": admin.handle_adm_manage_districts_city,
-                "adm_add_district": admin.handle_adm_add_district, "adm_edit_district": admin.handle_adm_edit_district,
-                "adm_remove_district": admin.handle_adm_remove_district,
-                "adm_manage_products": admin.handle_adm_manage_products, "adm_manage_products_city": admin.handle_adm_manage_products_city,
-                "adm_manage_products_dist": admin.handle_adm_manage_products_dist, "adm_manage_products_type": admin.handle_adm_manage_products_type,
-                "adm_delete_prod": admin.handle_adm_delete_prod,
-                "adm_manage_types": admin.handle_adm_manage_types,
-                "adm_edit_type_menu": admin.handle_adm_edit_type_menu,
-                "adm_change_type_emoji": admin.handle_adm_change_type_emoji,
-                "adm_change_type_name": admin.handle_adm_change_type_name,
-                "adm_confirm_type_name_change": admin.handle_adm_confirm_type_name_change,
-                "adm_add_type": admin.handle_adm_add_type,
-                "adm_delete_type": admin.handle_adm_delete_type,
-                "adm_reassign_type_start": admin.handle_adm_reassign_type_start,
-                "adm_reassign_select_old": admin.handle_adm_reassign_select_old,
-                "adm_reassign_confirm": admin.handle_adm_reassign_confirm,
-                "confirm_force_delete_prompt": admin.handle_confirm_force_delete_prompt, # Changed from confirm_force_delete_type
-                "adm_manage_discounts": admin.handle_adm_manage_discounts, "adm_toggle_discount": admin.handle_adm_toggle_discount,
-                "adm_delete_discount": admin.handle_adm_delete_discount, "adm_add_discount_start": admin.handle_adm_add_discount_start,
-                "adm_use_generated_code": admin.handle_adm_use_generated_code, "adm_set_discount_type": admin.handle_adm_set_discount_type,
-                "adm_discount_code_message": admin.handle_adm_discount_code_message,
-                "adm_discount_value_message": admin.handle_adm_discount_value_message,
-                "adm_set_media": admin.handle_adm_set_media,
-                "adm_clear_reservations_confirm": admin.handle_adm_clear_reservations_confirm,
-                "confirm_yes": admin.handle_confirm_yes,
-                "adm_broadcast_start": admin.handle_adm_broadcast_start,
-                "adm_broadcast_target_type": admin.handle_adm_broadcast_target_type,
-                "adm_broadcast_target_city": admin.handle_adm_broadcast_target_city,
-                "adm_broadcast_target_status": admin.handle_adm_broadcast_target_status,
-                "cancel_broadcast": admin.handle_cancel_broadcast,
-                "confirm_broadcast": admin.handle_confirm_broadcast,
-                "adm_manage_reviews": admin.handle_adm_manage_reviews,
-                "adm_delete_review_confirm": admin.handle_adm_delete_review_confirm,
-                "adm_manage_welcome": admin.handle_adm_manage_welcome,
-                "adm_activate_welcome": admin.handle_adm_activate_welcome,
-                "adm_add_welcome_start": admin.handle_adm_add_welcome_start,
-                "adm_edit_welcome": admin.handle_adm_edit_welcome,
-                "adm_delete_welcome_confirm": admin.handle_adm_delete_welcome_confirm,
-                "adm_edit_welcome_text": admin.handle_adm_edit_welcome_text,
-                "adm_edit_welcome_desc": admin.handle_adm_edit_welcome_desc,
-                "adm_reset_default_confirm": admin.handle_reset_default_welcome,
-                "confirm_save_welcome": admin.handle_confirm_save_welcome,
-                # Bulk product handlers
-                "adm_bulk_city": admin.handle_adm_bulk_city,
-                "adm_bulk_dist": admin.handle_adm_bulk_dist,
-                "adm_bulk_type": admin.handle_adm_bulk_type,
-                "adm_bulk_add": admin.handle_adm_bulk_add,
-                "adm_bulk_size": admin.handle_adm_bulk_size,
-                "adm_bulk_custom_size": admin.handle_adm_bulk_custom_size,
-                "cancel_bulk_add": admin.cancel_bulk_add,
-                # New bulk message handlers
-                "adm_bulk_remove_last_message": admin.handle_adm_bulk_remove_last_message,
-                "adm_bulk_back_to_messages": admin.handle_adm_bulk_back_to_messages,
-                "adm_bulk_execute_messages": admin.handle_adm_bulk_execute_messages,
-                "adm_bulk_create_all": admin.handle_adm_bulk_confirm_all,
-
-                # Viewer Admin Handlers (from viewer_admin.py)
-                "viewer_admin_menu": handle_viewer_admin_menu,
-                "viewer_added_products": handle_viewer_added_products,
-                "viewer_view_product_media": handle_viewer_view_product_media,
-                "adm_manage_users": handle_manage_users_start,
-                "adm_view_user": handle_view_user_profile,
-                "adm_adjust_balance_start": handle_adjust_balance_start,
-                "adm_toggle_ban": handle_toggle_ban_user,
-
-                # Reseller Management Handlers (from reseller_management.py)
-                "manage_resellers_menu": handle_manage_resellers_menu,
-                "reseller_toggle_status": handle_reseller_toggle_status,
-                "manage_reseller_discounts_select_reseller": handle_manage_reseller_discounts_select_reseller,
-                "reseller_manage_specific": handle_manage_specific_reseller_discounts,
-                "reseller_add_discount_select_type": handle_reseller_add_discount_select_type,
-                "reseller_add_discount_enter_percent": handle_reseller_add_discount_enter_percent,
-                "reseller_edit_discount": handle_reseller_edit_discount,
-                "reseller_delete_discount_confirm": handle_reseller_delete_discount_confirm,
-
-                # Stock Handler (from stock.py)
-                "view_stock": handle_view_stock,
-                
-                # User Search Handlers (from admin.py)
-                "adm_search_user_start": admin.handle_adm_search_user_start,
-                "adm_user_deposits": admin.handle_adm_user_deposits,
-                "adm_user_purchases": admin.handle_adm_user_purchases,
-                "adm_user_actions": admin.handle_adm_user_actions,
-                "adm_user_discounts": admin.handle_adm_user_discounts,
-    "adm_debug_reseller_discount": admin.handle_adm_debug_reseller_discount,
-    "adm_recent_purchases": admin.handle_adm_recent_purchases,
-                "adm_user_overview": admin.handle_adm_user_overview,
-                "manual_payment_recovery": admin.handle_manual_payment_recovery,
-                
-                # Userbot Admin Callback Handlers
-                # Clean Userbot Handlers
-                "userbot_status": userbot_admin.handle_userbot_status,
-                "userbot_set_credentials": userbot_admin.handle_userbot_set_credentials,
-                # Note: Authentication handled via message flow, not callback buttons
-                "userbot_connect": userbot_admin.handle_userbot_connect,
-                "userbot_disconnect": userbot_admin.handle_userbot_disconnect,
-                "userbot_test": userbot_admin.handle_userbot_test,
-                "userbot_clear_config": userbot_admin.handle_userbot_clear_config,
-            }
-
-            target_func = KNOWN_HANDLERS.get(command)
-
-            if target_func and asyncio.iscoroutinefunction(target_func):
-                await target_func(update, context, params)
-            else:
+            # Routes are registered at import time via @callback_route in the handler modules
+            if not await router.dispatch_callback(command, update, context, params):
                 logger.warning(f"No async handler function found or mapped for callback command: {command}")
                 try: await query.answer("Unknown action.", show_alert=True)
                 except Exception as e: logger.error(f"Error answering unknown callback query {command}: {e}")
@@ -399,71 +254,6 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     state = context.user_data.get('state')
     logger.debug(f"Message received from user {user_id}, state: {state}")
 
-    STATE_HANDLERS = {
-        # User Handlers (from user.py)
-        'awaiting_review': user.handle_leave_review_message,
-        'awaiting_user_discount_code': user.handle_user_discount_code_message,
-        'awaiting_basket_discount_code': user.handle_basket_discount_code_message,
-        'awaiting_refill_amount': user.handle_refill_amount_message,
-        'awaiting_single_item_discount_code': user.handle_single_item_discount_code_message, # <<< ADDED
-        'awaiting_refill_crypto_choice': None,
-        'awaiting_basket_crypto_choice': None,
-
-        # Admin Message Handlers (from admin.py)
-        'awaiting_new_city_name': admin.handle_adm_add_city_message,
-        'awaiting_edit_city_name': admin.handle_adm_edit_city_message,
-        'awaiting_new_district_name': admin.handle_adm_add_district_message,
-        'awaiting_edit_district_name': admin.handle_adm_edit_district_message,
-        'awaiting_custom_size': admin.handle_adm_custom_size_message,
-        'awaiting_drop_details': admin.handle_adm_drop_details_message,
-        'awaiting_price': admin.handle_adm_price_message,
-        # Discount code message handlers
-        'awaiting_discount_code': admin.handle_adm_discount_code_message,
-        'awaiting_discount_value': admin.handle_adm_discount_value_message,
-        # Product type message handlers
-        'awaiting_new_type_name': admin.handle_adm_new_type_name_message,
-        'awaiting_edit_type_name': admin.handle_adm_edit_type_name_message,
-        'awaiting_new_type_emoji': admin.handle_adm_new_type_emoji_message,
-        'awaiting_new_type_description': admin.handle_adm_new_type_description_message,
-        'awaiting_edit_type_emoji': admin.handle_adm_edit_type_emoji_message,
-        # Bulk product message handlers
-        'awaiting_bulk_custom_size': admin.handle_adm_bulk_custom_size_message,
-        'awaiting_bulk_price': admin.handle_adm_bulk_price_message,
-        'awaiting_bulk_drop_details': admin.handle_adm_bulk_drop_details_message,
-        'awaiting_bulk_messages': admin.handle_adm_bulk_drop_details_message,
-
-        # User Management States (from viewer_admin.py)
-        'awaiting_balance_adjustment_amount': handle_adjust_balance_amount_message,
-        'awaiting_balance_adjustment_reason': handle_adjust_balance_reason_message,
-
-        # Reseller Management States (from reseller_management.py)
-        'awaiting_reseller_manage_id': handle_reseller_manage_id_message,
-        'awaiting_reseller_discount_percent': handle_reseller_percent_message,
-        
-        # User Search States (from admin.py)
-        'awaiting_search_username': admin.handle_adm_search_username_message,
-        
-        # Broadcast States (from admin.py)
-        'awaiting_broadcast_message': admin.handle_adm_broadcast_message,
-        'awaiting_broadcast_inactive_days': admin.handle_adm_broadcast_inactive_days_message,
-        
-        # Bot Media States (from admin.py)
-        'awaiting_bot_media': admin.handle_adm_bot_media_message,
-        
-        # Welcome Message States (from admin.py)
-        'awaiting_welcome_template_name': admin.handle_adm_welcome_template_name_message,
-        'awaiting_welcome_template_text': admin.handle_adm_welcome_template_text_message,
-        'awaiting_welcome_template_edit': admin.handle_adm_welcome_template_text_message,
-        'awaiting_welcome_description': admin.handle_adm_welcome_description_message,
-        'awaiting_welcome_description_edit': admin.handle_adm_welcome_description_message,
-        
-        # Manual Payment Recovery States (from admin.py)
-        'awaiting_payment_recovery_id': admin.handle_payment_recovery_id_message,
-        'awaiting_recovery_decision': admin.handle_recovery_decision_message,
-        
-        # Note: Userbot uses session-based handling, not state-based
-    }
-
     # Check if user is banned before processing ANY message (including state handlers)
     if await is_user_banned(user_id):
         logger.info(f"Ignoring message from banned user {user_id} (state: {state}).")
@@ -481,10 +271,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await userbot_admin.handle_userbot_message(update, context)
         return
     
-    handler_func = STATE_HANDLERS.get(state)
-    if handler_func:
+    # State handlers are registered at import time via @state_route in the handler modules
+    if state in router.STATE_ROUTES:
         logger.info(f"🔍 MESSAGE: Handling state '{state}' for user {user_id}")
-        await handler_func(update, context)
+        await router.dispatch_state(state, update, context)
     else:
         logger.debug(f"No handler found for user {user_id} in state: {state}")
         # Also log user data for debugging
@@ -526,7 +316,7 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
              logger.warning(f"Forbidden error for chat {chat_id} (User: {user_id}): Bot possibly blocked or kicked.")
              return
         elif isinstance(context.error, RetryAfter):
-             retry_seconds = context.error.retry_after + 1
+             retry_seconds = retry_after_seconds(context.error) + 1
              logger.warning(f"Rate limit hit during update processing for chat {chat_id}. Error: {context.error}")
              return
         elif isinstance(context.error, sqlite3.Error):
@@ -561,6 +351,7 @@ async def post_init(application: Application) -> None:
     ])
     
     # Userbot initialization is now handled in main thread
+    # Background services (payment events, delivery queue, broadcast resume) are started by main()
     
     logger.info("Post_init finished.")
 
@@ -577,6 +368,17 @@ async def post_shutdown(application: Application) -> None:
     except Exception as e:
         logger.error(f"❌ TELETHON USERBOT: Error disconnecting userbot: {e}")
     
+    # Stop the DB executor threads
+    shutdown_db_executor()
+    stop_db_writer()
+    close_db_pool()
+    logger.info(f"Slowest routes: {router.get_route_stats(top=10)}")
+    logger.info(f"User profile cache: {USER_PROFILES.get_stats()}")
+    try:
+        from userbot_simple import get_delivery_stats
+        logger.info(f"Userbot deliveries: {get_delivery_stats()}")
+    except Exception as e:
+        logger.error(f"❌ TELETHON USERBOT: Could not read delivery stats: {e}")
     logger.info("Post_shutdown finished.")
 
 async def _schedule_userbot_health_checks():
@@ -589,48 +391,66 @@ async def _schedule_userbot_health_checks():
     except Exception as e:
         logger.error(f"❌ USERBOT: Error setting up health checks: {e}")
 
-async def clear_expired_baskets_job_wrapper(context: ContextTypes.DEFAULT_TYPE):
-    logger.debug("Running background job: clear_expired_baskets_job")
+# --- Reservation Expiry Handlers (called by RESERVATION_EXPIRY at each deadline) ---
+async def expire_baskets_handler(user_ids: list):
+    await run_db(clear_all_expired_baskets) # Indexed range delete; covers every user due by now
+
+async def expire_payments_handler(payment_ids: list):
+    expired_user_notifications = await run_db(expire_pending_payments, payment_ids)
+    if expired_user_notifications and telegram_app:
+        await send_timeout_notifications(telegram_app.bot, expired_user_notifications)
+
+async def expire_abandoned_handler(user_ids: list):
+    await run_db(clean_abandoned_reservations)
+
+RESERVATION_EXPIRY.register('basket', expire_baskets_handler)
+RESERVATION_EXPIRY.register('payment', expire_payments_handler)
+RESERVATION_EXPIRY.register('abandoned', expire_abandoned_handler)
+
+async def reload_reservation_deadlines_job_wrapper(context: ContextTypes.DEFAULT_TYPE):
+    """Safety net: re-reads deadlines from the DB in case a write path did not schedule one."""
+    logger.debug("Running background job: reload_reservation_deadlines_job")
     try:
-        await asyncio.to_thread(clear_all_expired_baskets)
+        await RESERVATION_EXPIRY.reload()
     except Exception as e:
-        logger.error(f"Error in background job clear_expired_baskets_job: {e}", exc_info=True)
+        logger.error(f"Error in background job reload_reservation_deadlines_job: {e}", exc_info=True)
 
-async def clean_expired_payments_job_wrapper(context: ContextTypes.DEFAULT_TYPE):
-    logger.debug("Running background job: clean_expired_payments_job")
+
+async def reconcile_ban_cache_job_wrapper(context: ContextTypes.DEFAULT_TYPE):
+    logger.debug("Running background job: reconcile_ban_cache_job")
     try:
-        # Get the list of expired payments before cleaning them up
-        expired_user_notifications = await asyncio.to_thread(get_expired_payments_for_notification)
-        
-        # Clean up the expired payments
-        await asyncio.to_thread(clean_expired_pending_payments)
-        
-        # Send notifications to users
-        if expired_user_notifications:
-            await send_timeout_notifications(context, expired_user_notifications)
-            
+        await run_db(load_banned_users)
     except Exception as e:
-        logger.error(f"Error in background job clean_expired_payments_job: {e}", exc_info=True)
+        logger.error(f"Error in background job reconcile_ban_cache_job: {e}", exc_info=True)
 
-async def clean_abandoned_reservations_job_wrapper(context: ContextTypes.DEFAULT_TYPE):
-    logger.debug("Running background job: clean_abandoned_reservations_job")
+async def media_gc_job_wrapper(context: ContextTypes.DEFAULT_TYPE):
+    """Removes media blobs/legacy dirs no product references and migrates legacy files into the blob store."""
+    logger.debug("Running background job: media_gc_job")
     try:
-        await asyncio.to_thread(clean_abandoned_reservations)
+        await run_db(collect_media_garbage)
     except Exception as e:
-        logger.error(f"Error in background job clean_abandoned_reservations_job: {e}", exc_info=True)
+        logger.error(f"Error in background job media_gc_job: {e}", exc_info=True)
 
+async def conversation_eviction_job_wrapper(context: ContextTypes.DEFAULT_TYPE):
+    """Saves and drops idle users' user_data from memory; it is reloaded on their next update."""
+    logger.debug("Running background job: conversation_eviction_job")
+    try:
+        evicted = USER_STATE_PERSISTENCE.evict_idle(context.application)
+        if evicted: logger.info(f"Conversation store: evicted {evicted} idle user(s) from memory, {USER_STATE_PERSISTENCE.get_stats()}")
+    except Exception as e:
+        logger.error(f"Error in background job conversation_eviction_job: {e}", exc_info=True)
 
 async def payment_recovery_job_wrapper(context: ContextTypes.DEFAULT_TYPE):
     """BULLETPROOF: Wrapper for payment recovery job"""
     logger.debug("Running background job: payment_recovery_job")
     try:
         from utils import run_payment_recovery_job
-        await asyncio.to_thread(run_payment_recovery_job)
+        await run_db(run_payment_recovery_job)
     except Exception as e:
         logger.error(f"❌ BULLETPROOF: Error in payment recovery job: {e}", exc_info=True)
 
 
-async def send_timeout_notifications(context: ContextTypes.DEFAULT_TYPE, user_notifications: list):
+async def send_timeout_notifications(bot, user_notifications: list):
     """Send timeout notifications to users whose payments have expired."""
     for user_notification in user_notifications:
         user_id = user_notification['user_id']
@@ -641,7 +461,7 @@ async def send_timeout_notifications(context: ContextTypes.DEFAULT_TYPE, user_no
             notification_msg = lang_data.get("payment_timeout_notification", 
                 "⏰ Payment Timeout: Your payment for basket items has expired after 2 hours. Reserved items have been released.")
             
-            await send_message_with_retry(context.bot, user_id, notification_msg, parse_mode=None)
+            await send_message_with_retry(bot, user_id, notification_msg, parse_mode=None)
             logger.info(f"Sent payment timeout notification to user {user_id}")
             
         except Exception as e:
@@ -670,7 +490,7 @@ async def retry_purchase_finalization(user_id: int, basket_snapshot: list, disco
             if purchase_finalized:
                 logger.info(f"✅ SUCCESS: Purchase finalization retry succeeded for payment {payment_id} on attempt {attempt + 1}")
                 # Remove the pending deposit on success
-                await asyncio.to_thread(remove_pending_deposit, payment_id, trigger="retry_success")
+                await run_db(remove_pending_deposit, payment_id, trigger="retry_success")
                 return True
             else:
                 logger.warning(f"Purchase finalization retry failed for payment {payment_id} on attempt {attempt + 1}")
@@ -697,7 +517,7 @@ async def retry_purchase_finalization(user_id: int, basket_snapshot: list, disco
     return False
 
 
-# --- Flask Webhook Routes ---
+# --- NOWPayments Signature Verification ---
 def verify_nowpayments_signature(request_data_bytes, signature_header, secret_key):
     if not secret_key or not signature_header:
         logger.warning("IPN Secret Key or signature header missing. Cannot verify webhook.")
@@ -762,406 +582,415 @@ async def process_payment_with_retry(user_id: int, basket_snapshot: list, discou
     
     return False
 
-@flask_app.route("/webhook", methods=['POST'])
-def nowpayments_webhook():
-    global telegram_app, main_loop, NOWPAYMENTS_IPN_SECRET
-    
-    # CRITICAL: Log every webhook attempt
-    logger.info("🔍 WEBHOOK RECEIVED: NOWPayments webhook endpoint accessed")
-    logger.info(f"🔍 WEBHOOK DEBUG: Request method: {request.method}")
-    logger.info(f"🔍 WEBHOOK DEBUG: Request headers: {dict(request.headers)}")
-    logger.info(f"🔍 WEBHOOK DEBUG: Content length: {request.content_length}")
-    logger.info(f"🔍 WEBHOOK DEBUG: Remote address: {request.remote_addr}")
-    
-    if not telegram_app or not main_loop:
-        logger.error("Webhook received but Telegram app or event loop not initialized.")
-        return Response(status=503)
+# --- NOWPayments IPN Inbox Consumers ---
+# The webhook only verifies, stores and acknowledges an IPN; these consumers do the actual
+# processing on the main loop, so a slow purchase finalization never holds a server thread.
+PAYMENT_EVENT_WORKERS = int(os.environ.get("PAYMENT_EVENT_WORKERS", "4"))
+PAYMENT_EVENT_MAX_ATTEMPTS = 5
+PAYMENT_EVENT_RETRY_BASE_SECONDS = 5
+PAYMENT_EVENT_STOP_TIMEOUT_SECONDS = 30 # On shutdown, events being processed get this long to finish
+PAYMENT_SUCCESS_STATUSES = ('finished', 'confirmed', 'partially_paid')
+PAYMENT_FAILURE_STATUSES = ('failed', 'expired', 'refunded')
+
+payment_event_queue: asyncio.Queue | None = None
+_payment_event_workers: list[asyncio.Task] = []
+_busy_payment_event_workers: set[asyncio.Task] = set() # Workers in the middle of an event
+_payment_locks: dict[str, list] = {} # {payment_id: [lock, users]} serializes events of one payment ('confirmed' then 'finished')
+
+
+class PaymentEventFailed(Exception):
+    """Terminal processing failure: recorded as 'failed' and reported, never retried automatically."""
+
+
+def enqueue_payment_event(event_id: int):
+    """Hands a stored event to the consumers. Must run on the main loop."""
+    if payment_event_queue is None:
+        logger.warning(f"Payment event {event_id} stored but consumers not running; it will be picked up on next start.")
+        return
+    payment_event_queue.put_nowait(event_id)
+
+
+async def _notify_primary_admin(text: str):
+    admin_id = get_first_primary_admin_id()
+    if admin_id and telegram_app:
+        await send_message_with_retry(telegram_app.bot, admin_id, text, parse_mode=None)
+
+
+async def _paid_eur_equivalent(log_prefix: str, payment_id, pay_currency: str, actually_paid_decimal: Decimal,
+                               expected_crypto_decimal: Decimal, target_eur_decimal: Decimal) -> Decimal | None:
+    """Converts the paid crypto amount to EUR. Returns None if it cannot be calculated."""
+    try:
+        crypto_price_eur = await asyncio.to_thread(get_crypto_price_eur, pay_currency)
+    except Exception as price_e:
+        logger.error(f"{log_prefix} {payment_id}: Error getting crypto price: {price_e}. Using proportion fallback.")
+        crypto_price_eur = None
+    if crypto_price_eur and crypto_price_eur > Decimal('0.0'):
+        logger.info(f"{log_prefix} {payment_id}: Used real-time price {crypto_price_eur} EUR/{pay_currency.upper()} for conversion.")
+        return (actually_paid_decimal * crypto_price_eur).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+    # Fallback to proportion method if price fetch fails
+    logger.warning(f"{log_prefix} {payment_id}: Could not get real-time price for {pay_currency}. Falling back to proportion method.")
+    if expected_crypto_decimal > Decimal('0.0'):
+        proportion = actually_paid_decimal / expected_crypto_decimal
+        return (proportion * target_eur_decimal).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+    logger.error(f"{log_prefix} {payment_id}: Cannot calculate EUR equivalent (expected crypto amount is zero).")
+    return None
+
+
+async def process_payment_event(data: dict) -> str:
+    """
+    Applies one verified NOWPayments IPN. Returns a short outcome for the inbox row.
+    Raises PaymentEventFailed for terminal failures; any other exception is retried by the consumer.
+    """
+    payment_id = data.get('payment_id')
+    status = data.get('payment_status')
+    pay_currency = data.get('pay_currency')
+    actually_paid_str = data.get('actually_paid')
+    order_id = data.get('order_id')
+
+    if not telegram_app:
+        raise RuntimeError("Telegram app not ready")
+
+    if status in PAYMENT_FAILURE_STATUSES:
+        logger.warning(f"Payment {payment_id} has status '{status}'. Removing pending record.")
+        pending_info_for_removal = await run_db(get_pending_deposit, payment_id)
+        await run_db(remove_pending_deposit, payment_id, trigger="failure" if status == 'failed' else "expiry")
+        if pending_info_for_removal:
+            user_id = pending_info_for_removal['user_id']
+            is_purchase_failure = pending_info_for_removal.get('is_purchase') == 1
+            try:
+                user_lang = 'en'
+                try:
+                    lang_res = await USER_PROFILES.get_async(user_id)
+                    if lang_res and lang_res['language'] in LANGUAGES: user_lang = lang_res['language']
+                except Exception as lang_e: logger.error(f"Failed to get lang for user {user_id} notify: {lang_e}")
+                lang_data_local = LANGUAGES.get(user_lang, LANGUAGES['en'])
+                if is_purchase_failure: fail_msg = lang_data_local.get("crypto_purchase_failed", "Payment Failed/Expired. Your items are no longer reserved.")
+                else: fail_msg = lang_data_local.get("payment_cancelled_or_expired", "Payment Status: Your payment ({payment_id}) was cancelled or expired.").format(payment_id=payment_id)
+                await send_message_with_retry(telegram_app.bot, user_id, fail_msg, parse_mode=None)
+            except Exception as notify_e: logger.error(f"Error notifying user {user_id} about failed/expired payment {payment_id}: {notify_e}")
+        return f"removed_{status}"
+
+    logger.info(f"🚀 BULLETPROOF: Processing '{status}' payment: {payment_id}")
+    logger.info(f"📊 BULLETPROOF: Payment details - Amount: {actually_paid_str} {pay_currency}, Order: {order_id}")
+
+    try:
+        actually_paid_decimal = Decimal(str(actually_paid_str))
+    except (ArithmeticError, ValueError, TypeError) as e:
+        raise PaymentEventFailed(f"Invalid number format in webhook data: {e}")
+
+    # CRITICAL: A missing pending deposit means the payment was already processed (duplicate/second IPN)
+    pending_info = await run_db(get_pending_deposit, payment_id)
+    if not pending_info:
+        logger.info(f"ℹ️ Pending deposit {payment_id} not found (likely already processed).")
+        return "already_processed"
+
+    if actually_paid_decimal <= 0:
+        logger.warning(f"⚠️ Ignoring webhook for payment {payment_id} with zero 'actually_paid'.")
+        if status != 'confirmed': # Only remove if not yet confirmed, might be a final "zero paid" update after other partials
+            await run_db(remove_pending_deposit, payment_id, trigger="zero_paid")
+        return "zero_paid"
+
+    user_id = pending_info['user_id']
+    stored_currency = pending_info['currency']
+    target_eur_decimal = Decimal(str(pending_info['target_eur_amount']))
+    expected_crypto_decimal = Decimal(str(pending_info.get('expected_crypto_amount', '0.0')))
+    is_purchase = pending_info.get('is_purchase') == 1
+    basket_snapshot = pending_info.get('basket_snapshot')
+    discount_code_used = pending_info.get('discount_code_used')
+    log_prefix = "PURCHASE" if is_purchase else "REFILL"
+
+    if stored_currency.lower() != str(pay_currency).lower():
+        logger.error(f"Currency mismatch {log_prefix} {payment_id}. DB: {stored_currency}, Webhook: {pay_currency}")
+        await run_db(remove_pending_deposit, payment_id, trigger="currency_mismatch")
+        raise PaymentEventFailed(f"Currency mismatch (DB: {stored_currency}, IPN: {pay_currency})")
+
+    paid_eur_equivalent = await _paid_eur_equivalent(log_prefix, payment_id, pay_currency, actually_paid_decimal,
+                                                     expected_crypto_decimal, target_eur_decimal)
+    if paid_eur_equivalent is None:
+        await run_db(remove_pending_deposit, payment_id, trigger="zero_expected_crypto")
+        raise PaymentEventFailed("Cannot calculate EUR equivalent")
+
+    logger.info(f"{log_prefix} {payment_id}: User {user_id} paid {actually_paid_decimal} {pay_currency}. Approx EUR value: {paid_eur_equivalent:.2f}. Target EUR: {target_eur_decimal:.2f}")
+
+    dummy_context = ContextTypes.DEFAULT_TYPE(application=telegram_app, chat_id=user_id, user_id=user_id)
+
+    if not is_purchase: # Refill
+        credited_eur_amount = paid_eur_equivalent
+        if credited_eur_amount <= 0:
+            logger.warning(f"{log_prefix} {payment_id} ({status}): Calculated credited EUR is zero for user {user_id}. Removing pending deposit without updating balance.")
+            await run_db(remove_pending_deposit, payment_id, trigger="zero_credit")
+            return "zero_credit"
+        try:
+            db_update_success = await payment.process_successful_refill(user_id, credited_eur_amount, payment_id, dummy_context)
+        except Exception as e:
+            # Not retried: the balance may already have been credited
+            logger.error(f"Error in process_successful_refill for {payment_id}: {e}. Pending deposit NOT removed.", exc_info=True)
+            raise PaymentEventFailed(f"Refill processing error: {e}")
+        if not db_update_success:
+            logger.critical(f"CRITICAL: {log_prefix} {payment_id} ({status}) processed, but process_successful_refill FAILED for user {user_id}. Pending deposit NOT removed. Manual intervention required.")
+            raise PaymentEventFailed("process_successful_refill failed")
+        await run_db(remove_pending_deposit, payment_id, trigger="refill_success")
+        logger.info(f"Successfully processed and removed pending deposit {payment_id} (Status: {status})")
+        return "refill_success"
+
+    # CRITICAL: Check payment amount BEFORE processing to prevent underpayment exploitation
+    if paid_eur_equivalent < target_eur_decimal:
+        # Underpayment: Reject payment, credit balance, don't give product
+        underpaid_eur = (target_eur_decimal - paid_eur_equivalent).quantize(Decimal("0.01"), rounding=ROUND_DOWN)
+        logger.warning(f"❌ UNDERPAYMENT REJECTED: User {user_id} paid {paid_eur_equivalent:.2f} EUR for {target_eur_decimal:.2f} EUR product. Short by {underpaid_eur:.2f} EUR. Crediting balance, NO PRODUCT DELIVERED.")
+        credit_success = False
+        try:
+            credit_success = await credit_user_balance(user_id, paid_eur_equivalent, f"Underpayment refund on purchase {payment_id}", dummy_context)
+        except Exception as e:
+            logger.error(f"Error crediting underpayment refund for {payment_id}: {e}", exc_info=True)
+        if not credit_success:
+            logger.critical(f"CRITICAL: Failed to credit balance for underpayment {payment_id} user {user_id}. Amount: {paid_eur_equivalent:.2f} EUR. MANUAL CHECK NEEDED!")
+        underpay_msg = f"❌ Payment Rejected: Underpayment detected!\n\nYou paid: {paid_eur_equivalent:.2f} EUR\nRequired: {target_eur_decimal:.2f} EUR\nShort by: {underpaid_eur:.2f} EUR\n\nYour payment has been refunded to your balance. Please try again with the correct amount."
+        await send_message_with_retry(telegram_app.bot, user_id, underpay_msg, parse_mode=None)
+        await run_db(remove_pending_deposit, payment_id, trigger="underpayment_rejected")
+        logger.info(f"Processed underpaid purchase {payment_id} for user {user_id}. Balance credited, items NOT delivered.")
+        return "underpayment_rejected"
+
+    # Process payment (overpayment or exact payment) - only if amount is sufficient
+    logger.info(f"🔄 BULLETPROOF: Starting purchase finalization for {payment_id} user {user_id}. Paid {paid_eur_equivalent:.2f} EUR, target {target_eur_decimal:.2f} EUR.")
+    purchase_finalized = await process_payment_with_retry(user_id, basket_snapshot, discount_code_used, payment_id, dummy_context)
+    if not purchase_finalized:
+        # DO NOT remove pending deposit - keep it for manual recovery
+        logger.critical(f"🚨 CRITICAL: {log_prefix} {payment_id} paid, but process_successful_crypto_purchase FAILED for user {user_id}. Pending deposit NOT removed. Manual intervention required.")
+        raise PaymentEventFailed("Purchase finalization failed after successful payment")
+
+    logger.info(f"✅ BULLETPROOF: Purchase finalization SUCCESSFUL for {payment_id} user {user_id}")
+    if paid_eur_equivalent > target_eur_decimal:
+        # Overpayment: Give product + credit excess
+        overpaid_eur = (paid_eur_equivalent - target_eur_decimal).quantize(Decimal("0.01"), rounding=ROUND_DOWN)
+        logger.info(f"💰 BULLETPROOF: Overpayment detected. User {user_id} paid {paid_eur_equivalent:.2f} EUR for {target_eur_decimal:.2f} EUR product. Crediting {overpaid_eur:.2f} EUR to balance.")
+        try:
+            await credit_user_balance(user_id, overpaid_eur, f"Overpayment on purchase {payment_id}", dummy_context)
+            overpay_msg = f"✅ Purchase successful! You overpaid by {overpaid_eur:.2f} EUR. The excess has been added to your balance."
+            await send_message_with_retry(telegram_app.bot, user_id, overpay_msg, parse_mode=None)
+        except Exception as e:
+            logger.error(f"Error crediting overpayment for {payment_id}: {e}", exc_info=True)
+    else:
+        logger.info(f"💰 BULLETPROOF: Exact payment. User {user_id} paid exactly {paid_eur_equivalent:.2f} EUR for {target_eur_decimal:.2f} EUR product.")
+
+    # CRITICAL: Only remove pending deposit AFTER confirming complete success
+    await run_db(remove_pending_deposit, payment_id, trigger="purchase_success")
+    logger.info(f"✅ COMPLETE SUCCESS: {log_prefix} {payment_id} fully processed and pending record removed for user {user_id}")
+    return "purchase_success"
+
+
+async def _handle_payment_event(event_id: int):
+    event = await run_db(claim_payment_event, event_id)
+    if not event: return # Already handled (duplicate enqueue)
+    payment_id = event['payment_id']
+    lock_entry = _payment_locks.setdefault(payment_id, [asyncio.Lock(), 0])
+    lock_entry[1] += 1
+    lock = lock_entry[0]
+    try:
+        async with lock:
+            try:
+                outcome = await process_payment_event(json.loads(event['payload']))
+            except PaymentEventFailed as e:
+                await run_db(finish_payment_event, event_id, 'failed', error=str(e))
+                await _notify_primary_admin(f"🚨 CRITICAL: Payment {payment_id} ({event['payment_status']}) failed: {e}. Manual intervention required!")
+                return
+            except Exception as e:
+                attempts = event['attempts']
+                if attempts >= PAYMENT_EVENT_MAX_ATTEMPTS:
+                    logger.critical(f"🚨 CRITICAL: Payment event {event_id} ({payment_id}) failed after {attempts} attempts: {e}", exc_info=True)
+                    await run_db(finish_payment_event, event_id, 'failed', error=str(e))
+                    await _notify_primary_admin(f"🚨 CRITICAL: Payment {payment_id} could not be processed after {attempts} attempts: {e}. Payment kept for manual recovery!")
+                    return
+                retry_in = PAYMENT_EVENT_RETRY_BASE_SECONDS * (3 ** (attempts - 1))
+                logger.warning(f"Payment event {event_id} ({payment_id}) attempt {attempts}/{PAYMENT_EVENT_MAX_ATTEMPTS} failed: {e}. Retrying in {retry_in}s.", exc_info=True)
+                await run_db(finish_payment_event, event_id, 'pending', error=str(e))
+                asyncio.get_running_loop().call_later(retry_in, enqueue_payment_event, event_id)
+                return
+            await run_db(finish_payment_event, event_id, 'done', result=outcome)
+            logger.info(f"Payment event {event_id} ({payment_id}, {event['payment_status']}) done: {outcome}")
+    finally:
+        lock_entry[1] -= 1
+        if lock_entry[1] == 0: _payment_locks.pop(payment_id, None)
+
+
+async def _payment_event_worker(queue: asyncio.Queue):
+    worker = asyncio.current_task()
+    while queue is payment_event_queue: # Detached by stop_payment_event_consumers: finish the current event, then exit
+        event_id = await queue.get()
+        _busy_payment_event_workers.add(worker)
+        try:
+            await _handle_payment_event(event_id)
+        except Exception as e:
+            logger.error(f"Unexpected error handling payment event {event_id}: {e}", exc_info=True)
+        finally:
+            _busy_payment_event_workers.discard(worker)
+            queue.task_done()
+
+
+async def start_payment_event_consumers():
+    """Starts the consumer pool and re-queues events left unfinished by a previous process."""
+    global payment_event_queue
+    payment_event_queue = asyncio.Queue()
+    _payment_event_workers.extend(asyncio.create_task(_payment_event_worker(payment_event_queue)) for _ in range(PAYMENT_EVENT_WORKERS))
+    unfinished = await run_db(get_unfinished_payment_event_ids)
+    for event_id in unfinished: payment_event_queue.put_nowait(event_id)
+    logger.info(f"Payment event consumers started ({PAYMENT_EVENT_WORKERS} workers, {len(unfinished)} unfinished event(s) re-queued).")
+
+
+async def stop_payment_event_consumers(timeout: float = PAYMENT_EVENT_STOP_TIMEOUT_SECONDS):
+    """Stops taking events, lets the ones being processed finish, then cancels the workers.
+    Queued events stay 'pending' in the inbox and are re-queued on the next start."""
+    global payment_event_queue
+    payment_event_queue = None # New IPNs are only stored from now on
+    busy = [worker for worker in _payment_event_workers if worker in _busy_payment_event_workers]
+    for worker in _payment_event_workers:
+        if worker not in _busy_payment_event_workers: worker.cancel()
+    if busy:
+        logger.info(f"Waiting up to {timeout:.0f}s for {len(busy)} payment event(s) in progress.")
+        _, pending = await asyncio.wait(busy, timeout=timeout)
+        if pending:
+            # Left 'processing'; the next start puts them back to pending
+            logger.warning(f"Cancelling {len(pending)} payment event worker(s) still busy after {timeout:.0f}s.")
+            for worker in pending: worker.cancel()
+    await asyncio.gather(*_payment_event_workers, return_exceptions=True)
+    _payment_event_workers.clear()
+
+
+# --- ASGI Webhook Routes ---
+# Served by uvicorn on the same event loop as telegram_app: handlers await PTB and the DB facade directly.
+WEBHOOK_MAX_BODY_BYTES = 10240 # 10KB limit for NOWPayments IPNs
+WEB_KEEP_ALIVE_SECONDS = int(os.environ.get("WEB_KEEP_ALIVE_SECONDS", "75")) # Outlive Telegram's/proxy idle connections
+
+async def nowpayments_webhook(request: Request) -> Response:
+    """Verifies a NOWPayments IPN, stores it in the payment_events inbox and acknowledges immediately."""
+    client_host = request.client.host if request.client else "unknown"
+    content_length = int(request.headers.get('content-length') or 0)
+    logger.info(f"🔍 WEBHOOK RECEIVED: NOWPayments IPN from {client_host} ({content_length} bytes)")
+
+    if not telegram_app:
+        logger.error("Webhook received but Telegram app not initialized.")
+        return Response(status_code=503)
 
     # Check request size limit
-    content_length = request.content_length
-    if content_length and content_length > 10240:  # 10KB limit
+    if content_length > WEBHOOK_MAX_BODY_BYTES:
         logger.warning(f"Webhook request too large: {content_length} bytes")
-        return Response("Request too large", status=413)
+        return PlainTextResponse("Request too large", status_code=413)
 
-    raw_body = request.get_data() # Get raw body once
+    raw_body = await request.body() # Get raw body once
+    if len(raw_body) > WEBHOOK_MAX_BODY_BYTES:
+        logger.warning(f"Webhook request too large: {len(raw_body)} bytes")
+        return PlainTextResponse("Request too large", status_code=413)
     signature = request.headers.get('x-nowpayments-sig')
 
     # BULLETPROOF: MANDATORY signature verification for security and reliability
     if not NOWPAYMENTS_IPN_SECRET:
         logger.critical("❌ CRITICAL SECURITY ERROR: NOWPAYMENTS_IPN_SECRET not configured! Rejecting all webhooks for security.")
-        return Response("IPN Secret not configured", status=500)
-    
+        return PlainTextResponse("IPN Secret not configured", status_code=500)
+
     if not signature:
         logger.warning("❌ SECURITY REJECTION: No signature header received from webhook. Rejecting for security.")
-        return Response("Missing signature header", status=400)
-    
+        return PlainTextResponse("Missing signature header", status_code=400)
+
     if not verify_nowpayments_signature(raw_body, signature, NOWPAYMENTS_IPN_SECRET):
         logger.warning("❌ SECURITY REJECTION: NOWPayments signature verification FAILED - webhook is fake or corrupted")
-        return Response("Invalid signature", status=400)
-    
-    logger.info("✅ NOWPayments signature verification PASSED - webhook is authentic")
-
-    logger.info(f"NOWPayments IPN Received (signature verification {'PASSED' if NOWPAYMENTS_IPN_SECRET and signature else 'SKIPPED'})")
-    
-    # Add webhook debugging
-    logger.info(f"🔍 WEBHOOK DEBUG: Raw body length: {len(raw_body)} bytes")
-    logger.info(f"🔍 WEBHOOK DEBUG: Signature header: {signature}")
-    logger.info(f"🔍 WEBHOOK DEBUG: IPN Secret configured: {bool(NOWPAYMENTS_IPN_SECRET)}")
-    logger.info(f"🔍 WEBHOOK DEBUG: Webhook URL: {WEBHOOK_URL}/webhook")
+        return PlainTextResponse("Invalid signature", status_code=400)
 
+    logger.info("✅ NOWPayments signature verification PASSED - webhook is authentic")
 
     try:
         data = json.loads(raw_body) # Parse JSON from raw body
     except json.JSONDecodeError:
         logger.warning("Webhook received non-JSON request.")
-        return Response("Invalid Request: Not JSON", status=400)
+        return PlainTextResponse("Invalid Request: Not JSON", status_code=400)
 
     logger.info(f"NOWPayments IPN Data: {json.dumps(data)}") # Log the parsed data
 
     required_keys = ['payment_id', 'payment_status', 'pay_currency', 'actually_paid']
     if not all(key in data for key in required_keys):
         logger.error(f"Webhook missing required keys. Data: {data}")
-        return Response("Missing required keys", status=400)
+        return PlainTextResponse("Missing required keys", status_code=400)
 
-    payment_id = data.get('payment_id')
+    payment_id = str(data.get('payment_id'))
     status = data.get('payment_status')
-    pay_currency = data.get('pay_currency')
-    actually_paid_str = data.get('actually_paid')
-    parent_payment_id = data.get('parent_payment_id')
-    order_id = data.get('order_id')
 
-    if parent_payment_id:
-         logger.info(f"Ignoring child payment webhook update {payment_id} (parent: {parent_payment_id}).")
-         return Response("Child payment ignored", status=200)
+    if data.get('parent_payment_id'):
+        logger.info(f"Ignoring child payment webhook update {payment_id} (parent: {data.get('parent_payment_id')}).")
+        return PlainTextResponse("Child payment ignored", status_code=200)
 
-    if status in ['finished', 'confirmed', 'partially_paid'] and actually_paid_str is not None:
-        logger.info(f"🚀 BULLETPROOF: Processing '{status}' payment: {payment_id}")
-        logger.info(f"📊 BULLETPROOF: Payment details - Amount: {actually_paid_str} {pay_currency}, Order: {order_id}")
-        
-        # CRITICAL: Check if payment was already processed to prevent duplicate processing
-        try:
-            existing_pending = asyncio.run_coroutine_threadsafe(
-                asyncio.to_thread(get_pending_deposit, payment_id), main_loop
-            ).result(timeout=5)
-            
-            if not existing_pending:
-                logger.warning(f"⚠️ Payment {payment_id} with status '{status}' already processed or not found. Skipping to prevent duplicate processing.")
-                return Response("Payment already processed", status=200)
-        except Exception as check_e:
-            logger.error(f"❌ Error checking existing payment {payment_id}: {check_e}")
-            # Continue processing if check fails
-        
-        try:
-            actually_paid_decimal = Decimal(str(actually_paid_str))
-            if actually_paid_decimal <= 0:
-                logger.warning(f"⚠️ Ignoring webhook for payment {payment_id} with zero 'actually_paid'.")
-                if status != 'confirmed': # Only remove if not yet confirmed, might be a final "zero paid" update after other partials
-                    asyncio.run_coroutine_threadsafe(asyncio.to_thread(remove_pending_deposit, payment_id, trigger="zero_paid"), main_loop)
-                return Response("Zero amount paid", status=200)
-
-            # BULLETPROOF: Get pending info with timeout and retry
-            pending_info = None
-            for attempt in range(3):  # 3 attempts with exponential backoff
-                try:
-                    pending_info = asyncio.run_coroutine_threadsafe(
-                        asyncio.to_thread(get_pending_deposit, payment_id), main_loop
-                    ).result(timeout=10)  # 10 second timeout
-                    break
-                except asyncio.TimeoutError:
-                    logger.warning(f"⏰ Timeout getting pending info for {payment_id}, attempt {attempt + 1}/3")
-                    if attempt < 2:  # Don't sleep on last attempt
-                        time.sleep(1 * (attempt + 1))  # Exponential backoff
-                except Exception as e:
-                    logger.error(f"❌ Error getting pending info for {payment_id}, attempt {attempt + 1}/3: {e}")
-                    if attempt < 2:
-                        time.sleep(1 * (attempt + 1))
-
-            if not pending_info:
-                 logger.info(f"ℹ️ Webhook Info: Pending deposit {payment_id} not found (likely already processed).")
-                 return Response("Pending deposit not found", status=200)
-
-            user_id = pending_info['user_id']
-            stored_currency = pending_info['currency']
-            target_eur_decimal = Decimal(str(pending_info['target_eur_amount']))
-            expected_crypto_decimal = Decimal(str(pending_info.get('expected_crypto_amount', '0.0')))
-            is_purchase = pending_info.get('is_purchase') == 1
-            basket_snapshot = pending_info.get('basket_snapshot')
-            discount_code_used = pending_info.get('discount_code_used')
-            log_prefix = "PURCHASE" if is_purchase else "REFILL"
-
-            if stored_currency.lower() != pay_currency.lower():
-                 logger.error(f"Currency mismatch {log_prefix} {payment_id}. DB: {stored_currency}, Webhook: {pay_currency}")
-                 asyncio.run_coroutine_threadsafe(asyncio.to_thread(remove_pending_deposit, payment_id, trigger="currency_mismatch"), main_loop)
-                 return Response("Currency mismatch", status=400)
-
-            paid_eur_equivalent = Decimal('0.0')
-            # Use real-time crypto price conversion instead of proportion-based calculation
-            try:
-                crypto_price_future = asyncio.run_coroutine_threadsafe(
-                    asyncio.to_thread(get_crypto_price_eur, pay_currency), main_loop
-                )
-                crypto_price_eur = crypto_price_future.result(timeout=10)
-                
-                if crypto_price_eur and crypto_price_eur > Decimal('0.0'):
-                    paid_eur_equivalent = (actually_paid_decimal * crypto_price_eur).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-                    logger.info(f"{log_prefix} {payment_id}: Used real-time price {crypto_price_eur} EUR/{pay_currency.upper()} for conversion.")
-                else:
-                    logger.warning(f"{log_prefix} {payment_id}: Could not get real-time price for {pay_currency}. Falling back to proportion method.")
-                    # Fallback to proportion method if price fetch fails
-                    if expected_crypto_decimal > Decimal('0.0'):
-                        proportion = actually_paid_decimal / expected_crypto_decimal
-                        paid_eur_equivalent = (proportion * target_eur_decimal).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-                    else:
-                        logger.error(f"{log_prefix} {payment_id}: Cannot calculate EUR equivalent (expected crypto amount is zero).")
-                        asyncio.run_coroutine_threadsafe(asyncio.to_thread(remove_pending_deposit, payment_id, trigger="zero_expected_crypto"), main_loop)
-                        return Response("Cannot calculate EUR equivalent", status=400)
-            except Exception as price_e:
-                logger.error(f"{log_prefix} {payment_id}: Error getting crypto price: {price_e}. Using proportion fallback.")
-                # Fallback to proportion method if price API fails
-                if expected_crypto_decimal > Decimal('0.0'):
-                    proportion = actually_paid_decimal / expected_crypto_decimal
-                    paid_eur_equivalent = (proportion * target_eur_decimal).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-                else:
-                    logger.error(f"{log_prefix} {payment_id}: Cannot calculate EUR equivalent (expected crypto amount is zero).")
-                    asyncio.run_coroutine_threadsafe(asyncio.to_thread(remove_pending_deposit, payment_id, trigger="zero_expected_crypto"), main_loop)
-                    return Response("Cannot calculate EUR equivalent", status=400)
-
-            logger.info(f"{log_prefix} {payment_id}: User {user_id} paid {actually_paid_decimal} {pay_currency}. Approx EUR value: {paid_eur_equivalent:.2f}. Target EUR: {target_eur_decimal:.2f}")
-
-            dummy_context = ContextTypes.DEFAULT_TYPE(application=telegram_app, chat_id=user_id, user_id=user_id) if telegram_app else None
-            if not dummy_context:
-                logger.error(f"Cannot process {log_prefix} {payment_id}, telegram_app not ready.")
-                return Response("Internal error: App not ready", status=503)
-
-            if is_purchase:
-                # CRITICAL: Check payment amount BEFORE processing to prevent underpayment exploitation
-                if paid_eur_equivalent < target_eur_decimal:
-                    # Underpayment: Reject payment, credit balance, don't give product
-                    underpaid_eur = (target_eur_decimal - paid_eur_equivalent).quantize(Decimal("0.01"), rounding=ROUND_DOWN)
-                    logger.warning(f"❌ UNDERPAYMENT REJECTED: User {user_id} paid {paid_eur_equivalent:.2f} EUR for {target_eur_decimal:.2f} EUR product. Short by {underpaid_eur:.2f} EUR. Crediting balance, NO PRODUCT DELIVERED.")
-                    
-                    # Credit the received amount to user's balance
-                    credit_future = asyncio.run_coroutine_threadsafe(
-                        credit_user_balance(user_id, paid_eur_equivalent, f"Underpayment refund on purchase {payment_id}", dummy_context),
-                        main_loop
-                    )
-                    credit_success = False
-                    try: 
-                        credit_success = credit_future.result(timeout=30)
-                    except Exception as e: 
-                        logger.error(f"Error crediting underpayment refund for {payment_id}: {e}", exc_info=True)
-                    
-                    if not credit_success:
-                        logger.critical(f"CRITICAL: Failed to credit balance for underpayment {payment_id} user {user_id}. Amount: {paid_eur_equivalent:.2f} EUR. MANUAL CHECK NEEDED!")
-                    
-                    # Send rejection message to user
-                    underpay_msg = f"❌ Payment Rejected: Underpayment detected!\n\nYou paid: {paid_eur_equivalent:.2f} EUR\nRequired: {target_eur_decimal:.2f} EUR\nShort by: {underpaid_eur:.2f} EUR\n\nYour payment has been refunded to your balance. Please try again with the correct amount."
-                    asyncio.run_coroutine_threadsafe(send_message_with_retry(telegram_app.bot, user_id, underpay_msg, parse_mode=None), main_loop)
-                    
-                    # Remove pending deposit as failed
-                    asyncio.run_coroutine_threadsafe(asyncio.to_thread(remove_pending_deposit, payment_id, trigger="underpayment_rejected"), main_loop)
-                    logger.info(f"Processed underpaid purchase {payment_id} for user {user_id}. Balance credited, items NOT delivered.")
-                    return Response("Underpayment rejected", status=200)
-                
-                # Process payment (overpayment or exact payment) - only if amount is sufficient
-                logger.info(f"{log_prefix} {payment_id}: Processing payment for user {user_id}. Paid {paid_eur_equivalent:.2f} EUR, target {target_eur_decimal:.2f} EUR.")
-                
-                # BULLETPROOF: Use the improved payment processing with retry and comprehensive error handling
-                logger.info(f"🔄 BULLETPROOF: Starting purchase finalization for {payment_id} user {user_id}")
-                
-                finalize_future = asyncio.run_coroutine_threadsafe(
-                    process_payment_with_retry(user_id, basket_snapshot, discount_code_used, payment_id, dummy_context),
-                    main_loop
-                )
-                purchase_finalized = False
-                
-                # BULLETPROOF: Multiple timeout attempts with different strategies
-                for attempt in range(3):
-                    try: 
-                        logger.info(f"🔄 BULLETPROOF: Purchase finalization attempt {attempt + 1}/3 for {payment_id}")
-                        purchase_finalized = finalize_future.result(timeout=180)  # 3 minutes per attempt
-                        break
-                    except asyncio.TimeoutError:
-                        logger.warning(f"⏰ BULLETPROOF: Purchase finalization timeout attempt {attempt + 1}/3 for {payment_id}")
-                        if attempt < 2:  # Not the last attempt
-                            # Try to cancel the future and restart
-                            finalize_future.cancel()
-                            time.sleep(5)  # Wait 5 seconds
-                            # Restart the process
-                            finalize_future = asyncio.run_coroutine_threadsafe(
-                                process_payment_with_retry(user_id, basket_snapshot, discount_code_used, payment_id, dummy_context),
-                                main_loop
-                            )
-                        else:
-                            # Last attempt failed
-                            logger.critical(f"🚨 CRITICAL TIMEOUT: Purchase finalization for {payment_id} user {user_id} failed after 3 attempts. Payment may be lost!")
-                            # Notify admin immediately about timeout
-                            if get_first_primary_admin_id():
-                                asyncio.run_coroutine_threadsafe(
-                                    send_message_with_retry(telegram_app.bot, get_first_primary_admin_id(), 
-                                        f"🚨 CRITICAL TIMEOUT: Purchase {payment_id} for user {user_id} failed after 3 attempts. Payment may be lost! Manual intervention required!"),
-                                    main_loop
-                                )
-                            # DO NOT remove pending deposit - keep it for manual recovery
-                            return Response("Purchase finalization timeout - payment kept for manual recovery", status=500)
-                    except Exception as e: 
-                        logger.critical(f"🚨 CRITICAL ERROR: Purchase finalization for {payment_id} user {user_id} failed with error: {e}. Payment may be lost!")
-                        # Notify admin about the error
-                        if get_first_primary_admin_id():
-                            asyncio.run_coroutine_threadsafe(
-                                send_message_with_retry(telegram_app.bot, get_first_primary_admin_id(), 
-                                    f"🚨 CRITICAL ERROR: Purchase {payment_id} for user {user_id} failed with error: {str(e)}. Payment may be lost! Manual intervention required!"),
-                                main_loop
-                            )
-                        # DO NOT remove pending deposit - keep it for manual recovery
-                        return Response("Purchase finalization error - payment kept for manual recovery", status=500)
-
-                # Process payment (overpayment or exact payment)
-                if purchase_finalized:
-                    logger.info(f"✅ BULLETPROOF: Purchase finalization SUCCESSFUL for {payment_id} user {user_id}")
-                    
-                    # Handle overpayment/exact payment
-                    if paid_eur_equivalent > target_eur_decimal:
-                        # Overpayment: Give product + credit excess
-                        overpaid_eur = (paid_eur_equivalent - target_eur_decimal).quantize(Decimal("0.01"), rounding=ROUND_DOWN)
-                        logger.info(f"💰 BULLETPROOF: Overpayment detected. User {user_id} paid {paid_eur_equivalent:.2f} EUR for {target_eur_decimal:.2f} EUR product. Crediting {overpaid_eur:.2f} EUR to balance.")
-                        credit_future = asyncio.run_coroutine_threadsafe(
-                            credit_user_balance(user_id, overpaid_eur, f"Overpayment on purchase {payment_id}", dummy_context),
-                            main_loop
-                        )
-                        try: 
-                            credit_future.result(timeout=30)
-                            # Send overpayment message to user
-                            overpay_msg = f"✅ Purchase successful! You overpaid by {overpaid_eur:.2f} EUR. The excess has been added to your balance."
-                            asyncio.run_coroutine_threadsafe(send_message_with_retry(telegram_app.bot, user_id, overpay_msg, parse_mode=None), main_loop)
-                        except Exception as e:
-                            logger.error(f"Error crediting overpayment for {payment_id}: {e}", exc_info=True)
-                    else:
-                        # Exact payment: Just give product
-                        logger.info(f"💰 BULLETPROOF: Exact payment. User {user_id} paid exactly {paid_eur_equivalent:.2f} EUR for {target_eur_decimal:.2f} EUR product.")
-                    
-                    # CRITICAL: Only remove pending deposit AFTER confirming complete success
-                    asyncio.run_coroutine_threadsafe(asyncio.to_thread(remove_pending_deposit, payment_id, trigger="purchase_success"), main_loop)
-                    logger.info(f"✅ COMPLETE SUCCESS: {log_prefix} {payment_id} fully processed and pending record removed for user {user_id}")
-                else:
-                    logger.critical(f"🚨 CRITICAL: {log_prefix} {payment_id} paid, but process_successful_crypto_purchase FAILED for user {user_id}. Pending deposit NOT removed. Manual intervention required.")
-                    # Notify admin about critical failure
-                    if get_first_primary_admin_id():
-                        asyncio.run_coroutine_threadsafe(
-                            send_message_with_retry(telegram_app.bot, get_first_primary_admin_id(), 
-                                f"🚨 CRITICAL: Payment {payment_id} for user {user_id} FAILED after successful payment! Manual intervention required!"),
-                            main_loop
-                        )
-            else: # Refill
-                 credited_eur_amount = paid_eur_equivalent
-                 if credited_eur_amount > 0:
-                     future = asyncio.run_coroutine_threadsafe(
-                         payment.process_successful_refill(user_id, credited_eur_amount, payment_id, dummy_context),
-                         main_loop
-                     )
-                     try:
-                          db_update_success = future.result(timeout=30)
-                          if db_update_success:
-                               asyncio.run_coroutine_threadsafe(asyncio.to_thread(remove_pending_deposit, payment_id, trigger="refill_success"), main_loop)
-                               logger.info(f"Successfully processed and removed pending deposit {payment_id} (Status: {status})")
-                          else:
-                               logger.critical(f"CRITICAL: {log_prefix} {payment_id} ({status}) processed, but process_successful_refill FAILED for user {user_id}. Pending deposit NOT removed. Manual intervention required.")
-                     except asyncio.TimeoutError:
-                          logger.error(f"Timeout waiting for process_successful_refill result for {payment_id}. Pending deposit NOT removed.")
-                     except Exception as e:
-                          logger.error(f"Error getting result from process_successful_refill for {payment_id}: {e}. Pending deposit NOT removed.", exc_info=True)
-                 else:
-                     logger.warning(f"{log_prefix} {payment_id} ({status}): Calculated credited EUR is zero for user {user_id}. Removing pending deposit without updating balance.")
-                     asyncio.run_coroutine_threadsafe(asyncio.to_thread(remove_pending_deposit, payment_id, trigger="zero_credit"), main_loop)
-        except (ValueError, TypeError) as e:
-            logger.error(f"Webhook Error: Invalid number format in webhook data for {payment_id}. Error: {e}. Data: {data}")
-        except Exception as e:
-            logger.error(f"Webhook Error: Could not process payment update {payment_id}.", exc_info=True)
-    elif status in ['failed', 'expired', 'refunded']:
-        logger.warning(f"Payment {payment_id} has status '{status}'. Removing pending record.")
-        pending_info_for_removal = None
-        try:
-            pending_info_for_removal = asyncio.run_coroutine_threadsafe(
-                 asyncio.to_thread(get_pending_deposit, payment_id), main_loop
-            ).result(timeout=5) 
-        except Exception as e:
-            logger.error(f"Error checking pending deposit for {payment_id} before removal/notification: {e}")
-        asyncio.run_coroutine_threadsafe(
-            asyncio.to_thread(remove_pending_deposit, payment_id, trigger="failure" if status == 'failed' else "expiry"),
-            main_loop
-        )
-        if pending_info_for_removal and telegram_app:
-            user_id = pending_info_for_removal['user_id']
-            is_purchase_failure = pending_info_for_removal.get('is_purchase') == 1
-            try:
-                conn_lang = None; user_lang = 'en'
-                try:
-                    conn_lang = get_db_connection()
-                    c_lang = conn_lang.cursor()
-                    c_lang.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-                    lang_res = c_lang.fetchone()
-                    if lang_res and lang_res['language'] in LANGUAGES: user_lang = lang_res['language']
-                except Exception as lang_e: logger.error(f"Failed to get lang for user {user_id} notify: {lang_e}")
-                finally:
-                     if conn_lang: conn_lang.close()
-                lang_data_local = LANGUAGES.get(user_lang, LANGUAGES['en'])
-                if is_purchase_failure: fail_msg = lang_data_local.get("crypto_purchase_failed", "Payment Failed/Expired. Your items are no longer reserved.")
-                else: fail_msg = lang_data_local.get("payment_cancelled_or_expired", "Payment Status: Your payment ({payment_id}) was cancelled or expired.").format(payment_id=payment_id)
-                dummy_context = ContextTypes.DEFAULT_TYPE(application=telegram_app, chat_id=user_id, user_id=user_id)
-                asyncio.run_coroutine_threadsafe(send_message_with_retry(telegram_app.bot, user_id, fail_msg, parse_mode=None), main_loop)
-            except Exception as notify_e: logger.error(f"Error notifying user {user_id} about failed/expired payment {payment_id}: {notify_e}")
-    else:
-         logger.info(f"Webhook received for payment {payment_id} with status: {status} (ignored).")
-    return Response(status=200)
-
-@flask_app.route(f"/telegram/{TOKEN}", methods=['POST'])
-async def telegram_webhook():
-    global telegram_app, main_loop
-    if not telegram_app or not main_loop:
-        logger.error("Telegram webhook received but app/loop not ready.")
-        return Response(status=503)
+    if status not in PAYMENT_SUCCESS_STATUSES + PAYMENT_FAILURE_STATUSES:
+        logger.info(f"Webhook received for payment {payment_id} with status: {status} (ignored).")
+        return Response(status_code=200)
+
+    try:
+        event_id = await run_db(record_payment_event, payment_id, status, raw_body.decode('utf-8'))
+    except (sqlite3.Error, UnicodeDecodeError) as e:
+        logger.error(f"❌ Could not store IPN for payment {payment_id} ({status}): {e}", exc_info=True)
+        return PlainTextResponse("Could not store event", status_code=500) # NOWPayments will redeliver
+
+    if event_id is None:
+        logger.info(f"Duplicate IPN for payment {payment_id} ({status}) ignored.")
+        return PlainTextResponse("Duplicate event", status_code=200)
+
+    enqueue_payment_event(event_id)
+    logger.info(f"📥 IPN for payment {payment_id} ({status}) stored as event {event_id}.")
+    return Response(status_code=200)
+
+async def telegram_webhook(request: Request) -> Response:
+    if not telegram_app:
+        logger.error("Telegram webhook received but app not ready.")
+        return Response(status_code=503)
     try:
-        update_data = request.get_json(force=True)
+        update_data = await request.json()
         update = Update.de_json(update_data, telegram_app.bot)
-        asyncio.run_coroutine_threadsafe(telegram_app.process_update(update), main_loop)
-        return Response(status=200)
+        await telegram_app.update_queue.put(update) # Dispatched by the running Application (block=False handlers)
+        return Response(status_code=200)
     except json.JSONDecodeError:
         logger.error("Telegram webhook received invalid JSON.")
-        return Response("Invalid JSON", status=400)
+        return PlainTextResponse("Invalid JSON", status_code=400)
     except Exception as e:
         logger.error(f"Error processing Telegram webhook: {e}", exc_info=True)
-        return Response("Internal Server Error", status=500)
+        return PlainTextResponse("Internal Server Error", status_code=500)
 
-@flask_app.route("/health", methods=['GET'])
-def health_check():
-    """Health check endpoint to verify Flask server is running"""
-    logger.info("🔍 HEALTH CHECK: Health check endpoint accessed")
-    return Response("OK - Flask server is running", status=200)
+async def health_check(request: Request) -> Response:
+    """Health check endpoint to verify the web server is running"""
+    logger.debug("🔍 HEALTH CHECK: Health check endpoint accessed")
+    return PlainTextResponse("OK - Web server is running", status_code=200)
 
-@flask_app.route("/webhook-test", methods=['POST'])
-def webhook_test():
+async def webhook_test(request: Request) -> Response:
     """Test endpoint to verify webhook reception"""
     logger.info("🔍 WEBHOOK TEST: Test webhook received!")
     logger.info(f"🔍 WEBHOOK TEST: Headers: {dict(request.headers)}")
-    logger.info(f"🔍 WEBHOOK TEST: Raw body: {request.get_data()}")
-    return Response("Test webhook received successfully", status=200)
+    logger.info(f"🔍 WEBHOOK TEST: Raw body: {await request.body()}")
+    return PlainTextResponse("Test webhook received successfully", status_code=200)
 
-@flask_app.route("/", methods=['GET'])
-def root():
+async def root(request: Request) -> Response:
     """Root endpoint to verify server is running"""
-    logger.info("🔍 ROOT: Root endpoint accessed")
-    return Response("Payment Bot Server is Running! Webhook: /webhook", status=200)
+    logger.debug("🔍 ROOT: Root endpoint accessed")
+    return PlainTextResponse("Payment Bot Server is Running! Webhook: /webhook", status_code=200)
+
+web_app = Starlette(routes=[
+    Route("/webhook", nowpayments_webhook, methods=["POST"]),
+    Route(f"/telegram/{TOKEN}", telegram_webhook, methods=["POST"]),
+    Route("/health", health_check, methods=["GET"]),
+    Route("/webhook-test", webhook_test, methods=["POST"]),
+    Route("/", root, methods=["GET"]),
+])
 
 def main() -> None:
-    global telegram_app, main_loop
+    global telegram_app
     logger.info("Starting bot...")
     init_db()
     load_all_data()
+    load_banned_users()
+    MEDIA_REGISTRY.load()
+    purge_stale_media_staging()
+    router.validate_routes()
     
     # Userbot initialization - connect if credentials exist
     logger.info("ℹ️ USERBOT: Checking userbot configuration...")
     try:
         from userbot_simple import simple_userbot as userbot
+        userbot.load_configuration()
         if userbot.has_session and userbot.session_string:
             logger.info("🔄 USERBOT: Found existing session, attempting to connect...")
             # We'll connect this after the main application is initialized
@@ -1171,7 +1000,7 @@ def main() -> None:
         logger.error(f"❌ USERBOT: Error checking userbot configuration: {e}")
         logger.info("ℹ️ USERBOT: Userbot available via admin interface")
     defaults = Defaults(parse_mode=None, block=False)
-    app_builder = ApplicationBuilder().token(TOKEN).defaults(defaults).job_queue(JobQueue())
+    app_builder = ApplicationBuilder().token(TOKEN).defaults(defaults).job_queue(JobQueue()).persistence(USER_STATE_PERSISTENCE)
     app_builder.post_init(post_init)
     app_builder.post_shutdown(post_shutdown)
     application = app_builder.build()
@@ -1184,26 +1013,24 @@ def main() -> None:
     ))
     application.add_error_handler(error_handler)
     telegram_app = application
-    main_loop = asyncio.get_event_loop()
     if BASKET_TIMEOUT > 0:
         job_queue = application.job_queue
         if job_queue:
             logger.info(f"Setting up background jobs...")
-            # Basket cleanup job (reduced frequency to 5 minutes for better performance)
-            job_queue.run_repeating(clear_expired_baskets_job_wrapper, interval=timedelta(minutes=5), first=timedelta(seconds=10), name="clear_baskets")
-            # Payment timeout cleanup job (runs every 10 minutes for better stability)
-            job_queue.run_repeating(clean_expired_payments_job_wrapper, interval=timedelta(minutes=10), first=timedelta(minutes=1), name="clean_payments")
-            # Abandoned reservation cleanup job (runs every 3 minutes for faster response)
-            job_queue.run_repeating(clean_abandoned_reservations_job_wrapper, interval=timedelta(minutes=3), first=timedelta(minutes=2), name="clean_abandoned")
-            
+            # Basket, payment-timeout and abandoned reservations are released at their deadline by RESERVATION_EXPIRY;
+            # this hourly reload only catches deadlines a write path failed to schedule.
+            job_queue.run_repeating(reload_reservation_deadlines_job_wrapper, interval=timedelta(hours=1), first=timedelta(hours=1), name="reload_reservation_deadlines")
+
             # BULLETPROOF: Payment recovery job (runs every 5 minutes to recover failed payments)
             job_queue.run_repeating(payment_recovery_job_wrapper, interval=timedelta(minutes=5), first=timedelta(minutes=3), name="payment_recovery")
-            logger.info("Background jobs setup complete (basket cleanup + payment timeout + abandoned reservations).")
+            job_queue.run_repeating(reconcile_ban_cache_job_wrapper, interval=timedelta(minutes=BAN_CACHE_RECONCILE_MINUTES), first=timedelta(minutes=BAN_CACHE_RECONCILE_MINUTES), name="reconcile_ban_cache")
+            job_queue.run_repeating(media_gc_job_wrapper, interval=timedelta(minutes=MEDIA_GC_INTERVAL_MINUTES), first=timedelta(minutes=5), name="media_gc")
+            job_queue.run_repeating(conversation_eviction_job_wrapper, interval=timedelta(minutes=CONVERSATION_EVICT_INTERVAL_MINUTES), first=timedelta(minutes=CONVERSATION_EVICT_INTERVAL_MINUTES), name="conversation_eviction")
+            logger.info("Background jobs setup complete (reservation deadline reload + payment recovery + ban cache + media GC + conversation eviction).")
         else: logger.warning("Job Queue is not available. Background jobs skipped.")
     else: logger.warning("BASKET_TIMEOUT is not positive. Skipping background job setup.")
 
     async def setup_webhooks_and_run():
-        nonlocal application
         logger.info("Initializing application...")
         await application.initialize()
         logger.info(f"Setting Telegram webhook to: {WEBHOOK_URL}/telegram/{TOKEN}")
@@ -1211,6 +1038,7 @@ def main() -> None:
             logger.info("Telegram webhook set successfully.")
         else:
             logger.error("Failed to set Telegram webhook.")
+            await application.shutdown()
             return
         await application.start()
         logger.info("Telegram application started (webhook mode).")
@@ -1219,7 +1047,7 @@ def main() -> None:
         try:
             from userbot_simple import simple_userbot as userbot
             if userbot.has_session and userbot.session_string:
-                logger.info("🔄 USERBOT: Connecting userbot with existing session...")
+                logger.info("🔄 USERBOT: Connecting userbot accounts with existing sessions...")
                 connect_success, connect_message = await userbot.connect()
                 if connect_success:
                     logger.info(f"✅ USERBOT: {connect_message}")
@@ -1227,42 +1055,45 @@ def main() -> None:
                     logger.warning(f"⚠️ USERBOT: Connection failed - {connect_message}")
         except Exception as e:
             logger.error(f"❌ USERBOT: Error connecting userbot at startup: {e}")
+        await start_payment_event_consumers()
+        await RESERVATION_EXPIRY.start()
+        await PRODUCT_CLEANUP.start()
+        await DELIVERY_QUEUE.start(application.bot)
+        # Resume broadcasts interrupted by a restart
+        resumed = await broadcast.resume_broadcasts(application.bot)
+        if resumed: logger.info(f"Resumed {resumed} unfinished broadcast(s).")
+        # PTB only calls post_init/post_shutdown from run_polling/run_webhook, so run them explicitly here
+        await post_init(application)
+
         port = int(os.environ.get("PORT", 10000))
-        flask_thread = threading.Thread(target=lambda: flask_app.run(host='0.0.0.0', port=port, debug=False), daemon=True)
-        flask_thread.start()
-        logger.info(f"Flask server started in a background thread on port {port}.")
-        logger.info("Main thread entering keep-alive loop...")
-        signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
-        for s in signals: main_loop.add_signal_handler(s, lambda s=s: asyncio.create_task(shutdown(s, main_loop, application)))
+        server = uvicorn.Server(uvicorn.Config(
+            web_app, host='0.0.0.0', port=port, log_level="warning",
+            timeout_keep_alive=WEB_KEEP_ALIVE_SECONDS,
+        ))
+        logger.info(f"ASGI web server starting on port {port}.")
         try:
-            while True: await asyncio.sleep(3600)
-        except asyncio.CancelledError: logger.info("Keep-alive loop cancelled.")
-        finally: logger.info("Exiting keep-alive loop.")
-
-    async def shutdown(signal, loop, application):
-        logger.info(f"Received exit signal {signal.name}...")
-        logger.info("Shutting down application...")
-        if application:
+            await server.serve() # Returns after SIGINT/SIGTERM (handled by uvicorn)
+        finally:
+            logger.info("Shutting down application...")
+            await stop_payment_event_consumers()
+            await RESERVATION_EXPIRY.stop()
+            await PRODUCT_CLEANUP.stop()
+            await DELIVERY_QUEUE.stop()
             await application.stop()
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for task in tasks: task.cancel()
+            logger.info(f"Cancelling {len(tasks)} outstanding tasks")
+            await asyncio.gather(*tasks, return_exceptions=True)
             await application.shutdown()
-        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
-        [task.cancel() for task in tasks]
-        logger.info(f"Cancelling {len(tasks)} outstanding tasks")
-        await asyncio.gather(*tasks, return_exceptions=True)
-        logger.info("Flushing metrics")
-        loop.stop()
+            await post_shutdown(application)
 
     try:
-        main_loop.run_until_complete(setup_webhooks_and_run())
+        asyncio.run(setup_webhooks_and_run())
     except (KeyboardInterrupt, SystemExit) as e:
         logger.info(f"Shutdown initiated by {type(e).__name__}.")
     except Exception as e:
         logger.critical(f"Critical error in main execution loop: {e}", exc_info=True)
     finally:
-        logger.info("Main loop finished or interrupted.")
-        if main_loop.is_running():
-            logger.info("Stopping event loop.") 
-            main_loop.stop()
         logger.info("Bot shutdown complete.")
 
 if __name__ == '__main__':
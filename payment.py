@@ -19,28 +19,35 @@ from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
 from telegram import helpers
 import telegram.error as telegram_error
-from telegram import InputMediaPhoto, InputMediaVideo, InputMediaAnimation # Import InputMedia types
+from telegram import InputMediaAnimation # Import InputMedia types
 # -------------------------
 
 # Import necessary items from utils and user
+from router import callback_route # Static update routing
 from utils import ( # Ensure utils imports are correct
     send_message_with_retry, format_currency, ADMIN_ID,
+    USER_PROFILES, # Cached users-row snapshot; balance/purchase writes invalidate it
     LANGUAGES, load_all_data, BASKET_TIMEOUT, MIN_DEPOSIT_EUR,
     NOWPAYMENTS_API_KEY, NOWPAYMENTS_API_URL, WEBHOOK_URL, clear_expired_basket,
     format_expiration_time, FEE_ADJUSTMENT,
     add_pending_deposit, remove_pending_deposit, # Make sure add_pending_deposit is imported
     get_nowpayments_min_amount,
-    get_db_connection, MEDIA_DIR, PRODUCT_TYPES, DEFAULT_PRODUCT_EMOJI, # Added PRODUCT_TYPES/Emoji
+    get_db_connection,
     _get_lang_data, # <--- *** ADDED IMPORT HERE ***
     log_admin_action, # <<< IMPORT log_admin_action >>>
-    get_first_primary_admin_id # Admin helper function for notifications
+    get_first_primary_admin_id, # Admin helper function for notifications
+    run_db, db_fetchall, db_execute, # Async DB facade (runs SQLite off the event loop)
+    CATALOG_INDEX # In-memory stock index for browsing menus
 )
 # <<< IMPORT USER MODULE >>>
 import user
 
 # --- Import Reseller Helper ---
 try:
-    from reseller_management import get_reseller_discount, get_reseller_discount_with_connection
+    from reseller_management import (
+        get_reseller_discount, get_reseller_discount_with_connection, get_reseller_discount_for_cursor,
+        get_reseller_discount_map_for_cursor, price_reseller_basket
+    )
 except ImportError:
     logger_dummy_reseller_payment = logging.getLogger(__name__ + "_dummy_reseller_payment")
     logger_dummy_reseller_payment.error("Could not import get_reseller_discount from reseller_management.py. Reseller discounts will not work in payment processing.")
@@ -50,6 +57,16 @@ except ImportError:
     
     async def get_reseller_discount_with_connection(cursor, user_id: int, product_type: str) -> Decimal:
         return Decimal('0.0')
+
+    def get_reseller_discount_for_cursor(cursor, user_id: int, product_type: str) -> Decimal:
+        return Decimal('0.0')
+
+    def get_reseller_discount_map_for_cursor(cursor, user_id: int) -> dict:
+        return {}
+
+    async def price_reseller_basket(user_id: int, items: list, price_key: str = 'price', type_key: str = 'product_type') -> dict:
+        total = sum((Decimal(str(item.get(price_key, 0) or 0)) for item in items), Decimal('0.0'))
+        return {'items': [], 'original_total': total, 'discount_total': Decimal('0.0'), 'final_total': total}
 # -----------------------------
 
 # --- Import Unreserve Helper ---
@@ -211,23 +228,18 @@ async def create_nowpayments_payment(
         # Re-calculate the total from basket snapshot to validate discount against current total
         basket_total_before_discount = Decimal('0.0')
         if basket_snapshot:
-            for item in basket_snapshot:
-                item_price = Decimal(str(item.get('price', 0)))
-                item_type = item.get('product_type', '')
-                # BULLETPROOF: Calculate reseller discount for this item with comprehensive error handling
-                try:
-                    logger.info(f"🔄 BULLETPROOF: Calculating reseller discount for user {user_id}, product {item_type}")
-                    reseller_discount_percent = await asyncio.to_thread(get_reseller_discount, user_id, item_type)
-                    reseller_discount = (item_price * reseller_discount_percent / Decimal('100')).quantize(Decimal('0.01'), rounding=ROUND_DOWN)
-                    basket_total_before_discount += (item_price - reseller_discount)
-                    logger.info(f"✅ BULLETPROOF: Reseller discount calculated: {reseller_discount_percent}% = {reseller_discount} EUR")
-                except Exception as reseller_error:
-                    logger.warning(f"⚠️ BULLETPROOF: Error calculating reseller discount for user {user_id}, product {item_type} during payment creation: {reseller_error}. Using full price.")
-                    # Fallback to full price - payment will still succeed
-                    basket_total_before_discount += item_price
+            # BULLETPROOF: Price the whole basket in one call; fall back to full price on any error
+            try:
+                pricing = await price_reseller_basket(user_id, basket_snapshot)
+                basket_total_before_discount = pricing['final_total']
+                logger.info(f"✅ BULLETPROOF: Reseller pricing for user {user_id}: {pricing['discount_total']} EUR off {pricing['original_total']} EUR")
+            except Exception as reseller_error:
+                logger.warning(f"⚠️ BULLETPROOF: Error calculating reseller discounts for user {user_id} during payment creation: {reseller_error}. Using full price.")
+                # Fallback to full price - payment will still succeed
+                basket_total_before_discount = sum((Decimal(str(item.get('price', 0))) for item in basket_snapshot), Decimal('0.0'))
         
         # SECURITY: Use atomic validation to prevent race conditions and multiple uses
-        code_valid, validation_message, discount_details = validate_and_apply_discount_atomic(discount_code, float(basket_total_before_discount), user_id)
+        code_valid, validation_message, discount_details = await run_db(validate_and_apply_discount_atomic, discount_code, float(basket_total_before_discount), user_id)
         if not code_valid:
             logger.warning(f"Discount code '{discount_code}' became invalid during payment creation for user {user_id}: {validation_message}")
             return {'error': 'discount_code_invalid', 'reason': validation_message, 'code': discount_code}
@@ -380,7 +392,7 @@ async def create_nowpayments_payment(
         logger.info(f"Payment invoice created: ID={payment_data['payment_id']}, Currency={pay_currency_code.upper()}, Amount={payment_data['pay_amount']}, EUR_Target={target_eur_amount}, User={user_id}, Type={'Purchase' if is_purchase else 'Refill'}, Expires={expiry_str}")
 
         # 6. Store Pending Deposit Info
-        add_success = await asyncio.to_thread(
+        add_success = await run_db(
             add_pending_deposit,
             payment_data['payment_id'], user_id, payment_data['pay_currency'],
             float(target_eur_amount), float(expected_crypto_amount_from_invoice), # Store the actual invoice amount
@@ -402,6 +414,7 @@ async def create_nowpayments_payment(
 
 
 # --- Callback Handler for Crypto Selection during Refill ---
+@callback_route("select_refill_crypto")
 async def handle_select_refill_crypto(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles the user selecting the crypto asset for refill, creates NOWPayments invoice."""
     query = update.callback_query
@@ -499,6 +512,7 @@ async def handle_select_refill_crypto(update: Update, context: ContextTypes.DEFA
 
 
 # --- UPDATED: Callback Handler for Crypto Selection during Basket Payment ---
+@callback_route("select_basket_crypto")
 async def handle_select_basket_crypto(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles the user selecting crypto asset for direct basket payment."""
     query = update.callback_query
@@ -566,7 +580,7 @@ async def handle_select_basket_crypto(update: Update, context: ContextTypes.DEFA
 
     # Clear reservation tracking since user proceeded to invoice creation
     from utils import clear_reservation_tracking
-    clear_reservation_tracking(user_id)
+    await run_db(clear_reservation_tracking, user_id)
 
     # Clear context *after* attempting payment creation
     context.user_data.pop('basket_pay_snapshot', None)
@@ -582,8 +596,8 @@ async def handle_select_basket_crypto(update: Update, context: ContextTypes.DEFA
         if error_code in ['amount_too_low_api', 'min_amount_fetch_error', 'estimate_failed', 'estimate_currency_not_found', 'payment_api_misconfigured']:
             logger.info(f"Invoice creation failed ({error_code}) before pending record. Un-reserving items from snapshot.")
             try:
-                # Use asyncio.to_thread for the synchronous helper
-                await asyncio.to_thread(_unreserve_basket_items, snapshot_before_clear)
+                # Run the synchronous helper on the DB executor
+                await run_db(_unreserve_basket_items, snapshot_before_clear)
             except NameError:
                  logger.critical("CRITICAL: _unreserve_basket_items function call failed due to NameError!")
             except Exception as unreserve_e:
@@ -746,18 +760,12 @@ _{helpers.escape_markdown(f"({lang_data.get('invoice_amount_label_text', 'Amount
 async def process_successful_refill(user_id: int, amount_to_add_eur: Decimal, payment_id: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
     bot = context.bot
     user_lang = 'en'
-    conn_lang = None
     try:
-        conn_lang = get_db_connection()
-        c_lang = conn_lang.cursor()
-        c_lang.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-        lang_res = c_lang.fetchone()
+        lang_res = await USER_PROFILES.get_async(user_id)
         if lang_res and lang_res['language'] in LANGUAGES:
             user_lang = lang_res['language']
     except sqlite3.Error as e:
         logger.error(f"DB error fetching language for user {user_id} during refill confirmation: {e}")
-    finally:
-        if conn_lang: conn_lang.close()
 
     lang_data = LANGUAGES.get(user_lang, LANGUAGES['en'])
 
@@ -769,28 +777,18 @@ async def process_successful_refill(user_id: int, amount_to_add_eur: Decimal, pa
     return await credit_user_balance(user_id, amount_to_add_eur, f"Refill payment {payment_id}", context)
 
 
-# --- HELPER: Finalize Purchase (Send Caption Separately) ---
-async def _finalize_purchase(user_id: int, basket_snapshot: list, discount_code_used: str | None, context: ContextTypes.DEFAULT_TYPE) -> bool:
+# --- HELPER: Finalize Purchase DB Transaction (Synchronous) ---
+def _finalize_purchase_db(user_id: int, basket_snapshot: list, discount_code_used: str | None) -> tuple[str, list, dict]:
     """
-    Shared logic to finalize a purchase after payment confirmation (balance or crypto).
-    Decrements stock, adds purchase record, sends media first, then text separately,
-    cleans up product records.
+    Decrements stock, records purchases and discount usage in one transaction (runs on DB executor).
+    Returns (status, processed_product_ids, final_pickup_details); status is 'ok', 'unavailable', 'no_items' or 'db_error'.
     """
-    chat_id = context._chat_id or context._user_id or user_id # Try to get chat_id
-    if not chat_id:
-         logger.error(f"Cannot determine chat_id for user {user_id} in _finalize_purchase")
-
-    lang, lang_data = _get_lang_data(context)
-    if not basket_snapshot: logger.error(f"Empty basket_snapshot for user {user_id} purchase finalization."); return False
-
     conn = None
     processed_product_ids = []
     purchases_to_insert = []
     final_pickup_details = defaultdict(list)
-    db_update_successful = False
     total_price_paid_decimal = Decimal('0.0')
 
-    # --- Database Operations (Reservation Decrement, Purchase Record) ---
     try:
         conn = get_db_connection()
         c = conn.cursor()
@@ -814,13 +812,20 @@ async def _finalize_purchase(user_id: int, basket_snapshot: list, discount_code_
             if product_id not in available_products:
                 logger.error(f"Product {product_id} no longer exists for user {user_id}")
                 conn.rollback()
-                return False
+                return 'unavailable', [], {}
             
             available = available_products[product_id]['available']
             if available <= 0:
                 logger.error(f"Product {product_id} no longer available for user {user_id}")
                 conn.rollback()
-                return False
+                return 'unavailable', [], {}
+
+        # One discount map lookup for the whole basket, on this transaction's cursor
+        try:
+            reseller_discount_map = get_reseller_discount_map_for_cursor(c, user_id)
+        except Exception as reseller_error:
+            logger.warning(f"⚠️ BULLETPROOF: Error loading reseller discounts for user {user_id}: {reseller_error}. Using full price.")
+            reseller_discount_map = {}
 
         for item_snapshot in basket_snapshot: # Iterate directly over the rich snapshot
             product_id = item_snapshot['product_id']
@@ -831,7 +836,7 @@ async def _finalize_purchase(user_id: int, basket_snapshot: list, discount_code_
             if avail_update.rowcount == 0:
                 logger.error(f"Failed to decrement stock for product {product_id} for user {user_id}")
                 conn.rollback()
-                return False
+                return 'unavailable', [], {}
 
             # Product stock successfully decremented. Proceed to record purchase using snapshot data.
             # Details from snapshot:
@@ -850,11 +855,9 @@ async def _finalize_purchase(user_id: int, basket_snapshot: list, discount_code_
             item_price_paid_decimal = item_original_price_decimal
             
             try:
-                logger.info(f"🔄 BULLETPROOF: Calculating reseller discount for user {user_id}, product {item_product_type}")
-                item_reseller_discount_percent = await get_reseller_discount_with_connection(c, user_id, item_product_type)
+                item_reseller_discount_percent = reseller_discount_map.get(item_product_type, Decimal('0.0'))
                 item_reseller_discount_amount = (item_original_price_decimal * item_reseller_discount_percent / Decimal('100')).quantize(Decimal('0.01'), rounding=ROUND_DOWN)
                 item_price_paid_decimal = item_original_price_decimal - item_reseller_discount_amount
-                logger.info(f"✅ BULLETPROOF: Reseller discount calculated: {item_reseller_discount_percent}% = {item_reseller_discount_amount} EUR")
             except Exception as reseller_error:
                 logger.warning(f"⚠️ BULLETPROOF: Error calculating reseller discount for user {user_id}, product {item_product_type}: {reseller_error}. Using full price.")
                 # Fallback to original price - payment will still succeed
@@ -875,9 +878,7 @@ async def _finalize_purchase(user_id: int, basket_snapshot: list, discount_code_
         if not purchases_to_insert:
             logger.warning(f"No items processed during finalization for user {user_id}. Rolling back.")
             conn.rollback()
-            if chat_id: await send_message_with_retry(context.bot, chat_id, lang_data.get("error_processing_purchase_contact_support", "❌ Error processing purchase."), parse_mode=None)
-            return False
-
+            return 'no_items', [], {}
         c.executemany("INSERT INTO purchases (user_id, product_id, product_name, product_type, product_size, price_paid, city, district, purchase_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", purchases_to_insert)
         c.execute("UPDATE users SET total_purchases = total_purchases + ? WHERE user_id = ?", (len(purchases_to_insert), user_id))
         if discount_code_used:
@@ -902,332 +903,81 @@ async def _finalize_purchase(user_id: int, basket_snapshot: list, discount_code_
                     logger.warning(f"Discount code '{discount_code_used}' not found in database during payment finalization for user {user_id}")
             else:
                 logger.info(f"Successfully incremented usage count for discount code '{discount_code_used}' for user {user_id}")
-        c.execute("UPDATE users SET basket = '' WHERE user_id = ?", (user_id,))
+        c.execute("DELETE FROM basket_items WHERE user_id = ?", (user_id,))
         conn.commit()
-        db_update_successful = True
+        USER_PROFILES.invalidate(user_id) # total_purchases changed
+        for product_id in processed_product_ids: CATALOG_INDEX.adjust_available(product_id, -1)
         logger.info(f"Finalized purchase DB update user {user_id}. Processed {len(purchases_to_insert)} items. General Discount: {discount_code_used or 'None'}. Total Paid (after reseller disc): {total_price_paid_decimal:.2f} EUR")
 
     except sqlite3.Error as e:
-        logger.error(f"DB error during purchase finalization user {user_id}: {e}", exc_info=True); db_update_successful = False
-        if conn and conn.in_transaction: conn.rollback()
-    except Exception as e:
-        logger.error(f"Unexpected error during purchase finalization user {user_id}: {e}", exc_info=True); db_update_successful = False
+        logger.error(f"DB error during purchase finalization user {user_id}: {e}", exc_info=True)
         if conn and conn.in_transaction: conn.rollback()
+        return 'db_error', [], {}
     finally:
         if conn: conn.close()
 
+    return 'ok', processed_product_ids, final_pickup_details
+
+
+# --- HELPER: Finalize Purchase (Send Caption Separately) ---
+async def _finalize_purchase(user_id: int, basket_snapshot: list, discount_code_used: str | None, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """
+    Shared logic to finalize a purchase after payment confirmation (balance or crypto).
+    Decrements stock, adds purchase record, sends media first, then text separately,
+    cleans up product records.
+    """
+    chat_id = context._chat_id or context._user_id or user_id # Try to get chat_id
+    if not chat_id:
+         logger.error(f"Cannot determine chat_id for user {user_id} in _finalize_purchase")
+
+    lang, lang_data = _get_lang_data(context)
+    if not basket_snapshot: logger.error(f"Empty basket_snapshot for user {user_id} purchase finalization."); return False
+
+    processed_product_ids = []
+    final_pickup_details = defaultdict(list)
+    db_update_successful = False
+
+    # --- Database Operations (Reservation Decrement, Purchase Record) ---
+    try:
+        finalize_status, processed_product_ids, final_pickup_details = await run_db(
+            _finalize_purchase_db, user_id, basket_snapshot, discount_code_used
+        )
+        db_update_successful = finalize_status == 'ok'
+        if finalize_status == 'no_items' and chat_id:
+            await send_message_with_retry(context.bot, chat_id, lang_data.get("error_processing_purchase_contact_support", "❌ Error processing purchase."), parse_mode=None)
+            return False
+        if finalize_status == 'unavailable':
+            return False
+    except Exception as e:
+        logger.error(f"Unexpected error during purchase finalization user {user_id}: {e}", exc_info=True); db_update_successful = False
+
     # --- Post-Transaction Cleanup & Message Sending (If DB success) ---
     if db_update_successful:
         context.user_data['basket'] = []
         context.user_data.pop('applied_discount', None)
 
-        # Fetch Media BEFORE attempting delivery
-        media_details = defaultdict(list)
-        if processed_product_ids:
-            conn_media = None
-            try:
-                conn_media = get_db_connection()
-                c_media = conn_media.cursor()
-                media_placeholders = ','.join('?' * len(processed_product_ids))
-                c_media.execute(f"SELECT product_id, media_type, telegram_file_id, file_path FROM product_media WHERE product_id IN ({media_placeholders})", processed_product_ids)
-                media_rows = c_media.fetchall()
-                logger.info(f"Fetched {len(media_rows)} media records for products {processed_product_ids} for user {user_id}")
-                for row in media_rows: 
-                    media_details[row['product_id']].append(dict(row))
-                    logger.debug(f"Media for P{row['product_id']}: {row['media_type']} - FileID: {'Yes' if row['telegram_file_id'] else 'No'}, Path: {row['file_path']}")
-            except sqlite3.Error as e: 
-                logger.error(f"DB error fetching media post-purchase: {e}")
-            finally:
-                if conn_media: conn_media.close()
-
-                # 🔐 SECRET CHAT ONLY: Try userbot delivery - NO BOT CHAT FALLBACK
-                userbot_delivery_successful = await _attempt_userbot_delivery_first(user_id, basket_snapshot, context)
-                
-                # 🚫 NO BOT CHAT DELIVERY - SECRET CHAT ONLY!
-                if userbot_delivery_successful:
-                    logger.info(f"✅ SECRET CHAT ONLY: Product delivered via secret chat for user {user_id}")
-                    # 🔐 SECRET CHAT SUCCESS - SKIP ALL BOT CHAT DELIVERY CODE!
-                    # Handle product deletion and cleanup only
-                    if processed_product_ids:
-                        logger.info(f"🔐 SECRET CHAT ONLY: Cleaning up product records for user {user_id}. IDs: {processed_product_ids}")
-                        try:
-                            # Delete purchased products and their media records
-                            conn_del = get_db_connection()
-                            c_del = conn_del.cursor()
-
-                            # Delete media records first (due to foreign key)
-                            for prod_id in processed_product_ids:
-                                c_del.execute("DELETE FROM product_media WHERE product_id = ?", (prod_id,))
-
-                            # Delete product records
-                            placeholders = ', '.join(['?' for _ in processed_product_ids])
-                            c_del.execute(f"DELETE FROM products WHERE id IN ({placeholders})", processed_product_ids)
-                            conn_del.commit()
-                            conn_del.close()
-
-                            logger.info(f"🗑️ SECRET CHAT ONLY: Deleted {len(processed_product_ids)} product records for user {user_id}")
-
-                            # Schedule deletion of media directories
-                            for prod_id in processed_product_ids:
-                                media_dir = f"/mnt/data/media/{prod_id}"
-                                if os.path.exists(media_dir):
-                                    try:
-                                        import shutil
-                                        shutil.rmtree(media_dir)
-                                        logger.info(f"🗑️ SECRET CHAT ONLY: Deleted media directory: {media_dir}")
-                                    except Exception as dir_error:
-                                        logger.error(f"❌ SECRET CHAT ONLY: Failed to delete media directory {media_dir}: {dir_error}")
-
-                        except Exception as delete_error:
-                            logger.error(f"❌ SECRET CHAT ONLY: Failed to delete purchased products for user {user_id}: {delete_error}")
-                    
-                    # Clear the basket and exit - NO BOT CHAT DELIVERY!
-                    clear_expired_basket(context, user_id)
-                    logger.info(f"🎉 SECRET CHAT ONLY: Complete - products delivered ONLY via secret chat for user {user_id}")
-                    return True  # SUCCESS - NO BOT CHAT CODE!
-                else:
-                    logger.error(f"❌ SECRET CHAT ONLY: Failed to deliver via secret chat for user {user_id} - NO FALLBACK!")
-                    # Send error message to bot chat explaining the issue
-                    if chat_id:
-                        error_msg = """❌ **Delivery Failed**
-
-🔐 **Secret chat delivery failed.** 
-⚠️ **Your payment is safe - we'll resolve this manually.**
-
-📞 **Contact support for assistance.**"""
-                        await send_message_with_retry(context.bot, chat_id, error_msg, parse_mode=None)
-                    
-                    # Clear the basket and exit - NO BOT CHAT DELIVERY!
-                    clear_expired_basket(context, user_id)
-                    logger.info(f"❌ SECRET CHAT ONLY: Failed delivery - NO bot chat fallback for user {user_id}")
-                    return False  # FAILURE - NO BOT CHAT CODE!
-
-                # 🚫 THIS CODE SHOULD NEVER RUN - SECRET CHAT ONLY!
-                logger.error(f"🚨 CRITICAL: Bot chat code reached - this should never happen in SECRET CHAT ONLY mode!")
-                for prod_id in processed_product_ids:
-                    item_details_list = final_pickup_details.get(prod_id)
-                    if not item_details_list: continue
-                    item_details = item_details_list[0] # First (and likely only) entry for this prod_id
-                    item_name, item_size = item_details['name'], item_details['size']
-                    item_original_text = item_details['text'] or "(No specific pickup details provided)"
-                    product_type = item_details['type'] # <<< USE TYPE FROM SNAPSHOT DATA
-                    product_emoji = PRODUCT_TYPES.get(product_type, DEFAULT_PRODUCT_EMOJI)
-                    item_header = f"--- Item: {product_emoji} {item_name} {item_size} ---"
-
-
-                # Prepare combined text caption
-                combined_caption = f"{item_header}\n\n{item_original_text}"
-                if len(combined_caption) > 4090: combined_caption = combined_caption[:4090] + "..." # Adjust for send_message limit
-
-                media_items_for_product = media_details.get(prod_id, [])
-                photo_video_group_details = []
-                animations_to_send_details = []
-                opened_files = []
-
-                logger.info(f"Processing media for P{prod_id} user {user_id}: Found {len(media_items_for_product)} media items")
-
-                # --- Separate Media ---
-                for media_item in media_items_for_product:
-                    media_type = media_item.get('media_type')
-                    file_id = media_item.get('telegram_file_id')
-                    file_path = media_item.get('file_path')
-                    logger.debug(f"Processing media item P{prod_id}: Type={media_type}, FileID={'Yes' if file_id else 'No'}, Path={file_path}")
-                    if media_type in ['photo', 'video']:
-                        photo_video_group_details.append({'type': media_type, 'id': file_id, 'path': file_path})
-                    elif media_type == 'gif':
-                        animations_to_send_details.append({'type': media_type, 'id': file_id, 'path': file_path})
-                    else:
-                        logger.warning(f"Unsupported media type '{media_type}' found for P{prod_id}")
-
-                logger.info(f"Media separation P{prod_id}: {len(photo_video_group_details)} photos/videos, {len(animations_to_send_details)} animations")
-
-                # --- Send Photos/Videos Group (No Caption) ---
-                if photo_video_group_details:
-                    media_group_input = []
-                    files_for_this_group = []
-                    logger.info(f"Attempting to send {len(photo_video_group_details)} photos/videos for P{prod_id} user {user_id}")
-                    
-                    # Validate that we don't exceed Telegram's media group limit (10 items)
-                    if len(photo_video_group_details) > 10:
-                        logger.warning(f"Media group for P{prod_id} has {len(photo_video_group_details)} items, which exceeds Telegram's 10-item limit. Will send in batches.")
-                        photo_video_group_details = photo_video_group_details[:10]  # Take only first 10 items
-                    
-                    try:
-                        for item in photo_video_group_details:
-                            input_media = None; file_handle = None
-                            
-                            # Skip file_id completely and go straight to local files for now
-                            # This avoids the "wrong file identifier" error entirely
-                            logger.debug(f"Using local file for P{prod_id} (skipping file_id due to token change)")
-                            
-                            # Use file path directly
-                            if item['path'] and await asyncio.to_thread(os.path.exists, item['path']):
-                                logger.debug(f"Using file path for P{prod_id}: {item['path']}")
-                                file_handle = await asyncio.to_thread(open, item['path'], 'rb')
-                                opened_files.append(file_handle)
-                                files_for_this_group.append(file_handle)
-                                if item['type'] == 'photo': input_media = InputMediaPhoto(media=file_handle)
-                                elif item['type'] == 'video': input_media = InputMediaVideo(media=file_handle)
-                            else:
-                                logger.warning(f"No valid media source for P{prod_id}: Path exists={await asyncio.to_thread(os.path.exists, item['path']) if item['path'] else False}")
-                                
-                            if input_media: 
-                                media_group_input.append(input_media)
-                                logger.debug(f"Added media to group for P{prod_id}: {item['type']}")
-                            else: 
-                                logger.warning(f"Could not prepare photo/video InputMedia P{prod_id}: {item}")
-
-                        if media_group_input:
-                            logger.info(f"Sending media group with {len(media_group_input)} items for P{prod_id} user {user_id}")
-                            try:
-                                await context.bot.send_media_group(chat_id, media=media_group_input, connect_timeout=30, read_timeout=30)
-                                logger.info(f"✅ Successfully sent photo/video group ({len(media_group_input)}) for P{prod_id} user {user_id}")
-                            except Exception as send_error:
-                                # If sending fails due to invalid file IDs, try to rebuild with file paths only
-                                if "wrong file identifier" in str(send_error).lower():
-                                    logger.warning(f"Media group send failed due to invalid file IDs for P{prod_id}. Attempting fallback with file paths only.")
-                                    
-                                    # Rebuild media group using only file paths
-                                    fallback_media_group = []
-                                    fallback_files = []
-                                    for item in photo_video_group_details:
-                                        if item['path'] and await asyncio.to_thread(os.path.exists, item['path']):
-                                            try:
-                                                fallback_file_handle = await asyncio.to_thread(open, item['path'], 'rb')
-                                                fallback_files.append(fallback_file_handle)
-                                                if item['type'] == 'photo': 
-                                                    fallback_media_group.append(InputMediaPhoto(media=fallback_file_handle))
-                                                elif item['type'] == 'video': 
-                                                    fallback_media_group.append(InputMediaVideo(media=fallback_file_handle))
-                                            except Exception as fallback_error:
-                                                logger.error(f"Error preparing fallback media for P{prod_id}: {fallback_error}")
-                                    
-                                    if fallback_media_group:
-                                        try:
-                                            await context.bot.send_media_group(chat_id, media=fallback_media_group, connect_timeout=30, read_timeout=30)
-                                            logger.info(f"✅ Successfully sent fallback media group for P{prod_id} user {user_id}")
-                                        except Exception as fallback_send_error:
-                                            logger.error(f"❌ Fallback media group send also failed for P{prod_id}: {fallback_send_error}")
-                                        finally:
-                                            # Close fallback files
-                                            for f in fallback_files:
-                                                try:
-                                                    if not f.closed: await asyncio.to_thread(f.close)
-                                                except Exception: pass
-                                    else:
-                                        logger.error(f"❌ No fallback media available for P{prod_id}")
-                                else:
-                                    logger.error(f"❌ Media group send failed for P{prod_id} (non-file-ID error): {send_error}")
-                        else:
-                            logger.warning(f"No media items prepared for sending P{prod_id} user {user_id}")
-                    except Exception as group_e:
-                        logger.error(f"❌ Error sending photo/video group P{prod_id} user {user_id}: {group_e}", exc_info=True)
-                    finally:
-                        for f in files_for_this_group:
-                             try:
-                                 if not f.closed: await asyncio.to_thread(f.close); opened_files.remove(f)
-                             except Exception: pass
-
-                # --- Send Animations (GIFs) Separately (No Caption) ---
-                if animations_to_send_details:
-                    logger.info(f"Attempting to send {len(animations_to_send_details)} animations for P{prod_id} user {user_id}")
-                    for item in animations_to_send_details:
-                        anim_file_handle = None
-                        try:
-                            # Skip file_id completely and go straight to local files for now
-                            # This avoids the "wrong file identifier" error entirely
-                            logger.debug(f"Using local file for animation P{prod_id} (skipping file_id due to token change)")
-                            media_to_send_ref = None
-                            
-                            # Use file path directly
-                            if item['path'] and await asyncio.to_thread(os.path.exists, item['path']):
-                                logger.debug(f"Using file path for animation P{prod_id}: {item['path']}")
-                                anim_file_handle = await asyncio.to_thread(open, item['path'], 'rb')
-                                opened_files.append(anim_file_handle)
-                                media_to_send_ref = anim_file_handle
-                                await context.bot.send_animation(chat_id=chat_id, animation=media_to_send_ref)
-                                logger.info(f"✅ Successfully sent animation with file path for P{prod_id} user {user_id}")
-                            else:
-                                logger.warning(f"Could not find GIF source for P{prod_id}: Path exists={await asyncio.to_thread(os.path.exists, item['path']) if item['path'] else False}")
-                                continue
-                        except Exception as anim_e:
-                            logger.error(f"❌ Error sending animation P{prod_id} user {user_id}: {anim_e}", exc_info=True)
-                        finally:
-                            if anim_file_handle and anim_file_handle in opened_files:
-                                try: await asyncio.to_thread(anim_file_handle.close); opened_files.remove(anim_file_handle)
-                                except Exception: pass
-
-                # --- Always Send Combined Text Separately ---
-                if combined_caption:
-                    logger.debug(f"Sending text details for P{prod_id} user {user_id}: {len(combined_caption)} characters")
-                    await send_message_with_retry(context.bot, chat_id, combined_caption, parse_mode=None)
-                    logger.info(f"✅ Successfully sent text details for P{prod_id} user {user_id}")
-                else:
-                     # Create a fallback message if both original text and header are missing somehow
-                    fallback_text = f"(No details provided for Product ID {prod_id})"
-                    await send_message_with_retry(context.bot, chat_id, fallback_text, parse_mode=None)
-                    logger.warning(f"No combined caption text to send for P{prod_id} user {user_id}. Sent fallback.")
-
-                # --- Close any remaining opened file handles ---
-                for f in opened_files:
-                    try:
-                        if not f.closed: await asyncio.to_thread(f.close)
-                    except Exception as close_e: logger.warning(f"Error closing file handle during final cleanup: {close_e}")
-
-                # 🔐 SECRET CHAT ONLY: No final message to bot chat - everything via secret chat!
-        else:
-            # Userbot delivery succeeded, no bot chat delivery needed
-            logger.info(f"🎯 USERBOT SUCCESS: Secret chat delivery completed for user {user_id} - skipping bot chat entirely")
-            media_delivery_successful = True  # Mark as successful since userbot worked
-
-        # --- Product Record Deletion (NOW MOVED TO END - AFTER media delivery) ---
-        if processed_product_ids:
-            conn_del = None
-            try:
-                conn_del = get_db_connection()
-                c_del = conn_del.cursor()
-                ids_tuple_list = [(pid,) for pid in processed_product_ids]
-                logger.info(f"Purchase Finalization: Attempting to delete product records AFTER media delivery for user {user_id}. IDs: {processed_product_ids}")
-                
-                # Delete product media records first
-                media_delete_placeholders = ','.join('?' * len(processed_product_ids))
-                c_del.execute(f"DELETE FROM product_media WHERE product_id IN ({media_delete_placeholders})", processed_product_ids)
-                
-                # Delete product records  
-                delete_result = c_del.executemany("DELETE FROM products WHERE id = ?", ids_tuple_list)
-                conn_del.commit()
-                deleted_count = delete_result.rowcount
-                logger.info(f"Deleted {deleted_count} purchased product records and their media records for user {user_id}. IDs: {processed_product_ids}")
-                
-                # Schedule media directory deletion AFTER successful delivery
-                for prod_id in processed_product_ids:
-                    media_dir_to_delete = os.path.join(MEDIA_DIR, str(prod_id))
-                    if await asyncio.to_thread(os.path.exists, media_dir_to_delete):
-                        asyncio.create_task(asyncio.to_thread(shutil.rmtree, media_dir_to_delete, ignore_errors=True))
-                        logger.info(f"Scheduled deletion of media dir: {media_dir_to_delete}")
-                        
-            except sqlite3.Error as e: 
-                logger.error(f"DB error deleting purchased products: {e}", exc_info=True)
-                if conn_del and conn_del.in_transaction: 
-                    conn_del.rollback()
-            except Exception as e: 
-                logger.error(f"Unexpected error deleting purchased products: {e}", exc_info=True)
-            finally:
-                if conn_del: conn_del.close()
-
-        # Return success if database operations succeeded
-        # (userbot delivery was already attempted first, bot chat was fallback if needed)
-        if db_update_successful:
-            if userbot_delivery_successful:
-                logger.info(f"✅ USERBOT: Products delivered via secret chat for user {user_id} - NO bot chat delivery")
-            elif media_delivery_successful:
-                logger.info(f"🔄 FALLBACK: Userbot failed - products delivered via bot chat for user {user_id}")
-            else:
-                logger.critical(f"🚨 CRITICAL: Both userbot AND bot chat delivery failed for user {user_id}")
-            return True # Indicate complete success
+        # 🔐 SECRET CHAT ONLY: Queue userbot delivery - NO BOT CHAT FALLBACK
+        userbot_delivery_queued = await _attempt_userbot_delivery_first(user_id, chat_id, basket_snapshot, processed_product_ids, context)
+        if userbot_delivery_queued:
+            # The delivery queue sends it on the next free userbot account, retries it, queues the purchased
+            # products for cleanup once it is delivered, and tells the customer if it finally fails
+            logger.info(f"✅ SECRET CHAT ONLY: Delivery queued for user {user_id}")
+
+            # Clear the basket and exit - NO BOT CHAT DELIVERY!
+            await run_db(clear_expired_basket, context, user_id)
+            logger.info(f"🎉 SECRET CHAT ONLY: Complete - products will be delivered ONLY via secret chat for user {user_id}")
+            return True
         else:
-            logger.critical(f"🚨 CRITICAL: Purchase {user_id} - Database updated but media delivery failed! Manual intervention required!")
-            return False # Indicate partial failure
+            logger.error(f"❌ SECRET CHAT ONLY: Failed to deliver via secret chat for user {user_id} - NO FALLBACK!")
+            # Send error message to bot chat explaining the issue
+            if chat_id:
+                from delivery_queue import DELIVERY_FAILED_MESSAGE
+                await send_message_with_retry(context.bot, chat_id, DELIVERY_FAILED_MESSAGE, parse_mode=None)
+
+            # Clear the basket and exit - NO BOT CHAT DELIVERY!
+            await run_db(clear_expired_basket, context, user_id)
+            logger.info(f"❌ SECRET CHAT ONLY: Failed delivery - NO bot chat fallback for user {user_id}")
+            return False
     else: # Purchase failed at DB level
         context.user_data['basket'] = []
         context.user_data.pop('applied_discount', None)
@@ -1235,6 +985,35 @@ async def _finalize_purchase(user_id: int, basket_snapshot: list, discount_code_
         return False
 
 
+def _deduct_balance_db(user_id: int, amount_to_deduct: Decimal) -> str:
+    """Verifies and deducts balance atomically (Synchronous, runs on DB executor). Returns 'ok', 'insufficient' or 'failed'."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        # Use IMMEDIATE instead of EXCLUSIVE to reduce lock conflicts
+        c.execute("BEGIN IMMEDIATE")
+        # 1. Verify balance
+        c.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+        current_balance_result = c.fetchone()
+        if not current_balance_result or Decimal(str(current_balance_result['balance'])) < amount_to_deduct:
+             logger.warning(f"Insufficient balance user {user_id}. Needed: {amount_to_deduct:.2f}")
+             conn.rollback()
+             return 'insufficient'
+        # 2. Deduct balance
+        update_res = c.execute("UPDATE users SET balance = balance - ? WHERE user_id = ?", (float(amount_to_deduct), user_id))
+        if update_res.rowcount == 0: logger.error(f"Failed to deduct balance user {user_id}."); conn.rollback(); return 'failed'
+
+        conn.commit() # Commit balance deduction *before* finalizing items
+        USER_PROFILES.invalidate(user_id)
+        return 'ok'
+    except Exception:
+        if conn and conn.in_transaction: conn.rollback()
+        raise
+    finally:
+        if conn: conn.close()
+
+
 # --- Process Purchase with Balance (Uses Helper) ---
 async def process_purchase_with_balance(user_id: int, amount_to_deduct: Decimal, basket_snapshot: list, discount_code_used: str | None, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """Handles DB updates when paying with internal balance."""
@@ -1245,43 +1024,28 @@ async def process_purchase_with_balance(user_id: int, amount_to_deduct: Decimal,
     if not basket_snapshot: logger.error(f"Empty basket_snapshot for user {user_id} balance purchase."); return False
     if not isinstance(amount_to_deduct, Decimal) or amount_to_deduct < Decimal('0.0'): logger.error(f"Invalid amount_to_deduct {amount_to_deduct}."); return False
 
-    conn = None
     db_balance_deducted = False
+    amount_float_to_deduct = float(amount_to_deduct)
     balance_changed_error = lang_data.get("balance_changed_error", "❌ Transaction failed: Balance changed.")
     error_processing_purchase_contact_support = lang_data.get("error_processing_purchase_contact_support", "❌ Error processing purchase. Contact support.")
 
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        # Use IMMEDIATE instead of EXCLUSIVE to reduce lock conflicts
-        c.execute("BEGIN IMMEDIATE")
-        # 1. Verify balance
-        c.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
-        current_balance_result = c.fetchone()
-        if not current_balance_result or Decimal(str(current_balance_result['balance'])) < amount_to_deduct:
-             logger.warning(f"Insufficient balance user {user_id}. Needed: {amount_to_deduct:.2f}")
-             conn.rollback()
+        deduct_status = await run_db(_deduct_balance_db, user_id, amount_to_deduct)
+        if deduct_status == 'insufficient':
              # --- Unreserve items if balance check fails ---
              logger.info(f"Un-reserving items for user {user_id} due to insufficient balance during payment.")
-             # Use asyncio.to_thread for synchronous helper
-             await asyncio.to_thread(_unreserve_basket_items, basket_snapshot)
+             # Run the synchronous helper on the DB executor
+             await run_db(_unreserve_basket_items, basket_snapshot)
              # --- End Unreserve ---
              if chat_id: await send_message_with_retry(context.bot, chat_id, balance_changed_error, parse_mode=None)
              return False
-        # 2. Deduct balance
-        amount_float_to_deduct = float(amount_to_deduct)
-        update_res = c.execute("UPDATE users SET balance = balance - ? WHERE user_id = ?", (amount_float_to_deduct, user_id))
-        if update_res.rowcount == 0: logger.error(f"Failed to deduct balance user {user_id}."); conn.rollback(); return False
+        if deduct_status == 'failed': return False
 
-        conn.commit() # Commit balance deduction *before* finalizing items
         db_balance_deducted = True
         logger.info(f"Deducted {amount_to_deduct:.2f} EUR from balance for user {user_id}.")
 
     except sqlite3.Error as e:
         logger.error(f"DB error deducting balance user {user_id}: {e}", exc_info=True); db_balance_deducted = False
-        if conn and conn.in_transaction: conn.rollback()
-    finally:
-        if conn: conn.close()
 
     # 3. Finalize purchase ONLY if balance was successfully deducted
     if db_balance_deducted:
@@ -1291,12 +1055,9 @@ async def process_purchase_with_balance(user_id: int, amount_to_deduct: Decimal,
         if not finalize_success:
             # Critical issue: Balance deducted but finalization failed.
             logger.critical(f"CRITICAL: Balance deducted for user {user_id} but _finalize_purchase FAILED! Attempting to refund.")
-            refund_conn = None
             try:
-                refund_conn = get_db_connection()
-                refund_c = refund_conn.cursor()
-                refund_c.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount_float_to_deduct, user_id))
-                refund_conn.commit()
+                await db_execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount_float_to_deduct, user_id))
+                USER_PROFILES.invalidate(user_id)
                 logger.info(f"Successfully refunded {amount_float_to_deduct} EUR to user {user_id} after finalization failure.")
                 if chat_id: await send_message_with_retry(context.bot, chat_id, error_processing_purchase_contact_support + " Balance refunded.", parse_mode=None)
             except Exception as refund_e:
@@ -1304,15 +1065,13 @@ async def process_purchase_with_balance(user_id: int, amount_to_deduct: Decimal,
                 if get_first_primary_admin_id() and chat_id: # Notify admin if refund fails
                     await send_message_with_retry(context.bot, get_first_primary_admin_id(), f"⚠️ CRITICAL REFUND FAILED for user {user_id} after purchase finalization error. Amount: {amount_to_deduct}. MANUAL CORRECTION NEEDED!", parse_mode=None)
                 if chat_id: await send_message_with_retry(context.bot, chat_id, error_processing_purchase_contact_support, parse_mode=None)
-            finally:
-                if refund_conn: refund_conn.close()
         return finalize_success
     else:
         logger.error(f"Skipping purchase finalization for user {user_id} due to balance deduction failure.")
         # --- Unreserve items if balance deduction failed ---
         logger.info(f"Un-reserving items for user {user_id} due to balance deduction failure.")
-        # Use asyncio.to_thread for synchronous helper
-        await asyncio.to_thread(_unreserve_basket_items, basket_snapshot)
+        # Run the synchronous helper on the DB executor
+        await run_db(_unreserve_basket_items, basket_snapshot)
         # --- End Unreserve ---
         if chat_id: await send_message_with_retry(context.bot, chat_id, error_processing_purchase_contact_support, parse_mode=None)
         return False
@@ -1356,17 +1115,10 @@ async def process_successful_crypto_purchase(user_id: int, basket_snapshot: list
 
 
 # --- NEW: Helper Function to Credit User Balance (Moved from Previous Response) ---
-async def credit_user_balance(user_id: int, amount_eur: Decimal, reason: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    """Adds funds to a user's balance and notifies them."""
-    if not isinstance(amount_eur, Decimal) or amount_eur <= Decimal('0.0'):
-        logger.error(f"Invalid amount provided to credit_user_balance for user {user_id}: {amount_eur}")
-        return False
-
+def _credit_user_balance_db(user_id: int, amount_eur: Decimal, reason: str):
+    """Credits balance and logs the action (Synchronous, runs on DB executor). Returns new balance Decimal or None."""
     conn = None
-    db_update_successful = False
     amount_float = float(amount_eur)
-    new_balance_decimal = Decimal('0.0')
-
     try:
         conn = get_db_connection()
         c = conn.cursor()
@@ -1381,17 +1133,17 @@ async def credit_user_balance(user_id: int, amount_eur: Decimal, reason: str, co
         if update_result.rowcount == 0:
             logger.error(f"User {user_id} not found during balance credit update. Reason: {reason}")
             conn.rollback()
-            return False
+            return None
 
         c.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
         new_balance_result = c.fetchone()
         if new_balance_result:
              new_balance_decimal = Decimal(str(new_balance_result['balance']))
         else:
-             logger.error(f"Could not fetch new balance for {user_id} after credit update."); conn.rollback(); return False
+             logger.error(f"Could not fetch new balance for {user_id} after credit update."); conn.rollback(); return None
 
         conn.commit()
-        db_update_successful = True
+        USER_PROFILES.update(user_id, balance=float(new_balance_decimal))
         logger.info(f"Successfully credited balance for user {user_id}. Added: {amount_eur:.2f} EUR. New Balance: {new_balance_decimal:.2f} EUR. Reason: {reason}")
 
         # Log this as an automatic system action (or maybe under ADMIN_ID if preferred)
@@ -1404,6 +1156,24 @@ async def credit_user_balance(user_id: int, amount_eur: Decimal, reason: str, co
              old_value=old_balance_float,
              new_value=float(new_balance_decimal)
         )
+        return new_balance_decimal
+    except Exception:
+        if conn and conn.in_transaction: conn.rollback()
+        raise
+    finally:
+        if conn: conn.close()
+
+
+async def credit_user_balance(user_id: int, amount_eur: Decimal, reason: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Adds funds to a user's balance and notifies them."""
+    if not isinstance(amount_eur, Decimal) or amount_eur <= Decimal('0.0'):
+        logger.error(f"Invalid amount provided to credit_user_balance for user {user_id}: {amount_eur}")
+        return False
+
+    try:
+        new_balance_decimal = await run_db(_credit_user_balance_db, user_id, amount_eur, reason)
+        if new_balance_decimal is None:
+            return False
 
         # Notify User
         bot_instance = context.bot if hasattr(context, 'bot') else None
@@ -1411,16 +1181,10 @@ async def credit_user_balance(user_id: int, amount_eur: Decimal, reason: str, co
             # Get user language for notification
             lang = context.user_data.get("lang", "en") # Get from context if available
             if not lang: # Fallback: Get from DB if not in context
-                conn_lang = None
                 try:
-                    conn_lang = get_db_connection()
-                    c_lang = conn_lang.cursor()
-                    c_lang.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-                    lang_res = c_lang.fetchone()
+                    lang_res = await USER_PROFILES.get_async(user_id)
                     if lang_res and lang_res['language'] in LANGUAGES: lang = lang_res['language']
                 except Exception as lang_e: logger.warning(f"Could not fetch user lang for credit msg: {lang_e}")
-                finally:
-                     if conn_lang: conn_lang.close()
             lang_data = LANGUAGES.get(lang, LANGUAGES['en'])
 
 
@@ -1449,14 +1213,10 @@ async def credit_user_balance(user_id: int, amount_eur: Decimal, reason: str, co
 
     except sqlite3.Error as e:
         logger.error(f"DB error during credit_user_balance user {user_id}: {e}", exc_info=True)
-        if conn and conn.in_transaction: conn.rollback()
         return False
     except Exception as e:
          logger.error(f"Unexpected error during credit_user_balance user {user_id}: {e}", exc_info=True)
-         if conn and conn.in_transaction: conn.rollback()
          return False
-    finally:
-        if conn: conn.close()
 # --- END credit_user_balance ---
 
 
@@ -1472,6 +1232,7 @@ async def handle_confirm_pay(update: Update, context: ContextTypes.DEFAULT_TYPE,
     await user.handle_confirm_pay(update, context, params)
 
 # --- UPDATED: Callback Handler for Crypto Payment Cancellation ---
+@callback_route("cancel_crypto_payment")
 async def handle_cancel_crypto_payment(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles user clicking Cancel Payment button to cancel their crypto payment and unreserve items."""
     query = update.callback_query
@@ -1492,7 +1253,7 @@ async def handle_cancel_crypto_payment(update: Update, context: ContextTypes.DEF
     logger.info(f"User {user_id} requested to cancel crypto payment {pending_payment_id}.")
     
     # Remove the pending payment (this will also unreserve items if it's a purchase)
-    removal_success = await asyncio.to_thread(remove_pending_deposit, pending_payment_id, trigger="user_cancellation")
+    removal_success = await run_db(remove_pending_deposit, pending_payment_id, trigger="user_cancellation")
     
     # Clear the stored payment_id from user_data regardless of success/failure
     context.user_data.pop('pending_payment_id', None)
@@ -1525,14 +1286,15 @@ async def handle_cancel_crypto_payment(update: Update, context: ContextTypes.DEF
 
 
 # --- USERBOT FIRST DELIVERY SYSTEM ---
-async def _attempt_userbot_delivery_first(user_id: int, basket_snapshot: list, context: ContextTypes.DEFAULT_TYPE) -> bool:
+async def _attempt_userbot_delivery_first(user_id: int, chat_id: int | None, basket_snapshot: list, product_ids: list, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """
-    🎯 YOLO SECRET CHAT FIRST: Attempt userbot delivery BEFORE any bot chat delivery.
-    Returns True if userbot delivery succeeded, False if it failed (so bot chat should be used).
+    🎯 YOLO SECRET CHAT FIRST: Queue userbot delivery BEFORE any bot chat delivery.
+    Returns True if the delivery job was queued, False if no userbot can deliver (so bot chat should be used).
     """
     try:
         # Import here to avoid circular imports - USING TELETHON SECRET CHAT
         from userbot_simple import simple_userbot as userbot
+        from delivery_queue import enqueue_delivery
         
         # Check if userbot is connected
         if not userbot.is_connected:
@@ -1563,12 +1325,7 @@ async def _attempt_userbot_delivery_first(user_id: int, basket_snapshot: list, c
         # Get media files - check database directly for all products
         media_files = []
         for item in basket_snapshot:
-            from utils import get_db_connection
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("SELECT file_path FROM product_media WHERE product_id = ?", (item['product_id'],))
-            media_data = c.fetchall()
-            conn.close()
+            media_data = await db_fetchall("SELECT file_path FROM product_media WHERE product_id = ?", (item['product_id'],))
             
             logger.info(f"🔍 USERBOT FIRST: Found {len(media_data)} media files for product {item['product_id']}")
             for media_row in media_data:
@@ -1580,18 +1337,13 @@ async def _attempt_userbot_delivery_first(user_id: int, basket_snapshot: list, c
         
         logger.info(f"📂 USERBOT FIRST: Total media files to send: {len(media_files)}")
         
-        # Send via userbot secret chat
-        success, message = await userbot.send_product_to_user(user_id, product_data, media_files)
-        
-        if success:
-            logger.info(f"✅ USERBOT FIRST: Secret chat delivery successful for user {user_id} - bot chat NOT needed")
-            return True  # Userbot succeeded - no bot chat needed
-        else:
-            logger.warning(f"⚠️ USERBOT FIRST: Secret chat delivery failed for user {user_id}: {message} - will use bot chat")
-            return False  # Userbot failed - use bot chat fallback
+        # Durable job; the delivery scheduler spreads jobs across all connected userbot accounts
+        job_id = await run_db(enqueue_delivery, user_id, chat_id, product_data, media_files, list(product_ids))
+        logger.info(f"✅ USERBOT FIRST: Secret chat delivery job {job_id} queued for user {user_id} - bot chat NOT needed")
+        return True
             
     except Exception as e:
-        logger.error(f"❌ USERBOT FIRST: Error attempting secret chat delivery for user {user_id}: {e}")
+        logger.error(f"❌ USERBOT FIRST: Error queueing secret chat delivery for user {user_id}: {e}")
         return False  # Userbot failed - use bot chat fallback
 
 # --- Simple Userbot Integration ---
@@ -1631,12 +1383,7 @@ async def _trigger_userbot_delivery(user_id: int, basket_snapshot: list, context
         # Get media files - check database directly for all products  
         media_files = []
         for item in basket_snapshot:
-            from utils import get_db_connection
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("SELECT file_path FROM product_media WHERE product_id = ?", (item['product_id'],))
-            media_data = c.fetchall()
-            conn.close()
+            media_data = await db_fetchall("SELECT file_path FROM product_media WHERE product_id = ?", (item['product_id'],))
             
             logger.info(f"🔍 USERBOT: Found {len(media_data)} media files for product {item['product_id']}")
             for media_row in media_data:
@@ -7,7 +7,7 @@ from pyrogram import Client
 from pyrogram.types import InputMediaPhoto, InputMediaDocument
 
 from userbot_config import userbot_config
-from utils import get_db_connection
+from utils import db_fetchone, db_fetchall, db_execute # Async DB facade (runs SQLite off the event loop)
 
 logger = logging.getLogger(__name__)
 
@@ -64,15 +64,11 @@ class ProductDeliveryHandler:
     async def _get_secret_chat_id(self, user_id: int) -> Optional[int]:
         """Get secret chat ID for user from database"""
         try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("""
+            result = await db_fetchone("""
                 SELECT secret_chat_id FROM userbot_secret_chats 
                 WHERE user_id = ? AND status = 'active'
                 ORDER BY created_at DESC LIMIT 1
             """, (user_id,))
-            result = c.fetchone()
-            conn.close()
             
             return result[0] if result else None
             
@@ -257,9 +253,7 @@ Your physical product is ready for pickup!
     async def _log_delivery(self, user_id: int, product_data: Dict[str, Any]):
         """Log delivery in database"""
         try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("""
+            await db_execute("""
                 INSERT INTO userbot_deliveries 
                 (user_id, order_id, product_name, delivery_type, delivered_at, status) 
                 VALUES (?, ?, ?, ?, ?, ?)
@@ -271,8 +265,6 @@ Your physical product is ready for pickup!
                 datetime.now(timezone.utc).isoformat(),
                 'delivered'
             ))
-            conn.commit()
-            conn.close()
             
         except Exception as e:
             logger.error(f"❌ DELIVERY: Error logging delivery: {e}")
@@ -280,9 +272,7 @@ Your physical product is ready for pickup!
     async def get_delivery_history(self, user_id: int) -> List[Dict[str, Any]]:
         """Get delivery history for a user"""
         try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("""
+            rows = await db_fetchall("""
                 SELECT order_id, product_name, delivery_type, delivered_at, status
                 FROM userbot_deliveries 
                 WHERE user_id = ?
@@ -290,7 +280,7 @@ Your physical product is ready for pickup!
             """, (user_id,))
             
             results = []
-            for row in c.fetchall():
+            for row in rows:
                 results.append({
                     'order_id': row[0],
                     'product_name': row[1],
@@ -299,7 +289,6 @@ Your physical product is ready for pickup!
                     'status': row[4]
                 })
             
-            conn.close()
             return results
             
         except Exception as e:
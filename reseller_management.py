@@ -3,6 +3,7 @@
 import sqlite3
 import logging
 import time
+import threading
 from decimal import Decimal, ROUND_DOWN # Use Decimal for precision
 import math # For pagination calculation
 
@@ -13,8 +14,10 @@ import telegram.error as telegram_error
 # -------------------------
 
 # Import shared elements from utils
+from router import callback_route, state_route # Static update routing
 from utils import (
-    ADMIN_ID, LANGUAGES, get_db_connection, send_message_with_retry,
+    ADMIN_ID, LANGUAGES, get_db_connection, run_db, db_fetchone, db_fetchall, send_message_with_retry,
+    USER_PROFILES, # Cached users-row snapshot (is_reseller short-circuits non-resellers)
     PRODUCT_TYPES, format_currency, log_admin_action, load_all_data,
     DEFAULT_PRODUCT_EMOJI,
     # Import action constants for logging
@@ -31,125 +34,148 @@ logger = logging.getLogger(__name__)
 # Constants
 USERS_PER_PAGE_DISCOUNT_SELECT = 10 # Keep for selecting reseller for discount mgmt
 
+# --- Reseller Pricing Service ---
+RESELLER_PRICING_TTL_SECONDS = 600 # Safety net for rows edited outside the admin handlers
+
+class ResellerPricing:
+    """
+    Per-user reseller discount maps ({product_type: Decimal percent}), loaded with one query
+    and cached until the reseller admin handlers invalidate them. Non-resellers cache an empty map.
+    """
+    def __init__(self, ttl_seconds: int = RESELLER_PRICING_TTL_SECONDS):
+        self._ttl = ttl_seconds
+        self._maps = {} # {user_id: (loaded_at, {product_type: Decimal})}
+        self._generation = 0 # Bumped on every invalidation so in-flight loads can't store stale maps
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _load_with_cursor(cursor, user_id: int) -> dict:
+        cursor.execute("""
+            SELECT u.is_reseller, rd.product_type, rd.discount_percentage
+            FROM users u
+            LEFT JOIN reseller_discounts rd ON rd.reseller_user_id = u.user_id
+            WHERE u.user_id = ?
+        """, (user_id,))
+        rows = cursor.fetchall()
+        if not rows or rows[0]['is_reseller'] != 1:
+            return {}
+        return {row['product_type']: Decimal(str(row['discount_percentage']))
+                for row in rows if row['product_type'] is not None}
+
+    def _cached(self, user_id: int):
+        entry = self._maps.get(user_id)
+        if entry and time.monotonic() - entry[0] < self._ttl:
+            return entry[1]
+        profile = USER_PROFILES.peek(user_id)
+        if profile is not None and profile['is_reseller'] != 1:
+            return {} # Known non-reseller, no rules to load
+        return None
+
+    def _store(self, user_id: int, generation: int, discount_map: dict):
+        with self._lock:
+            if generation == self._generation:
+                self._maps[user_id] = (time.monotonic(), discount_map)
+
+    def get_discount_map(self, user_id: int, cursor=None) -> dict:
+        """Returns the user's discount map, loading it on a cache miss. (Synchronous, runs on DB executor)"""
+        discount_map = self._cached(user_id)
+        if discount_map is not None:
+            return discount_map
+        generation = self._generation
+        conn = None
+        try:
+            if cursor is None:
+                conn = get_db_connection()
+                cursor = conn.cursor()
+            discount_map = self._load_with_cursor(cursor, user_id)
+        except sqlite3.Error as e:
+            logger.error(f"DB error loading reseller discount map for user {user_id}: {e}")
+            return {} # Not cached, next call retries
+        finally:
+            if conn: conn.close()
+        self._store(user_id, generation, discount_map)
+        if discount_map:
+            logger.debug(f"Loaded reseller discount map for user {user_id}: {len(discount_map)} rules")
+        return discount_map
+
+    async def get_discount_map_async(self, user_id: int) -> dict:
+        """Cache hits return without a DB executor hop."""
+        discount_map = self._cached(user_id)
+        if discount_map is not None:
+            return discount_map
+        return await run_db(self.get_discount_map, user_id)
+
+    def get_discount(self, user_id: int, product_type: str, cursor=None) -> Decimal:
+        return self.get_discount_map(user_id, cursor).get(product_type, Decimal('0.0'))
+
+    @staticmethod
+    def price_items(discount_map: dict, items: list, price_key: str = 'price', type_key: str = 'product_type') -> dict:
+        """Applies a discount map to basket items. Per-item discounts round down to the cent, as at checkout."""
+        priced = []
+        original_total = discount_total = Decimal('0.0')
+        for item in items:
+            price = Decimal(str(item.get(price_key, 0) or 0))
+            percent = discount_map.get(item.get(type_key, ''), Decimal('0.0'))
+            discount = (price * percent / Decimal('100')).quantize(Decimal('0.01'), rounding=ROUND_DOWN)
+            priced.append({'price': price, 'discount_percent': percent, 'discount_amount': discount, 'final_price': price - discount})
+            original_total += price
+            discount_total += discount
+        return {'items': priced, 'original_total': original_total,
+                'discount_total': discount_total, 'final_total': original_total - discount_total}
+
+    async def price_basket(self, user_id: int, items: list, price_key: str = 'price', type_key: str = 'product_type') -> dict:
+        """Prices a whole basket with a single discount map lookup."""
+        discount_map = await self.get_discount_map_async(user_id) if items else {}
+        return self.price_items(discount_map, items, price_key, type_key)
+
+    def invalidate(self, user_id: int | None = None):
+        """Drops one user's map, or every map when user_id is None (e.g. product type renamed/deleted)."""
+        with self._lock:
+            self._generation += 1
+            if user_id is None: self._maps.clear()
+            else: self._maps.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {'cached_users': len(self._maps), 'generation': self._generation}
+
+
+RESELLER_PRICING = ResellerPricing()
+
+
 # --- Helper Function to Get Reseller Discount ---
-# (Keep this function as is)
 async def get_reseller_discount_with_connection(cursor, user_id: int, product_type: str) -> Decimal:
     """Fetches the discount percentage for a specific reseller and product type using existing cursor."""
-    discount = Decimal('0.0')
-    
-    try:
-        # Enhanced logging for debugging
-        logger.info(f"Checking reseller discount for user {user_id}, product type '{product_type}'")
-        
-        cursor.execute("SELECT is_reseller FROM users WHERE user_id = ?", (user_id,))
-        res = cursor.fetchone()
-        
-        if not res:
-            logger.warning(f"User {user_id} not found in database for reseller discount check")
-            return discount
-            
-        is_reseller = res['is_reseller']
-        logger.info(f"User {user_id} reseller status: {is_reseller} (1=reseller, 0=not reseller)")
-        
-        if res and res['is_reseller'] == 1:
-            # User is a reseller, get their discount for this product type
-            cursor.execute("""
-                SELECT discount_percentage FROM reseller_discounts 
-                WHERE reseller_user_id = ? AND product_type = ?
-            """, (user_id, product_type))
-            
-            discount_result = cursor.fetchone()
-            if discount_result:
-                discount = Decimal(str(discount_result['discount_percentage']))
-                logger.info(f"Reseller discount for user {user_id}, type '{product_type}': {discount}%")
-            else:
-                logger.info(f"No specific discount found for reseller {user_id}, type '{product_type}'. Using 0%")
-        else:
-            logger.info(f"User {user_id} is not a reseller (is_reseller={is_reseller}), returning 0% discount")
-            
-    except sqlite3.Error as e:
-        logger.error(f"DB error fetching reseller discount for user {user_id}, type {product_type}: {e}")
-        return Decimal('0.0')  # Return 0% discount on error
-    except Exception as e:
-        logger.error(f"Unexpected error in reseller discount check for user {user_id}: {e}", exc_info=True)
-        return Decimal('0.0')
-    
-    return discount
+    return get_reseller_discount_for_cursor(cursor, user_id, product_type)
+
+def get_reseller_discount_for_cursor(cursor, user_id: int, product_type: str) -> Decimal:
+    """Synchronous variant of get_reseller_discount_with_connection, for use inside DB executor transactions."""
+    return RESELLER_PRICING.get_discount(user_id, product_type, cursor)
+
+def get_reseller_discount_map_for_cursor(cursor, user_id: int) -> dict:
+    """Whole discount map via an existing cursor, for pricing every item of a basket inside one transaction."""
+    return RESELLER_PRICING.get_discount_map(user_id, cursor)
 
 def get_reseller_discount(user_id: int, product_type: str) -> Decimal:
     """Fetches the discount percentage for a specific reseller and product type."""
-    discount = Decimal('0.0')
-    conn = None
-    max_retries = 3
-    retry_delay = 0.1  # 100ms
-    
-    for attempt in range(max_retries):
-        try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            
-            # Enhanced logging for debugging
-            logger.info(f"Checking reseller discount for user {user_id}, product type '{product_type}'")
-            
-            c.execute("SELECT is_reseller FROM users WHERE user_id = ?", (user_id,))
-            res = c.fetchone()
-            
-            if not res:
-                logger.warning(f"User {user_id} not found in database for reseller discount check")
-                return discount
-                
-            is_reseller = res['is_reseller']
-            logger.info(f"User {user_id} reseller status: {is_reseller} (1=reseller, 0=not reseller)")
-            
-            if res and res['is_reseller'] == 1:
-                # Check what discount records exist for this user
-                c.execute("SELECT product_type, discount_percentage FROM reseller_discounts WHERE reseller_user_id = ?", (user_id,))
-                all_discounts = c.fetchall()
-                logger.info(f"User {user_id} has {len(all_discounts)} discount records: {[(d['product_type'], d['discount_percentage']) for d in all_discounts]}")
-                
-                c.execute("""
-                    SELECT discount_percentage FROM reseller_discounts
-                    WHERE reseller_user_id = ? AND product_type = ?
-                """, (user_id, product_type))
-                discount_res = c.fetchone()
-                if discount_res:
-                    discount = Decimal(str(discount_res['discount_percentage']))
-                    logger.info(f"✅ Found reseller discount for user {user_id}, type '{product_type}': {discount}%")
-                else:
-                    logger.info(f"❌ No reseller discount found for user {user_id}, type '{product_type}' (user is reseller but no specific discount set)")
-            else:
-                logger.info(f"User {user_id} is not a reseller (is_reseller={is_reseller}), returning 0% discount")
-            
-            # Success - break out of retry loop
-            break
-            
-        except sqlite3.Error as e:
-            if "database is locked" in str(e).lower() and attempt < max_retries - 1:
-                logger.warning(f"Database locked for reseller discount check (attempt {attempt + 1}/{max_retries}), retrying in {retry_delay}s...")
-                if conn: 
-                    conn.close()
-                    conn = None
-                time.sleep(retry_delay)
-                retry_delay *= 2  # Exponential backoff
-                continue
-            else:
-                logger.error(f"DB error fetching reseller discount for user {user_id}, type {product_type}: {e}")
-                break
-        except Exception as e:
-            logger.error(f"Unexpected error fetching reseller discount: {e}", exc_info=True)
-            break
-        finally:
-            if conn: 
-                conn.close()
-                conn = None
-    
-    return discount
+    return RESELLER_PRICING.get_discount(user_id, product_type)
+
+async def fetch_reseller_discount_map(user_id: int) -> dict:
+    """Returns {product_type: Decimal percent} for the user ({} for non-resellers)."""
+    return await RESELLER_PRICING.get_discount_map_async(user_id)
+
+async def price_reseller_basket(user_id: int, items: list, price_key: str = 'price', type_key: str = 'product_type') -> dict:
+    """Prices a whole basket in one call. See ResellerPricing.price_items for the result shape."""
+    return await RESELLER_PRICING.price_basket(user_id, items, price_key, type_key)
+
+def invalidate_reseller_pricing(user_id: int | None = None):
+    RESELLER_PRICING.invalidate(user_id)
 
 
 # ==================================
 # --- Admin: Manage Reseller Status --- (REVISED FLOW)
 # ==================================
 
+@callback_route("manage_resellers_menu")
 async def handle_manage_resellers_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Prompts admin to enter the User ID to manage reseller status."""
     query = update.callback_query
@@ -166,6 +192,7 @@ async def handle_manage_resellers_menu(update: Update, context: ContextTypes.DEF
     await query.answer("Enter User ID in chat.")
 
 
+@state_route("awaiting_reseller_manage_id")
 async def handle_reseller_manage_id_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles the admin entering a User ID for reseller status management."""
     admin_id = update.effective_user.id
@@ -192,21 +219,15 @@ async def handle_reseller_manage_id_message(update: Update, context: ContextType
     context.user_data.pop('state', None)
 
     # Fetch user info
-    conn = None
     user_info = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT user_id, username, is_reseller FROM users WHERE user_id = ?", (target_user_id,))
-        user_info = c.fetchone()
+        user_info = await db_fetchone("SELECT user_id, username, is_reseller FROM users WHERE user_id = ?", (target_user_id,))
     except sqlite3.Error as e:
         logger.error(f"DB error fetching user {target_user_id} for reseller check: {e}")
         await send_message_with_retry(context.bot, chat_id, "❌ Database error checking user.", parse_mode=None)
         # Go back to admin menu on error
         await send_message_with_retry(context.bot, chat_id, "Returning to menu...", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Admin Menu", callback_data="admin_menu")]]), parse_mode=None)
         return
-    finally:
-        if conn: conn.close()
 
     if not user_info:
         await send_message_with_retry(context.bot, chat_id, f"❌ User ID {target_user_id} not found in the bot's database.", parse_mode=None)
@@ -234,6 +255,37 @@ async def handle_reseller_manage_id_message(update: Update, context: ContextType
     await send_message_with_retry(context.bot, chat_id, msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
 
+def _toggle_reseller_status_db(admin_id: int, target_user_id: int):
+    """Toggles a user's reseller flag (Synchronous, runs on DB executor). Returns (username, new_status) or None if user missing."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT username, is_reseller FROM users WHERE user_id = ?", (target_user_id,))
+        user_data = c.fetchone()
+        if not user_data:
+            return None
+
+        current_status = user_data['is_reseller']
+        username = user_data['username'] or f"ID_{target_user_id}"
+        new_status = 0 if current_status == 1 else 1
+        c.execute("UPDATE users SET is_reseller = ? WHERE user_id = ?", (new_status, target_user_id))
+        conn.commit()
+        RESELLER_PRICING.invalidate(target_user_id)
+        USER_PROFILES.update(target_user_id, is_reseller=new_status)
+    except Exception:
+        if conn and conn.in_transaction: conn.rollback()
+        raise
+    finally:
+        if conn: conn.close()
+
+    # Log action using constants from utils
+    action_desc = ACTION_RESELLER_ENABLED if new_status == 1 else ACTION_RESELLER_DISABLED
+    log_admin_action(admin_id, action_desc, target_user_id=target_user_id, old_value=current_status, new_value=new_status)
+    return username, new_status
+
+
+@callback_route("reseller_toggle_status")
 async def handle_reseller_toggle_status(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Toggles the is_reseller flag for a user (called from user display)."""
     query = update.callback_query
@@ -246,26 +298,13 @@ async def handle_reseller_toggle_status(update: Update, context: ContextTypes.DE
         await query.answer("Error: Invalid data.", show_alert=True); return
 
     target_user_id = int(params[0])
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT username, is_reseller FROM users WHERE user_id = ?", (target_user_id,))
-        user_data = c.fetchone()
-        if not user_data:
+        toggle_result = await run_db(_toggle_reseller_status_db, admin_id, target_user_id)
+        if toggle_result is None:
             await query.answer("User not found.", show_alert=True)
             # Go back to the prompt to enter another ID
             return await handle_manage_resellers_menu(update, context)
-
-        current_status = user_data['is_reseller']
-        username = user_data['username'] or f"ID_{target_user_id}"
-        new_status = 0 if current_status == 1 else 1
-        c.execute("UPDATE users SET is_reseller = ? WHERE user_id = ?", (new_status, target_user_id))
-        conn.commit()
-
-        # Log action using constants from utils
-        action_desc = ACTION_RESELLER_ENABLED if new_status == 1 else ACTION_RESELLER_DISABLED
-        log_admin_action(admin_id, action_desc, target_user_id=target_user_id, old_value=current_status, new_value=new_status)
+        username, new_status = toggle_result
 
         status_text = "enabled" if new_status == 1 else "disabled"
         await query.answer(f"Reseller status {status_text} for user {target_user_id}.")
@@ -293,14 +332,13 @@ async def handle_reseller_toggle_status(update: Update, context: ContextTypes.DE
     except Exception as e:
         logger.error(f"Error toggling reseller status {target_user_id}: {e}", exc_info=True)
         await query.answer("Error.", show_alert=True)
-    finally:
-        if conn: conn.close()
 
 
 # ========================================
 # --- Admin: Manage Reseller Discounts --- (Pagination kept)
 # ========================================
 
+@callback_route("manage_reseller_discounts_select_reseller")
 async def handle_manage_reseller_discounts_select_reseller(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Admin selects which active reseller to manage discounts for (PAGINATED)."""
     query = update.callback_query
@@ -310,23 +348,17 @@ async def handle_manage_reseller_discounts_select_reseller(update: Update, conte
 
     resellers = []
     total_resellers = 0
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) as count FROM users WHERE is_reseller = 1")
-        count_res = c.fetchone(); total_resellers = count_res['count'] if count_res else 0
-        c.execute("""
+        count_res = await db_fetchone("SELECT COUNT(*) as count FROM users WHERE is_reseller = 1")
+        total_resellers = count_res['count'] if count_res else 0
+        resellers = await db_fetchall("""
             SELECT user_id, username FROM users
             WHERE is_reseller = 1 ORDER BY user_id DESC LIMIT ? OFFSET ?
         """, (USERS_PER_PAGE_DISCOUNT_SELECT, offset)) # Use specific constant
-        resellers = c.fetchall()
     except sqlite3.Error as e:
         logger.error(f"DB error fetching active resellers: {e}")
         await query.edit_message_text("❌ DB Error fetching resellers.", parse_mode=None)
         return
-    finally:
-        if conn: conn.close()
 
     msg = "👤 Manage Reseller Discounts\n\nSelect an active reseller to set their discounts:\n"
     keyboard = []
@@ -363,6 +395,7 @@ async def handle_manage_reseller_discounts_select_reseller(update: Update, conte
 
 # --- Manage Specific Reseller Discounts ---
 
+@callback_route("reseller_manage_specific")
 async def handle_manage_specific_reseller_discounts(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Displays current discounts for a specific reseller and allows adding/editing."""
     query = update.callback_query
@@ -374,23 +407,17 @@ async def handle_manage_specific_reseller_discounts(update: Update, context: Con
     target_reseller_id = int(params[0])
     discounts = []
     username = f"ID_{target_reseller_id}"
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT username FROM users WHERE user_id = ?", (target_reseller_id,))
-        user_res = c.fetchone(); username = user_res['username'] if user_res and user_res['username'] else username
-        c.execute("""
+        user_res = await db_fetchone("SELECT username FROM users WHERE user_id = ?", (target_reseller_id,))
+        username = user_res['username'] if user_res and user_res['username'] else username
+        discounts = await db_fetchall("""
             SELECT product_type, discount_percentage FROM reseller_discounts
             WHERE reseller_user_id = ? ORDER BY product_type
         """, (target_reseller_id,))
-        discounts = c.fetchall()
     except sqlite3.Error as e:
         logger.error(f"DB error fetching discounts for reseller {target_reseller_id}: {e}")
         await query.edit_message_text("❌ DB Error fetching discounts.", parse_mode=None)
         return
-    finally:
-        if conn: conn.close()
 
     msg = f"🏷️ Discounts for Reseller @{username} (ID: {target_reseller_id})\n\n"
     keyboard = []
@@ -424,6 +451,7 @@ async def handle_manage_specific_reseller_discounts(update: Update, context: Con
 
 
 # <<< FIXED >>>
+@callback_route("reseller_add_discount_select_type")
 async def handle_reseller_add_discount_select_type(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Admin selects product type for a new reseller discount rule."""
     query = update.callback_query
@@ -436,7 +464,7 @@ async def handle_reseller_add_discount_select_type(update: Update, context: Cont
     # <<< STORE the target ID in context >>>
     context.user_data['reseller_mgmt_target_id'] = target_reseller_id
 
-    load_all_data() # Ensure PRODUCT_TYPES is fresh
+    await run_db(load_all_data) # Ensure PRODUCT_TYPES is fresh
 
     if not PRODUCT_TYPES:
         await query.edit_message_text("❌ No product types configured. Please add types via 'Manage Product Types'.", parse_mode=None)
@@ -458,6 +486,7 @@ async def handle_reseller_add_discount_select_type(update: Update, context: Cont
 
 
 # <<< FIXED >>>
+@callback_route("reseller_add_discount_enter_percent")
 async def handle_reseller_add_discount_enter_percent(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Admin needs to enter the percentage for the new rule."""
     query = update.callback_query
@@ -491,6 +520,7 @@ async def handle_reseller_add_discount_enter_percent(update: Update, context: Co
     await query.answer("Enter percentage in chat.")
 
 
+@callback_route("reseller_edit_discount")
 async def handle_reseller_edit_discount(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Admin wants to edit an existing discount percentage."""
     query = update.callback_query
@@ -519,6 +549,42 @@ async def handle_reseller_edit_discount(update: Update, context: ContextTypes.DE
     await query.answer("Enter new percentage in chat.")
 
 
+def _save_reseller_discount_db(admin_id: int, target_user_id: int, product_type: str, mode: str, stored_value: float):
+    """Adds or replaces a reseller discount rule and logs it (Synchronous, runs on DB executor). Returns the previous percentage (None if new)."""
+    conn = None
+    old_value = None # For logging edits
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("BEGIN")
+
+        if mode == 'edit':
+            c.execute("SELECT discount_percentage FROM reseller_discounts WHERE reseller_user_id = ? AND product_type = ?", (target_user_id, product_type))
+            old_res = c.fetchone()
+            old_value = old_res['discount_percentage'] if old_res else None
+
+        # Use INSERT OR REPLACE for both add and edit to simplify logic
+        # If it's an 'edit' but the row doesn't exist, it becomes an 'add'
+        c.execute("INSERT OR REPLACE INTO reseller_discounts (reseller_user_id, product_type, discount_percentage) VALUES (?, ?, ?)",
+                  (target_user_id, product_type, stored_value))
+        conn.commit()
+        RESELLER_PRICING.invalidate(target_user_id)
+    except Exception:
+        if conn and conn.in_transaction: conn.rollback()
+        raise
+    finally:
+        if conn: conn.close()
+
+    # Determine action description based on whether old value existed
+    action_desc = ACTION_RESELLER_DISCOUNT_ADD if old_value is None else ACTION_RESELLER_DISCOUNT_EDIT
+    log_admin_action(
+        admin_id=admin_id, action=action_desc, target_user_id=target_user_id,
+        reason=f"Type: {product_type}", old_value=old_value, new_value=stored_value # Log the value stored
+    )
+    return old_value
+
+
+@state_route("awaiting_reseller_discount_percent")
 async def handle_reseller_percent_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles the admin entering the discount percentage via message."""
     admin_id = update.effective_user.id
@@ -551,37 +617,12 @@ async def handle_reseller_percent_message(update: Update, context: ContextTypes.
         if not (Decimal('0.0') <= percentage <= Decimal('100.0')):
             raise ValueError("Percentage must be between 0 and 100.")
 
-        conn = None
-        old_value = None # For logging edits
         try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("BEGIN")
-
-            if mode == 'edit':
-                c.execute("SELECT discount_percentage FROM reseller_discounts WHERE reseller_user_id = ? AND product_type = ?", (target_user_id, product_type))
-                old_res = c.fetchone()
-                old_value = old_res['discount_percentage'] if old_res else None
-
-            # Use INSERT OR REPLACE for both add and edit to simplify logic
-            # If it's an 'edit' but the row doesn't exist, it becomes an 'add'
-            sql = "INSERT OR REPLACE INTO reseller_discounts (reseller_user_id, product_type, discount_percentage) VALUES (?, ?, ?)"
             # Use quantize before converting to float for DB storage if needed, or store as TEXT
             # Storing as REAL (float) is generally fine for percentages if precision issues are acceptable,
             # but TEXT is safer if exact Decimal values are critical. Let's stick with REAL for now.
-            params_sql = (target_user_id, product_type, float(percentage.quantize(Decimal("0.1")))) # Store with one decimal place
-
-            # Determine action description based on whether old value existed
-            action_desc = ACTION_RESELLER_DISCOUNT_ADD if old_value is None else ACTION_RESELLER_DISCOUNT_EDIT
-
-            result = c.execute(sql, params_sql)
-            conn.commit()
-
-            # Log the action
-            log_admin_action(
-                admin_id=admin_id, action=action_desc, target_user_id=target_user_id,
-                reason=f"Type: {product_type}", old_value=old_value, new_value=params_sql[2] # Log the value stored
-            )
+            stored_value = float(percentage.quantize(Decimal("0.1"))) # Store with one decimal place
+            old_value = await run_db(_save_reseller_discount_db, admin_id, target_user_id, product_type, mode, stored_value)
 
             action_verb = "set" if old_value is None else "updated"
             await send_message_with_retry(context.bot, chat_id, f"✅ Discount rule {action_verb} for {product_type}: {percentage:.1f}%",
@@ -593,21 +634,19 @@ async def handle_reseller_percent_message(update: Update, context: ContextTypes.
 
         except sqlite3.Error as e: # Catch potential DB errors like IntegrityError implicitly
             logger.error(f"DB error {mode} reseller discount: {e}", exc_info=True)
-            if conn and conn.in_transaction: conn.rollback()
             await send_message_with_retry(context.bot, chat_id, "❌ DB Error saving discount rule.", parse_mode=None)
             context.user_data.pop('state', None) # Clear state on error
             # Clean up other related context data on error
             context.user_data.pop('reseller_mgmt_target_id', None)
             context.user_data.pop('reseller_mgmt_product_type', None)
             context.user_data.pop('reseller_mgmt_mode', None)
-        finally:
-            if conn: conn.close()
 
     except ValueError:
         await send_message_with_retry(context.bot, chat_id, "❌ Invalid percentage. Enter a number between 0 and 100 (e.g., 10 or 15.5).", parse_mode=None)
         # Keep state awaiting percentage
 
 
+@callback_route("reseller_delete_discount_confirm")
 async def handle_reseller_delete_discount_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles 'Delete Discount' button press, shows confirmation."""
     query = update.callback_query
@@ -0,0 +1,114 @@
+"""
+Static Update Router
+Callback commands and conversation states are registered once, at import time,
+by decorating handlers in their own modules. main.py only looks them up.
+"""
+import asyncio
+import logging
+import time
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# --- Route Registries ---
+CALLBACK_ROUTES = {} # {command: coroutine(update, context, params)}
+CALLBACK_PREFIX_ROUTES = {} # {prefix: coroutine(update, context, params)} - used when no exact command matches
+STATE_ROUTES = {} # {state: coroutine(update, context)}
+
+# {route_key: [calls, total_seconds, max_seconds, errors]}
+ROUTE_STATS = defaultdict(lambda: [0, 0.0, 0.0, 0])
+
+
+def _register(registry: dict, kind: str, key: str, func):
+    if not asyncio.iscoroutinefunction(func):
+        raise TypeError(f"Route {kind} '{key}' must map to a coroutine function, got {func!r}")
+    existing = registry.get(key)
+    if existing is not None and existing is not func:
+        raise ValueError(f"Route {kind} '{key}' already registered to {existing.__module__}.{existing.__name__}")
+    registry[key] = func
+
+
+def callback_route(*commands: str, prefix: str | None = None):
+    """Registers a callback query handler for one or more commands (and optionally a prefix)."""
+    def decorator(func):
+        for command in commands:
+            _register(CALLBACK_ROUTES, "callback", command, func)
+        if prefix:
+            _register(CALLBACK_PREFIX_ROUTES, "callback prefix", prefix, func)
+        return func
+    return decorator
+
+
+def state_route(*states: str):
+    """Registers a message handler for one or more `context.user_data['state']` values."""
+    def decorator(func):
+        for state in states:
+            _register(STATE_ROUTES, "state", state, func)
+        return func
+    return decorator
+
+
+# Longest prefix first; rebuilt by validate_routes() once all modules are imported
+_sorted_prefixes: list[str] = []
+
+
+def resolve_callback(command: str):
+    """Returns the handler for a callback command: exact match first, then the longest registered prefix."""
+    func = CALLBACK_ROUTES.get(command)
+    if func is not None or not CALLBACK_PREFIX_ROUTES:
+        return func
+    for prefix in _sorted_prefixes:
+        if command.startswith(prefix):
+            return CALLBACK_PREFIX_ROUTES[prefix]
+    return None
+
+
+def validate_routes():
+    """Startup check that every registered route maps to a coroutine. Raises on misconfiguration."""
+    global _sorted_prefixes
+    bad = [(key, func) for registry in (CALLBACK_ROUTES, CALLBACK_PREFIX_ROUTES, STATE_ROUTES)
+           for key, func in registry.items() if not asyncio.iscoroutinefunction(func)]
+    if bad:
+        raise TypeError(f"Routes not mapped to coroutines: {[key for key, _ in bad]}")
+    _sorted_prefixes = sorted(CALLBACK_PREFIX_ROUTES, key=len, reverse=True)
+    logger.info(f"Router ready: {len(CALLBACK_ROUTES)} callback commands, {len(CALLBACK_PREFIX_ROUTES)} prefixes, {len(STATE_ROUTES)} states.")
+
+
+async def _timed(route_key: str, coro):
+    stats = ROUTE_STATS[route_key]
+    start = time.perf_counter()
+    try:
+        return await coro
+    except Exception:
+        stats[3] += 1
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        stats[0] += 1; stats[1] += elapsed
+        if elapsed > stats[2]: stats[2] = elapsed
+
+
+async def dispatch_callback(command: str, update, context, params: list) -> bool:
+    """Runs the handler for a callback command. Returns False if no route matches."""
+    func = resolve_callback(command)
+    if func is None: return False
+    await _timed(f"cb:{command}", func(update, context, params))
+    return True
+
+
+async def dispatch_state(state: str, update, context) -> bool:
+    """Runs the message handler for a conversation state. Returns False if no route matches."""
+    func = STATE_ROUTES.get(state)
+    if func is None: return False
+    await _timed(f"state:{state}", func(update, context))
+    return True
+
+
+def get_route_stats(top: int | None = None) -> list[dict]:
+    """Per-route call counts and timings, slowest total time first."""
+    rows = [{'route': key, 'calls': calls, 'total_ms': round(total * 1000, 2),
+             'avg_ms': round(total * 1000 / calls, 2) if calls else 0.0,
+             'max_ms': round(max_s * 1000, 2), 'errors': errors}
+            for key, (calls, total, max_s, errors) in list(ROUTE_STATS.items())]
+    rows.sort(key=lambda r: r['total_ms'], reverse=True)
+    return rows[:top] if top else rows
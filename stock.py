@@ -12,9 +12,10 @@ import telegram.error as telegram_error # Use telegram.error
 # -------------------------
 
 # Import necessary items from utils
+from router import callback_route # Static update routing
 from utils import (
     ADMIN_ID, format_currency, send_message_with_retry, SECONDARY_ADMIN_IDS,
-    get_db_connection, # Import DB helper
+    CATALOG_INDEX, # In-memory stock index
     is_primary_admin, is_secondary_admin, is_any_admin # Admin helper functions
 )
 
@@ -22,6 +23,7 @@ from utils import (
 logger = logging.getLogger(__name__)
 
 # Note: The 'params' argument isn't used in this handler but kept for consistency
+@callback_route("view_stock")
 async def handle_view_stock(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Displays a formatted list of all available products in stock."""
     query = update.callback_query
@@ -38,22 +40,10 @@ async def handle_view_stock(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
     # Structure: {city: {district: {product_type: [(size, price, avail, res), ...]}}}
     stock_data = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
-    conn = None
 
     try:
-        conn = get_db_connection() # Use helper
-        # row_factory is set in helper
-        c = conn.cursor()
-        # Fetch all products that have *any* stock (available OR reserved)
-        # Use column names
-        # >>> MODIFIED QUERY HERE <<<
-        c.execute("""
-            SELECT city, district, product_type, size, price, available, reserved
-            FROM products WHERE available > 0 OR reserved > 0
-            ORDER BY city, district, product_type, price, size
-        """)
-        # >>> END MODIFICATION <<<
-        products = c.fetchall()
+        # All products that have *any* stock (available OR reserved), served from the catalog index
+        products = CATALOG_INDEX.stock_rows()
 
         if not products:
             msg = "📦 Bot Stock\n\nNo products currently in stock (neither available nor reserved)." # Clarified message
@@ -109,7 +99,5 @@ async def handle_view_stock(update: Update, context: ContextTypes.DEFAULT_TYPE,
     except Exception as e:
          logger.error(f"Unexpected error in handle_view_stock: {e}", exc_info=True)
          await query.edit_message_text("❌ An unexpected error occurred while generating the stock list.", parse_mode=None)
-    finally:
-        if conn: conn.close() # Close connection if opened
 
 # --- END OF FILE stock.py ---
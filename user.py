@@ -16,14 +16,21 @@ import telegram.error as telegram_error
 # -------------------------
 
 # Import from utils
+from router import callback_route, state_route # Static update routing
 from utils import (
     CITIES, DISTRICTS, PRODUCT_TYPES, THEMES, LANGUAGES, BOT_MEDIA, ADMIN_ID, BASKET_TIMEOUT, MIN_DEPOSIT_EUR,
     format_currency, get_progress_bar, send_message_with_retry, format_discount_value,
     clear_expired_basket, fetch_last_purchases, get_user_status, fetch_reviews,
     NOWPAYMENTS_API_KEY, # Check if NOWPayments is configured
     get_db_connection, MEDIA_DIR, # Import helper and MEDIA_DIR
+    run_db, db_fetchall, db_execute, # Async DB facade (runs SQLite off the event loop)
+    CATALOG_INDEX, # In-memory stock index for browsing menus
+    RESERVATION_EXPIRY, # Deadline scheduler for reservation release
+    send_cached_media, # Reuses uploaded file_ids for bot media
     DEFAULT_PRODUCT_EMOJI, # Import default emoji
     load_active_welcome_message, # <<< Import welcome message loader (though we'll modify its usage)
+    get_active_welcome_template, # Cached active welcome template for the start menu
+    USER_PROFILES, # Cached users-row snapshot (balance, purchases, language, reseller/ban flags)
     DEFAULT_WELCOME_MESSAGE, # <<< Import default welcome message fallback
     _get_lang_data, # <<< IMPORT THE HELPER FROM UTILS >>>
     _unreserve_basket_items, # <<< IMPORT UNRESERVE HELPER >>>
@@ -36,13 +43,18 @@ import payment # <<< Make sure payment module is imported
 
 # --- Import Reseller Helper ---
 try:
-    from reseller_management import get_reseller_discount
+    from reseller_management import get_reseller_discount, fetch_reseller_discount_map, price_reseller_basket
 except ImportError:
     logger_dummy_reseller = logging.getLogger(__name__ + "_dummy_reseller")
     logger_dummy_reseller.error("Could not import get_reseller_discount from reseller_management.py. Reseller discounts will not work.")
     # Define a dummy function that always returns zero discount
     def get_reseller_discount(user_id: int, product_type: str) -> Decimal:
         return Decimal('0.0')
+    async def fetch_reseller_discount_map(user_id: int) -> dict:
+        return {}
+    async def price_reseller_basket(user_id: int, items: list, price_key: str = 'price', type_key: str = 'product_type') -> dict:
+        total = sum((Decimal(str(item.get(price_key, 0) or 0)) for item in items), Decimal('0.0'))
+        return {'items': [], 'original_total': total, 'discount_total': Decimal('0.0'), 'final_total': total}
 # -----------------------------
 
 
@@ -91,72 +103,65 @@ SUPPORTED_CRYPTO = {
 
 
 # --- Helper Function to Build Start Menu ---
-def _build_start_menu_content(user_id: int, username: str, lang_data: dict, context: ContextTypes.DEFAULT_TYPE) -> tuple[str, InlineKeyboardMarkup]:
-    """Builds the text and keyboard for the start menu using provided lang_data."""
-    logger.debug(f"_build_start_menu_content: Building menu for user {user_id} with lang_data.")
+def _prune_expired_basket_items(context: ContextTypes.DEFAULT_TYPE) -> list:
+    """Drops basket items past their reservation window from user_data, without touching the DB.
+    The reservation expiry scheduler releases the matching basket_items rows."""
+    basket = context.user_data.get("basket", [])
+    if basket:
+        cutoff = time.time() - BASKET_TIMEOUT
+        basket = [item for item in basket if (item.get("timestamp") or 0) >= cutoff]
+        context.user_data["basket"] = basket
+    return basket
 
-    balance, purchases, basket_count = Decimal('0.0'), 0, 0
-    conn = None
-    active_template_name_from_db = None # Variable to store DB setting
+_START_MENU_KEYBOARDS = {} # {(lang, is_admin): InlineKeyboardMarkup}; markups are immutable, so they are shared
 
-    # --- Initial Data Fetch ---
-    try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        # Get user stats
-        c.execute("SELECT balance, total_purchases FROM users WHERE user_id = ?", (user_id,))
-        result = c.fetchone()
-        if result:
-            balance = Decimal(str(result['balance']))
-            purchases = result['total_purchases']
-
-        # Get active welcome template name setting
-        c.execute("SELECT setting_value FROM bot_settings WHERE setting_key = ?", ("active_welcome_message_name",)) # LINE 89
-        setting_row = c.fetchone()
-        if setting_row and setting_row['setting_value']: # Check if value is not None/empty
-            active_template_name_from_db = setting_row['setting_value']
-            logger.info(f"Active welcome template name from settings: '{active_template_name_from_db}'")
-        else:
-            active_template_name_from_db = "default" # Fallback to 'default' if setting is missing/empty
-            logger.info("Active welcome message name not found in settings, falling back to 'default'.")
+def _get_start_menu_keyboard(lang: str, lang_data: dict, is_admin: bool) -> InlineKeyboardMarkup:
+    """Returns the start menu keyboard for a language and admin flag, building it once."""
+    reply_markup = _START_MENU_KEYBOARDS.get((lang, is_admin))
+    if reply_markup is not None: return reply_markup
 
-        # Call synchronous clear_expired_basket (no await needed)
-        clear_expired_basket(context, user_id) # Assuming clear_expired_basket is synchronous
-        basket = context.user_data.get("basket", [])
-        basket_count = len(basket)
-        if not basket: context.user_data.pop('applied_discount', None)
+    shop_button_text = lang_data.get("shop_button", "Shop")
+    profile_button_text = lang_data.get("profile_button", "Profile")
+    top_up_button_text = lang_data.get("top_up_button", "Top Up")
+    reviews_button_text = lang_data.get("reviews_button", "Reviews")
+    price_list_button_text = lang_data.get("price_list_button", "Price List")
+    language_button_text = lang_data.get("language_button", "Language")
+    admin_button_text = lang_data.get("admin_button", "🔧 Admin Panel")
+    keyboard = [
+        [InlineKeyboardButton(f"{EMOJI_SHOP} {shop_button_text}", callback_data="shop")],
+        [InlineKeyboardButton(f"{EMOJI_PROFILE} {profile_button_text}", callback_data="profile"),
+         InlineKeyboardButton(f"{EMOJI_REFILL} {top_up_button_text}", callback_data="refill")],
+        [InlineKeyboardButton(f"{EMOJI_REVIEW} {reviews_button_text}", callback_data="reviews"),
+         InlineKeyboardButton(f"{EMOJI_PRICELIST} {price_list_button_text}", callback_data="price_list"),
+         InlineKeyboardButton(f"{EMOJI_LANG} {language_button_text}", callback_data="language")]
+    ]
+    if is_admin:
+        keyboard.insert(0, [InlineKeyboardButton(admin_button_text, callback_data="admin_menu")])
 
-    except sqlite3.Error as e:
-        logger.error(f"Database error fetching initial data for start menu build (user {user_id}): {e}", exc_info=True)
-        active_template_name_from_db = "default" # Fallback on DB error fetching setting
-    finally:
-        if conn: conn.close()
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    _START_MENU_KEYBOARDS[(lang, is_admin)] = reply_markup
+    return reply_markup
 
-    # --- Determine which template text to use ---
-    welcome_template_to_use = None # Start with None
 
-    if active_template_name_from_db: # Only try if we have a name (even if it's 'default')
-        conn_load = None
-        try:
-            conn_load = get_db_connection()
-            c_load = conn_load.cursor()
-            c_load.execute("SELECT template_text FROM welcome_messages WHERE name = ?", (active_template_name_from_db,))
-            template_row = c_load.fetchone()
-            if template_row:
-                welcome_template_to_use = template_row['template_text']
-                logger.info(f"Using welcome message template from DB: '{active_template_name_from_db}'")
-            else:
-                logger.warning(f"Active template '{active_template_name_from_db}' set in DB but not found in templates table. Will fall back.")
-                # welcome_template_to_use remains None
-        except sqlite3.Error as e:
-            logger.error(f"DB error loading specific welcome template '{active_template_name_from_db}': {e}")
-            # welcome_template_to_use remains None
-        finally:
-            if conn_load: conn_load.close()
+def _build_start_menu_content(user_id: int, username: str, lang: str, lang_data: dict, context: ContextTypes.DEFAULT_TYPE, profile: dict | None) -> tuple[str, InlineKeyboardMarkup]:
+    """Builds the text and keyboard for the start menu using provided lang_data and the user's cached profile.
+    Never touches the DB: the active template and the keyboards are cached in memory, and expired basket
+    rows are released by the reservation expiry scheduler, so the basket count comes from user_data."""
+    logger.debug(f"_build_start_menu_content: Building menu for user {user_id} with lang_data.")
+
+    balance, purchases = Decimal('0.0'), 0
+    if profile:
+        balance = Decimal(str(profile['balance']))
+        purchases = profile['total_purchases']
 
-    # Fallback logic if DB load failed or no active name was determined initially
+    basket = _prune_expired_basket_items(context)
+    basket_count = len(basket)
+    if not basket: context.user_data.pop('applied_discount', None)
+
+    # --- Determine which template text to use ---
+    active_template_name, welcome_template_to_use = get_active_welcome_template()
     if welcome_template_to_use is None:
-        logger.warning("Falling back to default welcome message defined in LANGUAGES.")
+        logger.debug(f"Active template '{active_template_name}' unavailable, falling back to the LANGUAGES welcome message.")
         welcome_template_to_use = lang_data.get('welcome', DEFAULT_WELCOME_MESSAGE) # Use language file default OR hardcoded default
 
     # --- Format the chosen template ---
@@ -181,31 +186,35 @@ def _build_start_menu_content(user_id: int, username: str, lang_data: dict, cont
         logger.error(f"Unexpected error formatting welcome message: {format_e}. Template: '{welcome_template_to_use[:100]}...' Using fallback.")
         full_welcome = f"👋 Welcome, {username}!\n\n💰 Balance: {balance_str} EUR"
 
-    # --- Build Keyboard ---
-    shop_button_text = lang_data.get("shop_button", "Shop")
-    profile_button_text = lang_data.get("profile_button", "Profile")
-    top_up_button_text = lang_data.get("top_up_button", "Top Up")
-    reviews_button_text = lang_data.get("reviews_button", "Reviews")
-    price_list_button_text = lang_data.get("price_list_button", "Price List")
-    language_button_text = lang_data.get("language_button", "Language")
-    admin_button_text = lang_data.get("admin_button", "🔧 Admin Panel")
-    keyboard = [
-        [InlineKeyboardButton(f"{EMOJI_SHOP} {shop_button_text}", callback_data="shop")],
-        [InlineKeyboardButton(f"{EMOJI_PROFILE} {profile_button_text}", callback_data="profile"),
-         InlineKeyboardButton(f"{EMOJI_REFILL} {top_up_button_text}", callback_data="refill")],
-        [InlineKeyboardButton(f"{EMOJI_REVIEW} {reviews_button_text}", callback_data="reviews"),
-         InlineKeyboardButton(f"{EMOJI_PRICELIST} {price_list_button_text}", callback_data="price_list"),
-         InlineKeyboardButton(f"{EMOJI_LANG} {language_button_text}", callback_data="language")]
-    ]
-    if is_primary_admin(user_id):
-        keyboard.insert(0, [InlineKeyboardButton(admin_button_text, callback_data="admin_menu")])
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = _get_start_menu_keyboard(lang, lang_data, is_primary_admin(user_id))
 
     return full_welcome, reply_markup
 
 
+def _ensure_user_and_get_language(user_id: int, username: str) -> str | None:
+    """Upserts the user row and returns the stored language (Synchronous, runs on DB executor)."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        # Ensure user exists
+        c.execute("""
+            INSERT INTO users (user_id, username, language, is_reseller) VALUES (?, ?, 'en', 0)
+            ON CONFLICT(user_id) DO UPDATE SET username=excluded.username
+        """, (user_id, username))
+        conn.commit()
+        USER_PROFILES.update(user_id, username=username)
+        # Get language (also warms the profile cache for the start menu)
+        profile = USER_PROFILES.get(user_id, c)
+    finally:
+        if conn: conn.close()
+    # Update user activity status (they successfully interacted with the bot)
+    update_user_broadcast_status(user_id, success=True)
+    return profile['language'] if profile else 'en'
+
+
 # --- User Command Handlers ---
+@callback_route("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles the /start command and the initial welcome message."""
     user = update.effective_user
@@ -238,13 +247,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Check if file exists using asyncio.to_thread
         if await asyncio.to_thread(os.path.exists, media_path):
             try:
-                # Pass the file path directly to the send_* methods
-                if media_type == "photo":
-                    await context.bot.send_photo(chat_id=chat_id, photo=media_path)
-                elif media_type == "video":
-                    await context.bot.send_video(chat_id=chat_id, video=media_path)
-                elif media_type == "gif":
-                    await context.bot.send_animation(chat_id=chat_id, animation=media_path)
+                # Reuses the file_id from the first upload; only uploads again if Telegram rejects it
+                if media_type in ("photo", "video", "gif"):
+                    await send_cached_media(context.bot, chat_id, media_type, media_path)
                 else:
                     logger.warning(f"Unsupported BOT_MEDIA type for sending: {media_type}")
 
@@ -259,41 +264,25 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Ensure user exists and language context is set
     lang = context.user_data.get("lang", None)
     if lang is None:
-        conn = None
         try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            # Ensure user exists
-            c.execute("""
-                INSERT INTO users (user_id, username, language, is_reseller) VALUES (?, ?, 'en', 0)
-                ON CONFLICT(user_id) DO UPDATE SET username=excluded.username
-            """, (user_id, username))
-            # Get language
-            c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-            result = c.fetchone()
-            db_lang = result['language'] if result else 'en'
+            db_lang = await run_db(_ensure_user_and_get_language, user_id, username)
             try: from utils import LANGUAGES as UTILS_LANGUAGES_START
             except ImportError: UTILS_LANGUAGES_START = {'en': {}}
             lang = db_lang if db_lang and db_lang in UTILS_LANGUAGES_START else 'en'
-            conn.commit()
             context.user_data["lang"] = lang
             logger.info(f"start: Set language for user {user_id} to '{lang}' from DB/default.")
-            
-            # Update user activity status (they successfully interacted with the bot)
-            update_user_broadcast_status(user_id, success=True)
         except sqlite3.Error as e:
             logger.error(f"DB error ensuring user/language in start for {user_id}: {e}")
             lang = 'en'
             context.user_data["lang"] = lang
             logger.warning(f"start: Defaulted language to 'en' for user {user_id} due to DB error.")
-        finally:
-            if conn: conn.close()
     else:
         logger.info(f"start: Using existing language '{lang}' from context for user {user_id}.")
 
     # Build and Send/Edit Menu
     lang, lang_data = _get_lang_data(context)
-    full_welcome, reply_markup = _build_start_menu_content(user_id, username, lang_data, context)
+    profile = await USER_PROFILES.get_async(user_id)
+    full_welcome, reply_markup = _build_start_menu_content(user_id, username, lang, lang_data, context, profile)
 
     if is_callback:
         query = update.callback_query
@@ -315,11 +304,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # --- Other handlers ---
+@callback_route("back_start")
 async def handle_back_start(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles 'Back' button presses that should return to the main start menu."""
     await start(update, context)
 
 # --- Shopping Handlers ---
+@callback_route("shop")
 async def handle_shop(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     user_id = query.from_user.id
@@ -358,6 +349,7 @@ async def handle_shop(update: Update, context: ContextTypes.DEFAULT_TYPE, params
 
 
 # --- Modified handle_city_selection (Corrected Formatting FINAL) ---
+@callback_route("city")
 async def handle_city_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     user_id = query.from_user.id # Added for logging
@@ -396,23 +388,12 @@ async def handle_city_selection(update: Update, context: ContextTypes.DEFAULT_TY
     else:
         # If districts are configured, check each one for products
         sorted_district_ids = sorted(districts_in_city.keys(), key=lambda dist_id: districts_in_city.get(dist_id, ''))
-        conn = None
         try:
-            conn = get_db_connection()
-            c = conn.cursor()
-
             for d_id in sorted_district_ids:
                 dist_name = districts_in_city.get(d_id)
                 if dist_name:
-                    # NEW Query for detailed product summary in this district
-                    c.execute("""
-                        SELECT product_type, size, price, COUNT(*) as quantity
-                        FROM products
-                        WHERE city = ? AND district = ? AND available > reserved
-                        GROUP BY product_type, size, price
-                        ORDER BY product_type, price, size
-                    """, (city_name, dist_name))
-                    products_in_district = c.fetchall()
+                    # Detailed product summary for this district (served from the catalog index)
+                    products_in_district = CATALOG_INDEX.district_summary(city_name, dist_name)
 
                     if products_in_district:
                         # Add district header to message text (using Markdown for bold)
@@ -442,15 +423,11 @@ async def handle_city_selection(update: Update, context: ContextTypes.DEFAULT_TY
                 else:
                     logger.warning(f"District name missing for ID {d_id} in city {city_id} (handle_city_selection)")
 
-        except sqlite3.Error as e:
-            logger.error(f"DB error checking product availability for districts in city {city_name} (ID: {city_id}) for user {user_id}: {e}")
+        except Exception as e:
+            logger.error(f"Error building product availability for districts in city {city_name} (ID: {city_id}) for user {user_id}: {e}", exc_info=True)
             keyboard_error = [[InlineKeyboardButton(f"{EMOJI_BACK} {back_cities_button}", callback_data="shop"), InlineKeyboardButton(f"{EMOJI_HOME} {home_button}", callback_data="back_start")]]
             await query.edit_message_text(f"{EMOJI_CITY} {city_name}\n\n❌ {error_loading_districts}", reply_markup=InlineKeyboardMarkup(keyboard_error), parse_mode=None)
-            if conn: conn.close()
             return # Stop processing on DB error
-        finally:
-            if conn:
-                conn.close()
 
         # After checking all districts:
         if not districts_with_products_info:
@@ -500,6 +477,7 @@ async def handle_city_selection(update: Update, context: ContextTypes.DEFAULT_TY
 # --- END handle_city_selection ---
 
 
+@callback_route("dist")
 async def handle_district_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     lang, lang_data = _get_lang_data(context)
@@ -511,40 +489,14 @@ async def handle_district_selection(update: Update, context: ContextTypes.DEFAUL
 
     back_districts_button = lang_data.get("back_districts_button", "Back to Districts"); home_button = lang_data.get("home_button", "Home")
     no_types_msg = lang_data.get("no_types_available", "No product types currently available here."); select_type_prompt = lang_data.get("select_type_prompt", "Select product type:")
-    error_loading_types = lang_data.get("error_loading_types", "Error: Failed to Load Product Types"); error_unexpected = lang_data.get("error_unexpected", "An unexpected error occurred")
+    error_unexpected = lang_data.get("error_unexpected", "An unexpected error occurred")
 
-    conn = None
-    max_retries = 3
-    retry_delay = 0.1  # 100ms
-    
-    for attempt in range(max_retries):
-        try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("SELECT DISTINCT product_type FROM products WHERE city = ? AND district = ? AND available > reserved ORDER BY product_type", (city, district))
-            available_types = [row['product_type'] for row in c.fetchall()]
-            break  # Success, exit retry loop
-        except sqlite3.Error as e:
-            if "database is locked" in str(e).lower() and attempt < max_retries - 1:
-                logger.warning(f"Database locked for district selection (attempt {attempt + 1}/{max_retries}), retrying in {retry_delay}s...")
-                await asyncio.sleep(retry_delay)
-                retry_delay *= 2  # Exponential backoff
-                if conn:
-                    conn.close()
-                    conn = None
-                continue
-            else:
-                logger.error(f"DB error fetching product types {city}/{district}: {e}", exc_info=True)
-                await query.edit_message_text(f"❌ {error_loading_types}", parse_mode=None)
-                return
-        except Exception as e:
-            logger.error(f"Unexpected error in handle_district_selection: {e}", exc_info=True)
-            await query.edit_message_text(f"❌ {error_unexpected}", parse_mode=None)
-            return
-        finally:
-            if conn:
-                conn.close()
-                conn = None
+    try:
+        available_types = CATALOG_INDEX.available_types(city, district)
+    except Exception as e:
+        logger.error(f"Unexpected error in handle_district_selection: {e}", exc_info=True)
+        await query.edit_message_text(f"❌ {error_unexpected}", parse_mode=None)
+        return
 
     if not available_types:
         keyboard = [[InlineKeyboardButton(f"{EMOJI_BACK} {back_districts_button}", callback_data=f"city|{city_id}"), InlineKeyboardButton(f"{EMOJI_HOME} {home_button}", callback_data="back_start")]]
@@ -568,6 +520,7 @@ async def handle_district_selection(update: Update, context: ContextTypes.DEFAUL
 
 
 # <<< MODIFIED: Incorporate Reseller Discount Display >>>
+@callback_route("type")
 async def handle_type_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     user_id = query.from_user.id # <<< GET USER ID
@@ -584,12 +537,8 @@ async def handle_type_selection(update: Update, context: ContextTypes.DEFAULT_TY
     available_options_prompt = lang_data.get("available_options_prompt", "Available options:")
     error_loading_products = lang_data.get("error_loading_products", "Error: Failed to Load Products"); error_unexpected = lang_data.get("error_unexpected", "An unexpected error occurred")
 
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT size, price, COUNT(*) as count_available FROM products WHERE city = ? AND district = ? AND product_type = ? AND available > reserved GROUP BY size, price ORDER BY price", (city, district, p_type))
-        products = c.fetchall()
+        products = CATALOG_INDEX.type_options(city, district, p_type)
 
         if not products:
             keyboard = [[InlineKeyboardButton(f"{EMOJI_BACK} {back_types_button}", callback_data=f"dist|{city_id}|{dist_id}"), InlineKeyboardButton(f"{EMOJI_HOME} {home_button}", callback_data="back_start")]]
@@ -598,7 +547,7 @@ async def handle_type_selection(update: Update, context: ContextTypes.DEFAULT_TY
             keyboard = []
             available_label_short = lang_data.get("available_label_short", "Av")
             # <<< Fetch reseller discount ONCE >>>
-            reseller_discount_percent = await asyncio.to_thread(get_reseller_discount, user_id, p_type)
+            reseller_discount_percent = (await fetch_reseller_discount_map(user_id)).get(p_type, Decimal('0.0'))
             # <<< End Fetch >>>
 
             for row in products:
@@ -628,12 +577,11 @@ async def handle_type_selection(update: Update, context: ContextTypes.DEFAULT_TY
 
     except sqlite3.Error as e: logger.error(f"DB error fetching products {city}/{district}/{p_type}: {e}", exc_info=True); await query.edit_message_text(f"❌ {error_loading_products}", parse_mode=None)
     except Exception as e: logger.error(f"Unexpected error in handle_type_selection: {e}", exc_info=True); await query.edit_message_text(f"❌ {error_unexpected}", parse_mode=None)
-    finally:
-        if conn: conn.close()
 
 # --- END OF handle_type_selection ---
 
 # <<< MODIFIED: Add Pay Now Button & Logic for Single Item Discount Flow >>>
+@callback_route("product")
 async def handle_product_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     user_id = query.from_user.id
@@ -659,19 +607,15 @@ async def handle_product_selection(update: Update, context: ContextTypes.DEFAULT
     pay_now_button_text = lang_data.get("pay_now_button", "Pay Now")
     error_loading_details = lang_data.get("error_loading_details", "Error: Failed to Load Product Details"); error_unexpected = lang_data.get("error_unexpected", "An unexpected error occurred")
 
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) as count FROM products WHERE city = ? AND district = ? AND product_type = ? AND size = ? AND price = ? AND available > reserved", (city, district, p_type, size, float(original_price)))
-        available_count_result = c.fetchone(); available_count = available_count_result['count'] if available_count_result else 0
+        available_count = CATALOG_INDEX.option_count(city, district, p_type, size, original_price)
 
         if available_count <= 0:
             keyboard = [[InlineKeyboardButton(f"{EMOJI_BACK} {back_options_button}", callback_data=f"type|{city_id}|{dist_id}|{p_type}"), InlineKeyboardButton(f"{EMOJI_HOME} {home_button}", callback_data="back_start")]]
             await query.edit_message_text(f"❌ {drop_unavailable_msg}", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
         else:
             original_price_formatted = format_currency(original_price)
-            reseller_discount_percent = await asyncio.to_thread(get_reseller_discount, user_id, p_type)
+            reseller_discount_percent = (await fetch_reseller_discount_map(user_id)).get(p_type, Decimal('0.0'))
             display_price_str = original_price_formatted
             if reseller_discount_percent > Decimal('0.0'):
                 discount_amount = (original_price * reseller_discount_percent / Decimal('100')).quantize(Decimal('0.01'), rounding=ROUND_DOWN)
@@ -697,12 +641,53 @@ async def handle_product_selection(update: Update, context: ContextTypes.DEFAULT
             await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
     except sqlite3.Error as e: logger.error(f"DB error checking availability {city}/{district}/{p_type}/{size}: {e}", exc_info=True); await query.edit_message_text(f"❌ {error_loading_details}", parse_mode=None)
     except Exception as e: logger.error(f"Unexpected error in handle_product_selection: {e}", exc_info=True); await query.edit_message_text(f"❌ {error_unexpected}", parse_mode=None)
+
+# --- END handle_product_selection ---
+
+def _reserve_product_for_basket(user_id: int, city: str, district: str, p_type: str, size: str, price: float) -> tuple[str, int | None, float | None]:
+    """
+    Reserves one matching product and inserts it into the user's basket_items (Synchronous, runs on DB executor).
+    Returns (status, product_id, timestamp) where status is 'reserved', 'out_of_stock' or 'taken'.
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE") # The guarded UPDATE below prevents over-reservation
+
+        # Step 1: Find an available product
+        c.execute("SELECT id FROM products WHERE city = ? AND district = ? AND product_type = ? AND size = ? AND price = ? AND available > reserved ORDER BY id LIMIT 1", (city, district, p_type, size, price))
+        product_row = c.fetchone()
+        if not product_row:
+            conn.rollback()
+            return 'out_of_stock', None, None
+
+        product_id_reserved = product_row['id']
+
+        # Step 2: Atomically reserve the specific product with availability check
+        # This prevents race conditions by ensuring reserved never exceeds available
+        update_result = c.execute("UPDATE products SET reserved = reserved + 1 WHERE id = ? AND available > reserved", (product_id_reserved,))
+        if update_result.rowcount == 0:
+            # Race condition: product was taken between SELECT and UPDATE
+            conn.rollback()
+            return 'taken', product_id_reserved, None
+
+        timestamp = time.time()
+        c.execute("INSERT INTO basket_items (user_id, product_id, reserved_at, expires_at) VALUES (?, ?, ?, ?)",
+                  (user_id, product_id_reserved, timestamp, timestamp + BASKET_TIMEOUT))
+        conn.commit()
+        CATALOG_INDEX.adjust_reserved(product_id_reserved, +1)
+        RESERVATION_EXPIRY.schedule(timestamp + BASKET_TIMEOUT, 'basket', user_id)
+        return 'reserved', product_id_reserved, timestamp
+    except Exception:
+        if conn and conn.in_transaction: conn.rollback()
+        raise
     finally:
         if conn: conn.close()
 
-# --- END handle_product_selection ---
 
 # <<< MODIFIED: Incorporate Reseller Discount Calculation & Display >>>
+@callback_route("add")
 async def handle_add_to_basket(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     user_id = query.from_user.id # <<< GET USER ID
@@ -719,7 +704,7 @@ async def handle_add_to_basket(update: Update, context: ContextTypes.DEFAULT_TYP
     product_emoji = PRODUCT_TYPES.get(p_type, DEFAULT_PRODUCT_EMOJI)
     theme_name = context.user_data.get("theme", "default"); theme = THEMES.get(theme_name, THEMES["default"])
     basket_emoji = theme.get('basket', EMOJI_BASKET)
-    product_id_reserved = None; conn = None
+    product_id_reserved = None
 
     back_options_button = lang_data.get("back_options_button", "Back to Options"); home_button = lang_data.get("home_button", "Home")
     out_of_stock_msg = lang_data.get("out_of_stock", "Out of Stock! Sorry, the last one was taken or reserved.")
@@ -733,38 +718,18 @@ async def handle_add_to_basket(update: Update, context: ContextTypes.DEFAULT_TYP
     reseller_discount_label = lang_data.get("reseller_discount_label", "Reseller Discount") # <<< NEW
 
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("BEGIN EXCLUSIVE")
-        
-        # Step 1: Find an available product
-        c.execute("SELECT id FROM products WHERE city = ? AND district = ? AND product_type = ? AND size = ? AND price = ? AND available > reserved ORDER BY id LIMIT 1", (city, district, p_type, size, float(original_price)))
-        product_row = c.fetchone()
+        reserve_status, product_id_reserved, timestamp = await run_db(
+            _reserve_product_for_basket, user_id, city, district, p_type, size, float(original_price)
+        )
 
-        if not product_row:
-            conn.rollback()
+        if reserve_status == 'out_of_stock':
             keyboard = [[InlineKeyboardButton(f"{EMOJI_BACK} {back_options_button}", callback_data=f"type|{city_id}|{dist_id}|{p_type}"), InlineKeyboardButton(f"{EMOJI_HOME} {home_button}", callback_data="back_start")]]
             await query.edit_message_text(f"❌ {out_of_stock_msg}", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
             return
-
-        product_id_reserved = product_row['id']
-        
-        # Step 2: Atomically reserve the specific product with availability check
-        # This prevents race conditions by ensuring reserved never exceeds available
-        update_result = c.execute("UPDATE products SET reserved = reserved + 1 WHERE id = ? AND available > reserved", (product_id_reserved,))
-        
-        if update_result.rowcount == 0:
-            # Race condition: product was taken between SELECT and UPDATE
-            conn.rollback()
+        if reserve_status == 'taken':
             keyboard = [[InlineKeyboardButton(f"{EMOJI_BACK} {back_options_button}", callback_data=f"type|{city_id}|{dist_id}|{p_type}"), InlineKeyboardButton(f"{EMOJI_HOME} {home_button}", callback_data="back_start")]]
             await query.edit_message_text("❌ Sorry, this item was just taken by another user! Please try again.", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
             return
-        c.execute("SELECT basket FROM users WHERE user_id = ?", (user_id,))
-        user_basket_row = c.fetchone(); current_basket_str = user_basket_row['basket'] if user_basket_row else ''
-        timestamp = time.time(); new_item_str = f"{product_id_reserved}:{timestamp}"
-        new_basket_str = f"{current_basket_str},{new_item_str}" if current_basket_str else new_item_str
-        c.execute("UPDATE users SET basket = ? WHERE user_id = ?", (new_basket_str, user_id))
-        conn.commit()
 
         if "basket" not in context.user_data or not isinstance(context.user_data["basket"], list): context.user_data["basket"] = []
         # <<< Store product_type along with original price >>>
@@ -784,13 +749,14 @@ async def handle_add_to_basket(update: Update, context: ContextTypes.DEFAULT_TYP
         basket_original_total = Decimal('0.0')
         total_reseller_discount_amount = Decimal('0.0')
         total_after_reseller = Decimal('0.0')
+        reseller_discount_map = await fetch_reseller_discount_map(user_id) # One lookup for the whole basket
 
         for item in current_basket_list:
             item_original_price = item.get('price', Decimal('0.0')) # Ensure it's Decimal
             item_type = item.get('product_type', '') # Ensure it exists
             basket_original_total += item_original_price
 
-            item_reseller_discount_percent = await asyncio.to_thread(get_reseller_discount, user_id, item_type)
+            item_reseller_discount_percent = reseller_discount_map.get(item_type, Decimal('0.0'))
             item_reseller_discount = (item_original_price * item_reseller_discount_percent / Decimal('100')).quantize(Decimal('0.01'), rounding=ROUND_DOWN)
             total_reseller_discount_amount += item_reseller_discount
             total_after_reseller += (item_original_price - item_reseller_discount)
@@ -805,7 +771,7 @@ async def handle_add_to_basket(update: Update, context: ContextTypes.DEFAULT_TYP
         if applied_discount_info:
             # Validate general code against the total *after* reseller discount
             # Note: For existing applied discounts, we don't re-validate atomically to avoid double-charging
-            code_valid, _, discount_details = validate_discount_code(applied_discount_info['code'], float(total_after_reseller))
+            code_valid, _, discount_details = await run_db(validate_discount_code, applied_discount_info['code'], float(total_after_reseller))
             if code_valid and discount_details:
                 general_discount_amount = Decimal(str(discount_details['discount_amount']))
                 final_total = Decimal(str(discount_details['final_total'])) # validate_discount_code returns final total after THIS code
@@ -851,20 +817,17 @@ async def handle_add_to_basket(update: Update, context: ContextTypes.DEFAULT_TYP
         await query.edit_message_text(reserved_msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
     except sqlite3.Error as e:
-        if conn and conn.in_transaction: conn.rollback()
         logger.error(f"DB error adding product {product_id_reserved if product_id_reserved else 'N/A'} user {user_id}: {e}", exc_info=True)
         await query.edit_message_text(f"❌ {error_adding_db}", parse_mode=None)
     except Exception as e:
-        if conn and conn.in_transaction: conn.rollback()
         logger.error(f"Unexpected error adding item user {user_id}: {e}", exc_info=True)
         await query.edit_message_text(f"❌ {error_adding_unexpected}", parse_mode=None)
-    finally:
-        if conn: conn.close()
 
 # --- END handle_add_to_basket ---
 
 
 # --- Profile Handlers ---
+@callback_route("profile")
 async def handle_profile(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     user_id = query.from_user.id
@@ -873,18 +836,12 @@ async def handle_profile(update: Update, context: ContextTypes.DEFAULT_TYPE, par
     theme = THEMES.get(theme_name, THEMES["default"])
     basket_emoji = theme.get('basket', EMOJI_BASKET)
 
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT balance, total_purchases FROM users WHERE user_id = ?", (user_id,))
-        result = c.fetchone()
+        result = await USER_PROFILES.get_async(user_id)
         if not result: logger.error(f"User {user_id} not found in DB for profile."); await query.edit_message_text("❌ Error: Could not load profile.", parse_mode=None); return
         balance, purchases = Decimal(str(result['balance'])), result['total_purchases']
 
-        # Call synchronous clear_expired_basket (no await needed)
-        clear_expired_basket(context, user_id) # Assuming clear_expired_basket is synchronous
-        basket_count = len(context.user_data.get("basket", []))
+        basket_count = len(_prune_expired_basket_items(context))
         status = get_user_status(purchases); progress_bar = get_progress_bar(purchases); balance_str = format_currency(balance)
         status_label = lang_data.get("status_label", "Status"); balance_label = lang_data.get("balance_label", "Balance")
         purchases_label = lang_data.get("purchases_label", "Total Purchases"); basket_label = lang_data.get("basket_label", "Basket Items")
@@ -906,8 +863,6 @@ async def handle_profile(update: Update, context: ContextTypes.DEFAULT_TYPE, par
         if "message is not modified" not in str(e).lower(): logger.error(f"Unexpected BadRequest handle_profile user {user_id}: {e}", exc_info=True); await query.edit_message_text("❌ Error: Unexpected issue.", parse_mode=None)
         else: await query.answer()
     except Exception as e: logger.error(f"Unexpected error handle_profile user {user_id}: {e}", exc_info=True); await query.edit_message_text("❌ Error: Unexpected issue.", parse_mode=None)
-    finally:
-        if conn: conn.close()
 
 # --- Discount Validation (Synchronous - Adjusted for base total) ---
 def validate_discount_code(code_text: str, base_total_float: float) -> tuple[bool, str, dict | None]:
@@ -1166,6 +1121,7 @@ def validate_and_apply_discount_atomic(code_text: str, base_total_float: float,
 
 # --- Basket Handlers ---
 # <<< MODIFIED: Incorporate Reseller Discount Calculation & Display >>>
+@callback_route("view_basket")
 async def handle_view_basket(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     user_id = query.from_user.id
@@ -1173,7 +1129,7 @@ async def handle_view_basket(update: Update, context: ContextTypes.DEFAULT_TYPE,
     theme_name = context.user_data.get("theme", "default"); theme = THEMES.get(theme_name, THEMES["default"]); basket_emoji = theme.get('basket', EMOJI_BASKET)
     reseller_discount_label = lang_data.get("reseller_discount_label", "Reseller Discount")
 
-    clear_expired_basket(context, user_id)
+    await run_db(clear_expired_basket, context, user_id)
     basket = context.user_data.get("basket", [])
 
     if not basket:
@@ -1192,7 +1148,6 @@ async def handle_view_basket(update: Update, context: ContextTypes.DEFAULT_TYPE,
     msg = f"{basket_emoji} {lang_data.get('your_basket_title', 'Your Basket')}\n\n"
     keyboard_items = []
     product_db_details = {}
-    conn = None
 
     basket_original_total = Decimal('0.0')
     total_reseller_discount_amount = Decimal('0.0')
@@ -1202,16 +1157,13 @@ async def handle_view_basket(update: Update, context: ContextTypes.DEFAULT_TYPE,
     product_ids_in_basket = list(set(item.get('product_id') for item in basket if item.get('product_id')))
     if product_ids_in_basket:
         try:
-            conn = get_db_connection()
-            c = conn.cursor()
             placeholders = ','.join('?' for _ in product_ids_in_basket)
-            c.execute(f"SELECT id, name, size FROM products WHERE id IN ({placeholders})", product_ids_in_basket)
-            product_db_details = {row['id']: {'name': row['name'], 'size': row['size']} for row in c.fetchall()}
+            detail_rows = await db_fetchall(f"SELECT id, name, size FROM products WHERE id IN ({placeholders})", tuple(product_ids_in_basket))
+            product_db_details = {row['id']: {'name': row['name'], 'size': row['size']} for row in detail_rows}
         except sqlite3.Error as e:
             logger.error(f"DB error fetching product names/sizes for basket view user {user_id}: {e}")
-        finally:
-            if conn: conn.close(); conn = None
 
+    reseller_discount_map = await fetch_reseller_discount_map(user_id) # One lookup for the whole basket
     items_to_process_count = 0
     for item in basket:
         prod_id = item.get('product_id')
@@ -1225,7 +1177,7 @@ async def handle_view_basket(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
         items_to_process_count += 1
         basket_original_total += original_price
-        item_reseller_discount_percent = await asyncio.to_thread(get_reseller_discount, user_id, product_type)
+        item_reseller_discount_percent = reseller_discount_map.get(product_type, Decimal('0.0'))
         item_reseller_discount = (original_price * item_reseller_discount_percent / Decimal('100')).quantize(Decimal('0.01'), rounding=ROUND_DOWN)
         item_price_after_reseller = original_price - item_reseller_discount
         total_reseller_discount_amount += item_reseller_discount
@@ -1256,7 +1208,7 @@ async def handle_view_basket(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
     if discount_code_to_revalidate:
         # Note: For revalidation of existing discounts, we don't use atomic to avoid double-charging
-        code_valid, validation_message, discount_details = validate_discount_code(discount_code_to_revalidate, float(total_after_reseller))
+        code_valid, validation_message, discount_details = await run_db(validate_discount_code, discount_code_to_revalidate, float(total_after_reseller))
         if code_valid and discount_details:
             general_discount_amount = Decimal(str(discount_details['discount_amount']))
             final_total = Decimal(str(discount_details['final_total']))
@@ -1328,12 +1280,13 @@ async def handle_view_basket(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
 
 # --- Discount Application Handlers ---
+@callback_route("apply_discount_start")
 async def apply_discount_start(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     user_id = query.from_user.id
     lang, lang_data = _get_lang_data(context)
 
-    clear_expired_basket(context, user_id)
+    await run_db(clear_expired_basket, context, user_id)
     basket = context.user_data.get("basket", [])
     if not basket: no_items_message = lang_data.get("discount_no_items", "Your basket is empty."); await query.answer(no_items_message, show_alert=True); return await handle_view_basket(update, context)
 
@@ -1344,6 +1297,7 @@ async def apply_discount_start(update: Update, context: ContextTypes.DEFAULT_TYP
     await query.edit_message_text(f"{EMOJI_DISCOUNT} {enter_code_prompt}", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
     await query.answer(lang_data.get("enter_code_answer", "Enter code in chat."))
 
+@callback_route("remove_discount")
 async def remove_discount(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Removes a *general* discount code."""
     query = update.callback_query
@@ -1359,6 +1313,7 @@ async def remove_discount(update: Update, context: ContextTypes.DEFAULT_TYPE, pa
     await handle_view_basket(update, context) # Refresh basket view
 
 # <<< MODIFIED: Calculate base total AFTER reseller discounts >>>
+@state_route("awaiting_user_discount_code")
 async def handle_user_discount_code_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles user entering a general discount code."""
     user_id = update.effective_user.id
@@ -1375,25 +1330,20 @@ async def handle_user_discount_code_message(update: Update, context: ContextType
 
     if not entered_code: no_code_entered_msg = lang_data.get("no_code_entered", "No code entered."); await send_message_with_retry(context.bot, chat_id, no_code_entered_msg, parse_mode=None); keyboard = [[InlineKeyboardButton(view_basket_button_text, callback_data="view_basket")]]; await send_message_with_retry(context.bot, chat_id, returning_to_basket_msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None); return
 
-    clear_expired_basket(context, user_id)
+    await run_db(clear_expired_basket, context, user_id)
     basket = context.user_data.get("basket", [])
     total_after_reseller_decimal = Decimal('0.0') # <<< Base total for validation
 
     if basket:
          try:
-            for item in basket:
-                original_price = item.get('price', Decimal('0.0'))
-                product_type = item.get('product_type', '')
-                reseller_discount_percent = await asyncio.to_thread(get_reseller_discount, user_id, product_type)
-                item_reseller_discount = (original_price * reseller_discount_percent / Decimal('100')).quantize(Decimal('0.01'), rounding=ROUND_DOWN)
-                total_after_reseller_decimal += (original_price - item_reseller_discount)
+            total_after_reseller_decimal = (await price_reseller_basket(user_id, basket))['final_total']
          except Exception as e:
              logger.error(f"Error recalculating reseller-adjusted total user {user_id}: {e}"); error_calc_total = lang_data.get("error_calculating_total", "Error calculating total."); await send_message_with_retry(context.bot, chat_id, f"❌ {error_calc_total}", parse_mode=None); kb = [[InlineKeyboardButton(view_basket_button_text, callback_data="view_basket")]]; await send_message_with_retry(context.bot, chat_id, returning_to_basket_msg, reply_markup=InlineKeyboardMarkup(kb), parse_mode=None); return
     else:
         basket_empty_no_discount = lang_data.get("basket_empty_no_discount", "Basket empty. Cannot apply code."); await send_message_with_retry(context.bot, chat_id, basket_empty_no_discount, parse_mode=None); kb = [[InlineKeyboardButton(view_basket_button_text, callback_data="view_basket")]]; await send_message_with_retry(context.bot, chat_id, returning_to_basket_msg, reply_markup=InlineKeyboardMarkup(kb), parse_mode=None); return
 
     # SECURITY: Use atomic validation to prevent race conditions and multiple uses
-    code_valid, validation_message, discount_details = validate_and_apply_discount_atomic(entered_code, float(total_after_reseller_decimal), user_id)
+    code_valid, validation_message, discount_details = await run_db(validate_and_apply_discount_atomic, entered_code, float(total_after_reseller_decimal), user_id)
 
     if code_valid and discount_details:
         context.user_data['applied_discount'] = {'code': entered_code, 'amount': discount_details['discount_amount'], 'final_total': discount_details['final_total']}
@@ -1411,7 +1361,37 @@ async def handle_user_discount_code_message(update: Update, context: ContextType
 # --- END handle_user_discount_code_message ---
 
 
+def _remove_basket_item_db(user_id: int, product_id: int, release_reservation: bool, reserved_at: float | None):
+    """Releases one reservation and deletes the matching basket_items row (Synchronous, runs on DB executor)."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor(); c.execute("BEGIN")
+        released = False
+        if release_reservation:
+             update_result = c.execute("UPDATE products SET reserved = MAX(0, reserved - 1) WHERE id = ?", (product_id,))
+             if update_result.rowcount > 0: released = True; logger.debug(f"Decremented reservation P{product_id}.")
+             else: logger.warning(f"Could not find P{product_id} to decrement reservation (maybe already cleared?).")
+        if reserved_at is not None:
+            delete_result = c.execute("""
+                DELETE FROM basket_items WHERE id = (
+                    SELECT id FROM basket_items WHERE user_id = ? AND product_id = ? AND reserved_at = ? LIMIT 1
+                )""", (user_id, product_id, reserved_at))
+            if delete_result.rowcount > 0: logger.debug(f"Removed basket item P{product_id} ({reserved_at}) user {user_id}.")
+            else: logger.warning(f"Basket item P{product_id} ({reserved_at}) not found in DB basket user {user_id}.")
+        elif release_reservation: logger.warning(f"Missing reservation timestamp for DB removal P{product_id}.")
+        elif not release_reservation: logger.debug(f"Item {product_id} not in context, DB basket not modified.")
+        conn.commit()
+        if released: CATALOG_INDEX.adjust_reserved(product_id, -1)
+    except Exception:
+        if conn and conn.in_transaction: conn.rollback()
+        raise
+    finally:
+        if conn: conn.close()
+
+
 # --- Remove From Basket ---
+@callback_route("remove")
 async def handle_remove_from_basket(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     user_id = query.from_user.id
@@ -1422,41 +1402,25 @@ async def handle_remove_from_basket(update: Update, context: ContextTypes.DEFAUL
     except ValueError: logger.warning(f"Invalid product_id format user {user_id}: {params[0]}"); await query.answer("Error: Invalid product data.", show_alert=True); return
 
     logger.info(f"Attempting remove product {product_id_to_remove} user {user_id}.")
-    item_removed_from_context = False; item_to_remove_str = None; conn = None
+    item_removed_from_context = False; item_reserved_at = None
     current_basket_context = context.user_data.get("basket", []); new_basket_context = []
     found_item_index = -1
 
     for index, item in enumerate(current_basket_context):
         if item.get('product_id') == product_id_to_remove:
             found_item_index = index
-            try: timestamp_float = float(item['timestamp']); item_to_remove_str = f"{item['product_id']}:{timestamp_float}"
-            except (ValueError, TypeError, KeyError) as e: logger.error(f"Invalid format in context item {item}: {e}"); item_to_remove_str = None
+            try: item_reserved_at = float(item['timestamp'])
+            except (ValueError, TypeError, KeyError) as e: logger.error(f"Invalid format in context item {item}: {e}"); item_reserved_at = None
             break
 
     if found_item_index != -1:
         item_removed_from_context = True
         new_basket_context = current_basket_context[:found_item_index] + current_basket_context[found_item_index+1:]
-        logger.debug(f"Found item {product_id_to_remove} in context user {user_id}. DB String: {item_to_remove_str}")
+        logger.debug(f"Found item {product_id_to_remove} in context user {user_id}. Reserved at: {item_reserved_at}")
     else: logger.warning(f"Product {product_id_to_remove} not in user_data basket user {user_id}."); new_basket_context = list(current_basket_context)
 
     try:
-        conn = get_db_connection()
-        c = conn.cursor(); c.execute("BEGIN")
-        if item_removed_from_context:
-             update_result = c.execute("UPDATE products SET reserved = MAX(0, reserved - 1) WHERE id = ?", (product_id_to_remove,))
-             if update_result.rowcount > 0: logger.debug(f"Decremented reservation P{product_id_to_remove}.")
-             else: logger.warning(f"Could not find P{product_id_to_remove} to decrement reservation (maybe already cleared?).")
-        c.execute("SELECT basket FROM users WHERE user_id = ?", (user_id,))
-        db_basket_result = c.fetchone(); db_basket_str = db_basket_result['basket'] if db_basket_result else ''
-        if db_basket_str and item_to_remove_str:
-            items_list = db_basket_str.split(',')
-            if item_to_remove_str in items_list:
-                items_list.remove(item_to_remove_str); new_db_basket_str = ','.join(items_list)
-                c.execute("UPDATE users SET basket = ? WHERE user_id = ?", (new_db_basket_str, user_id)); logger.debug(f"Updated DB basket user {user_id} to: {new_db_basket_str}")
-            else: logger.warning(f"Item string '{item_to_remove_str}' not found in DB basket '{db_basket_str}' user {user_id}.")
-        elif item_removed_from_context and not item_to_remove_str: logger.warning(f"Could not construct item string for DB removal P{product_id_to_remove}.")
-        elif not item_removed_from_context: logger.debug(f"Item {product_id_to_remove} not in context, DB basket not modified.")
-        conn.commit()
+        await run_db(_remove_basket_item_db, user_id, product_id_to_remove, item_removed_from_context, item_reserved_at)
         logger.info(f"DB ops complete remove P{product_id_to_remove} user {user_id}.")
         context.user_data['basket'] = new_basket_context
 
@@ -1464,14 +1428,8 @@ async def handle_remove_from_basket(update: Update, context: ContextTypes.DEFAUL
             context.user_data.pop('applied_discount', None)
         elif context.user_data.get('applied_discount'):
             applied_discount_info = context.user_data['applied_discount']
-            total_after_reseller_decimal = Decimal('0.0')
-            for item in context.user_data['basket']:
-                original_price = item.get('price', Decimal('0.0'))
-                product_type = item.get('product_type', '')
-                reseller_discount_percent = await asyncio.to_thread(get_reseller_discount, user_id, product_type)
-                item_reseller_discount = (original_price * reseller_discount_percent / Decimal('100')).quantize(Decimal('0.01'), rounding=ROUND_DOWN)
-                total_after_reseller_decimal += (original_price - item_reseller_discount)
-            code_valid, validation_message, _ = validate_discount_code(applied_discount_info['code'], float(total_after_reseller_decimal))
+            total_after_reseller_decimal = (await price_reseller_basket(user_id, context.user_data['basket']))['final_total']
+            code_valid, validation_message, _ = await run_db(validate_discount_code, applied_discount_info['code'], float(total_after_reseller_decimal))
             if not code_valid:
                 reason_removed = lang_data.get("discount_removed_invalid_basket", "Discount removed (basket changed).")
                 logger.info(f"Removing invalid general discount '{applied_discount_info['code']}' for user {user_id} after item removal.")
@@ -1479,22 +1437,38 @@ async def handle_remove_from_basket(update: Update, context: ContextTypes.DEFAUL
                 await query.answer(reason_removed, show_alert=False)
 
     except sqlite3.Error as e:
-        if conn and conn.in_transaction: conn.rollback()
         logger.error(f"DB error removing item {product_id_to_remove} user {user_id}: {e}", exc_info=True); await query.edit_message_text("❌ Error: Failed to remove item (DB).", parse_mode=None); return
     except Exception as e:
-        if conn and conn.in_transaction: conn.rollback()
         logger.error(f"Unexpected error removing item {product_id_to_remove} user {user_id}: {e}", exc_info=True); await query.edit_message_text("❌ Error: Unexpected issue removing item.", parse_mode=None); return
-    finally:
-        if conn: conn.close()
     await handle_view_basket(update, context)
 # --- END handle_remove_from_basket ---
 
 
+def _clear_basket_db(user_id: int, product_ids_to_release_counts: Counter):
+    """Empties the DB basket and releases the given reservations (Synchronous, runs on DB executor)."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor(); c.execute("BEGIN"); c.execute("DELETE FROM basket_items WHERE user_id = ?", (user_id,))
+        decrement_data = []
+        if product_ids_to_release_counts:
+             decrement_data = [(count, pid) for pid, count in product_ids_to_release_counts.items()]
+             c.executemany("UPDATE products SET reserved = MAX(0, reserved - ?) WHERE id = ?", decrement_data)
+             total_items_released = sum(product_ids_to_release_counts.values()); logger.info(f"Released {total_items_released} reservations user {user_id} clear.")
+        conn.commit()
+        CATALOG_INDEX.release_reservations(decrement_data)
+    except Exception:
+        if conn and conn.in_transaction: conn.rollback()
+        raise
+    finally:
+        if conn: conn.close()
+
+
+@callback_route("clear_basket")
 async def handle_clear_basket(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     user_id = query.from_user.id
     lang, lang_data = _get_lang_data(context)
-    conn = None
 
     current_basket_context = context.user_data.get("basket", [])
     if not current_basket_context: already_empty_msg = lang_data.get("basket_already_empty", "Basket already empty."); await query.answer(already_empty_msg, show_alert=False); return await handle_view_basket(update, context)
@@ -1502,13 +1476,7 @@ async def handle_clear_basket(update: Update, context: ContextTypes.DEFAULT_TYPE
     product_ids_to_release_counts = Counter(item['product_id'] for item in current_basket_context)
 
     try:
-        conn = get_db_connection()
-        c = conn.cursor(); c.execute("BEGIN"); c.execute("UPDATE users SET basket = '' WHERE user_id = ?", (user_id,))
-        if product_ids_to_release_counts:
-             decrement_data = [(count, pid) for pid, count in product_ids_to_release_counts.items()]
-             c.executemany("UPDATE products SET reserved = MAX(0, reserved - ?) WHERE id = ?", decrement_data)
-             total_items_released = sum(product_ids_to_release_counts.values()); logger.info(f"Released {total_items_released} reservations user {user_id} clear.")
-        conn.commit()
+        await run_db(_clear_basket_db, user_id, product_ids_to_release_counts)
         context.user_data["basket"] = []; context.user_data.pop('applied_discount', None)
         logger.info(f"Cleared basket/discount user {user_id}.")
         shop_button_text = lang_data.get("shop_button", "Shop"); home_button_text = lang_data.get("home_button", "Home")
@@ -1517,16 +1485,13 @@ async def handle_clear_basket(update: Update, context: ContextTypes.DEFAULT_TYPE
         await query.edit_message_text(cleared_msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
     except sqlite3.Error as e:
-        if conn and conn.in_transaction: conn.rollback()
         logger.error(f"DB error clearing basket user {user_id}: {e}", exc_info=True); await query.edit_message_text("❌ Error: DB issue clearing basket.", parse_mode=None)
     except Exception as e:
-        if conn and conn.in_transaction: conn.rollback()
         logger.error(f"Unexpected error clearing basket user {user_id}: {e}", exc_info=True); await query.edit_message_text("❌ Error: Unexpected issue.", parse_mode=None)
-    finally:
-        if conn: conn.close()
 
 
 # --- Confirm Pay Handler (Modified for Reseller Discount) ---
+@callback_route("confirm_pay")
 async def handle_confirm_pay(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles the 'Pay Now' button press from the basket."""
     query = update.callback_query
@@ -1534,7 +1499,7 @@ async def handle_confirm_pay(update: Update, context: ContextTypes.DEFAULT_TYPE,
     chat_id = query.message.chat_id
     lang, lang_data = _get_lang_data(context)
 
-    clear_expired_basket(context, user_id)
+    await run_db(clear_expired_basket, context, user_id)
     basket = context.user_data.get("basket", [])
     applied_discount_info = context.user_data.get('applied_discount')
 
@@ -1543,7 +1508,6 @@ async def handle_confirm_pay(update: Update, context: ContextTypes.DEFAULT_TYPE,
         await handle_view_basket(update, context)
         return
 
-    conn = None
     original_total = Decimal('0.0')
     total_after_reseller = Decimal('0.0')
     final_total = Decimal('0.0')
@@ -1553,9 +1517,6 @@ async def handle_confirm_pay(update: Update, context: ContextTypes.DEFAULT_TYPE,
     error_occurred = False
 
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-
         product_ids_in_basket = list(set(item['product_id'] for item in basket))
         if not product_ids_in_basket:
              logger.warning(f"Basket context had items, but no product IDs found for user {user_id}.")
@@ -1565,8 +1526,9 @@ async def handle_confirm_pay(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
         placeholders = ','.join('?' for _ in product_ids_in_basket)
         # MODIFIED: Fetch city, district, original_text
-        c.execute(f"SELECT id, price, name, size, product_type, city, district, original_text FROM products WHERE id IN ({placeholders})", product_ids_in_basket)
-        product_db_details = {row['id']: dict(row) for row in c.fetchall()}
+        detail_rows = await db_fetchall(f"SELECT id, price, name, size, product_type, city, district, original_text FROM products WHERE id IN ({placeholders})", tuple(product_ids_in_basket))
+        product_db_details = {row['id']: dict(row) for row in detail_rows}
+        reseller_discount_map = await fetch_reseller_discount_map(user_id)
 
         for item_context in basket:
              prod_id = item_context.get('product_id')
@@ -1575,7 +1537,7 @@ async def handle_confirm_pay(update: Update, context: ContextTypes.DEFAULT_TYPE,
                  item_original_price = Decimal(str(details['price']))
                  item_product_type = details['product_type']
                  original_total += item_original_price
-                 item_reseller_discount_percent = await asyncio.to_thread(get_reseller_discount, user_id, item_product_type)
+                 item_reseller_discount_percent = reseller_discount_map.get(item_product_type, Decimal('0.0'))
                  item_reseller_discount = (item_original_price * item_reseller_discount_percent / Decimal('100')).quantize(Decimal('0.01'), rounding=ROUND_DOWN)
                  item_price_after_reseller = item_original_price - item_reseller_discount
                  total_after_reseller += item_price_after_reseller
@@ -1603,7 +1565,7 @@ async def handle_confirm_pay(update: Update, context: ContextTypes.DEFAULT_TYPE,
         final_total = total_after_reseller
         if applied_discount_info:
             # Note: For existing applied discounts, we don't re-validate atomically to avoid double-charging
-            code_valid, _, discount_details = validate_discount_code(applied_discount_info['code'], float(total_after_reseller))
+            code_valid, _, discount_details = await run_db(validate_discount_code, applied_discount_info['code'], float(total_after_reseller))
             if code_valid and discount_details:
                 final_total = Decimal(str(discount_details['final_total']))
                 discount_code_to_use = applied_discount_info.get('code')
@@ -1616,8 +1578,7 @@ async def handle_confirm_pay(update: Update, context: ContextTypes.DEFAULT_TYPE,
                 await query.answer("Applied discount code became invalid.", show_alert=True)
 
         if final_total < Decimal('0.0'): final_total = Decimal('0.0')
-        c.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
-        balance_result = c.fetchone()
+        balance_result = await USER_PROFILES.get_async(user_id)
         user_balance = Decimal(str(balance_result['balance'])) if balance_result else Decimal('0.0')
     except (sqlite3.Error, Exception) as e:
         logger.error(f"Error during payment confirm data processing user {user_id}: {e}", exc_info=True)
@@ -1625,8 +1586,6 @@ async def handle_confirm_pay(update: Update, context: ContextTypes.DEFAULT_TYPE,
         kb = [[InlineKeyboardButton("⬅️ Back", callback_data="view_basket")]]
         try: await query.edit_message_text("❌ Error preparing payment.", reply_markup=InlineKeyboardMarkup(kb), parse_mode=None)
         except Exception as edit_err: logger.error(f"Failed to edit message in error handler: {edit_err}")
-    finally:
-        if conn: conn.close(); logger.debug("DB connection closed in handle_confirm_pay.")
 
     if error_occurred: return
 
@@ -1646,7 +1605,7 @@ async def handle_confirm_pay(update: Update, context: ContextTypes.DEFAULT_TYPE,
         
         # Track reservation for abandonment cleanup  
         from utils import track_reservation
-        track_reservation(user_id, valid_basket_items_snapshot, "basket")
+        await run_db(track_reservation, user_id, valid_basket_items_snapshot, "basket")
         insufficient_msg_template = lang_data.get("insufficient_balance_pay_option", "⚠️ Insufficient Balance! ({balance} / {required} EUR)")
         insufficient_msg = insufficient_msg_template.format(balance=format_currency(user_balance), required=format_currency(final_total))
         prompt_msg = lang_data.get("prompt_discount_or_pay", "Do you have a discount code to apply before paying with crypto?")
@@ -1664,6 +1623,7 @@ async def handle_confirm_pay(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
 
 # --- NEW: Handler to Ask for Discount Code in Basket Pay Flow ---
+@callback_route("apply_discount_basket_pay")
 async def handle_apply_discount_basket_pay(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     user_id = query.from_user.id
@@ -1684,6 +1644,7 @@ async def handle_apply_discount_basket_pay(update: Update, context: ContextTypes
 
 
 # --- NEW: Message Handler for Basket Pay Discount Code ---
+@state_route("awaiting_basket_discount_code")
 async def handle_basket_discount_code_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
@@ -1711,7 +1672,7 @@ async def handle_basket_discount_code_message(update: Update, context: ContextTy
         return
 
     # SECURITY: Use atomic validation to prevent race conditions and multiple uses
-    code_valid, validation_message, discount_details = validate_and_apply_discount_atomic(entered_code, total_after_reseller_float, user_id)
+    code_valid, validation_message, discount_details = await run_db(validate_and_apply_discount_atomic, entered_code, total_after_reseller_float, user_id)
     feedback_msg_template = ""
     if code_valid and discount_details:
         new_final_total_float = discount_details['final_total']
@@ -1735,6 +1696,7 @@ async def handle_basket_discount_code_message(update: Update, context: ContextTy
 
 
 # --- NEW: Handler to Skip Discount in Basket Pay Flow ---
+@callback_route("skip_discount_basket_pay")
 async def handle_skip_discount_basket_pay(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     user_id = query.from_user.id
@@ -1812,6 +1774,39 @@ async def _show_crypto_choices_for_basket(update: Update, context: ContextTypes.
 # --- END _show_crypto_choices_for_basket ---
 
 # --- CORRECTED Handler for Pay Single Item Button ---
+def _reserve_single_item(user_id: int, city: str, district: str, p_type: str, size: str, price: float) -> dict | None:
+    """Reserves one matching product and returns its snapshot details, or None if taken (Synchronous, runs on DB executor)."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("BEGIN EXCLUSIVE")
+        # MODIFIED: Fetch city, district, original_text for snapshot
+        c.execute("SELECT id, name, price, size, product_type, city, district, original_text FROM products WHERE city = ? AND district = ? AND product_type = ? AND size = ? AND price = ? AND available > reserved ORDER BY id LIMIT 1", (city, district, p_type, size, price))
+        product_to_reserve = c.fetchone()
+
+        if not product_to_reserve:
+            conn.rollback()
+            logger.warning(f"Item {p_type} {size} in {city}/{district} taken before pay_single user {user_id}.")
+            return None
+        reserved_id = product_to_reserve['id']
+        update_result = c.execute("UPDATE products SET reserved = reserved + 1 WHERE id = ? AND available > reserved", (reserved_id,))
+        if update_result.rowcount == 1:
+            conn.commit()
+            CATALOG_INDEX.adjust_reserved(reserved_id, +1)
+            logger.info(f"Successfully reserved product {reserved_id} for single item payment by user {user_id}.")
+            return dict(product_to_reserve) # Now contains enriched data
+        conn.rollback()
+        logger.warning(f"Failed to reserve product {reserved_id} (race condition?) for single item payment user {user_id}.")
+        return None
+    except Exception:
+        if conn and conn.in_transaction: conn.rollback()
+        raise
+    finally:
+        if conn: conn.close()
+
+
+@callback_route("pay_single_item")
 async def handle_pay_single_item(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles the 'Pay Now' button directly from product selection."""
     query = update.callback_query
@@ -1832,45 +1827,22 @@ async def handle_pay_single_item(update: Update, context: ContextTypes.DEFAULT_T
     await query.answer("⏳ Reserving & preparing payment options...")
 
     reserved_id = None
-    conn = None
     product_details_for_snapshot = None
     error_occurred_reservation = False
 
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("BEGIN EXCLUSIVE")
-        # MODIFIED: Fetch city, district, original_text for snapshot
-        c.execute("SELECT id, name, price, size, product_type, city, district, original_text FROM products WHERE city = ? AND district = ? AND product_type = ? AND size = ? AND price = ? AND available > reserved ORDER BY id LIMIT 1", (city, district, p_type, size, float(original_price)))
-        product_to_reserve = c.fetchone()
-
-        if not product_to_reserve:
-            conn.rollback()
-            logger.warning(f"Item {p_type} {size} in {city}/{district} taken before pay_single user {user_id}.")
+        product_details_for_snapshot = await run_db(_reserve_single_item, user_id, city, district, p_type, size, float(original_price))
+        if not product_details_for_snapshot:
             try: await query.edit_message_text("❌ Sorry, this item was just taken!", parse_mode=None)
             except Exception: pass
             error_occurred_reservation = True
         else:
-            reserved_id = product_to_reserve['id']
-            product_details_for_snapshot = dict(product_to_reserve) # Now contains enriched data
-            update_result = c.execute("UPDATE products SET reserved = reserved + 1 WHERE id = ? AND available > reserved", (reserved_id,))
-            if update_result.rowcount == 1:
-                conn.commit()
-                logger.info(f"Successfully reserved product {reserved_id} for single item payment by user {user_id}.")
-            else:
-                conn.rollback()
-                logger.warning(f"Failed to reserve product {reserved_id} (race condition?) for single item payment user {user_id}.")
-                try: await query.edit_message_text("❌ Sorry, this item was just taken!", parse_mode=None)
-                except Exception: pass
-                error_occurred_reservation = True
+            reserved_id = product_details_for_snapshot['id']
     except sqlite3.Error as e:
         logger.error(f"DB error reserving single item {p_type} {size} user {user_id}: {e}")
-        if conn and conn.in_transaction: conn.rollback()
         try: await query.edit_message_text("❌ Database error during reservation.", parse_mode=None)
         except Exception: pass
         error_occurred_reservation = True
-    finally:
-        if conn: conn.close()
 
     if error_occurred_reservation:
         return
@@ -1888,7 +1860,7 @@ async def handle_pay_single_item(update: Update, context: ContextTypes.DEFAULT_T
             "original_text": product_details_for_snapshot.get('original_text')
         }]
 
-        reseller_discount_percent = await asyncio.to_thread(get_reseller_discount, user_id, p_type)
+        reseller_discount_percent = (await fetch_reseller_discount_map(user_id)).get(p_type, Decimal('0.0'))
         reseller_discount_amount = (original_price * reseller_discount_percent / Decimal('100')).quantize(Decimal('0.01'), rounding=ROUND_DOWN)
         price_after_reseller = original_price - reseller_discount_amount
 
@@ -1899,7 +1871,7 @@ async def handle_pay_single_item(update: Update, context: ContextTypes.DEFAULT_T
         
         # Track reservation for abandonment cleanup
         from utils import track_reservation
-        track_reservation(user_id, single_item_snapshot, "single")
+        await run_db(track_reservation, user_id, single_item_snapshot, "single")
 
         item_name_display = f"{PRODUCT_TYPES.get(p_type, '')} {product_details_for_snapshot['name']} {product_details_for_snapshot['size']}"
         price_display_str = format_currency(price_after_reseller)
@@ -1930,11 +1902,12 @@ async def handle_pay_single_item(update: Update, context: ContextTypes.DEFAULT_T
 
 
 # --- Other User Handlers ---
+@callback_route("view_history")
 async def handle_view_history(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     user_id = query.from_user.id
     lang, lang_data = _get_lang_data(context)
-    history = fetch_last_purchases(user_id, limit=10)
+    history = await run_db(fetch_last_purchases, user_id, limit=10)
 
     history_title = lang_data.get("purchase_history_title", "Purchase History"); no_history_msg = lang_data.get("no_purchases_yet", "No purchases yet.")
     recent_purchases_title = lang_data.get("recent_purchases_title", "Recent Purchases"); back_profile_button = lang_data.get("back_profile_button", "Back to Profile")
@@ -1967,13 +1940,13 @@ async def handle_view_history(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 
 # --- Language Selection ---
+@callback_route("language")
 async def handle_language_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Allows the user to select language and immediately refreshes the start menu."""
     query = update.callback_query
     user_id = query.from_user.id
     current_lang, current_lang_data = _get_lang_data(context)
     username = update.effective_user.username or update.effective_user.first_name or f"User_{user_id}"
-    conn = None
 
     if params:
         new_lang = params[0]
@@ -1985,10 +1958,8 @@ async def handle_language_selection(update: Update, context: ContextTypes.DEFAUL
 
         if new_lang in UTILS_LANGUAGES_SELECT:
             try:
-                conn = get_db_connection()
-                c = conn.cursor()
-                c.execute("UPDATE users SET language = ? WHERE user_id = ?", (new_lang, user_id))
-                conn.commit()
+                await db_execute("UPDATE users SET language = ? WHERE user_id = ?", (new_lang, user_id))
+                USER_PROFILES.update(user_id, language=new_lang)
                 logger.info(f"User {user_id} DB language updated to {new_lang}")
 
                 context.user_data["lang"] = new_lang
@@ -2001,14 +1972,14 @@ async def handle_language_selection(update: Update, context: ContextTypes.DEFAUL
 
                 # <<< FIX: Rebuild and edit start menu >>>
                 logger.info(f"Rebuilding start menu in {new_lang} for user {user_id}")
-                start_menu_text, start_menu_markup = _build_start_menu_content(user_id, username, new_lang_data, context)
+                profile = await USER_PROFILES.get_async(user_id)
+                start_menu_text, start_menu_markup = _build_start_menu_content(user_id, username, new_lang, new_lang_data, context, profile)
                 await query.edit_message_text(start_menu_text, reply_markup=start_menu_markup, parse_mode=None)
                 logger.info(f"Successfully edited message to show start menu in {new_lang}")
                 # <<< END FIX >>>
 
             except sqlite3.Error as e:
                 logger.error(f"DB error updating language user {user_id}: {e}");
-                if conn and conn.in_transaction: conn.rollback()
                 error_saving_lang = current_lang_data.get("error_saving_language", "Error saving.")
                 await query.answer(error_saving_lang, show_alert=True)
                 await _display_language_menu(update, context, current_lang, current_lang_data)
@@ -2016,8 +1987,6 @@ async def handle_language_selection(update: Update, context: ContextTypes.DEFAUL
                 logger.error(f"Unexpected error in language selection update for user {user_id}: {e}", exc_info=True)
                 await query.answer("An error occurred.", show_alert=True)
                 await _display_language_menu(update, context, current_lang, current_lang_data)
-            finally:
-                if conn: conn.close()
         else:
              invalid_lang_answer = current_lang_data.get("invalid_language_answer", "Invalid language selected.")
              await query.answer(invalid_lang_answer, show_alert=True)
@@ -2052,6 +2021,7 @@ async def _display_language_menu(update: Update, context: ContextTypes.DEFAULT_T
 
 
 # --- Price List ---
+@callback_route("price_list")
 async def handle_price_list(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     lang, lang_data = _get_lang_data(context)
@@ -2074,6 +2044,7 @@ async def handle_price_list(update: Update, context: ContextTypes.DEFAULT_TYPE,
             logger.error(f"Error editing price list message: {e}")
             await query.answer("Error displaying price list.", show_alert=True)
 
+@callback_route("price_list_city")
 async def handle_price_list_city(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     lang, lang_data = _get_lang_data(context)
@@ -2083,13 +2054,10 @@ async def handle_price_list_city(update: Update, context: ContextTypes.DEFAULT_T
     if not city_name: error_city_not_found = lang_data.get("error_city_not_found", "Error: City not found."); await query.edit_message_text(f"❌ {error_city_not_found}", parse_mode=None); return await handle_price_list(update, context)
 
     price_list_title_city_template = lang_data.get("price_list_title_city", "Price List: {city_name}"); msg = f"{EMOJI_PRICELIST} {price_list_title_city_template.format(city_name=city_name)}\n\n"
-    found_products = False; conn = None
+    found_products = False
 
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT product_type, size, price, district, COUNT(*) as quantity FROM products WHERE city = ? AND available > reserved GROUP BY product_type, size, price, district ORDER BY product_type, price, size, district", (city_name,))
-        results = c.fetchall()
+        results = CATALOG_INDEX.city_price_rows(city_name)
         no_products_in_city = lang_data.get("no_products_in_city", "No products available here."); available_label = lang_data.get("available_label", "available")
 
         if not results: msg += no_products_in_city
@@ -2129,11 +2097,10 @@ async def handle_price_list_city(update: Update, context: ContextTypes.DEFAULT_T
         logger.error(f"Unexpected error price list city {city_name}: {e}", exc_info=True)
         error_unexpected_prices = lang_data.get("error_unexpected_prices", "Error: Unexpected issue.")
         await query.edit_message_text(f"❌ {error_unexpected_prices}", parse_mode=None)
-    finally:
-         if conn: conn.close()
 
 
 # --- Review Handlers ---
+@callback_route("reviews")
 async def handle_reviews_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     lang, lang_data = _get_lang_data(context)
@@ -2150,6 +2117,7 @@ async def handle_reviews_menu(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.edit_message_text(review_prompt, reply_markup=reply_markup, parse_mode=None)
 
 
+@callback_route("leave_review")
 async def handle_leave_review(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     lang, lang_data = _get_lang_data(context)
@@ -2166,6 +2134,7 @@ async def handle_leave_review(update: Update, context: ContextTypes.DEFAULT_TYPE
     except Exception as e: logger.error(f"Unexpected error handle_leave_review: {e}", exc_info=True); await query.answer("Error occurred.", show_alert=True)
 
 
+@state_route("awaiting_review")
 async def handle_leave_review_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
@@ -2196,15 +2165,11 @@ async def handle_leave_review_message(update: Update, context: ContextTypes.DEFA
          await send_message_with_retry(context.bot, chat_id, review_too_long, parse_mode=None)
          return
 
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute(
+        await db_execute(
             "INSERT INTO reviews (user_id, review_text, review_date) VALUES (?, ?, ?)",
             (user_id, review_text, datetime.now(timezone.utc).isoformat())
         )
-        conn.commit()
         logger.info(f"User {user_id} left a review.")
         context.user_data.pop("state", None)
 
@@ -2215,25 +2180,21 @@ async def handle_leave_review_message(update: Update, context: ContextTypes.DEFA
 
     except sqlite3.Error as e:
         logger.error(f"DB error saving review user {user_id}: {e}", exc_info=True)
-        if conn and conn.in_transaction: conn.rollback()
         context.user_data.pop("state", None)
         await send_message_with_retry(context.bot, chat_id, f"❌ {error_saving_review_db}", parse_mode=None)
 
     except Exception as e:
         logger.error(f"Unexpected error saving review user {user_id}: {e}", exc_info=True)
-        if conn and conn.in_transaction: conn.rollback()
         context.user_data.pop("state", None)
         await send_message_with_retry(context.bot, chat_id, f"❌ {error_saving_review_unexpected}", parse_mode=None)
 
-    finally:
-        if conn: conn.close()
-
+@callback_route("view_reviews")
 async def handle_view_reviews(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     lang, lang_data = _get_lang_data(context)
     offset = 0; reviews_per_page = 5
     if params and len(params) > 0 and params[0].isdigit(): offset = int(params[0])
-    reviews_data = fetch_reviews(offset=offset, limit=reviews_per_page + 1)
+    reviews_data = await run_db(fetch_reviews, offset=offset, limit=reviews_per_page + 1)
     user_reviews_title = lang_data.get("user_reviews_title", "User Reviews"); no_reviews_yet = lang_data.get("no_reviews_yet", "No reviews yet."); no_more_reviews = lang_data.get("no_more_reviews", "No more reviews."); prev_button = lang_data.get("prev_button", "Prev"); next_button = lang_data.get("next_button", "Next"); back_review_menu_button = lang_data.get("back_review_menu_button", "Back to Reviews"); unknown_date_label = lang_data.get("unknown_date_label", "Unknown Date"); error_displaying_review = lang_data.get("error_displaying_review", "Error display"); error_updating_review_list = lang_data.get("error_updating_review_list", "Error updating list.")
     msg = f"{EMOJI_REVIEW} {user_reviews_title}\n\n"; keyboard = []
     if not reviews_data:
@@ -2261,11 +2222,13 @@ async def handle_view_reviews(update: Update, context: ContextTypes.DEFAULT_TYPE
         if "message is not modified" not in str(e).lower(): logger.warning(f"Failed edit view_reviews: {e}"); await query.answer(error_updating_review_list, show_alert=True)
         else: await query.answer()
 
+@callback_route("leave_review_now")
 async def handle_leave_review_now(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Callback handler specifically for the 'Leave Review Now' button after purchase."""
     await handle_leave_review(update, context, params)
 
 # --- Refill Handlers ---
+@callback_route("refill")
 async def handle_refill(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     user_id = query.from_user.id
@@ -2301,6 +2264,7 @@ async def handle_refill(update: Update, context: ContextTypes.DEFAULT_TYPE, para
     except Exception as e: logger.error(f"Unexpected error handle_refill: {e}", exc_info=True); error_occurred_answer = lang_data.get("error_occurred_answer", "An error occurred."); await query.answer(error_occurred_answer, show_alert=True)
 
 # <<< MODIFIED: Use SUPPORTED_CRYPTO dictionary >>>
+@state_route("awaiting_refill_amount")
 async def handle_refill_amount_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
@@ -2369,6 +2333,7 @@ async def handle_refill_amount_message(update: Update, context: ContextTypes.DEF
         context.user_data.pop('refill_eur_amount', None)
 
 # --- Single Item Discount Code Message Handler ---
+@state_route("awaiting_single_item_discount_code")
 async def handle_single_item_discount_code_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ Handles the general discount code entered during the single item crypto pay flow """
     user_id = update.effective_user.id
@@ -2403,7 +2368,7 @@ async def handle_single_item_discount_code_message(update: Update, context: Cont
         return
 
     # SECURITY: Use atomic validation to prevent race conditions and multiple uses
-    code_valid, validation_message, discount_details = validate_and_apply_discount_atomic(entered_code, price_after_reseller_float, user_id)
+    code_valid, validation_message, discount_details = await run_db(validate_and_apply_discount_atomic, entered_code, price_after_reseller_float, user_id)
     feedback_msg_template = ""
     new_final_total_for_single_item_float = price_after_reseller_float
 
@@ -2431,20 +2396,15 @@ async def handle_single_item_discount_code_message(update: Update, context: Cont
     snapshot = context.user_data['single_item_pay_snapshot']
     discount_code_to_use = context.user_data.get('single_item_pay_discount_code')
 
-    conn_balance = None; user_balance = Decimal('0.0'); balance_check_error = False
+    user_balance = Decimal('0.0'); balance_check_error = False
     try:
-        conn_balance = get_db_connection()
-        c_balance = conn_balance.cursor()
-        c_balance.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
-        balance_result = c_balance.fetchone()
+        balance_result = await USER_PROFILES.get_async(user_id)
         user_balance = Decimal(str(balance_result['balance'])) if balance_result else Decimal('0.0')
     except sqlite3.Error as e:
         logger.error(f"DB error fetching balance after single item discount: {e}")
-        await asyncio.to_thread(_unreserve_basket_items, snapshot)
+        await run_db(_unreserve_basket_items, snapshot)
         await send_message_with_retry(context.bot, chat_id, "❌ Error checking balance. Item released.", parse_mode=None)
         balance_check_error = True
-    finally:
-        if conn_balance: conn_balance.close()
 
     if balance_check_error:
         context.user_data.pop('single_item_pay_snapshot', None)
@@ -2459,7 +2419,7 @@ async def handle_single_item_discount_code_message(update: Update, context: Cont
         
         # Clear reservation tracking since payment completed
         from utils import clear_reservation_tracking
-        clear_reservation_tracking(user_id)
+        await run_db(clear_reservation_tracking, user_id)
         
         context.user_data.pop('single_item_pay_snapshot', None)
         context.user_data.pop('single_item_pay_final_eur', None)
@@ -2472,6 +2432,7 @@ async def handle_single_item_discount_code_message(update: Update, context: Cont
         await _show_crypto_choices_for_basket(update, context, edit_message=False)
 
 # --- NEW: Handler to Ask for Discount Code in Single Item Pay Flow ---
+@callback_route("apply_discount_single_pay")
 async def handle_apply_discount_single_pay(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     user_id = query.from_user.id
@@ -2503,6 +2464,7 @@ async def handle_apply_discount_single_pay(update: Update, context: ContextTypes
     await query.answer("Enter discount code in chat.")
 
 # --- NEW: Handler to Skip Discount in Single Item Pay Flow ---
+@callback_route("skip_discount_single_pay")
 async def handle_skip_discount_single_pay(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     query = update.callback_query
     user_id = query.from_user.id
@@ -10,7 +10,8 @@ import re
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
-from userbot_simple import simple_userbot as userbot
+from userbot_simple import simple_userbot as userbot, get_delivery_stats
+from router import callback_route # Static update routing
 from utils import is_any_admin
 
 logger = logging.getLogger(__name__)
@@ -18,6 +19,7 @@ logger = logging.getLogger(__name__)
 # Session storage for userbot authentication
 user_sessions = {}
 
+@callback_route("userbot_status")
 async def handle_userbot_status(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Show userbot status"""
     if not is_any_admin(update.effective_user.id):
@@ -38,6 +40,10 @@ async def handle_userbot_status(update: Update, context: ContextTypes.DEFAULT_TY
                 status_text += f"🎯 Mode: SECRET CHAT DELIVERY\n\n"
                 status_text += f"✅ Products will be delivered via ENCRYPTED SECRET CHATS\n"
                 status_text += f"🔒 Maximum security and privacy for customers"
+                stats = get_delivery_stats()
+                if stats['delivered'] or stats['failed']:
+                    status_text += f"\n\n⏱️ Deliveries: {stats['delivered']} ok / {stats['failed']} failed\n"
+                    status_text += f"⏱️ Latency: avg {stats['avg_s']:.1f}s, p95 {stats['recent_p95_s']:.1f}s (chat accept wait avg {stats['avg_ready_wait_s']:.1f}s)"
             else:
                 status_text += f"🟡 **CONFIGURED BUT DISCONNECTED**\n"
                 status_text += f"📱 Phone: {userbot.phone_number}\n"
@@ -81,6 +87,7 @@ async def handle_userbot_status(update: Update, context: ContextTypes.DEFAULT_TY
         logger.error(f"Error showing userbot status: {e}")
         await update.callback_query.answer("❌ Error loading status")
 
+@callback_route("userbot_set_credentials")
 async def handle_userbot_set_credentials(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Start userbot credential setup"""
     if not is_any_admin(update.effective_user.id):
@@ -519,6 +526,7 @@ async def handle_userbot_session_message(update: Update, context: ContextTypes.D
         logger.error(f"Error processing userbot session message: {e}")
         await update.message.reply_text("Error processing your message.")
 
+@callback_route("userbot_connect")
 async def handle_userbot_connect(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Connect userbot"""
     if not is_any_admin(update.effective_user.id):
@@ -542,6 +550,7 @@ async def handle_userbot_connect(update: Update, context: ContextTypes.DEFAULT_T
         logger.error(f"Error connecting userbot: {e}")
         await update.callback_query.answer("❌ Error connecting userbot")
 
+@callback_route("userbot_disconnect")
 async def handle_userbot_disconnect(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Disconnect userbot"""
     if not is_any_admin(update.effective_user.id):
@@ -557,6 +566,7 @@ async def handle_userbot_disconnect(update: Update, context: ContextTypes.DEFAUL
         logger.error(f"Error disconnecting userbot: {e}")
         await update.callback_query.answer("❌ Error disconnecting userbot")
 
+@callback_route("userbot_test")
 async def handle_userbot_test(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Test userbot delivery"""
     if not is_any_admin(update.effective_user.id):
@@ -590,6 +600,7 @@ async def handle_userbot_test(update: Update, context: ContextTypes.DEFAULT_TYPE
         logger.error(f"Error testing userbot: {e}")
         await update.callback_query.answer("❌ Error testing userbot")
 
+@callback_route("userbot_clear_config")
 async def handle_userbot_clear_config(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Clear userbot configuration"""
     if not is_any_admin(update.effective_user.id):
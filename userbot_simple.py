@@ -6,389 +6,403 @@ Direct message delivery that actually works!
 
 import os
 import json
+import time
 import logging
 import asyncio
+import sqlite3
+import threading
+from collections import deque
 from typing import Optional, Dict, Any, List, Tuple
 from telethon import TelegramClient
-from telethon.tl.types import User
+from telethon.tl.types import User, InputPeerUser
 from telethon.errors import SessionPasswordNeededError, PhoneCodeInvalidError
 
+from utils import DATABASE_PATH, SQLITE_BUSY_TIMEOUT_MS, SQLITE_CONNECTION_PRAGMAS, get_db_connection, run_db, db_fetchone, db_execute, enqueue_db_write, USER_PROFILES
+
 logger = logging.getLogger(__name__)
 
-class SimpleUserbot:
+# --- Secret Chat Peer Cache ---
+# access_hash is per (userbot account, customer) and rarely changes; a secret chat stays usable until either side closes it
+USERBOT_ENTITY_CACHE_TTL_HOURS = int(os.environ.get("USERBOT_ENTITY_CACHE_TTL_HOURS", "168"))
+USERBOT_SECRET_CHAT_TTL_HOURS = int(os.environ.get("USERBOT_SECRET_CHAT_TTL_HOURS", "720"))
+# How long a delivery waits for the customer's client to accept a new secret chat
+USERBOT_SECRET_CHAT_READY_TIMEOUT_SECONDS = float(os.environ.get("USERBOT_SECRET_CHAT_READY_TIMEOUT_SECONDS", "30"))
+USERBOT_MEDIA_SEND_ATTEMPTS = 3
+
+# --- Per-Account Delivery Budget ---
+# Every configured account stays connected; deliveries are spread across them within these limits
+USERBOT_ACCOUNT_CONCURRENCY = int(os.environ.get("USERBOT_ACCOUNT_CONCURRENCY", "2"))
+USERBOT_ACCOUNT_DELIVERIES_PER_MINUTE = int(os.environ.get("USERBOT_ACCOUNT_DELIVERIES_PER_MINUTE", "6"))
+USERBOT_ACCOUNT_MAX_FAILURES = 3 # Consecutive failed deliveries before an account is rested
+USERBOT_ACCOUNT_COOLDOWN_SECONDS = 300
+
+# --- Delivery Metrics ---
+DELIVERY_STATS = {'delivered': 0, 'failed': 0, 'total_s': 0.0, 'max_s': 0.0, 'ready_wait_total_s': 0.0}
+RECENT_DELIVERIES = deque(maxlen=200) # Per-order timings, newest last
+
+
+def record_delivery(user_id: int, ok: bool, seconds: float, ready_wait_s: float, media_count: int):
+    """Counts one order's userbot delivery and keeps its timing for get_delivery_stats()."""
+    DELIVERY_STATS['delivered' if ok else 'failed'] += 1
+    DELIVERY_STATS['total_s'] += seconds
+    DELIVERY_STATS['ready_wait_total_s'] += ready_wait_s
+    if seconds > DELIVERY_STATS['max_s']: DELIVERY_STATS['max_s'] = seconds
+    RECENT_DELIVERIES.append({'user_id': user_id, 'ok': ok, 'seconds': round(seconds, 3),
+                              'ready_wait_s': round(ready_wait_s, 3), 'media': media_count, 'at': time.time()})
+    logger.info(f"⏱️ DELIVERY: user {user_id} {'delivered' if ok else 'failed'} in {seconds:.2f}s "
+                f"(chat ready wait {ready_wait_s:.2f}s, {media_count} media)")
+
+
+def get_delivery_stats() -> dict:
+    """Userbot delivery counts and latencies: lifetime totals plus p50/p95 over recent orders."""
+    count = DELIVERY_STATS['delivered'] + DELIVERY_STATS['failed']
+    recent = sorted(d['seconds'] for d in RECENT_DELIVERIES)
+    percentile = lambda q: recent[min(len(recent) - 1, int(q * len(recent)))] if recent else 0.0
+    return {'delivered': DELIVERY_STATS['delivered'], 'failed': DELIVERY_STATS['failed'],
+            'avg_s': round(DELIVERY_STATS['total_s'] / count, 3) if count else 0.0,
+            'max_s': round(DELIVERY_STATS['max_s'], 3),
+            'avg_ready_wait_s': round(DELIVERY_STATS['ready_wait_total_s'] / count, 3) if count else 0.0,
+            'recent_p50_s': percentile(0.5), 'recent_p95_s': percentile(0.95)}
+
+
+class SecretChatPeerCache:
+    """Remembers, per userbot account, each customer's access_hash and secret chat id.
+
+    A hit skips the username lookup + ResolveUsername call and the secret chat handshake. Entries
+    expire after their TTL; a secret chat that stops accepting messages is forgotten and recreated.
+    """
+
     def __init__(self):
-        self.api_id = None
-        self.api_hash = None
-        self.phone_number = None
-        self.session_string = None
-        self.has_session = False
-        self.is_connected = False
-        self.client = None
-        
-        # Multi-userbot support
-        self.userbots = []  # List of userbot configurations
-        self.current_userbot_index = 0
-        
-        # Load existing configuration
-        self._load_configuration()
-    
-    def _load_configuration(self):
-        """Load userbot configurations from persistent storage"""
-        try:
-            config_file = '/mnt/data/userbot_config.json'
-            if os.path.exists(config_file):
-                with open(config_file, 'r') as f:
-                    config = json.load(f)
-                    
-                    # Check if it's multi-userbot format
-                    if 'userbots' in config:
-                        self.userbots = config['userbots']
-                        logger.info(f"✅ MULTI-USERBOT: Loaded {len(self.userbots)} userbot configurations")
-                        
-                        # Set primary userbot as current
-                        if self.userbots:
-                            primary = self.userbots[0]
-                            self.api_id = primary.get('api_id')
-                            self.api_hash = primary.get('api_hash')
-                            self.phone_number = primary.get('phone_number')
-                            self.session_string = primary.get('session_string')
-                            
-                            if self.session_string:
-                                self.has_session = True
-                                logger.info(f"✅ MULTI-USERBOT: Primary userbot: {self.phone_number}")
-                    else:
-                        # Legacy single userbot format - convert to multi-userbot
-                        legacy_userbot = {
-                            'api_id': config.get('api_id'),
-                            'api_hash': config.get('api_hash'),
-                            'phone_number': config.get('phone_number'),
-                            'session_string': config.get('session_string'),
-                            'rate_limited_until': 0
-                        }
-                        self.userbots = [legacy_userbot]
-                        
-                        # Set legacy as current
-                        self.api_id = legacy_userbot['api_id']
-                        self.api_hash = legacy_userbot['api_hash']
-                        self.phone_number = legacy_userbot['phone_number']
-                        self.session_string = legacy_userbot['session_string']
-                        
-                        if self.session_string:
-                            self.has_session = True
-                            logger.info(f"✅ SIMPLE: Converted legacy config for {self.phone_number}")
-                        
-                        # Save in new format
-                        self._save_configuration()
-            else:
-                logger.info(f"ℹ️ SIMPLE: No configuration file found")
-        except Exception as e:
-            logger.error(f"❌ SIMPLE: Error loading configuration: {e}")
-    
-    def _save_configuration(self):
-        """Save userbot configurations to persistent storage"""
+        self._lock = threading.Lock()
+        self._entries = {} # {(account, user_id): {'access_hash', 'entity_expires_at', 'secret_chat_id', 'secret_chat_expires_at'}}
+
+    def load(self, account: str) -> int:
+        """Loads one account's unexpired entries and drops fully expired rows. (Synchronous, runs on DB executor)"""
+        now = time.time()
         try:
-            config_file = '/mnt/data/userbot_config.json'
-            config = {
-                'userbots': self.userbots,
-                'current_userbot_index': self.current_userbot_index
-            }
-            
-            with open(config_file, 'w') as f:
-                json.dump(config, f, indent=2)
-            logger.info(f"✅ MULTI-USERBOT: Configuration saved ({len(self.userbots)} userbots)")
-        except Exception as e:
-            logger.error(f"❌ MULTI-USERBOT: Error saving configuration: {e}")
-    
-    def add_userbot(self, api_id: int, api_hash: str, phone_number: str, session_string: str = None):
-        """Add a new userbot to the rotation"""
-        new_userbot = {
-            'api_id': api_id,
-            'api_hash': api_hash,
-            'phone_number': phone_number,
-            'session_string': session_string,
-            'rate_limited_until': 0
-        }
-        
-        self.userbots.append(new_userbot)
-        self._save_configuration()
-        logger.info(f"✅ MULTI-USERBOT: Added userbot {phone_number} (Total: {len(self.userbots)})")
-        return True, f"Userbot {phone_number} added successfully"
-    
-    def get_available_userbot(self):
-        """Get next available userbot (not rate limited)"""
-        import time
-        current_time = time.time()
-        
-        # Check all userbots for availability
-        for i, userbot in enumerate(self.userbots):
-            if userbot.get('rate_limited_until', 0) < current_time:
-                if userbot.get('session_string'):
-                    logger.info(f"✅ MULTI-USERBOT: Using userbot {i+1}: {userbot['phone_number']}")
-                    return i, userbot
-        
-        logger.warning(f"⚠️ MULTI-USERBOT: All {len(self.userbots)} userbots are rate limited")
-        return None, None
-    
-    def mark_userbot_rate_limited(self, userbot_index: int, wait_seconds: int):
-        """Mark a userbot as rate limited"""
-        import time
-        if userbot_index < len(self.userbots):
-            self.userbots[userbot_index]['rate_limited_until'] = time.time() + wait_seconds
-            self._save_configuration()
-            logger.warning(f"⚠️ MULTI-USERBOT: Marked userbot {userbot_index+1} as rate limited for {wait_seconds}s")
-    
-    def set_credentials(self, api_id: int, api_hash: str, phone_number: str, session_string: str = None):
-        """Set userbot credentials"""
-        self.api_id = api_id
-        self.api_hash = api_hash
-        self.phone_number = phone_number
-        if session_string:
-            self.session_string = session_string
-            self.has_session = True
-        
-        self._save_configuration()
-        logger.info(f"✅ SIMPLE: Credentials set for {phone_number}")
-    
-    async def _switch_to_userbot(self, userbot_index: int):
-        """Switch to a different userbot"""
-        if userbot_index >= len(self.userbots):
-            return False
-        
-        # Disconnect current userbot
-        if self.client and self.is_connected:
-            await self.disconnect()
-        
-        # Switch to new userbot
-        userbot_config = self.userbots[userbot_index]
-        self.api_id = userbot_config['api_id']
-        self.api_hash = userbot_config['api_hash']
-        self.phone_number = userbot_config['phone_number']
-        self.session_string = userbot_config['session_string']
-        self.current_userbot_index = userbot_index
-        
-        # Connect new userbot
-        if self.session_string:
-            self.has_session = True
-            success, message = await self.connect()
-            logger.info(f"🔄 MULTI-USERBOT: Switched to userbot {userbot_index+1}: {self.phone_number}")
-            return success
-        
-        return False
-    
-    def is_configured(self) -> bool:
-        """Check if userbot is configured"""
-        return bool(self.api_id and self.api_hash and self.phone_number)
-    
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                c.execute("""DELETE FROM userbot_peer_cache WHERE account = ?
+                             AND COALESCE(entity_expires_at, 0) < ? AND COALESCE(secret_chat_expires_at, 0) < ?""", (account, now, now))
+                c.execute("""SELECT user_id, access_hash, entity_expires_at, secret_chat_id, secret_chat_expires_at
+                             FROM userbot_peer_cache WHERE account = ?""", (account,))
+                rows = c.fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"❌ PEER CACHE: Failed to load entries for {account}: {e}")
+            return 0
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == account]: del self._entries[key]
+            for row in rows:
+                self._entries[(account, row['user_id'])] = {k: row[k] for k in row.keys() if k != 'user_id'}
+        logger.info(f"✅ PEER CACHE: {len(rows)} cached peers loaded for {account}")
+        return len(rows)
+
+    def get_input_peer(self, account: str, user_id: int) -> InputPeerUser | None:
+        with self._lock: entry = self._entries.get((account, user_id))
+        if not entry or entry.get('access_hash') is None or (entry.get('entity_expires_at') or 0) < time.time(): return None
+        return InputPeerUser(user_id, entry['access_hash'])
+
+    def get_secret_chat_id(self, account: str, user_id: int) -> int | None:
+        with self._lock: entry = self._entries.get((account, user_id))
+        if not entry or not entry.get('secret_chat_id') or (entry.get('secret_chat_expires_at') or 0) < time.time(): return None
+        return entry['secret_chat_id']
+
+    def remember_entity(self, account: str, user_id: int, access_hash: int):
+        expires_at = time.time() + USERBOT_ENTITY_CACHE_TTL_HOURS * 3600
+        with self._lock:
+            entry = self._entries.setdefault((account, user_id), {})
+            entry.update(access_hash=access_hash, entity_expires_at=expires_at)
+        enqueue_db_write("""INSERT INTO userbot_peer_cache (account, user_id, access_hash, entity_expires_at, updated_at) VALUES (?, ?, ?, ?, ?)
+                            ON CONFLICT(account, user_id) DO UPDATE SET access_hash = excluded.access_hash,
+                            entity_expires_at = excluded.entity_expires_at, updated_at = excluded.updated_at""",
+                         (account, user_id, access_hash, expires_at, time.time()))
+
+    def remember_secret_chat(self, account: str, user_id: int, secret_chat_id: int):
+        expires_at = time.time() + USERBOT_SECRET_CHAT_TTL_HOURS * 3600
+        with self._lock:
+            entry = self._entries.setdefault((account, user_id), {})
+            entry.update(secret_chat_id=secret_chat_id, secret_chat_expires_at=expires_at)
+        enqueue_db_write("""INSERT INTO userbot_peer_cache (account, user_id, secret_chat_id, secret_chat_expires_at, updated_at) VALUES (?, ?, ?, ?, ?)
+                            ON CONFLICT(account, user_id) DO UPDATE SET secret_chat_id = excluded.secret_chat_id,
+                            secret_chat_expires_at = excluded.secret_chat_expires_at, updated_at = excluded.updated_at""",
+                         (account, user_id, secret_chat_id, expires_at, time.time()))
+
+    def forget_secret_chat(self, account: str, user_id: int):
+        with self._lock:
+            entry = self._entries.get((account, user_id))
+            if entry: entry.update(secret_chat_id=None, secret_chat_expires_at=None)
+        enqueue_db_write("UPDATE userbot_peer_cache SET secret_chat_id = NULL, secret_chat_expires_at = NULL, updated_at = ? WHERE account = ? AND user_id = ?",
+                         (time.time(), account, user_id))
+
+
+PEER_CACHE = SecretChatPeerCache()
+
+
+def _open_secret_chat_session():
+    """
+    Secret chat keys live in the shop DB (plugin_secret_chats) so cached chat ids survive restarts.
+    The plugin needs a plain sqlite3 connection of its own, so this one is opened outside the pool but with
+    the pool's pragmas; each account gets its own. (Synchronous, runs on DB executor)
+    """
+    from telethon_secret_chat.storage.sqlite import SecretSQLiteSession
+    conn = sqlite3.connect(DATABASE_PATH, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    for pragma in SQLITE_CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return SecretSQLiteSession(conn)
+
+
+
+# --- Account Storage ---
+USERBOT_LEGACY_CONFIG_FILE = '/mnt/data/userbot_config.json' # Imported into userbot_accounts once, then renamed
+_ACCOUNT_COLUMNS = ('phone_number', 'api_id', 'api_hash', 'session_string', 'rate_limited_until', 'consecutive_failures', 'last_used')
+_UPSERT_ACCOUNT_SQL = """INSERT INTO userbot_accounts
+    (phone_number, api_id, api_hash, session_string, rate_limited_until, consecutive_failures, last_used, position, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(phone_number) DO UPDATE SET api_id = excluded.api_id, api_hash = excluded.api_hash,
+        session_string = excluded.session_string, rate_limited_until = excluded.rate_limited_until,
+        consecutive_failures = excluded.consecutive_failures, last_used = excluded.last_used,
+        position = excluded.position, updated_at = excluded.updated_at"""
+
+
+def _account_row(config: dict, position: int) -> tuple:
+    return (config.get('phone_number'), config.get('api_id'), config.get('api_hash'), config.get('session_string'),
+            config.get('rate_limited_until') or 0, config.get('consecutive_failures') or 0, config.get('last_used') or 0,
+            position, time.time())
+
+
+def _flood_wait_seconds(error: Exception) -> int | None:
+    """Seconds to wait if `error` is a Telegram flood wait, else None."""
+    seconds = getattr(error, 'seconds', None)
+    if isinstance(seconds, int): return seconds
+    text = str(error).lower()
+    if "wait" in text and "seconds" in text:
+        import re
+        wait_match = re.search(r'wait of (\d+) seconds', text)
+        return int(wait_match.group(1)) if wait_match else 3600  # Default 1 hour
+    return None
+
+
+class UserbotAccount:
+    """One configured Telethon account with its own client, secret chat manager and delivery budget.
+
+    `config` is the account's dict in SimpleUserbot.userbots, so rate-limit deadlines written there are seen here.
+    """
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.client = None
+        self.secret_chat_manager = None # One per client; keeps a single event handler and reads keys through secret_session
+        self.secret_session = None # This account's connection to the key store
+        self.is_connected = False
+        self.in_flight = 0
+        self._recent_starts = deque() # Delivery start times within the last minute
+        self._secret_chat_ready = {} # {secret_chat_id: asyncio.Event} for deliveries waiting on a new chat
+
+    @property
+    def phone_number(self) -> str:
+        return self.config.get('phone_number')
+
+    # Health and last use live in `config` so SimpleUserbot persists them with the rest of the account state
+    @property
+    def consecutive_failures(self) -> int:
+        return self.config.get('consecutive_failures') or 0
+
+    @consecutive_failures.setter
+    def consecutive_failures(self, value: int):
+        self.config['consecutive_failures'] = value
+
+    @property
+    def last_used(self) -> float:
+        return self.config.get('last_used') or 0.0
+
+    @last_used.setter
+    def last_used(self, value: float):
+        self.config['last_used'] = value
+
+    def budget_left(self, now: float) -> int:
+        while self._recent_starts and self._recent_starts[0] <= now - 60: self._recent_starts.popleft()
+        return USERBOT_ACCOUNT_DELIVERIES_PER_MINUTE - len(self._recent_starts)
+
+    def free_slots(self, now: float) -> int:
+        """How many more deliveries this account may start right now (0 if disconnected or resting)."""
+        if not self.is_connected or self.config.get('rate_limited_until', 0) > now: return 0
+        return max(0, min(USERBOT_ACCOUNT_CONCURRENCY - self.in_flight, self.budget_left(now)))
+
+    def reserve(self, now: float):
+        self.in_flight += 1
+        self.last_used = now
+        self._recent_starts.append(now)
+
     async def connect(self) -> Tuple[bool, str]:
-        """Connect the userbot"""
-        if not self.is_configured():
-            return False, "Userbot not configured"
-        
-        if not self.has_session:
-            return False, "No session available"
-        
         try:
-            logger.info(f"🔌 SIMPLE: Connecting...")
+            logger.info(f"🔌 SIMPLE: Connecting {self.phone_number}...")
             
             # Create Telethon client with session string
             from telethon.sessions import StringSession
             self.client = TelegramClient(
-                StringSession(self.session_string), 
-                self.api_id, 
-                self.api_hash
+                StringSession(self.config['session_string']), 
+                self.config['api_id'], 
+                self.config['api_hash']
             )
             
             await self.client.connect()
             
             if not await self.client.is_user_authorized():
-                return False, "Session expired - please re-authenticate"
+                return False, f"{self.phone_number}: Session expired - please re-authenticate"
             
             # Get user info
             me = await self.client.get_me()
+            
+            from telethon_secret_chat import SecretChatManager
+            if self.secret_session is None:
+                self.secret_session = await run_db(_open_secret_chat_session)
+            self.secret_chat_manager = SecretChatManager(self.client, session=self.secret_session, auto_accept=True,
+                                                         new_chat_created=self._on_secret_chat_created)
+            await run_db(PEER_CACHE.load, self.phone_number)
             self.is_connected = True
+            self.consecutive_failures = 0
             
             success_msg = f"Connected as @{me.username or me.first_name}"
-            logger.info(f"✅ SIMPLE: {success_msg}")
+            logger.info(f"✅ SIMPLE: {self.phone_number} {success_msg}")
             return True, success_msg
             
         except Exception as e:
-            logger.error(f"❌ SIMPLE: Connection failed: {e}")
-            return False, f"Connection error: {e}"
-    
+            logger.error(f"❌ SIMPLE: Connection failed for {self.phone_number}: {e}")
+            return False, f"{self.phone_number}: Connection error: {e}"
+
     async def disconnect(self):
-        """Disconnect the userbot"""
         try:
             if self.client:
                 await self.client.disconnect()
                 self.client = None
+            self.secret_chat_manager = None
+            if self.secret_session:
+                self.secret_session.close()
+                self.secret_session = None
             self.is_connected = False
-            logger.info(f"✅ SIMPLE: Disconnected")
+            logger.info(f"✅ SIMPLE: Disconnected {self.phone_number}")
         except Exception as e:
-            logger.error(f"❌ SIMPLE: Error disconnecting: {e}")
-    
-    def get_status(self) -> str:
-        """Get userbot status"""
-        if not self.is_configured():
-            return "❌ Not configured"
-        elif not self.has_session:
-            return "⚠️ No session - needs authentication"
-        elif self.is_connected:
-            return "✅ Connected and ready"
-        else:
-            return "⚠️ Configured but not connected"
+            logger.error(f"❌ SIMPLE: Error disconnecting {self.phone_number}: {e}")
+
+    async def _on_secret_chat_created(self, chat, created_by_me=False):
+        """SecretChatManager callback: the chat's keys are stored, so wake the delivery waiting on it"""
+        event = self._secret_chat_ready.get(chat.id)
+        if event: event.set()
     
-    def clear_configuration(self):
-        """Clear userbot configuration and session"""
+    def _secret_chat_has_keys(self, secret_chat_id: int) -> bool:
         try:
-            config_file = '/mnt/data/userbot_config.json'
-            if os.path.exists(config_file):
-                os.remove(config_file)
-                logger.info("✅ SIMPLE: Configuration file deleted")
-            
-            # Reset all properties
-            self.api_id = None
-            self.api_hash = None
-            self.phone_number = None
-            self.session_string = None
-            self.has_session = False
-            self.is_connected = False
-            
-            # Disconnect if connected
-            if self.client:
-                try:
-                    asyncio.create_task(self.client.disconnect())
-                except:
-                    pass
-                self.client = None
-            
-            logger.info("✅ SIMPLE: Configuration cleared")
-            return True, "Configuration cleared successfully"
-            
-        except Exception as e:
-            logger.error(f"❌ SIMPLE: Error clearing configuration: {e}")
-            return False, f"Error clearing configuration: {e}"
+            self.secret_chat_manager.get_secret_chat(secret_chat_id)
+            return True
+        except ValueError:
+            return False
     
-    def _create_product_message(self, product_data: dict) -> str:
-        """Create product message"""
-        message = f"""🔐 **DIRECT SECURE DELIVERY** 🔐
-
-📦 **Product**: {product_data['product_name']}
-🏙️ **City**: {product_data['city'].title()}
-🏘️ **District**: {product_data['district'].title()}
-📏 **Size**: {product_data['size']}
-💰 **Price**: {product_data['price']} EUR
-
-✅ **Payment confirmed - product ready for pickup!**
+    async def _wait_for_secret_chat(self, secret_chat_id: int, timeout: float) -> bool:
+        """Waits until the customer's client accepts the chat (keys exchanged). Returns False on timeout."""
+        if self._secret_chat_has_keys(secret_chat_id): return True
+        event = self._secret_chat_ready.setdefault(secret_chat_id, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._secret_chat_ready.pop(secret_chat_id, None)
+        return self._secret_chat_has_keys(secret_chat_id)
 
-🚀 **This message was delivered directly via secure userbot - no bot chat delivery!**"""
-        return message
-    
-    async def send_product_to_user(self, user_id: int, product_data: dict, media_files: List[str] = None) -> Tuple[bool, str]:
-        """🔐 MULTI-USERBOT SECRET CHAT - Automatic rotation to avoid rate limits"""
-        
-        # Get available userbot (not rate limited)
-        userbot_index, userbot_config = self.get_available_userbot()
-        if not userbot_config:
-            return False, "All userbots are rate limited"
-        
-        # Switch to available userbot if different from current
-        if userbot_index != self.current_userbot_index:
-            logger.info(f"🔄 MULTI-USERBOT: Switching from userbot {self.current_userbot_index+1} to {userbot_index+1}")
-            await self._switch_to_userbot(userbot_index)
-        
-        if not self.is_connected:
-            return False, "Selected userbot not connected"
-        
+    async def deliver(self, user_id: int, message: str, media_files: List[str], timings: dict,
+                      skip_message: bool = False, on_message_sent=None) -> Tuple[str, str]:
+        """
+        Sends the product message and media to the customer's secret chat on this account.
+        skip_message: the message already went out on an earlier attempt, only the media is sent.
+        on_message_sent: optional coroutine function awaited right after the message was sent.
+        Returns (status, detail): 'delivered', 'retry' (worth trying again later), 'unaccepted' (the customer's
+        client did not accept the chat in time), 'failed' (won't succeed), or 'flood' (this account hit a
+        FloodWait; detail is the wait in seconds).
+        """
         try:
-            logger.info(f"🔐 SECRET CHAT RETRY: Starting encrypted delivery to user {user_id}")
-            
-            # Get user's Telegram username from database
-            from utils import get_db_connection
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("SELECT username FROM users WHERE user_id = ?", (user_id,))
-            user_data = c.fetchone()
-            conn.close()
-            
-            if not user_data or not user_data[0]:
-                return False, f"No username found for user {user_id}"
+            logger.info(f"🔐 SECRET CHAT RETRY: Starting encrypted delivery to user {user_id} via {self.phone_number}")
             
-            username = user_data[0]
-            logger.info(f"🔍 SECRET CHAT RETRY: Found username @{username} for user {user_id}")
+            account = self.phone_number
+            secret_chat_manager = self.secret_chat_manager
             
-            # Get user entity
-            try:
-                user_entity = await self.client.get_entity(username)
-                logger.info(f"✅ SECRET CHAT RETRY: Found user entity for @{username}")
-            except Exception as e:
-                logger.error(f"❌ SECRET CHAT RETRY: Error finding user @{username}: {e}")
-                return False, f"Error finding user @{username}: {e}"
+            # Cached access_hash skips the username lookup and ResolveUsername
+            user_entity = PEER_CACHE.get_input_peer(account, user_id)
+            username = None
+            if user_entity:
+                logger.info(f"♻️ SECRET CHAT RETRY: Using cached peer for user {user_id}")
+            else:
+                user_data = await USER_PROFILES.get_async(user_id)
+                if not user_data or not user_data['username']:
+                    return 'failed', f"No username found for user {user_id}"
+                
+                username = user_data['username']
+                logger.info(f"🔍 SECRET CHAT RETRY: Found username @{username} for user {user_id}")
+                
+                # Get user entity
+                try:
+                    user_entity = await self.client.get_entity(username)
+                    logger.info(f"✅ SECRET CHAT RETRY: Found user entity for @{username}")
+                except Exception as e:
+                    logger.error(f"❌ SECRET CHAT RETRY: Error finding user @{username}: {e}")
+                    wait_seconds = _flood_wait_seconds(e)
+                    if wait_seconds is not None: return 'flood', str(wait_seconds)
+                    return 'failed', f"Error finding user @{username}: {e}"
+                if user_entity.id != user_id:
+                    logger.error(f"❌ SECRET CHAT RETRY: @{username} now belongs to {user_entity.id}, not user {user_id}")
+                    return 'failed', f"Username @{username} no longer belongs to user {user_id}"
+                PEER_CACHE.remember_entity(account, user_id, user_entity.access_hash)
+            recipient = f"@{username}" if username else f"user {user_id}"
             
             # 🔐 CREATE OR REUSE SECRET CHAT (AVOID RATE LIMITS)
             try:
-                from telethon_secret_chat import SecretChatManager
-                secret_chat_manager = SecretChatManager(self.client, auto_accept=True)
-                
-                # Check if we have an existing secret chat with this user
-                existing_chats = []
-                try:
-                    # Try to get existing secret chats
-                    if hasattr(secret_chat_manager, 'get_all_secret_chats'):
-                        existing_chats = secret_chat_manager.get_all_secret_chats()
-                        logger.info(f"🔍 SECRET CHAT RETRY: Found {len(existing_chats)} existing secret chats")
-                except Exception as check_error:
-                    logger.info(f"ℹ️ SECRET CHAT RETRY: Could not check existing chats: {check_error}")
-                
-                # Try to reuse existing secret chat or create new one
-                secret_chat_id = None
-                for chat in existing_chats:
-                    try:
-                        # Check if this chat is with our target user
-                        if hasattr(chat, 'user_id') and chat.user_id == user_entity.id:
-                            secret_chat_id = chat.id
-                            logger.info(f"✅ SECRET CHAT RETRY: Reusing existing secret chat, ID: {secret_chat_id}")
-                            break
-                    except:
-                        continue
+                # Reuse the cached secret chat if its keys are still in the store
+                secret_chat_id = PEER_CACHE.get_secret_chat_id(account, user_id)
+                if secret_chat_id and not self._secret_chat_has_keys(secret_chat_id):
+                    logger.info(f"ℹ️ SECRET CHAT RETRY: Cached secret chat {secret_chat_id} has no keys, creating a new one")
+                    PEER_CACHE.forget_secret_chat(account, user_id)
+                    secret_chat_id = None
+                reused_chat = bool(secret_chat_id)
                 
                 # If no existing chat found, create new one
                 if not secret_chat_id:
-                    logger.info(f"🔐 SECRET CHAT RETRY: Creating NEW secret chat with @{username}")
+                    logger.info(f"🔐 SECRET CHAT RETRY: Creating NEW secret chat with {recipient}")
                     secret_chat_id = await secret_chat_manager.start_secret_chat(user_entity)
                     logger.info(f"✅ SECRET CHAT RETRY: NEW secret chat created, ID: {secret_chat_id}")
                 else:
                     logger.info(f"♻️ SECRET CHAT RETRY: Using EXISTING secret chat, ID: {secret_chat_id}")
                 
-                # 🔐 WAIT-AND-RETRY MESSAGE SENDING (5 attempts with increasing delays)
-                message = self._create_product_message(product_data)
-                message_sent = False
+                # 🔐 WAIT FOR THE CHAT TO BE ACCEPTED, THEN STREAM MESSAGE AND MEDIA BACK-TO-BACK
+                ready_started = time.perf_counter()
+                chat_ready = await self._wait_for_secret_chat(secret_chat_id, USERBOT_SECRET_CHAT_READY_TIMEOUT_SECONDS)
+                timings['ready_wait_s'] += time.perf_counter() - ready_started
+                if not chat_ready:
+                    logger.warning(f"⚠️ SECRET CHAT RETRY: Chat {secret_chat_id} not accepted within {USERBOT_SECRET_CHAT_READY_TIMEOUT_SECONDS:.0f}s")
+                    if reused_chat: PEER_CACHE.forget_secret_chat(account, user_id)
+                    return 'unaccepted', f"Secret chat not accepted by {recipient} within {USERBOT_SECRET_CHAT_READY_TIMEOUT_SECONDS:.0f}s"
+                logger.info(f"✅ SECRET CHAT RETRY: Chat {secret_chat_id} ready after {timings['ready_wait_s']:.2f}s")
                 
-                for attempt in range(1, 6):  # 5 attempts
+                message_sent = False
+                if skip_message:
+                    logger.info(f"⏭️ SECRET CHAT RETRY: Message already sent on an earlier attempt, sending media only")
+                    message_sent = True
+                else:
                     try:
-                        wait_time = attempt * 2  # 2, 4, 6, 8, 10 seconds
-                        logger.info(f"🔄 SECRET CHAT RETRY: Attempt {attempt}/5 - waiting {wait_time}s before sending")
-                        await asyncio.sleep(wait_time)
-                        
-                        # Try to get the secret chat object
-                        secret_chat_obj = secret_chat_manager.get_secret_chat(secret_chat_id)
-                        if secret_chat_obj:
-                            logger.info(f"🔍 SECRET CHAT RETRY: Got secret chat object: {type(secret_chat_obj)}")
-                            await secret_chat_manager.send_secret_message(secret_chat_obj, message)
-                        else:
-                            logger.info(f"🔍 SECRET CHAT RETRY: No object, trying direct ID")
-                            await secret_chat_manager.send_secret_message(secret_chat_id, message)
-                        
-                        logger.info(f"✅ SECRET CHAT RETRY: Message sent successfully on attempt {attempt}")
+                        await secret_chat_manager.send_secret_message(secret_chat_manager.get_secret_chat(secret_chat_id), message)
+                        logger.info(f"✅ SECRET CHAT RETRY: Message sent successfully")
                         message_sent = True
-                        break
-                        
                     except Exception as send_error:
-                        logger.warning(f"⚠️ SECRET CHAT RETRY: Attempt {attempt}/5 failed: {send_error}")
-                        if attempt == 5:
-                            logger.error(f"❌ SECRET CHAT RETRY: All 5 attempts failed!")
+                        logger.error(f"❌ SECRET CHAT RETRY: Message send failed: {send_error}")
+                    if message_sent and on_message_sent:
+                        try: await on_message_sent()
+                        except Exception as record_error:
+                            logger.error(f"❌ SECRET CHAT RETRY: Could not record sent message: {record_error}")
                 
                 if not message_sent:
-                    return False, "Failed to send message to secret chat after 5 attempts"
+                    if reused_chat:
+                        # Most likely closed on the customer's side; the next delivery starts a fresh one
+                        PEER_CACHE.forget_secret_chat(account, user_id)
+                    return 'retry', "Failed to send message to secret chat"
+                if not reused_chat:
+                    PEER_CACHE.remember_secret_chat(account, user_id, secret_chat_id)
                 
                 # 🔐 SEND ACTUAL MEDIA FILES TO SECRET CHAT
                 if media_files and len(media_files) > 0:
@@ -396,19 +410,16 @@ class SimpleUserbot:
                     
                     for i, media_file in enumerate(media_files):
                         media_sent = False
-                        for attempt in range(1, 4):  # 3 attempts per media file
+                        for attempt in range(1, USERBOT_MEDIA_SEND_ATTEMPTS + 1):
                             try:
-                                await asyncio.sleep(2)  # Wait between attempts
-                                
                                 file_name = os.path.basename(media_file)
                                 file_ext = os.path.splitext(media_file)[1].lower()
                                 file_size = os.path.getsize(media_file)
                                 
-                                logger.info(f"📁 SECRET CHAT RETRY: Attempt {attempt}/3 for {file_name} ({file_size:,} bytes)")
+                                logger.info(f"📁 SECRET CHAT RETRY: Attempt {attempt}/{USERBOT_MEDIA_SEND_ATTEMPTS} for {file_name} ({file_size:,} bytes)")
                                 
                                 # Get secret chat object
-                                secret_chat_obj = secret_chat_manager.get_secret_chat(secret_chat_id)
-                                target = secret_chat_obj if secret_chat_obj else secret_chat_id
+                                target = secret_chat_manager.get_secret_chat(secret_chat_id)
                                 
                                 # 🔐 TRY TO SEND ACTUAL MEDIA FILE WITH FILE PATH (PRESERVE FORMAT)
                                 if file_ext in ['.jpg', '.jpeg', '.png', '.webp']:
@@ -480,8 +491,8 @@ class SimpleUserbot:
                                 break  # Success - exit retry loop
                                 
                             except Exception as send_error:
-                                logger.warning(f"⚠️ SECRET CHAT RETRY: Attempt {attempt}/3 failed for {file_name}: {send_error}")
-                                if attempt == 3:
+                                logger.warning(f"⚠️ SECRET CHAT RETRY: Attempt {attempt}/{USERBOT_MEDIA_SEND_ATTEMPTS} failed for {file_name}: {send_error}")
+                                if attempt == USERBOT_MEDIA_SEND_ATTEMPTS:
                                     logger.error(f"❌ SECRET CHAT RETRY: All attempts failed for {file_name}")
                         
                         if not media_sent:
@@ -490,38 +501,325 @@ class SimpleUserbot:
                     logger.info(f"📂 SECRET CHAT RETRY: Finished sending ACTUAL media files")
                 
                 logger.info(f"🎉 SECRET CHAT RETRY: Delivery completed for user {user_id}")
-                return True, f"Product delivered via SECRET CHAT to @{username}"
+                return 'delivered', f"Product delivered via SECRET CHAT to {recipient}"
                 
             except Exception as secret_error:
                 logger.error(f"❌ SECRET CHAT RETRY: Failed to create secret chat: {secret_error}")
                 
-                # RATE LIMIT HANDLING: Mark current userbot as rate limited and try next one
-                if "wait" in str(secret_error).lower() and "seconds" in str(secret_error).lower():
-                    # Extract wait time from error message
-                    import re
-                    wait_match = re.search(r'wait of (\d+) seconds', str(secret_error))
-                    wait_seconds = int(wait_match.group(1)) if wait_match else 3600  # Default 1 hour
-                    
-                    logger.warning(f"⚠️ MULTI-USERBOT: Current userbot rate limited for {wait_seconds}s")
-                    self.mark_userbot_rate_limited(self.current_userbot_index, wait_seconds)
-                    
-                    # Try next available userbot
-                    next_index, next_userbot = self.get_available_userbot()
-                    if next_userbot:
-                        logger.info(f"🔄 MULTI-USERBOT: Trying next userbot {next_index+1}")
-                        await self._switch_to_userbot(next_index)
-                        
-                        # Retry delivery with new userbot
-                        return await self.send_product_to_user(user_id, product_data, media_files)
-                    else:
-                        logger.error(f"❌ MULTI-USERBOT: All userbots are rate limited!")
-                        return False, f"All userbots are rate limited. Please add more userbots or wait."
-                else:
-                    return False, f"Failed to create secret chat: {secret_error}"
+                # RATE LIMIT HANDLING: the caller rests this account and moves the delivery to another one
+                wait_seconds = _flood_wait_seconds(secret_error)
+                if wait_seconds is not None:
+                    logger.warning(f"⚠️ MULTI-USERBOT: {account} rate limited for {wait_seconds}s")
+                    return 'flood', str(wait_seconds)
+                return 'retry', f"Failed to create secret chat: {secret_error}"
             
         except Exception as e:
             logger.error(f"❌ SECRET CHAT RETRY: General error: {e}")
-            return False, f"Error in secret chat delivery: {e}"
+            return 'retry', f"Error in secret chat delivery: {e}"
+
+
+class SimpleUserbot:
+    def __init__(self):
+        self.api_id = None
+        self.api_hash = None
+        self.phone_number = None
+        self.session_string = None
+        self.has_session = False
+        
+        # Multi-userbot support
+        self.userbots = []  # List of userbot configurations (loaded by load_configuration() at startup)
+        self.accounts = [] # UserbotAccount per configuration with a session, all connected at once
+    
+    @property
+    def is_connected(self) -> bool:
+        return any(account.is_connected for account in self.accounts)
+    
+    @property
+    def client(self):
+        """Client of the first connected account (kept for callers that expect a single client)"""
+        return next((account.client for account in self.accounts if account.is_connected), None)
+    
+    @property
+    def secret_chat_manager(self):
+        return next((account.secret_chat_manager for account in self.accounts if account.is_connected), None)
+    
+    def _sync_accounts(self):
+        """Builds one UserbotAccount per configured session, keeping already-connected ones"""
+        existing = {account.phone_number: account for account in self.accounts}
+        accounts = []
+        for config in self.userbots:
+            if not config.get('session_string'): continue
+            account = existing.get(config.get('phone_number'))
+            if account and account.config.get('session_string') == config['session_string']:
+                account.config = config
+            else:
+                account = UserbotAccount(config)
+            accounts.append(account)
+        self.accounts = accounts
+    
+    def load_configuration(self) -> int:
+        """
+        Loads userbot accounts from userbot_accounts into memory, importing the legacy JSON config once.
+        Runs at startup after init_db(); afterwards every lookup is served from memory. (Synchronous)
+        """
+        try:
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                c.execute("SELECT * FROM userbot_accounts ORDER BY position, phone_number")
+                rows = c.fetchall()
+                if not rows and os.path.exists(USERBOT_LEGACY_CONFIG_FILE):
+                    legacy = self._read_legacy_configuration()
+                    c.executemany(_UPSERT_ACCOUNT_SQL, [_account_row(config, i) for i, config in enumerate(legacy) if config.get('phone_number')])
+                    conn.commit()
+                    os.replace(USERBOT_LEGACY_CONFIG_FILE, USERBOT_LEGACY_CONFIG_FILE + '.migrated')
+                    logger.info(f"✅ MULTI-USERBOT: Imported {len(legacy)} userbot(s) from {USERBOT_LEGACY_CONFIG_FILE}")
+                    c.execute("SELECT * FROM userbot_accounts ORDER BY position, phone_number")
+                    rows = c.fetchall()
+        except (sqlite3.Error, OSError, ValueError) as e:
+            logger.error(f"❌ SIMPLE: Error loading configuration: {e}")
+            return 0
+        
+        self.userbots = [{column: row[column] for column in _ACCOUNT_COLUMNS} for row in rows]
+        if self.userbots:
+            # Set primary userbot as current
+            primary = self.userbots[0]
+            self.api_id = primary.get('api_id')
+            self.api_hash = primary.get('api_hash')
+            self.phone_number = primary.get('phone_number')
+            self.session_string = primary.get('session_string')
+            self.has_session = bool(self.session_string)
+            logger.info(f"✅ MULTI-USERBOT: Loaded {len(self.userbots)} userbot configurations, primary: {self.phone_number}")
+        else:
+            logger.info(f"ℹ️ SIMPLE: No userbot configured")
+        self._sync_accounts()
+        return len(self.userbots)
+    
+    @staticmethod
+    def _read_legacy_configuration() -> list:
+        """Reads /mnt/data/userbot_config.json (multi-userbot or legacy single-userbot format)"""
+        with open(USERBOT_LEGACY_CONFIG_FILE, 'r') as f:
+            config = json.load(f)
+        if 'userbots' in config:
+            return config['userbots']
+        return [{
+            'api_id': config.get('api_id'),
+            'api_hash': config.get('api_hash'),
+            'phone_number': config.get('phone_number'),
+            'session_string': config.get('session_string'),
+            'rate_limited_until': 0
+        }]
+    
+    def _save_account(self, config: dict):
+        """Persists an account's credentials and state through the DB writer (never blocks the event loop)"""
+        position = next((i for i, c in enumerate(self.userbots) if c is config), len(self.userbots))
+        enqueue_db_write(_UPSERT_ACCOUNT_SQL, _account_row(config, position))
+    
+    def _save_account_state(self, config: dict):
+        """Persists rotation state only: rate-limit deadline, health and last use"""
+        enqueue_db_write("""UPDATE userbot_accounts SET rate_limited_until = ?, consecutive_failures = ?, last_used = ?, updated_at = ?
+                            WHERE phone_number = ?""",
+                         (config.get('rate_limited_until', 0), config.get('consecutive_failures', 0), config.get('last_used', 0),
+                          time.time(), config.get('phone_number')))
+    
+    def add_userbot(self, api_id: int, api_hash: str, phone_number: str, session_string: str = None):
+        """Add a new userbot to the rotation"""
+        new_userbot = {
+            'api_id': api_id,
+            'api_hash': api_hash,
+            'phone_number': phone_number,
+            'session_string': session_string,
+            'rate_limited_until': 0
+        }
+        
+        self.userbots.append(new_userbot)
+        self._save_account(new_userbot)
+        self._sync_accounts()
+        logger.info(f"✅ MULTI-USERBOT: Added userbot {phone_number} (Total: {len(self.userbots)})")
+        return True, f"Userbot {phone_number} added successfully"
+    
+    def mark_userbot_rate_limited(self, userbot_index: int, wait_seconds: int):
+        """Mark a userbot as rate limited"""
+        if userbot_index < len(self.userbots):
+            self.userbots[userbot_index]['rate_limited_until'] = time.time() + wait_seconds
+            self._save_account_state(self.userbots[userbot_index])
+            logger.warning(f"⚠️ MULTI-USERBOT: Marked userbot {userbot_index+1} as rate limited for {wait_seconds}s")
+    
+    def _mark_account_rate_limited(self, account: UserbotAccount, wait_seconds: int):
+        index = next((i for i, config in enumerate(self.userbots) if config is account.config), None)
+        if index is not None: self.mark_userbot_rate_limited(index, wait_seconds)
+        else: account.config['rate_limited_until'] = time.time() + wait_seconds
+    
+    def set_credentials(self, api_id: int, api_hash: str, phone_number: str, session_string: str = None):
+        """Set userbot credentials (adds the account to the rotation, or updates it if already present)"""
+        self.api_id = api_id
+        self.api_hash = api_hash
+        self.phone_number = phone_number
+        if session_string:
+            self.session_string = session_string
+            self.has_session = True
+        
+        config = next((c for c in self.userbots if c.get('phone_number') == phone_number), None)
+        if config is None:
+            config = {'rate_limited_until': 0}
+            self.userbots.append(config)
+        config.update(api_id=api_id, api_hash=api_hash, phone_number=phone_number)
+        if session_string: config['session_string'] = session_string
+        
+        self._save_account(config)
+        self._sync_accounts()
+        logger.info(f"✅ SIMPLE: Credentials set for {phone_number}")
+    
+    def is_configured(self) -> bool:
+        """Check if userbot is configured"""
+        return bool(self.api_id and self.api_hash and self.phone_number)
+    
+    async def connect(self) -> Tuple[bool, str]:
+        """Connect every configured userbot account that is not connected yet"""
+        if not self.is_configured():
+            return False, "Userbot not configured"
+        
+        if not self.has_session:
+            return False, "No session available"
+        
+        self._sync_accounts()
+        pending = [account for account in self.accounts if not account.is_connected]
+        if pending:
+            results = await asyncio.gather(*(account.connect() for account in pending))
+            for success, message in results:
+                if not success: logger.warning(f"⚠️ MULTI-USERBOT: {message}")
+        
+        connected = [account for account in self.accounts if account.is_connected]
+        if not connected:
+            return False, "; ".join(message for _, message in results) if pending else "No userbot accounts with a session"
+        success_msg = f"{len(connected)}/{len(self.accounts)} userbot account(s) connected"
+        logger.info(f"✅ MULTI-USERBOT: {success_msg}")
+        return True, success_msg
+    
+    async def disconnect(self):
+        """Disconnect all userbot accounts"""
+        await asyncio.gather(*(account.disconnect() for account in self.accounts if account.client))
+        logger.info(f"✅ SIMPLE: Disconnected")
+    
+    def get_status(self) -> str:
+        """Get userbot status"""
+        if not self.is_configured():
+            return "❌ Not configured"
+        elif not self.has_session:
+            return "⚠️ No session - needs authentication"
+        elif self.is_connected:
+            connected = sum(1 for account in self.accounts if account.is_connected)
+            return f"✅ Connected and ready ({connected}/{len(self.accounts)} accounts)"
+        else:
+            return "⚠️ Configured but not connected"
+    
+    def clear_configuration(self):
+        """Clear userbot configuration and session"""
+        try:
+            enqueue_db_write("DELETE FROM userbot_accounts")
+            if os.path.exists(USERBOT_LEGACY_CONFIG_FILE):
+                os.remove(USERBOT_LEGACY_CONFIG_FILE)
+                logger.info("✅ SIMPLE: Configuration file deleted")
+            
+            # Reset all properties
+            self.api_id = None
+            self.api_hash = None
+            self.phone_number = None
+            self.session_string = None
+            self.has_session = False
+            self.userbots = []
+            
+            # Disconnect if connected
+            for account in self.accounts:
+                if account.client:
+                    try:
+                        asyncio.create_task(account.disconnect())
+                    except:
+                        pass
+            self.accounts = []
+            
+            logger.info("✅ SIMPLE: Configuration cleared")
+            return True, "Configuration cleared successfully"
+            
+        except Exception as e:
+            logger.error(f"❌ SIMPLE: Error clearing configuration: {e}")
+            return False, f"Error clearing configuration: {e}"
+    
+    def _create_product_message(self, product_data: dict) -> str:
+        """Create product message"""
+        message = f"""🔐 **DIRECT SECURE DELIVERY** 🔐
+
+📦 **Product**: {product_data['product_name']}
+🏙️ **City**: {product_data['city'].title()}
+🏘️ **District**: {product_data['district'].title()}
+📏 **Size**: {product_data['size']}
+💰 **Price**: {product_data['price']} EUR
+
+✅ **Payment confirmed - product ready for pickup!**
+
+🚀 **This message was delivered directly via secure userbot - no bot chat delivery!**"""
+        return message
+    
+    def available_slots(self) -> int:
+        """Deliveries that can start right now across all healthy accounts"""
+        now = time.time()
+        return sum(account.free_slots(now) for account in self.accounts)
+    
+    def _pick_account(self, user_id: int, exclude: set) -> UserbotAccount | None:
+        """Least-loaded account with budget left; one that already has a secret chat with the customer wins"""
+        now = time.time()
+        candidates = [account for account in self.accounts if account not in exclude and account.free_slots(now) > 0]
+        if not candidates: return None
+        return min(candidates, key=lambda account: (PEER_CACHE.get_secret_chat_id(account.phone_number, user_id) is None,
+                                                    account.in_flight, -account.budget_left(now), account.last_used))
+    
+    async def deliver(self, user_id: int, product_data: dict, media_files: List[str] = None, timings: dict = None,
+                      skip_message: bool = False, on_message_sent=None) -> Tuple[str, str]:
+        """
+        🔐 MULTI-USERBOT SECRET CHAT - Runs one delivery on the best available account, moving to the next
+        account on FloodWait. Returns (status, message) with status 'delivered', 'retry', 'failed', or 'busy'
+        (no account can take it right now; nothing was attempted). skip_message/on_message_sent are passed
+        through to UserbotAccount.deliver.
+        """
+        timings = timings if timings is not None else {'ready_wait_s': 0.0}
+        message = self._create_product_message(product_data)
+        tried = set()
+        while True:
+            account = self._pick_account(user_id, tried)
+            if not account:
+                if not self.is_connected: return 'busy', "No userbot account connected"
+                logger.warning(f"⚠️ MULTI-USERBOT: No account has delivery budget left ({len(self.accounts)} configured)")
+                return 'busy', "All userbots are busy or rate limited"
+            tried.add(account)
+            account.reserve(time.time())
+            try:
+                status, detail = await account.deliver(user_id, message, media_files or [], timings, skip_message, on_message_sent)
+            finally:
+                account.in_flight -= 1
+            
+            if status == 'flood':
+                self._mark_account_rate_limited(account, int(detail))
+                logger.info(f"🔄 MULTI-USERBOT: Moving delivery for user {user_id} off {account.phone_number}")
+                continue
+            if status == 'unaccepted':
+                return 'retry', detail # Customer-side; not held against the account
+            if status == 'delivered':
+                account.consecutive_failures = 0
+            elif status == 'retry':
+                account.consecutive_failures += 1
+                if account.consecutive_failures >= USERBOT_ACCOUNT_MAX_FAILURES:
+                    logger.warning(f"⚠️ MULTI-USERBOT: {account.phone_number} failed {account.consecutive_failures} deliveries in a row, resting it")
+                    account.consecutive_failures = 0
+                    self._mark_account_rate_limited(account, USERBOT_ACCOUNT_COOLDOWN_SECONDS)
+            self._save_account_state(account.config)
+            return status, detail
+    
+    async def send_product_to_user(self, user_id: int, product_data: dict, media_files: List[str] = None) -> Tuple[bool, str]:
+        """🔐 MULTI-USERBOT SECRET CHAT - Automatic rotation to avoid rate limits. Records per-order latency."""
+        started = time.perf_counter()
+        timings = {'ready_wait_s': 0.0}
+        status, message = await self.deliver(user_id, product_data, media_files, timings)
+        record_delivery(user_id, status == 'delivered', time.perf_counter() - started, timings['ready_wait_s'], len(media_files or []))
+        return status == 'delivered', message
     
     async def handle_secret_chat_confirmation(self, user_id: int, message_text: str) -> bool:
         """Handle confirmation message from secret chat"""
@@ -530,11 +828,7 @@ class SimpleUserbot:
                 logger.info(f"🎯 SECRET CHAT CONFIRMATION: Processing for user {user_id}")
                 
                 # Get pending delivery from database
-                from utils import get_db_connection
-                conn = get_db_connection()
-                c = conn.cursor()
-                c.execute("SELECT * FROM pending_deliveries WHERE user_id = ?", (user_id,))
-                delivery_data = c.fetchone()
+                delivery_data = await db_fetchone("SELECT * FROM pending_deliveries WHERE user_id = ?", (user_id,))
                 
                 if not delivery_data:
                     logger.warning(f"⚠️ SECRET CHAT CONFIRMATION: No pending delivery for user {user_id}")
@@ -550,8 +844,7 @@ class SimpleUserbot:
                 message = self._create_product_message(product_data)
                 
                 # Send product details and media to secret chat
-                from telethon_secret_chat import SecretChatManager
-                secret_chat_manager = SecretChatManager(self.client, auto_accept=True)
+                secret_chat_manager = self.secret_chat_manager
                 
                 # Send product message
                 await secret_chat_manager.send_secret_message(secret_chat_id, message)
@@ -576,9 +869,7 @@ class SimpleUserbot:
                             logger.error(f"❌ SECRET CHAT CONFIRMATION: Failed to send media {i+1}: {media_error}")
                 
                 # Remove from pending deliveries
-                c.execute("DELETE FROM pending_deliveries WHERE user_id = ?", (user_id,))
-                conn.commit()
-                conn.close()
+                await db_execute("DELETE FROM pending_deliveries WHERE user_id = ?", (user_id,))
                 
                 logger.info(f"🎉 SECRET CHAT CONFIRMATION: Delivery completed for user {user_id}")
                 return True
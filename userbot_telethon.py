@@ -224,12 +224,8 @@ class TelethonSecretUserbot:
             logger.info(f"🔐 SECRET CHAT: Starting encrypted delivery to user {user_id}")
             
             # Get user information from database
-            from utils import get_db_connection
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("SELECT username FROM users WHERE user_id = ?", (user_id,))
-            user_data = c.fetchone()
-            conn.close()
+            from utils import db_fetchone
+            user_data = await db_fetchone("SELECT username FROM users WHERE user_id = ?", (user_id,))
             
             if not user_data or not user_data[0]:
                 return False, f"No username found for user {user_id}"
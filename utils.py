@@ -6,13 +6,21 @@ import json
 import shutil
 import tempfile
 import asyncio
+import functools
+import hashlib
+import heapq
+import itertools
+import queue
+import contextlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from decimal import Decimal, ROUND_DOWN, ROUND_UP
 import requests
-from collections import Counter, defaultdict # Moved higher up
+from collections import Counter, defaultdict, OrderedDict # Moved higher up
 
 # --- Telegram Imports ---
-from telegram import Update, Bot
+from telegram import Update, Bot, InputMediaPhoto, InputMediaVideo, InputMediaAnimation
 from telegram.constants import ParseMode
 import telegram.error as telegram_error
 from telegram.ext import ContextTypes
@@ -1060,29 +1068,441 @@ currency_price_cache = {}
 min_amount_cache = {}
 CACHE_EXPIRY_SECONDS = 900
 
+# --- Database Connection Pool ---
+DB_POOL_SIZE_STR = os.environ.get("DB_POOL_SIZE", "8")
+DB_POOL_TIMEOUT_STR = os.environ.get("DB_POOL_TIMEOUT_SECONDS", "5")
+try:
+    DB_POOL_SIZE = max(1, int(DB_POOL_SIZE_STR))
+except ValueError:
+    logger.warning(f"Invalid DB_POOL_SIZE '{DB_POOL_SIZE_STR}', using default 8.")
+    DB_POOL_SIZE = 8
+try:
+    DB_POOL_TIMEOUT_SECONDS = max(0.1, float(DB_POOL_TIMEOUT_STR))
+except ValueError:
+    logger.warning(f"Invalid DB_POOL_TIMEOUT_SECONDS '{DB_POOL_TIMEOUT_STR}', using default 5.")
+    DB_POOL_TIMEOUT_SECONDS = 5.0
+DB_POOL_HEALTH_CHECK_SECONDS = 60 # Idle connections older than this are pinged before reuse
+
+# Per-connection tuning. journal_mode=WAL is persistent and is set once in init_db().
+SQLITE_BUSY_TIMEOUT_MS = 10000
+SQLITE_CONNECTION_PRAGMAS = (
+    "PRAGMA foreign_keys = ON;",
+    f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS};",
+    "PRAGMA synchronous = NORMAL;", # Durable across app crashes in WAL mode; fewer fsyncs than FULL
+    "PRAGMA cache_size = -16000;", # ~16 MB page cache per connection
+    "PRAGMA mmap_size = 268435456;", # 256 MB memory-mapped reads
+    "PRAGMA temp_store = MEMORY;",
+)
+
+
+class PooledConnection:
+    """Wraps a pooled sqlite3 connection. close() returns it to the pool instead of closing it."""
+    __slots__ = ("_pool", "_conn", "_overflow")
+
+    def __init__(self, pool, conn, overflow=False):
+        object.__setattr__(self, "_pool", pool)
+        object.__setattr__(self, "_conn", conn)
+        object.__setattr__(self, "_overflow", overflow)
+
+    def _raw(self):
+        conn = object.__getattribute__(self, "_conn")
+        if conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return conn
+
+    def __getattr__(self, name):
+        return getattr(self._raw(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._raw(), name, value)
+
+    def close(self):
+        conn = object.__getattribute__(self, "_conn")
+        if conn is None: return
+        object.__setattr__(self, "_conn", None)
+        self._pool._release(conn, self._overflow)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Same commit/rollback semantics as sqlite3.Connection, then hand the connection back
+        try:
+            self._raw().__exit__(exc_type, exc, tb)
+        finally:
+            self.close()
+        return False
+
+    def __del__(self):
+        # Safety net for callers that never close(); CPython refcounting makes this prompt
+        try: self.close()
+        except Exception: pass
+
+
+class SQLiteConnectionPool:
+    """Bounded pool of pre-configured sqlite3 connections with per-thread reuse and health checks."""
+
+    def __init__(self, db_path: str, max_size: int, timeout: float):
+        self.db_path = db_path
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = [] # [(conn, last_used_monotonic)]
+        self._open_count = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._dir_checked = False
+        self._closed = False
+        self._stats = {
+            'checkouts': 0, 'thread_reuses': 0, 'created': 0, 'discarded': 0,
+            'overflow': 0, 'waits': 0, 'wait_time_total': 0.0, 'wait_time_max': 0.0,
+        }
+
+    def _create_connection(self):
+        """Opens and configures a new connection (setup cost paid once per pooled connection)."""
+        if not self._dir_checked:
+            db_dir = os.path.dirname(self.db_path)
+            if db_dir:
+                try: os.makedirs(db_dir, exist_ok=True)
+                except OSError as e: logger.warning(f"Could not create DB dir {db_dir}: {e}")
+            self._dir_checked = True
+        conn = sqlite3.connect(self.db_path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+        for pragma in SQLITE_CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        conn.row_factory = sqlite3.Row
+        with self._cond: self._stats['created'] += 1
+        return conn
+
+    def _is_healthy(self, conn) -> bool:
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error as e:
+            logger.warning(f"Discarding unhealthy pooled DB connection: {e}")
+            return False
+
+    def _discard(self, conn):
+        try: conn.close()
+        except Exception: pass
+        with self._cond:
+            self._open_count -= 1
+            self._stats['discarded'] += 1
+            self._cond.notify()
+
+    def acquire(self) -> PooledConnection:
+        """Checks out a connection, preferring the one this thread used last."""
+        conn, last_used, overflow = None, 0.0, False
+        with self._cond:
+            self._stats['checkouts'] += 1
+            preferred = getattr(self._local, 'conn', None)
+            if preferred is not None:
+                for i, (idle_conn, idle_ts) in enumerate(self._idle):
+                    if idle_conn is preferred:
+                        conn, last_used = self._idle.pop(i)
+                        self._stats['thread_reuses'] += 1
+                        break
+            if conn is None and self._idle:
+                conn, last_used = self._idle.pop()
+            if conn is None and self._open_count < self.max_size:
+                self._open_count += 1
+                last_used = None # Needs creating outside the lock
+            elif conn is None:
+                self._stats['waits'] += 1
+                wait_start = time.monotonic()
+                deadline = wait_start + self.timeout
+                while not self._idle and self._open_count >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0: break
+                    self._cond.wait(remaining)
+                waited = time.monotonic() - wait_start
+                self._stats['wait_time_total'] += waited
+                self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                elif self._open_count < self.max_size:
+                    self._open_count += 1
+                    last_used = None
+                else:
+                    # Pool exhausted (e.g. nested checkouts) - hand out a one-off connection rather than deadlock
+                    overflow = True
+                    self._stats['overflow'] += 1
+                    last_used = None
+                    logger.warning(f"DB pool exhausted after {waited:.2f}s wait (size {self.max_size}). Using overflow connection.")
+
+        try:
+            if last_used is None:
+                conn = self._create_connection()
+            elif time.monotonic() - last_used > DB_POOL_HEALTH_CHECK_SECONDS and not self._is_healthy(conn):
+                # Replace in the same pool slot
+                try: conn.close()
+                except Exception: pass
+                with self._cond: self._stats['discarded'] += 1
+                conn = self._create_connection()
+        except sqlite3.Error:
+            if not overflow:
+                with self._cond:
+                    self._open_count -= 1
+                    self._cond.notify()
+            raise
+
+        if not overflow: self._local.conn = conn
+        return PooledConnection(self, conn, overflow)
+
+    def _release(self, conn, overflow: bool):
+        """Returns a connection to the idle list, rolling back anything left uncommitted."""
+        try:
+            if conn.in_transaction: conn.rollback()
+            conn.row_factory = sqlite3.Row
+        except sqlite3.Error as e:
+            logger.warning(f"Error resetting pooled DB connection, discarding it: {e}")
+            if overflow:
+                try: conn.close()
+                except Exception: pass
+            else:
+                self._discard(conn)
+            return
+        if overflow or self._closed:
+            try: conn.close()
+            except Exception: pass
+            if not overflow:
+                with self._cond: self._open_count -= 1
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def stats(self) -> dict:
+        """Returns a snapshot of pool metrics."""
+        with self._cond:
+            snapshot = dict(self._stats)
+            snapshot['size'] = self._open_count
+            snapshot['idle'] = len(self._idle)
+            snapshot['in_use'] = self._open_count - len(self._idle)
+            snapshot['max_size'] = self.max_size
+        checkouts = snapshot['checkouts'] or 1
+        snapshot['avg_wait_ms'] = round(snapshot['wait_time_total'] * 1000 / checkouts, 3)
+        return snapshot
+
+    def close_all(self):
+        """Closes idle connections; connections still checked out are closed when released."""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._open_count -= len(idle)
+        for conn, _ in idle:
+            try: conn.close()
+            except Exception: pass
+
+
+_db_pool = SQLiteConnectionPool(DATABASE_PATH, DB_POOL_SIZE, DB_POOL_TIMEOUT_SECONDS)
+
 # --- Database Connection Helper ---
 def get_db_connection():
-    """Returns a connection to the SQLite database using the configured path."""
+    """Returns a pooled connection to the SQLite database. Call close() (or use `with`) to return it."""
     try:
-        db_dir = os.path.dirname(DATABASE_PATH)
-        if db_dir:
-            try: os.makedirs(db_dir, exist_ok=True)
-            except OSError as e: logger.warning(f"Could not create DB dir {db_dir}: {e}")
-        conn = sqlite3.connect(DATABASE_PATH, timeout=10)
-        conn.execute("PRAGMA foreign_keys = ON;")
-        conn.row_factory = sqlite3.Row
-        return conn
+        return _db_pool.acquire()
     except sqlite3.Error as e:
         logger.critical(f"CRITICAL ERROR connecting to database at {DATABASE_PATH}: {e}")
         raise SystemExit(f"Failed to connect to database: {e}")
 
+@contextlib.contextmanager
+def db_connection():
+    """Context manager yielding a pooled connection; returned to the pool on exit (no implicit commit)."""
+    conn = get_db_connection()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def get_db_pool_stats() -> dict:
+    """Returns DB pool metrics (checkouts, waits, wait time, size, overflow)."""
+    return _db_pool.stats()
+
+def close_db_pool():
+    """Closes pooled connections on shutdown and logs final pool metrics."""
+    logger.info(f"DB pool stats at shutdown: {_db_pool.stats()}")
+    _db_pool.close_all()
+
+
+# --- Serialized Writer Queue ---
+DB_WRITE_BATCH_MAX = 200 # Max queued writes per group commit
+DB_WRITE_BATCH_DELAY_SECONDS = 0.05 # How long the writer waits to gather a batch
+
+
+class DBWriteQueue:
+    """Single writer thread that group-commits small fire-and-forget writes (status/last_active updates)."""
+
+    def __init__(self, max_batch: int, max_delay: float):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {'submitted': 0, 'written': 0, 'failed': 0, 'batches': 0}
+
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive(): return
+        with self._lock:
+            if self._thread and self._thread.is_alive(): return
+            self._thread = threading.Thread(target=self._run, name="shopdb-writer", daemon=True)
+            self._thread.start()
+
+    def submit(self, item):
+        """Queues a write: either (sql, params) or a callable taking a cursor."""
+        self._ensure_started()
+        self._stats['submitted'] += 1
+        self._queue.put(item)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None: return
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            stop_after = False
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: break
+                try: nxt = self._queue.get(timeout=remaining)
+                except queue.Empty: break
+                if nxt is None: stop_after = True; break
+                batch.append(nxt)
+            self._write_batch(batch)
+            if stop_after: return
+
+    def _write_batch(self, batch: list):
+        conn = None
+        written = 0
+        try:
+            conn = get_db_connection()
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            for item in batch:
+                # A callable may run several statements: its own SAVEPOINT undoes all of them if it fails
+                if callable(item): c.execute("SAVEPOINT queued_write")
+                try:
+                    if callable(item):
+                        item(c)
+                        c.execute("RELEASE SAVEPOINT queued_write")
+                    else: c.execute(item[0], item[1])
+                    written += 1
+                except Exception as e:
+                    # A failed statement is rolled back on its own; the rest of the batch still commits
+                    if callable(item): c.execute("ROLLBACK TO SAVEPOINT queued_write"); c.execute("RELEASE SAVEPOINT queued_write")
+                    self._stats['failed'] += 1
+                    logger.error(f"DB writer: queued write failed: {e}")
+            conn.commit()
+            self._stats['written'] += written
+            self._stats['batches'] += 1
+            if len(batch) > 1: logger.debug(f"DB writer: group-committed {written}/{len(batch)} writes.")
+        except sqlite3.Error as e:
+            self._stats['failed'] += len(batch) - written
+            logger.error(f"DB writer: batch of {len(batch)} writes failed: {e}", exc_info=True)
+            if conn and conn.in_transaction: conn.rollback()
+        except Exception as e:
+            logger.error(f"DB writer: unexpected error writing batch: {e}", exc_info=True)
+            if conn and conn.in_transaction: conn.rollback()
+        finally:
+            if conn: conn.close()
+
+    def stop(self, timeout: float = 10.0):
+        """Flushes pending writes and stops the writer thread."""
+        if not self._thread or not self._thread.is_alive(): return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        logger.info(f"DB writer stopped. Stats: {self._stats}")
+
+
+_db_write_queue = DBWriteQueue(DB_WRITE_BATCH_MAX, DB_WRITE_BATCH_DELAY_SECONDS)
+
+def enqueue_db_write(sql_or_callable, params: tuple = ()):
+    """Queues a small write for the serialized writer (group commit). Does not block or return a result."""
+    if callable(sql_or_callable): _db_write_queue.submit(sql_or_callable)
+    else: _db_write_queue.submit((sql_or_callable, params))
+
+def stop_db_writer():
+    """Flushes the writer queue on shutdown."""
+    _db_write_queue.stop()
+
+
+# --- Async Database Facade ---
+# All blocking sqlite3 work from async handlers goes through this dedicated executor,
+# so the PTB event loop only awaits results and never runs SQLite itself.
+DB_EXECUTOR_WORKERS_STR = os.environ.get("DB_EXECUTOR_WORKERS", "4")
+try:
+    DB_EXECUTOR_WORKERS = max(1, int(DB_EXECUTOR_WORKERS_STR))
+except ValueError:
+    logger.warning(f"Invalid DB_EXECUTOR_WORKERS '{DB_EXECUTOR_WORKERS_STR}', using default 4.")
+    DB_EXECUTOR_WORKERS = 4
+
+_db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="shopdb")
+
+async def run_db(func, *args, **kwargs):
+    """Runs a synchronous DB function on the DB executor and awaits its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+
+def _db_query_sync(sql: str, params: tuple, fetch: str):
+    """Executes a single statement on its own connection (Synchronous, runs on DB executor)."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute(sql, params)
+        if fetch == "all":
+            return c.fetchall()
+        if fetch == "one":
+            return c.fetchone()
+        conn.commit()
+        return c.rowcount
+    finally:
+        if conn: conn.close()
+
+async def db_fetchall(sql: str, params: tuple = ()) -> list:
+    """Runs a SELECT on the DB executor and returns all rows."""
+    return await run_db(_db_query_sync, sql, params, "all")
+
+async def db_fetchone(sql: str, params: tuple = ()):
+    """Runs a SELECT on the DB executor and returns the first row (or None)."""
+    return await run_db(_db_query_sync, sql, params, "one")
+
+async def db_execute(sql: str, params: tuple = ()) -> int:
+    """Runs a single write statement on the DB executor, commits, and returns rowcount."""
+    return await run_db(_db_query_sync, sql, params, "write")
+
+def shutdown_db_executor():
+    """Stops the DB executor, waiting for in-flight queries to finish."""
+    _db_executor.shutdown(wait=True)
+    logger.info("DB executor shut down.")
+
 
 # --- Database Initialization ---
+def _migrate_legacy_baskets(c):
+    """Moves "product_id:timestamp" entries from users.basket into basket_items, then empties the column."""
+    c.execute("SELECT user_id, basket FROM users WHERE basket IS NOT NULL AND basket != ''")
+    legacy_rows = c.fetchall()
+    if not legacy_rows: return
+    items_to_insert = []
+    for row in legacy_rows:
+        for item_str in row['basket'].split(','):
+            if not item_str: continue
+            try:
+                prod_id_str, ts_str = item_str.split(':'); reserved_at = float(ts_str)
+                items_to_insert.append((row['user_id'], int(prod_id_str), reserved_at, reserved_at + BASKET_TIMEOUT))
+            except (ValueError, IndexError) as e:
+                logger.warning(f"Skipping malformed legacy basket item '{item_str}' for user {row['user_id']}: {e}")
+    c.executemany("INSERT INTO basket_items (user_id, product_id, reserved_at, expires_at) VALUES (?, ?, ?, ?)", items_to_insert)
+    c.execute("UPDATE users SET basket = '' WHERE basket IS NOT NULL AND basket != ''")
+    logger.info(f"Migrated {len(items_to_insert)} legacy basket items for {len(legacy_rows)} users into basket_items.")
+
 def init_db():
     """Initializes the database schema."""
     try:
         with get_db_connection() as conn:
             c = conn.cursor()
+            # --- WAL mode (persistent in the DB file): readers no longer wait on writers ---
+            journal_mode = c.execute("PRAGMA journal_mode = WAL;").fetchone()[0]
+            if str(journal_mode).lower() != 'wal':
+                logger.warning(f"Could not enable WAL mode on {DATABASE_PATH}, journal_mode is '{journal_mode}'.")
             # --- users table ---
             c.execute('''CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY, username TEXT, balance REAL DEFAULT 0.0,
@@ -1155,6 +1575,9 @@ def init_db():
                 media_type TEXT NOT NULL, file_path TEXT NOT NULL, telegram_file_id TEXT,
                 FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
             )''')
+            # sha256 of the stored blob; rows sharing a hash share one file (NULL for legacy per-product copies)
+            try: c.execute("ALTER TABLE product_media ADD COLUMN content_hash TEXT")
+            except sqlite3.OperationalError: pass # Ignore if already exists
             # purchases table
             c.execute('''CREATE TABLE IF NOT EXISTS purchases (
                 id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, product_id INTEGER,
@@ -1314,8 +1737,138 @@ def init_db():
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )""")
             
+            # Broadcast jobs: audience + keyset cursor so an interrupted broadcast resumes where it stopped
+            c.execute("""CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_chat_id INTEGER NOT NULL,
+                target_type TEXT NOT NULL,
+                target_value TEXT,
+                text TEXT,
+                media_file_id TEXT,
+                media_type TEXT,
+                status TEXT NOT NULL DEFAULT 'running',
+                last_user_id INTEGER NOT NULL DEFAULT 0,
+                total_users INTEGER DEFAULT 0,
+                success_count INTEGER DEFAULT 0,
+                fail_count INTEGER DEFAULT 0,
+                block_count INTEGER DEFAULT 0,
+                status_message_id INTEGER,
+                created_at TEXT NOT NULL,
+                updated_at TEXT,
+                finished_at TEXT
+            )""")
+
+            # Basket items: one row per reserved product (replaces the legacy users.basket CSV string)
+            c.execute("""CREATE TABLE IF NOT EXISTS basket_items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                product_id INTEGER NOT NULL,
+                reserved_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )""")
+            _migrate_legacy_baskets(c)
+
+            # Reserved-but-unpaid checkout items (one row per item), released after ABANDONED_RESERVATION_TIMEOUT_SECONDS
+            c.execute("""CREATE TABLE IF NOT EXISTS reservation_tracking (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                product_id INTEGER NOT NULL,
+                reservation_type TEXT NOT NULL,
+                reserved_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )""")
+
+            # Telegram file_ids of uploaded media, keyed by content hash (file_ids are only valid for the bot that got them)
+            c.execute("""CREATE TABLE IF NOT EXISTS media_file_ids (
+                content_hash TEXT NOT NULL,
+                bot_id TEXT NOT NULL,
+                media_type TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (content_hash, bot_id, media_type)
+            )""")
+
+            # Purchased products waiting for row/media deletion by the cleanup worker
+            c.execute("""CREATE TABLE IF NOT EXISTS product_cleanup_queue (
+                product_id INTEGER PRIMARY KEY,
+                enqueued_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT
+            )""")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_product_cleanup_queue_next ON product_cleanup_queue(next_attempt_at)")
+
+            # Per-userbot-account customer peers: access_hash (skips username resolution) and the secret chat to reuse
+            c.execute("""CREATE TABLE IF NOT EXISTS userbot_peer_cache (
+                account TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                access_hash INTEGER,
+                entity_expires_at REAL,
+                secret_chat_id INTEGER,
+                secret_chat_expires_at REAL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (account, user_id)
+            )""")
+
+            # Pickled context.user_data per user, written incrementally by conversation_store.py
+            c.execute("""CREATE TABLE IF NOT EXISTS user_conversation_state (
+                user_id INTEGER PRIMARY KEY,
+                data BLOB NOT NULL,
+                updated_at REAL NOT NULL
+            )""")
+
+            # Userbot accounts and their rotation state (rate-limit deadline, health, last use); cached in memory by SimpleUserbot
+            c.execute("""CREATE TABLE IF NOT EXISTS userbot_accounts (
+                phone_number TEXT PRIMARY KEY,
+                api_id INTEGER,
+                api_hash TEXT,
+                session_string TEXT,
+                rate_limited_until REAL NOT NULL DEFAULT 0,
+                consecutive_failures INTEGER NOT NULL DEFAULT 0,
+                last_used REAL NOT NULL DEFAULT 0,
+                position INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL
+            )""")
+
+            # Secret chat deliveries waiting for (or being run by) a userbot account; see delivery_queue.py
+            c.execute("""CREATE TABLE IF NOT EXISTS userbot_delivery_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER,
+                product_data TEXT NOT NULL,
+                media_files TEXT NOT NULL,
+                product_ids TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                finished_at REAL,
+                last_error TEXT,
+                message_sent_at REAL
+            )""")
+            # Set once the product message reached the customer, so a retried job only sends the media
+            try: c.execute("ALTER TABLE userbot_delivery_jobs ADD COLUMN message_sent_at REAL")
+            except sqlite3.OperationalError: pass # Ignore if already exists
+            c.execute("CREATE INDEX IF NOT EXISTS idx_userbot_delivery_jobs_due ON userbot_delivery_jobs(status, next_attempt_at)")
+
+            # NOWPayments IPN inbox: one row per (payment_id, payment_status), processed by async consumers
+            c.execute("""CREATE TABLE IF NOT EXISTS payment_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payment_id TEXT NOT NULL,
+                payment_status TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                result TEXT,
+                received_at TEXT NOT NULL,
+                processed_at TEXT,
+                UNIQUE (payment_id, payment_status)
+            )""")
+
             # Create Indices
             c.execute("CREATE INDEX IF NOT EXISTS idx_product_media_product_id ON product_media(product_id)")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_product_media_content_hash ON product_media(content_hash)")
             c.execute("CREATE INDEX IF NOT EXISTS idx_purchases_date ON purchases(purchase_date)")
             c.execute("CREATE INDEX IF NOT EXISTS idx_pending_deliveries_created ON pending_deliveries(created_at)")
             c.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user ON purchases(user_id)")
@@ -1326,6 +1879,12 @@ def init_db():
             c.execute("CREATE INDEX IF NOT EXISTS idx_pending_deposits_user_id ON pending_deposits(user_id)")
             c.execute("CREATE INDEX IF NOT EXISTS idx_admin_log_timestamp ON admin_log(timestamp)")
             c.execute("CREATE INDEX IF NOT EXISTS idx_users_banned ON users(is_banned)")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status)")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_payment_events_status ON payment_events(status)")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_basket_items_user ON basket_items(user_id)")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_basket_items_expires ON basket_items(expires_at)")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_reservation_tracking_user ON reservation_tracking(user_id)")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_reservation_tracking_expires ON reservation_tracking(expires_at)")
             c.execute("CREATE INDEX IF NOT EXISTS idx_pending_deposits_is_purchase ON pending_deposits(is_purchase)")
             c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_welcome_message_name ON welcome_messages(name)")
             # <<< ADDED Indices for reseller >>>
@@ -1358,6 +1917,8 @@ def add_pending_deposit(payment_id: str, user_id: int, currency: str, target_eur
                 1 if is_purchase else 0, basket_json, discount_code
                 ))
             conn.commit()
+            if is_purchase:
+                RESERVATION_EXPIRY.schedule(time.time() + PAYMENT_TIMEOUT_SECONDS, 'payment', payment_id)
             log_type = "direct purchase" if is_purchase else "refill"
             logger.info(f"Added pending {log_type} deposit {payment_id} for user {user_id} ({target_eur_amount:.2f} EUR / exp: {expected_crypto_amount} {currency}). Basket items: {len(basket_snapshot) if basket_snapshot else 0}.")
             return True
@@ -1401,6 +1962,71 @@ def get_pending_deposit(payment_id: str):
         logger.error(f"DB error fetching pending deposit {payment_id}: {e}", exc_info=True)
         return None
 
+# --- Payment Event Inbox (Synchronous) ---
+def record_payment_event(payment_id: str, payment_status: str, payload: str) -> int | None:
+    """
+    Durably stores a verified IPN before it is acknowledged.
+    Returns the new event id, or None if this payment_id + status was already received.
+    Raises sqlite3.Error so the webhook can answer 500 and let NOWPayments redeliver.
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("""
+            INSERT OR IGNORE INTO payment_events (payment_id, payment_status, payload, received_at)
+            VALUES (?, ?, ?, ?)
+        """, (payment_id, payment_status, payload, datetime.now(timezone.utc).isoformat()))
+        conn.commit()
+        return c.lastrowid if c.rowcount > 0 else None
+    finally:
+        if conn: conn.close()
+
+def get_unfinished_payment_event_ids() -> list[int]:
+    """Returns pending events, re-queueing any left 'processing' by a previous process."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("UPDATE payment_events SET status = 'pending' WHERE status = 'processing'")
+        conn.commit()
+        c.execute("SELECT id FROM payment_events WHERE status = 'pending' ORDER BY id")
+        return [row['id'] for row in c.fetchall()]
+    finally:
+        if conn: conn.close()
+
+def claim_payment_event(event_id: int) -> dict | None:
+    """Marks a pending event as 'processing' and counts the attempt. Returns None if it is not pending."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("UPDATE payment_events SET status = 'processing', attempts = attempts + 1 WHERE id = ? AND status = 'pending'", (event_id,))
+        conn.commit()
+        if c.rowcount == 0: return None
+        c.execute("SELECT * FROM payment_events WHERE id = ?", (event_id,))
+        row = c.fetchone()
+        return dict(row) if row else None
+    finally:
+        if conn: conn.close()
+
+def finish_payment_event(event_id: int, status: str, result: str | None = None, error: str | None = None):
+    """Records the outcome of an attempt. status is 'done', 'failed', or 'pending' (retry scheduled)."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("""
+            UPDATE payment_events SET status = ?, result = ?, last_error = ?, processed_at = ?
+            WHERE id = ?
+        """, (status, result, error, datetime.now(timezone.utc).isoformat() if status != 'pending' else None, event_id))
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"DB error updating payment event {event_id} to '{status}': {e}", exc_info=True)
+    finally:
+        if conn: conn.close()
+
+
 # --- HELPER TO UNRESERVE ITEMS (Synchronous) ---
 def _unreserve_basket_items(basket_snapshot: list | None):
     """Helper to decrement reserved counts for items in a snapshot."""
@@ -1419,6 +2045,7 @@ def _unreserve_basket_items(basket_snapshot: list | None):
         decrement_data = [(count, pid) for pid, count in product_ids_to_release_counts.items()]
         c.executemany("UPDATE products SET reserved = MAX(0, reserved - ?) WHERE id = ?", decrement_data)
         conn.commit()
+        CATALOG_INDEX.release_reservations(decrement_data)
         total_released = sum(product_ids_to_release_counts.values())
         logger.info(f"Un-reserved {total_released} items due to failed/expired/cancelled payment.") # General log message
     except sqlite3.Error as e:
@@ -1487,6 +2114,143 @@ def load_product_types():
         logger.error(f"Failed to load product types and emojis: {e}")
     return product_types_dict
 
+# --- In-Memory Catalog Index ---
+class CatalogIndex:
+    """In-memory view of the products table for the browsing menus.
+
+    Holds every product row plus per-location counts of sellable items (available > reserved),
+    so city/district/type menus render without touching SQLite. Rebuilt by load_all_data()
+    and kept current by the reserve/unreserve/purchase/add/delete paths after they commit.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._products = {} # {product_id: [city, district, product_type, size, price, available, reserved]}
+        # {city: {district: {product_type: {(size, price): sellable_count}}}}
+        self._counts = defaultdict(lambda: defaultdict(lambda: defaultdict(Counter)))
+        self.ready = False
+
+    @staticmethod
+    def _is_sellable(entry) -> bool:
+        return entry[5] > entry[6]
+
+    def _bump(self, entry, delta: int):
+        city, district, p_type, size, price = entry[:5]
+        options = self._counts[city][district][p_type]
+        options[(size, price)] += delta
+        if options[(size, price)] <= 0:
+            del options[(size, price)]
+            if not options: del self._counts[city][district][p_type]
+            if not self._counts[city][district]: del self._counts[city][district]
+            if not self._counts[city]: del self._counts[city]
+
+    def _set_entry(self, product_id: int, entry):
+        old = self._products.get(product_id)
+        if old and self._is_sellable(old): self._bump(old, -1)
+        if entry is None:
+            self._products.pop(product_id, None)
+            return
+        self._products[product_id] = entry
+        if self._is_sellable(entry): self._bump(entry, +1)
+
+    def rebuild(self):
+        """Reloads the whole index from the products table (Synchronous)."""
+        conn = None
+        try:
+            conn = get_db_connection()
+            c = conn.cursor()
+            c.execute("SELECT id, city, district, product_type, size, price, available, reserved FROM products")
+            rows = c.fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to rebuild catalog index: {e}", exc_info=True)
+            return
+        finally:
+            if conn: conn.close()
+        with self._lock:
+            self._products = {}
+            self._counts = defaultdict(lambda: defaultdict(lambda: defaultdict(Counter)))
+            for row in rows:
+                self._set_entry(row['id'], [row['city'], row['district'], row['product_type'], row['size'],
+                                            float(row['price']), row['available'] or 0, row['reserved'] or 0])
+            self.ready = True
+        logger.info(f"Catalog index rebuilt: {len(rows)} products.")
+
+    # --- Incremental updates (call after the DB change is committed) ---
+    def upsert_product(self, product_id: int, city: str, district: str, product_type: str, size: str, price, available: int = 1, reserved: int = 0):
+        with self._lock:
+            self._set_entry(product_id, [city, district, product_type, size, float(price), available, reserved])
+
+    def remove_products(self, product_ids):
+        with self._lock:
+            for product_id in product_ids:
+                self._set_entry(product_id, None)
+
+    def adjust_reserved(self, product_id: int, delta: int):
+        with self._lock:
+            entry = self._products.get(product_id)
+            if entry is None: return
+            new_entry = list(entry); new_entry[6] = max(0, entry[6] + delta)
+            self._set_entry(product_id, new_entry)
+
+    def release_reservations(self, decrement_data):
+        """Mirrors `UPDATE products SET reserved = MAX(0, reserved - ?) WHERE id = ?` for [(count, product_id)]."""
+        for count, product_id in decrement_data:
+            self.adjust_reserved(product_id, -count)
+
+    def adjust_available(self, product_id: int, delta: int):
+        with self._lock:
+            entry = self._products.get(product_id)
+            if entry is None: return
+            new_entry = list(entry); new_entry[5] = max(0, entry[5] + delta)
+            self._set_entry(product_id, new_entry)
+
+    # --- Read API (no SQL) ---
+    def district_summary(self, city: str, district: str) -> list:
+        """[{product_type, size, price, quantity}] ordered by type, price, size."""
+        with self._lock:
+            types = self._counts.get(city, {}).get(district, {})
+            rows = [{'product_type': p_type, 'size': size, 'price': price, 'quantity': qty}
+                    for p_type, options in types.items() for (size, price), qty in options.items()]
+        rows.sort(key=lambda r: (r['product_type'], r['price'], r['size']))
+        return rows
+
+    def available_types(self, city: str, district: str) -> list:
+        with self._lock:
+            return sorted(self._counts.get(city, {}).get(district, {}).keys())
+
+    def type_options(self, city: str, district: str, product_type: str) -> list:
+        """[{size, price, count_available}] ordered by price."""
+        with self._lock:
+            options = self._counts.get(city, {}).get(district, {}).get(product_type, {})
+            rows = [{'size': size, 'price': price, 'count_available': qty} for (size, price), qty in options.items()]
+        rows.sort(key=lambda r: (r['price'], r['size']))
+        return rows
+
+    def option_count(self, city: str, district: str, product_type: str, size: str, price) -> int:
+        with self._lock:
+            return self._counts.get(city, {}).get(district, {}).get(product_type, {}).get((size, float(price)), 0)
+
+    def city_price_rows(self, city: str) -> list:
+        """[{product_type, size, price, district, quantity}] for every district of a city."""
+        with self._lock:
+            rows = [{'product_type': p_type, 'size': size, 'price': price, 'district': district, 'quantity': qty}
+                    for district, types in self._counts.get(city, {}).items()
+                    for p_type, options in types.items() for (size, price), qty in options.items()]
+        rows.sort(key=lambda r: (r['product_type'], r['price'], r['size'], r['district']))
+        return rows
+
+    def stock_rows(self) -> list:
+        """Products with any stock (available or reserved), ordered like the admin stock query."""
+        with self._lock:
+            rows = [{'city': e[0], 'district': e[1], 'product_type': e[2], 'size': e[3], 'price': e[4], 'available': e[5], 'reserved': e[6]}
+                    for e in self._products.values() if e[5] > 0 or e[6] > 0]
+        rows.sort(key=lambda r: (r['city'], r['district'], r['product_type'], r['price'], r['size']))
+        return rows
+
+
+CATALOG_INDEX = CatalogIndex()
+
+
 def load_all_data():
     """Loads all dynamic data, modifying global variables IN PLACE."""
     global CITIES, DISTRICTS, PRODUCT_TYPES
@@ -1505,6 +2269,9 @@ def load_all_data():
         logger.error(f"Error during load_all_data (in-place): {e}", exc_info=True)
         CITIES.clear(); DISTRICTS.clear(); PRODUCT_TYPES.clear()
 
+    # Catalog index follows the same lifecycle (covers renames/deletes done by admin handlers)
+    CATALOG_INDEX.rebuild()
+
 
 # --- Bot Media Loading (from specified path on disk) ---
 if os.path.exists(BOT_MEDIA_JSON_PATH):
@@ -1544,9 +2311,524 @@ def _write_bot_media_config(bot_media_data: dict):
     logger.debug(f"Bot media config written to {BOT_MEDIA_JSON_PATH}")
 
 
+# --- Media file_id Registry ---
+class MediaRegistry:
+    """Maps file content (sha256) to the Telegram file_id this bot got for it on first upload.
+
+    Later sends reuse the file_id instead of re-uploading; an id Telegram rejects is forgotten
+    and the file is uploaded again. Hashes are memoized per (path, mtime, size).
+    """
+
+    def __init__(self, bot_id: str):
+        self.bot_id = bot_id
+        self._lock = threading.Lock()
+        self._hashes = {} # {path: (mtime_ns, size, digest)}
+        self._file_ids = {} # {(digest, media_type): file_id}
+
+    def load(self) -> int:
+        """Loads this bot's file_ids from the DB. (Synchronous)"""
+        try:
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                c.execute("SELECT content_hash, media_type, file_id FROM media_file_ids WHERE bot_id = ?", (self.bot_id,))
+                rows = c.fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to load media file_id registry: {e}")
+            return 0
+        with self._lock:
+            self._file_ids = {(row['content_hash'], row['media_type']): row['file_id'] for row in rows}
+        logger.info(f"Media registry: {len(rows)} cached file_ids loaded.")
+        return len(rows)
+
+    def content_hash(self, path: str) -> str:
+        """sha256 of the file, recomputed only when its mtime/size change. (Synchronous, raises OSError)"""
+        stat = os.stat(path)
+        with self._lock: cached = self._hashes.get(path)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size: return cached[2]
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''): sha.update(chunk)
+        digest = sha.hexdigest()
+        with self._lock: self._hashes[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    def prime(self, path: str, digest: str):
+        """Records a known hash for a file (e.g. right after it was moved into the blob store)."""
+        with contextlib.suppress(OSError):
+            stat = os.stat(path)
+            with self._lock: self._hashes[path] = (stat.st_mtime_ns, stat.st_size, digest)
+
+    def get(self, digest: str, media_type: str) -> str | None:
+        with self._lock: return self._file_ids.get((digest, media_type))
+
+    def remember(self, digest: str, media_type: str, file_id: str):
+        with self._lock:
+            if self._file_ids.get((digest, media_type)) == file_id: return
+            self._file_ids[(digest, media_type)] = file_id
+        enqueue_db_write("INSERT OR REPLACE INTO media_file_ids (content_hash, bot_id, media_type, file_id, updated_at) VALUES (?, ?, ?, ?, ?)",
+                         (digest, self.bot_id, media_type, file_id, datetime.now(timezone.utc).isoformat()))
+
+    def forget(self, digest: str, media_type: str):
+        with self._lock: self._file_ids.pop((digest, media_type), None)
+        enqueue_db_write("DELETE FROM media_file_ids WHERE content_hash = ? AND bot_id = ? AND media_type = ?", (digest, self.bot_id, media_type))
+
+
+MEDIA_REGISTRY = MediaRegistry(TOKEN.split(':')[0])
+
+_MEDIA_SEND_METHODS = {'photo': ('send_photo', 'photo'), 'video': ('send_video', 'video'), 'gif': ('send_animation', 'animation')}
+_INPUT_MEDIA_TYPES = {'photo': InputMediaPhoto, 'video': InputMediaVideo, 'gif': InputMediaAnimation}
+_FILE_ID_REJECTED_MARKERS = ("wrong file identifier", "wrong remote file", "file_id", "file reference")
+
+def _is_file_id_rejection(e: Exception) -> bool:
+    return isinstance(e, telegram_error.BadRequest) and any(marker in str(e).lower() for marker in _FILE_ID_REJECTED_MARKERS)
+
+def retry_after_seconds(e: telegram_error.RetryAfter) -> float:
+    """RetryAfter.retry_after is an int or a timedelta depending on the PTB version; returns seconds either way."""
+    retry_after = e.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+def _file_id_from_message(message, media_type: str) -> str | None:
+    if not message: return None
+    if media_type == 'photo': return message.photo[-1].file_id if message.photo else None
+    if media_type == 'video': return message.video.file_id if message.video else None
+    if media_type == 'gif':
+        media = message.animation or message.document
+        return media.file_id if media else None
+    return None
+
+async def send_cached_media(bot: Bot, chat_id: int, media_type: str, path: str, **kwargs):
+    """Sends a local photo/video/gif, reusing the cached file_id and uploading only on a miss or rejection."""
+    method_name, media_arg = _MEDIA_SEND_METHODS[media_type]
+    send = getattr(bot, method_name)
+    digest = await asyncio.to_thread(MEDIA_REGISTRY.content_hash, path)
+    file_id = MEDIA_REGISTRY.get(digest, media_type)
+    if file_id:
+        try:
+            return await send(chat_id=chat_id, **{media_arg: file_id}, **kwargs)
+        except telegram_error.BadRequest as e:
+            if not _is_file_id_rejection(e): raise
+            logger.warning(f"Cached file_id for {path} rejected ({e}); re-uploading.")
+            MEDIA_REGISTRY.forget(digest, media_type)
+    file_handle = await asyncio.to_thread(open, path, 'rb')
+    try:
+        message = await send(chat_id=chat_id, **{media_arg: file_handle}, **kwargs)
+    finally:
+        await asyncio.to_thread(file_handle.close)
+    new_file_id = _file_id_from_message(message, media_type)
+    if new_file_id: MEDIA_REGISTRY.remember(digest, media_type, new_file_id)
+    return message
+
+async def send_cached_media_group(bot: Bot, chat_id: int, items: list[dict], **kwargs):
+    """
+    Sends [{'type', 'path', 'caption'?}] as one media group, using cached file_ids where known.
+    If Telegram rejects a cached id the whole group is re-sent as uploads.
+    """
+    digests = [await asyncio.to_thread(MEDIA_REGISTRY.content_hash, item['path']) for item in items]
+    for use_cache in (True, False):
+        opened_files = []; cached_keys = []; media_group = []
+        try:
+            for item, digest in zip(items, digests):
+                source = MEDIA_REGISTRY.get(digest, item['type']) if use_cache else None
+                if source: cached_keys.append((digest, item['type']))
+                else:
+                    source = await asyncio.to_thread(open, item['path'], 'rb')
+                    opened_files.append(source)
+                media_group.append(_INPUT_MEDIA_TYPES[item['type']](media=source, caption=item.get('caption'), parse_mode=None))
+            try:
+                messages = await bot.send_media_group(chat_id, media=media_group, **kwargs)
+            except telegram_error.BadRequest as e:
+                if not (cached_keys and _is_file_id_rejection(e)): raise
+                logger.warning(f"Cached file_id rejected in media group for chat {chat_id} ({e}); re-uploading all items.")
+                for digest, media_type in cached_keys: MEDIA_REGISTRY.forget(digest, media_type)
+                continue
+        finally:
+            for f in opened_files:
+                try: await asyncio.to_thread(f.close)
+                except Exception: pass
+        for message, item, digest in zip(messages, items, digests):
+            new_file_id = _file_id_from_message(message, item['type'])
+            if new_file_id: MEDIA_REGISTRY.remember(digest, item['type'], new_file_id)
+        return messages
+
+
+# --- Media Download Pipeline ---
+# Staging lives on the same volume as MEDIA_DIR, so promoting a finished download is a rename, not a copy
+MEDIA_STAGING_DIR = os.path.join(MEDIA_DIR, '.staging')
+MEDIA_DOWNLOAD_CONCURRENCY = int(os.environ.get("MEDIA_DOWNLOAD_CONCURRENCY", "8"))
+MEDIA_DOWNLOAD_ATTEMPTS = int(os.environ.get("MEDIA_DOWNLOAD_ATTEMPTS", "3"))
+MEDIA_STAGING_MAX_AGE_SECONDS = 24 * 3600
+
+def media_file_extension(media_type: str, telegram_path: str | None = None) -> str:
+    extension = os.path.splitext(telegram_path)[1] if telegram_path else ""
+    if extension: return extension
+    if media_type == "photo": return ".jpg"
+    if media_type in ("video", "gif", "animation"): return ".mp4"
+    return ".bin"
+
+def create_media_staging_dir() -> str:
+    """Creates a fresh staging directory under MEDIA_DIR. (Synchronous)"""
+    os.makedirs(MEDIA_STAGING_DIR, exist_ok=True)
+    return tempfile.mkdtemp(prefix="drop_", dir=MEDIA_STAGING_DIR)
+
+def purge_stale_media_staging() -> int:
+    """Removes staging dirs left behind by abandoned drops or restarts. (Synchronous)"""
+    if not os.path.isdir(MEDIA_STAGING_DIR): return 0
+    cutoff = time.time() - MEDIA_STAGING_MAX_AGE_SECONDS
+    removed = 0
+    for entry in os.scandir(MEDIA_STAGING_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True) if entry.is_dir() else os.remove(entry.path)
+                removed += 1
+        except OSError as e:
+            logger.warning(f"Could not purge staging entry {entry.path}: {e}")
+    if removed: logger.info(f"🧹 Purged {removed} stale media staging entries.")
+    return removed
+
+async def _download_media_item(bot: Bot, item: dict, dest_dir: str, name: str, semaphore: asyncio.Semaphore) -> dict:
+    """Downloads one item to dest_dir/<name><ext> via a .part file, retrying transient errors."""
+    last_error = None
+    async with semaphore:
+        for attempt in range(1, MEDIA_DOWNLOAD_ATTEMPTS + 1):
+            part_path = None
+            try:
+                file_obj = await bot.get_file(item['file_id'])
+                final_path = os.path.join(dest_dir, f"{name}{media_file_extension(item['type'], file_obj.file_path)}")
+                part_path = final_path + ".part"
+                await file_obj.download_to_drive(custom_path=part_path)
+                if await asyncio.to_thread(os.path.getsize, part_path) == 0:
+                    raise IOError(f"Downloaded file {part_path} is empty.")
+                await asyncio.to_thread(os.replace, part_path, final_path)
+                return {**item, 'path': final_path}
+            except telegram_error.RetryAfter as e:
+                last_error = e; delay = retry_after_seconds(e) + 1
+            except telegram_error.BadRequest as e: # Invalid/too large file: retrying won't help
+                last_error = e; break
+            except (telegram_error.NetworkError, OSError) as e:
+                last_error = e; delay = 2 ** attempt
+            except Exception as e:
+                last_error = e; break
+            if part_path:
+                with contextlib.suppress(OSError): await asyncio.to_thread(os.remove, part_path)
+            if attempt < MEDIA_DOWNLOAD_ATTEMPTS:
+                logger.warning(f"Media download {item['file_id']} attempt {attempt} failed ({last_error}); retrying in {delay}s")
+                await asyncio.sleep(delay)
+    logger.error(f"Media download {item['file_id']} failed: {last_error}")
+    return {**item, 'path': None, 'error': str(last_error)}
+
+async def download_media_batch(bot: Bot, jobs: list[tuple[dict, str, str]]) -> list[dict]:
+    """
+    Downloads many media items concurrently (bounded by MEDIA_DOWNLOAD_CONCURRENCY).
+    jobs: [(media_item {'type', 'file_id'}, dest_dir, file_name_without_ext)].
+    Returns the items in job order with 'path' set, or 'path' None and 'error' on failure.
+    """
+    semaphore = asyncio.Semaphore(MEDIA_DOWNLOAD_CONCURRENCY)
+    dest_dirs = {dest_dir for _, dest_dir, _ in jobs}
+    for dest_dir in dest_dirs: await asyncio.to_thread(os.makedirs, dest_dir, exist_ok=True)
+    started = time.monotonic()
+    results = await asyncio.gather(*(_download_media_item(bot, item, dest_dir, name, semaphore) for item, dest_dir, name in jobs))
+    failed = sum(1 for result in results if not result['path'])
+    logger.info(f"📥 Downloaded {len(results) - failed}/{len(results)} media files in {time.monotonic() - started:.1f}s")
+    return list(results)
+
+# --- Content-Addressed Media Store ---
+# Product media lives once per content at blobs/<sha[:2]>/<sha><ext>; product_media rows reference it by
+# content_hash, so the row count per hash is the blob's reference count. Deleting a product's media rows
+# releases its blobs and collect_media_garbage() removes the files nothing references any more.
+MEDIA_BLOB_DIR = os.path.join(MEDIA_DIR, 'blobs')
+MEDIA_GC_INTERVAL_MINUTES = int(os.environ.get("MEDIA_GC_INTERVAL_MINUTES", "30"))
+MEDIA_GC_GRACE_SECONDS = 3600 # Unreferenced blobs younger than this are kept (an import may not have committed yet)
+MEDIA_LEGACY_MIGRATION_BATCH = 200
+
+def media_blob_path(digest: str, extension: str) -> str:
+    return os.path.join(MEDIA_BLOB_DIR, digest[:2], f"{digest}{extension.lower()}")
+
+def store_media_blob(src_path: str, keep_source: bool = False) -> tuple[str, str]:
+    """
+    Moves (or hard-links, when keep_source) a file into the blob store and returns (digest, blob_path).
+    Content that is already stored is not written again. (Synchronous)
+    """
+    digest = MEDIA_REGISTRY.content_hash(src_path)
+    blob_path = media_blob_path(digest, os.path.splitext(src_path)[1])
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    if os.path.exists(blob_path):
+        os.utime(blob_path) # Restart the GC grace period: a new reference is about to be committed
+        if not keep_source: os.remove(src_path)
+    elif keep_source:
+        try: os.link(src_path, blob_path)
+        except FileExistsError: pass
+        except OSError: shutil.copy2(src_path, blob_path)
+    else:
+        os.replace(src_path, blob_path)
+    MEDIA_REGISTRY.prime(blob_path, digest)
+    return digest, blob_path
+
+def store_staged_media(staged_items: list[dict]) -> list[dict]:
+    """Moves downloaded items into the blob store; returns them with 'path' and 'content_hash' set. (Synchronous)"""
+    stored = []
+    for item in staged_items:
+        if not item.get('path'): continue
+        try:
+            digest, blob_path = store_media_blob(item['path'])
+        except OSError as e:
+            logger.error(f"Could not store media {item['path']}: {e}")
+            continue
+        stored.append({**item, 'path': blob_path, 'content_hash': digest})
+    return stored
+
+def _migrate_legacy_media(conn, referenced: set) -> int:
+    """Moves a batch of per-product media copies into the blob store, deduplicating identical files."""
+    c = conn.cursor()
+    c.execute("SELECT id, file_path FROM product_media WHERE content_hash IS NULL LIMIT ?", (MEDIA_LEGACY_MIGRATION_BATCH,))
+    rows = c.fetchall()
+    updates, originals = [], []
+    for row in rows:
+        if not os.path.exists(row['file_path']):
+            updates.append(('', row['file_path'], row['id'])) # Marks the row as handled; the file is gone
+            continue
+        try:
+            digest, blob_path = store_media_blob(row['file_path'], keep_source=True)
+        except OSError as e:
+            logger.warning(f"Media GC: could not migrate {row['file_path']}: {e}")
+            updates.append(('', row['file_path'], row['id']))
+            continue
+        updates.append((digest, blob_path, row['id'])); originals.append(row['file_path'])
+        referenced.add(digest)
+    if updates:
+        c.executemany("UPDATE product_media SET content_hash = ?, file_path = ? WHERE id = ?", updates)
+        conn.commit()
+    for path in originals: # Only removed once the rows point at the blobs
+        with contextlib.suppress(OSError): os.remove(path)
+    return len(originals)
+
+def collect_media_garbage() -> dict:
+    """
+    Background media GC (Synchronous, runs on DB executor):
+    migrates a batch of legacy per-product files into the blob store, deletes blobs no product_media row
+    references, and removes legacy MEDIA_DIR/<product_id> dirs whose product no longer exists.
+    """
+    stats = {'migrated': 0, 'blobs_removed': 0, 'dirs_removed': 0}
+    now = time.time()
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT DISTINCT content_hash FROM product_media WHERE content_hash IS NOT NULL AND content_hash != ''")
+        referenced = {row['content_hash'] for row in c.fetchall()}
+        stats['migrated'] = _migrate_legacy_media(conn, referenced)
+        c.execute("SELECT id FROM products")
+        product_ids = {str(row['id']) for row in c.fetchall()}
+    except sqlite3.Error as e:
+        logger.error(f"Media GC: DB error, skipping this run: {e}")
+        return stats
+    finally:
+        if conn: conn.close()
+
+    if os.path.isdir(MEDIA_BLOB_DIR):
+        for shard in os.scandir(MEDIA_BLOB_DIR):
+            if not shard.is_dir(): continue
+            for blob in os.scandir(shard.path):
+                digest = os.path.splitext(blob.name)[0]
+                if digest in referenced: continue
+                try:
+                    if now - blob.stat().st_mtime < MEDIA_GC_GRACE_SECONDS: continue
+                    os.remove(blob.path)
+                    stats['blobs_removed'] += 1
+                except OSError as e:
+                    logger.warning(f"Media GC: could not remove {blob.path}: {e}")
+
+    for entry in os.scandir(MEDIA_DIR):
+        if entry.is_dir() and entry.name.isdigit() and entry.name not in product_ids:
+            try:
+                if now - entry.stat().st_mtime < MEDIA_GC_GRACE_SECONDS: continue
+                shutil.rmtree(entry.path, ignore_errors=True)
+                stats['dirs_removed'] += 1
+            except OSError as e:
+                logger.warning(f"Media GC: could not remove {entry.path}: {e}")
+
+    if any(stats.values()): logger.info(f"🧹 Media GC: {stats}")
+    return stats
+
+
+# --- Post-Purchase Cleanup Queue ---
+PRODUCT_CLEANUP_BATCH_SIZE = 500
+PRODUCT_CLEANUP_BATCH_WINDOW_SECONDS = 2.0 # Lets purchases finishing together share one delete transaction
+PRODUCT_CLEANUP_POLL_SECONDS = 60 # Picks up retries and rows enqueued before a restart
+PRODUCT_CLEANUP_MAX_BACKOFF_SECONDS = 3600
+
+def enqueue_product_cleanup(product_ids: list) -> int:
+    """Durably queues sold products for deletion and hides them from the catalog. (Synchronous, runs on DB executor)"""
+    if not product_ids: return 0
+    now = time.time()
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.executemany("INSERT OR IGNORE INTO product_cleanup_queue (product_id, enqueued_at, next_attempt_at) VALUES (?, ?, ?)",
+                      [(product_id, now, now) for product_id in product_ids])
+        conn.commit()
+    finally:
+        if conn: conn.close()
+    CATALOG_INDEX.remove_products(product_ids)
+    PRODUCT_CLEANUP.notify()
+    return len(product_ids)
+
+def _release_media_files(conn, content_hashes: set, product_ids: list):
+    """Removes blobs left unreferenced by a delete, plus legacy MEDIA_DIR/<product_id> dirs."""
+    c = conn.cursor()
+    for digest in content_hashes:
+        c.execute("SELECT 1 FROM product_media WHERE content_hash = ? LIMIT 1", (digest,))
+        if c.fetchone(): continue
+        shard_dir = os.path.dirname(media_blob_path(digest, ""))
+        for blob_name in os.listdir(shard_dir) if os.path.isdir(shard_dir) else []:
+            if not blob_name.startswith(digest): continue
+            blob_path = os.path.join(shard_dir, blob_name)
+            try:
+                # A just-touched blob may be about to be referenced by an import; the GC gets it later
+                if time.time() - os.stat(blob_path).st_mtime < MEDIA_GC_GRACE_SECONDS: continue
+                os.remove(blob_path)
+            except OSError as e: logger.warning(f"Cleanup: could not remove blob {blob_path}: {e}")
+    for product_id in product_ids:
+        legacy_dir = os.path.join(MEDIA_DIR, str(product_id))
+        if os.path.isdir(legacy_dir): shutil.rmtree(legacy_dir, ignore_errors=True)
+
+def run_product_cleanup_batch() -> int:
+    """
+    Deletes one batch of due queued products and their media rows in a single transaction, then their
+    media files. On failure the batch is rescheduled with exponential backoff. (Synchronous, runs on DB executor)
+    Returns the number of products processed.
+    """
+    now = time.time()
+    conn = None
+    product_ids = []
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT product_id FROM product_cleanup_queue WHERE next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                  (now, PRODUCT_CLEANUP_BATCH_SIZE))
+        product_ids = [row['product_id'] for row in c.fetchall()]
+        if not product_ids: return 0
+        placeholders = ','.join('?' * len(product_ids))
+        c.execute("BEGIN IMMEDIATE")
+        c.execute(f"SELECT DISTINCT content_hash FROM product_media WHERE product_id IN ({placeholders}) AND content_hash IS NOT NULL AND content_hash != ''", product_ids)
+        content_hashes = {row['content_hash'] for row in c.fetchall()}
+        c.execute(f"DELETE FROM product_media WHERE product_id IN ({placeholders})", product_ids)
+        deleted = c.execute(f"DELETE FROM products WHERE id IN ({placeholders})", product_ids).rowcount
+        c.execute(f"DELETE FROM product_cleanup_queue WHERE product_id IN ({placeholders})", product_ids)
+        conn.commit()
+        logger.info(f"🗑️ Cleanup: deleted {deleted} purchased product(s) and their media records ({len(product_ids)} queued).")
+        try: _release_media_files(conn, content_hashes, product_ids)
+        except (OSError, sqlite3.Error) as e: logger.warning(f"Cleanup: media file removal deferred to GC: {e}")
+        return len(product_ids)
+    except sqlite3.Error as e:
+        logger.error(f"Cleanup batch failed for {len(product_ids)} product(s): {e}", exc_info=True)
+        if conn and conn.in_transaction: conn.rollback()
+        if conn and product_ids:
+            try:
+                placeholders = ','.join('?' * len(product_ids))
+                conn.execute(f"""UPDATE product_cleanup_queue
+                                 SET attempts = attempts + 1, last_error = ?,
+                                     next_attempt_at = ? + MIN(?, 30 * (1 << MIN(attempts, 10)))
+                                 WHERE product_id IN ({placeholders})""",
+                             [str(e)[:500], now, PRODUCT_CLEANUP_MAX_BACKOFF_SECONDS, *product_ids])
+                conn.commit()
+            except sqlite3.Error as retry_e: logger.error(f"Cleanup: could not reschedule failed batch: {retry_e}")
+        return 0
+    finally:
+        if conn: conn.close()
+
+
+class ProductCleanupWorker:
+    """Background task that drains product_cleanup_queue so the purchase path never waits on deletes."""
+
+    def __init__(self):
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+
+    def notify(self):
+        """Thread-safe: wakes the worker after rows were enqueued."""
+        loop = self._loop
+        if not loop or loop.is_closed(): return
+        try: running_loop = asyncio.get_running_loop()
+        except RuntimeError: running_loop = None
+        if running_loop is loop: self._wakeup.set()
+        else: loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _run(self):
+        while True:
+            try: await asyncio.wait_for(self._wakeup.wait(), PRODUCT_CLEANUP_POLL_SECONDS)
+            except asyncio.TimeoutError: pass
+            self._wakeup.clear()
+            await asyncio.sleep(PRODUCT_CLEANUP_BATCH_WINDOW_SECONDS)
+            try:
+                while await run_db(run_product_cleanup_batch) >= PRODUCT_CLEANUP_BATCH_SIZE: pass
+            except Exception as e:
+                logger.error(f"Product cleanup worker error: {e}", exc_info=True)
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._wakeup.set() # Drain anything left from before the restart
+        self._task = asyncio.create_task(self._run())
+        logger.info("Product cleanup worker started.")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._loop = None
+
+
+PRODUCT_CLEANUP = ProductCleanupWorker()
+
+
+# --- Ban Status Cache ---
+# Loaded at boot, updated by the ban toggle, reconciled periodically against the DB
+BANNED_USER_IDS: set[int] = set()
+BAN_CACHE_RECONCILE_MINUTES = 5
+_ban_cache_lock = threading.Lock()
+_ban_cache_generation = 0 # Bumped by every toggle so a reload that read the DB before it can't undo it
+
+def load_banned_users() -> int:
+    """(Re)loads the banned user set from the DB (Synchronous). Replaces the set contents in place."""
+    generation = _ban_cache_generation
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT user_id FROM users WHERE is_banned = 1")
+        banned_ids = {row['user_id'] for row in c.fetchall()}
+    except sqlite3.Error as e:
+        logger.error(f"DB error loading banned users: {e}", exc_info=True)
+        return len(BANNED_USER_IDS) # Keep the last known set
+    finally:
+        if conn: conn.close()
+    with _ban_cache_lock:
+        if generation != _ban_cache_generation:
+            logger.debug("Ban cache reload skipped: a ban was toggled while it ran; the next reconcile picks it up.")
+            return len(BANNED_USER_IDS)
+        added, removed = banned_ids - BANNED_USER_IDS, BANNED_USER_IDS - banned_ids
+        if added or removed:
+            BANNED_USER_IDS.difference_update(removed); BANNED_USER_IDS.update(added)
+    if added or removed:
+        logger.info(f"Ban cache reconciled: {len(BANNED_USER_IDS)} banned (+{len(added)} / -{len(removed)}).")
+    return len(BANNED_USER_IDS)
+
+def set_user_ban_cached(user_id: int, banned: bool):
+    """Pushes a ban status change into the cache (call after the DB update commits)."""
+    global _ban_cache_generation
+    with _ban_cache_lock:
+        _ban_cache_generation += 1
+        if banned: BANNED_USER_IDS.add(user_id)
+        else: BANNED_USER_IDS.discard(user_id)
+
 async def is_user_banned(user_id: int) -> bool:
     """Check if a user is banned. Returns True if banned, False otherwise.
     
+    Served from the in-process ban cache - no DB round trip.
+
     Args:
         user_id: The Telegram user ID to check
         
@@ -1556,33 +2838,105 @@ async def is_user_banned(user_id: int) -> bool:
     # Skip ban check for admins
     if user_id == ADMIN_ID or user_id in SECONDARY_ADMIN_IDS:
         return False
-    
-    conn = None
-    max_retries = 3
-    retry_delay = 0.1  # 100ms
-    
-    for attempt in range(max_retries):
+    return user_id in BANNED_USER_IDS
+
+
+# --- User Profile Cache ---
+USER_PROFILE_CACHE_TTL_SECONDS = int(os.environ.get("USER_PROFILE_CACHE_TTL_SECONDS", "300")) # Safety net for writes outside the known paths
+USER_PROFILE_CACHE_MAX_USERS = int(os.environ.get("USER_PROFILE_CACHE_MAX_USERS", "20000"))
+
+class UserProfileCache:
+    """
+    Per-user snapshot of the users row (username, balance, total_purchases, language, is_reseller, is_banned),
+    loaded with one query on a miss. Writers whose new value is known push it through update() (language,
+    username, ban and reseller toggles); balance and purchase changes call invalidate() after they commit.
+    Returned dicts are shared and must not be mutated.
+    """
+    def __init__(self, ttl_seconds: int = USER_PROFILE_CACHE_TTL_SECONDS, max_users: int = USER_PROFILE_CACHE_MAX_USERS):
+        self._ttl = ttl_seconds
+        self._max_users = max_users
+        self._profiles = OrderedDict() # {user_id: (loaded_at, profile)}, least recently loaded first
+        self._generation = 0 # Bumped on every write so in-flight loads can't store stale rows
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    @staticmethod
+    def _load_with_cursor(cursor, user_id: int) -> dict | None:
+        cursor.execute("""SELECT username, balance, total_purchases, language, is_reseller, is_banned
+                          FROM users WHERE user_id = ?""", (user_id,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+    def _cached(self, user_id: int):
+        entry = self._profiles.get(user_id)
+        if entry and time.monotonic() - entry[0] < self._ttl:
+            self.stats['hits'] += 1
+            return entry[1]
+        return None
+
+    def _store(self, user_id: int, generation: int, profile: dict):
+        with self._lock:
+            if generation != self._generation: return
+            self._profiles[user_id] = (time.monotonic(), profile)
+            self._profiles.move_to_end(user_id)
+            while len(self._profiles) > self._max_users:
+                self._profiles.popitem(last=False)
+
+    def get(self, user_id: int, cursor=None) -> dict | None:
+        """Returns the user's profile (None if there is no users row), loading it on a miss. (Synchronous, runs on DB executor)"""
+        profile = self._cached(user_id)
+        if profile is not None:
+            return profile
+        self.stats['misses'] += 1
+        generation = self._generation
+        conn = None
         try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("SELECT is_banned FROM users WHERE user_id = ?", (user_id,))
-            res = c.fetchone()
-            return res and res['is_banned'] == 1
+            if cursor is None:
+                conn = get_db_connection()
+                cursor = conn.cursor()
+            profile = self._load_with_cursor(cursor, user_id)
         except sqlite3.Error as e:
-            if "database is locked" in str(e).lower() and attempt < max_retries - 1:
-                logger.warning(f"Database locked for ban check (attempt {attempt + 1}/{max_retries}), retrying in {retry_delay}s...")
-                await asyncio.sleep(retry_delay)
-                retry_delay *= 2  # Exponential backoff
-                continue
-            else:
-                logger.error(f"DB error checking ban status for user {user_id}: {e}")
-                return False  # Default to not banned if there's a DB error
+            logger.error(f"DB error loading profile for user {user_id}: {e}")
+            return None # Not cached, next call retries
         finally:
-            if conn:
-                conn.close()
-                conn = None
-    
-    return False  # Default to not banned if all retries failed
+            if conn: conn.close()
+        if profile is not None:
+            self._store(user_id, generation, profile)
+        return profile
+
+    async def get_async(self, user_id: int) -> dict | None:
+        """Cache hits return without a DB executor hop."""
+        profile = self._cached(user_id)
+        if profile is not None:
+            return profile
+        return await run_db(self.get, user_id)
+
+    def peek(self, user_id: int) -> dict | None:
+        """Returns the cached profile, or None without loading it."""
+        return self._cached(user_id)
+
+    def update(self, user_id: int, **fields):
+        """Writes known new values through to a cached profile (call after the DB update commits)."""
+        with self._lock:
+            self._generation += 1
+            entry = self._profiles.get(user_id)
+            if entry: self._profiles[user_id] = (entry[0], {**entry[1], **fields})
+
+    def invalidate(self, user_id: int | None = None):
+        """Drops one user's profile, or every profile when user_id is None."""
+        with self._lock:
+            self._generation += 1
+            self.stats['invalidations'] += 1
+            if user_id is None: self._profiles.clear()
+            else: self._profiles.pop(user_id, None)
+
+    def get_stats(self) -> dict:
+        lookups = self.stats['hits'] + self.stats['misses']
+        hit_rate = round(100 * self.stats['hits'] / lookups, 1) if lookups else 0.0
+        return {**self.stats, 'hit_rate_pct': hit_rate, 'cached_users': len(self._profiles)}
+
+
+USER_PROFILES = UserProfileCache()
 
 
 # --- Utility Functions ---
@@ -1637,7 +2991,7 @@ async def send_message_with_retry(
             if attempt < max_retries - 1: await asyncio.sleep(1 * (2 ** attempt)); continue
             else: logger.error(f"Max retries reached for BadRequest sending to {chat_id}: {e}"); break
         except telegram_error.RetryAfter as e:
-            retry_seconds = e.retry_after + 1
+            retry_seconds = retry_after_seconds(e) + 1
             logger.warning(f"Rate limit hit sending to {chat_id}. Retrying after {retry_seconds} seconds.")
             if retry_seconds > 60: logger.error(f"RetryAfter requested > 60s ({retry_seconds}s). Aborting for chat {chat_id}."); return None
             await asyncio.sleep(retry_seconds); continue
@@ -1676,69 +3030,42 @@ def get_user_status(purchases):
         else: return "New 🌱"
     except (ValueError, TypeError): return "New 🌱"
 
-# --- Modified clear_expired_basket (Individual user focus) ---
+# --- Basket Expiry (basket_items) ---
 def clear_expired_basket(context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    """Drops the user's expired basket items, releases their reservations and reloads context.user_data['basket']."""
     if 'basket' not in context.user_data: context.user_data['basket'] = []
     conn = None
     try:
         conn = get_db_connection()
         c = conn.cursor()
         c.execute("BEGIN")
-        c.execute("SELECT basket FROM users WHERE user_id = ?", (user_id,))
-        result = c.fetchone(); basket_str = result['basket'] if result else ''
-        if not basket_str:
-            # If DB basket is empty, ensure context basket is also empty
-            if context.user_data.get('basket'): context.user_data['basket'] = []
-            if context.user_data.get('applied_discount'): context.user_data.pop('applied_discount', None)
-            c.execute("COMMIT"); # Commit potential state change from BEGIN
-            return # Exit early if no basket string in DB
-
-        items = basket_str.split(',')
-        current_time = time.time(); valid_items_str_list = []; valid_items_userdata_list = []
-        expired_product_ids_counts = Counter(); expired_items_found = False
-        potential_prod_ids = []
-        for item_part in items:
-            if item_part and ':' in item_part:
-                try: potential_prod_ids.append(int(item_part.split(':')[0]))
-                except ValueError: logger.warning(f"Invalid product ID format in basket string '{item_part}' for user {user_id}")
-
-        product_details = {}
-        if potential_prod_ids:
-             placeholders = ','.join('?' * len(potential_prod_ids))
-             # Fetch product_type along with price
-             c.execute(f"SELECT id, price, product_type FROM products WHERE id IN ({placeholders})", potential_prod_ids)
-             product_details = {row['id']: {'price': Decimal(str(row['price'])), 'type': row['product_type']} for row in c.fetchall()}
-
-        for item_str in items:
-            if not item_str: continue
-            try:
-                prod_id_str, ts_str = item_str.split(':'); prod_id = int(prod_id_str); ts = float(ts_str)
-                if current_time - ts <= BASKET_TIMEOUT:
-                    valid_items_str_list.append(item_str)
-                    details = product_details.get(prod_id)
-                    if details:
-                        # Add product_type to context item
-                        valid_items_userdata_list.append({
-                            "product_id": prod_id,
-                            "price": details['price'], # Original price
-                            "product_type": details['type'], # Store product type
-                            "timestamp": ts
-                        })
-                    else: logger.warning(f"P{prod_id} details not found during basket validation (user {user_id}).")
-                else:
-                    expired_product_ids_counts[prod_id] += 1
-                    expired_items_found = True
-            except (ValueError, IndexError) as e: logger.warning(f"Malformed item '{item_str}' in basket for user {user_id}: {e}")
-
-        if expired_items_found:
-            new_basket_str = ','.join(valid_items_str_list)
-            c.execute("UPDATE users SET basket = ? WHERE user_id = ?", (new_basket_str, user_id))
-            if expired_product_ids_counts:
-                decrement_data = [(count, pid) for pid, count in expired_product_ids_counts.items()]
-                c.executemany("UPDATE products SET reserved = MAX(0, reserved - ?) WHERE id = ?", decrement_data)
-                logger.info(f"Released {sum(expired_product_ids_counts.values())} reservations for user {user_id} due to expiry.")
+        current_time = time.time()
+        c.execute("SELECT product_id, COUNT(*) AS cnt FROM basket_items WHERE user_id = ? AND expires_at < ? GROUP BY product_id", (user_id, current_time))
+        decrement_data = [(row['cnt'], row['product_id']) for row in c.fetchall()]
+        if decrement_data:
+            c.execute("DELETE FROM basket_items WHERE user_id = ? AND expires_at < ?", (user_id, current_time))
+            c.executemany("UPDATE products SET reserved = MAX(0, reserved - ?) WHERE id = ?", decrement_data)
+            logger.info(f"Released {sum(count for count, _ in decrement_data)} reservations for user {user_id} due to expiry.")
+
+        c.execute("""
+            SELECT b.product_id, b.reserved_at, p.price, p.product_type
+            FROM basket_items b LEFT JOIN products p ON p.id = b.product_id
+            WHERE b.user_id = ? ORDER BY b.id
+        """, (user_id,))
+        valid_items_userdata_list = []
+        for row in c.fetchall():
+            if row['price'] is None:
+                logger.warning(f"P{row['product_id']} details not found during basket validation (user {user_id}).")
+                continue
+            valid_items_userdata_list.append({
+                "product_id": row['product_id'],
+                "price": Decimal(str(row['price'])), # Original price
+                "product_type": row['product_type'], # Store product type
+                "timestamp": row['reserved_at']
+            })
 
         c.execute("COMMIT") # Commit transaction
+        CATALOG_INDEX.release_reservations(decrement_data)
         context.user_data['basket'] = valid_items_userdata_list
         if not valid_items_userdata_list and context.user_data.get('applied_discount'):
             context.user_data.pop('applied_discount', None); logger.info(f"Cleared discount for user {user_id} as basket became empty.")
@@ -1752,104 +3079,30 @@ def clear_expired_basket(context: ContextTypes.DEFAULT_TYPE, user_id: int):
     finally:
         if conn: conn.close()
 
-# --- MODIFIED clear_all_expired_baskets (Individual user processing) ---
 def clear_all_expired_baskets():
-    logger.info("Running scheduled job: clear_all_expired_baskets (Improved)")
-    all_expired_product_counts = Counter()
-    processed_user_count = 0
-    failed_user_count = 0
-    conn_outer = None
-    users_to_process = []
-
-    # 1. Fetch all users with baskets first
-    try:
-        conn_outer = get_db_connection()
-        c_outer = conn_outer.cursor()
-        c_outer.execute("SELECT user_id, basket FROM users WHERE basket IS NOT NULL AND basket != ''")
-        users_to_process = c_outer.fetchall() # Fetch all relevant users
-    except sqlite3.Error as e:
-        logger.error(f"Failed to fetch users for basket clearing job: {e}", exc_info=True)
-        return # Cannot proceed if user fetch fails
-    finally:
-        if conn_outer: conn_outer.close()
-
-    if not users_to_process:
-        logger.info("Scheduled clear: No users with active baskets found.")
-        return
-
-    logger.info(f"Scheduled clear: Found {len(users_to_process)} users with baskets to check.")
-    current_time = time.time()
-    user_basket_updates = [] # Batch updates for user basket strings
-
-    # 2. Process each user individually for basket string updates and count expired items
-    for user_row in users_to_process:
-        user_id = user_row['user_id']
-        basket_str = user_row['basket']
-        items = basket_str.split(',')
-        valid_items_str_list = []
-        user_had_expired = False
-        user_error = False
-
-        for item_str in items:
-            if not item_str: continue
-            try:
-                prod_id_str, ts_str = item_str.split(':')
-                prod_id = int(prod_id_str)
-                ts = float(ts_str)
-                if current_time - ts <= BASKET_TIMEOUT:
-                    valid_items_str_list.append(item_str)
-                else:
-                    all_expired_product_counts[prod_id] += 1
-                    user_had_expired = True
-            except (ValueError, IndexError) as e:
-                logger.warning(f"Malformed item '{item_str}' user {user_id} in global clear: {e}")
-                user_error = True # Mark user had an error, but continue processing others
-                continue # Skip this malformed item
-
-        if user_error:
-            failed_user_count += 1
-
-        # Only add to batch update if expired items were found for this user
-        if user_had_expired:
-            new_basket_str = ','.join(valid_items_str_list)
-            user_basket_updates.append((new_basket_str, user_id))
-
-        processed_user_count += 1
-        # Optional: Add a small sleep if processing many users to avoid bursts
-        # time.sleep(0.01) # Using time.sleep in sync function is fine
-
-    # 3. Perform batch updates outside the user loop
-    conn_update = None
+    """Releases every expired basket reservation with one indexed range delete."""
+    logger.debug("Running scheduled job: clear_all_expired_baskets")
+    conn = None
     try:
-        conn_update = get_db_connection()
-        c_update = conn_update.cursor()
-        c_update.execute("BEGIN") # Start transaction for batch updates
-
-        # Update user basket strings
-        if user_basket_updates:
-            c_update.executemany("UPDATE users SET basket = ? WHERE user_id = ?", user_basket_updates)
-            logger.info(f"Scheduled clear: Updated basket strings for {len(user_basket_updates)} users.")
-
-        # Decrement reservations
-        if all_expired_product_counts:
-            decrement_data = [(count, pid) for pid, count in all_expired_product_counts.items()]
-            if decrement_data:
-                c_update.executemany("UPDATE products SET reserved = MAX(0, reserved - ?) WHERE id = ?", decrement_data)
-                total_released = sum(all_expired_product_counts.values())
-                logger.info(f"Scheduled clear: Released {total_released} expired product reservations.")
-
-        conn_update.commit() # Commit all updates together
-
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("BEGIN")
+        current_time = time.time()
+        c.execute("SELECT product_id, COUNT(*) AS cnt FROM basket_items WHERE expires_at < ? GROUP BY product_id", (current_time,))
+        decrement_data = [(row['cnt'], row['product_id']) for row in c.fetchall()]
+        if not decrement_data:
+            conn.rollback()
+            return
+        deleted = c.execute("DELETE FROM basket_items WHERE expires_at < ?", (current_time,)).rowcount
+        c.executemany("UPDATE products SET reserved = MAX(0, reserved - ?) WHERE id = ?", decrement_data)
+        conn.commit()
+        CATALOG_INDEX.release_reservations(decrement_data)
+        logger.info(f"Scheduled clear: Removed {deleted} expired basket items and released {sum(count for count, _ in decrement_data)} reservations.")
     except sqlite3.Error as e:
-        logger.error(f"SQLite error during batch updates in clear_all_expired_baskets: {e}", exc_info=True)
-        if conn_update and conn_update.in_transaction: conn_update.rollback()
-    except Exception as e:
-        logger.error(f"Unexpected error during batch updates in clear_all_expired_baskets: {e}", exc_info=True)
-        if conn_update and conn_update.in_transaction: conn_update.rollback()
+        logger.error(f"SQLite error in clear_all_expired_baskets: {e}", exc_info=True)
+        if conn and conn.in_transaction: conn.rollback()
     finally:
-        if conn_update: conn_update.close()
-
-    logger.info(f"Scheduled job clear_all_expired_baskets finished. Processed: {processed_user_count}, Users with errors: {failed_user_count}, Total items un-reserved: {sum(all_expired_product_counts.values())}")
+        if conn: conn.close()
 
 
 def fetch_last_purchases(user_id, limit=10):
@@ -2015,174 +3268,147 @@ async def handle_coming_soon(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
 
 # --- Fetch User IDs for Broadcast (Synchronous) ---
-def fetch_user_ids_for_broadcast(target_type: str, target_value: str | int | None = None) -> list[int]:
-    """Fetches user IDs based on broadcast target criteria."""
-    user_ids = []
+BROADCAST_PAGE_SIZE = 500
+
+def _broadcast_target_sql(target_type: str, target_value: str | int | None, as_of: datetime | None = None):
+    """
+    Builds (sql, params) selecting `user_id` for a broadcast audience, excluding banned users.
+    The SQL has a trailing `user_id > ?` keyset condition so audiences can be streamed and resumed
+    in user_id order. Returns (None, None) for unknown/invalid targets.
+    """
+    if target_type == 'all':
+        # Send to ALL users who have ever pressed /start (exist in users table) except banned ones
+        return "SELECT user_id FROM users WHERE is_banned = 0 AND user_id > ?", ()
+
+    if target_type == 'status' and target_value:
+        status = str(target_value).lower()
+        # Use the status string including emoji for matching (rely on English definition)
+        if status == LANGUAGES['en'].get("broadcast_status_vip", "VIP 👑").lower():
+            return "SELECT user_id FROM users WHERE total_purchases >= ? AND is_banned = 0 AND user_id > ?", (10,)
+        if status == LANGUAGES['en'].get("broadcast_status_regular", "Regular ⭐").lower():
+            return "SELECT user_id FROM users WHERE total_purchases BETWEEN ? AND ? AND is_banned = 0 AND user_id > ?", (5, 9)
+        if status == LANGUAGES['en'].get("broadcast_status_new", "New 🌱").lower():
+            return "SELECT user_id FROM users WHERE total_purchases BETWEEN ? AND ? AND is_banned = 0 AND user_id > ?", (0, 4)
+        logger.warning(f"Invalid status value for broadcast: {target_value}")
+        return None, None
+
+    if target_type == 'city' and target_value:
+        # Non-banned users whose *most recent* purchase was in this city
+        return """
+            SELECT DISTINCT p1.user_id AS user_id
+            FROM purchases p1
+            JOIN users u ON p1.user_id = u.user_id
+            WHERE p1.city = ? AND u.is_banned = 0 AND p1.purchase_date = (
+                SELECT MAX(purchase_date)
+                FROM purchases p2
+                WHERE p1.user_id = p2.user_id
+            ) AND p1.user_id > ?
+        """, (str(target_value),)
+
+    if target_type == 'inactive' and target_value:
+        try:
+            days_inactive = int(target_value)
+            if days_inactive <= 0: raise ValueError("Days must be positive")
+        except (ValueError, TypeError):
+            logger.error(f"Invalid number of days for inactive broadcast: {target_value}")
+            return None, None
+        # Cutoff is pinned to `as_of` so a resumed broadcast keeps its original audience
+        cutoff_iso = ((as_of or datetime.now(timezone.utc)) - timedelta(days=days_inactive)).isoformat()
+        # Non-banned users with no purchases, or whose last purchase is older than the cutoff
+        return """
+            SELECT u.user_id AS user_id
+            FROM users u
+            WHERE u.is_banned = 0 AND (
+                u.total_purchases = 0 OR
+                (SELECT MAX(p.purchase_date) FROM purchases p WHERE p.user_id = u.user_id) < ?
+            ) AND u.user_id > ?
+        """, (cutoff_iso,)
+
+    logger.error(f"Unknown broadcast target type or missing value: type={target_type}, value={target_value}")
+    return None, None
+
+
+def fetch_broadcast_user_page(target_type: str, target_value: str | int | None = None, after_user_id: int = 0,
+                              limit: int = BROADCAST_PAGE_SIZE, as_of: datetime | None = None) -> list[int]:
+    """Fetches the next page of broadcast user IDs after `after_user_id`, in user_id order."""
+    sql, params = _broadcast_target_sql(target_type, target_value, as_of)
+    if sql is None: return []
     conn = None
     try:
         conn = get_db_connection()
         c = conn.cursor()
+        c.execute(f"{sql} ORDER BY user_id LIMIT ?", (*params, after_user_id, limit))
+        return [row['user_id'] for row in c.fetchall()]
+    except sqlite3.Error as e:
+        logger.error(f"DB error fetching broadcast page ({target_type}, {target_value}, after {after_user_id}): {e}", exc_info=True)
+        raise
+    finally:
+        if conn: conn.close()
 
-        if target_type == 'all':
-            # Send to ALL users who have ever pressed /start (exist in users table) except banned ones
-            # TEMPORARILY REMOVED broadcast_failed_count filtering to ensure ALL users get messages
-            c.execute("SELECT user_id FROM users WHERE is_banned = 0 ORDER BY total_purchases DESC")
-            user_ids = [row['user_id'] for row in c.fetchall()]
-            logger.info(f"Broadcast target 'all': Found {len(user_ids)} users (excluding only banned users).")
-
-        elif target_type == 'status' and target_value:
-            status = str(target_value).lower()
-            min_purchases, max_purchases = -1, -1
-            # Use the status string including emoji for matching (rely on English definition)
-            if status == LANGUAGES['en'].get("broadcast_status_vip", "VIP 👑").lower(): min_purchases = 10; max_purchases = float('inf')
-            elif status == LANGUAGES['en'].get("broadcast_status_regular", "Regular ⭐").lower(): min_purchases = 5; max_purchases = 9
-            elif status == LANGUAGES['en'].get("broadcast_status_new", "New 🌱").lower(): min_purchases = 0; max_purchases = 4
-
-            if min_purchases != -1:
-                 if max_purchases == float('inf'):
-                     c.execute("SELECT user_id FROM users WHERE total_purchases >= ? AND is_banned=0", (min_purchases,)) # Exclude banned
-                 else:
-                     c.execute("SELECT user_id FROM users WHERE total_purchases BETWEEN ? AND ? AND is_banned=0", (min_purchases, max_purchases)) # Exclude banned
-                 user_ids = [row['user_id'] for row in c.fetchall()]
-                 logger.info(f"Broadcast target status '{target_value}': Found {len(user_ids)} non-banned users.")
-            else: logger.warning(f"Invalid status value for broadcast: {target_value}")
-
-        elif target_type == 'city' and target_value:
-            city_name = str(target_value)
-            # Find non-banned users whose *most recent* purchase was in this city
-            c.execute("""
-                SELECT p1.user_id
-                FROM purchases p1
-                JOIN users u ON p1.user_id = u.user_id
-                WHERE p1.city = ? AND u.is_banned = 0 AND p1.purchase_date = (
-                    SELECT MAX(purchase_date)
-                    FROM purchases p2
-                    WHERE p1.user_id = p2.user_id
-                )
-            """, (city_name,))
-            user_ids = [row['user_id'] for row in c.fetchall()]
-            logger.info(f"Broadcast target city '{city_name}': Found {len(user_ids)} non-banned users based on last purchase.")
-
-        elif target_type == 'inactive' and target_value:
-            try:
-                days_inactive = int(target_value)
-                if days_inactive <= 0: raise ValueError("Days must be positive")
-                cutoff_date = datetime.now(timezone.utc) - timedelta(days=days_inactive)
-                cutoff_iso = cutoff_date.isoformat()
-
-                # Find non-banned users whose last purchase date is older than the cutoff date OR have no purchases
-                # 1. Get users with last purchase older than cutoff
-                c.execute("""
-                    SELECT p1.user_id
-                    FROM purchases p1
-                    JOIN users u ON p1.user_id = u.user_id
-                    WHERE u.is_banned = 0 AND p1.purchase_date = (
-                        SELECT MAX(purchase_date)
-                        FROM purchases p2
-                        WHERE p1.user_id = p2.user_id
-                    ) AND p1.purchase_date < ?
-                """, (cutoff_iso,))
-                inactive_users = {row['user_id'] for row in c.fetchall()}
-
-                # 2. Get users with zero purchases (who implicitly meet the inactive criteria)
-                c.execute("SELECT user_id FROM users WHERE total_purchases = 0 AND is_banned = 0") # Exclude banned
-                zero_purchase_users = {row['user_id'] for row in c.fetchall()}
-
-                # Combine the sets
-                user_ids_set = inactive_users.union(zero_purchase_users)
-                user_ids = list(user_ids_set)
-                logger.info(f"Broadcast target inactive >= {days_inactive} days: Found {len(user_ids)} non-banned users.")
-
-            except (ValueError, TypeError):
-                logger.error(f"Invalid number of days for inactive broadcast: {target_value}")
-
-        else:
-            logger.error(f"Unknown broadcast target type or missing value: type={target_type}, value={target_value}")
 
+def count_broadcast_users(target_type: str, target_value: str | int | None = None, as_of: datetime | None = None) -> int:
+    """Counts the broadcast audience without materializing it."""
+    sql, params = _broadcast_target_sql(target_type, target_value, as_of)
+    if sql is None: return 0
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute(f"SELECT COUNT(*) AS cnt FROM ({sql})", (*params, 0))
+        return c.fetchone()['cnt']
     except sqlite3.Error as e:
-        logger.error(f"DB error fetching users for broadcast ({target_type}, {target_value}): {e}", exc_info=True)
-    except Exception as e:
-        logger.error(f"Unexpected error fetching users for broadcast: {e}", exc_info=True)
+        logger.error(f"DB error counting broadcast users ({target_type}, {target_value}): {e}", exc_info=True)
+        return 0
     finally:
         if conn: conn.close()
 
-    # IMPROVED: Limit broadcast size to prevent overwhelming the system
-    max_broadcast_users = 10000  # Reasonable limit
-    if len(user_ids) > max_broadcast_users:
-        logger.warning(f"Broadcast target too large ({len(user_ids)} users), limiting to {max_broadcast_users}")
-        user_ids = user_ids[:max_broadcast_users]
 
+def fetch_user_ids_for_broadcast(target_type: str, target_value: str | int | None = None) -> list[int]:
+    """Fetches all user IDs for a broadcast target. Prefer fetch_broadcast_user_page for large audiences."""
+    user_ids = []
+    after_user_id = 0
+    as_of = datetime.now(timezone.utc)
+    try:
+        while True:
+            page = fetch_broadcast_user_page(target_type, target_value, after_user_id, as_of=as_of)
+            user_ids.extend(page)
+            if len(page) < BROADCAST_PAGE_SIZE: break
+            after_user_id = page[-1]
+    except sqlite3.Error:
+        pass # Already logged; return what was fetched
+    logger.info(f"Broadcast target {target_type}={target_value}: Found {len(user_ids)} non-banned users.")
     return user_ids
 
 
 # --- User Broadcast Status Tracking (Synchronous) ---
+def _increment_broadcast_failure(cursor, user_id: int):
+    """Writer-queue job: bumps the failure counter and logs when the user becomes unreachable."""
+    cursor.execute("""
+        UPDATE users 
+        SET broadcast_failed_count = COALESCE(broadcast_failed_count, 0) + 1
+        WHERE user_id = ?
+    """, (user_id,))
+    cursor.execute("SELECT broadcast_failed_count FROM users WHERE user_id = ?", (user_id,))
+    result = cursor.fetchone()
+    if result and result['broadcast_failed_count'] >= 5:
+        logger.info(f"User {user_id} marked as unreachable after {result['broadcast_failed_count']} consecutive failures")
+
 def update_user_broadcast_status(user_id: int, success: bool):
-    """Update user's broadcast status based on success/failure."""
-    conn = None
-    max_retries = 3
-    
-    for attempt in range(max_retries):
-        try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            
-            if success:
-                # Reset failure count and update last active time
-                current_time = datetime.now(timezone.utc).isoformat()
-                c.execute("""
-                    UPDATE users 
-                    SET broadcast_failed_count = 0, last_active = ?
-                    WHERE user_id = ?
-                """, (current_time, user_id))
-                logger.debug(f"Reset broadcast failure count for user {user_id}")
-            else:
-                # Increment failure count
-                c.execute("""
-                    UPDATE users 
-                    SET broadcast_failed_count = COALESCE(broadcast_failed_count, 0) + 1
-                    WHERE user_id = ?
-                """, (user_id,))
-                
-                # Check new failure count
-                c.execute("SELECT broadcast_failed_count FROM users WHERE user_id = ?", (user_id,))
-                result = c.fetchone()
-                if result and result['broadcast_failed_count'] >= 5:
-                    logger.info(f"User {user_id} marked as unreachable after {result['broadcast_failed_count']} consecutive failures")
-            
-            conn.commit()
-            return  # Success, exit the retry loop
-            
-        except sqlite3.Error as e:
-            logger.error(f"DB error updating broadcast status for user {user_id} (attempt {attempt+1}/{max_retries}): {e}")
-            if conn and conn.in_transaction:
-                try:
-                    conn.rollback()
-                except:
-                    pass
-            if attempt < max_retries - 1:
-                time.sleep(0.1 * (attempt + 1))  # Brief delay before retry
-                continue
-            else:
-                logger.error(f"Failed to update broadcast status for user {user_id} after {max_retries} attempts")
-        except Exception as e:
-            logger.error(f"Unexpected error updating broadcast status for user {user_id} (attempt {attempt+1}/{max_retries}): {e}")
-            if conn and conn.in_transaction:
-                try:
-                    conn.rollback()
-                except:
-                    pass
-            if attempt < max_retries - 1:
-                time.sleep(0.1 * (attempt + 1))  # Brief delay before retry
-                continue
-            else:
-                logger.error(f"Failed to update broadcast status for user {user_id} after {max_retries} attempts")
-        finally:
-            if conn:
-                try:
-                    conn.close()
-                except:
-                    pass
-                conn = None
+    """Update user's broadcast status based on success/failure.
+
+    Queued on the serialized DB writer and group-committed with other small writes.
+    """
+    if success:
+        # Reset failure count and update last active time
+        current_time = datetime.now(timezone.utc).isoformat()
+        enqueue_db_write("""
+            UPDATE users 
+            SET broadcast_failed_count = 0, last_active = ?
+            WHERE user_id = ?
+        """, (current_time, user_id))
+        logger.debug(f"Queued broadcast failure count reset for user {user_id}")
+    else:
+        enqueue_db_write(functools.partial(_increment_broadcast_failure, user_id=user_id))
 
 
 # --- Admin Action Logging (Synchronous) ---
@@ -2279,6 +3505,48 @@ def load_active_welcome_message() -> str:
     finally:
         if conn: conn.close()
 
+# --- Active Welcome Template Cache ---
+# /start renders the active template on every call, so it is held in memory. Every write to welcome_messages
+# or to the active_welcome_message_name setting must call invalidate_welcome_template_cache().
+_welcome_template_lock = threading.Lock()
+_welcome_template_cache = None # (active_name, template_text or None if the active name has no template)
+
+def get_active_welcome_template() -> tuple[str, str | None]:
+    """Returns (active_name, template_text); template_text is None if the active template does not exist.
+    Reads the DB only after an invalidation. (Synchronous, may run on DB executor)"""
+    global _welcome_template_cache
+    cached = _welcome_template_cache
+    if cached is not None: return cached
+    with _welcome_template_lock:
+        if _welcome_template_cache is not None: return _welcome_template_cache
+        conn = None
+        try:
+            conn = get_db_connection()
+            c = conn.cursor()
+            c.execute("SELECT setting_value FROM bot_settings WHERE setting_key = ?", ("active_welcome_message_name",))
+            setting_row = c.fetchone()
+            active_name = setting_row['setting_value'] if setting_row and setting_row['setting_value'] else "default"
+            c.execute("SELECT template_text FROM welcome_messages WHERE name = ?", (active_name,))
+            template_row = c.fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"DB error loading active welcome template: {e}", exc_info=True)
+            return ("default", None) # Not cached; retried on the next call
+        finally:
+            if conn: conn.close()
+        if template_row:
+            logger.info(f"Cached active welcome template '{active_name}'.")
+            _welcome_template_cache = (active_name, template_row['template_text'])
+        else:
+            logger.warning(f"Active welcome template '{active_name}' not found in welcome_messages.")
+            _welcome_template_cache = (active_name, None)
+        return _welcome_template_cache
+
+def invalidate_welcome_template_cache():
+    """Drops the cached active welcome template; the next /start reloads it."""
+    global _welcome_template_cache
+    with _welcome_template_lock:
+        _welcome_template_cache = None
+
 # <<< MODIFIED: Fetch description as well >>>
 def get_welcome_message_templates(limit: int | None = None, offset: int = 0) -> list[dict]:
     """Fetches welcome message templates (name, text, description), optionally paginated."""
@@ -2320,6 +3588,7 @@ def add_welcome_message_template(name: str, template_text: str, description: str
             c.execute("INSERT INTO welcome_messages (name, template_text, description) VALUES (?, ?, ?)",
                       (name, template_text, description))
             conn.commit()
+            invalidate_welcome_template_cache() # The active name may point at this (previously missing) template
             logger.info(f"Added welcome message template: '{name}'")
             return True
     except sqlite3.IntegrityError:
@@ -2354,6 +3623,7 @@ def update_welcome_message_template(name: str, new_template_text: str | None = N
             c = conn.cursor()
             result = c.execute(sql, params)
             conn.commit()
+            invalidate_welcome_template_cache()
             if result.rowcount > 0:
                 logger.info(f"Updated welcome message template: '{name}'")
                 return True
@@ -2372,6 +3642,7 @@ def delete_welcome_message_template(name: str) -> bool:
             # Check if it's the active one (handled better in admin logic now)
             result = c.execute("DELETE FROM welcome_messages WHERE name = ?", (name,))
             conn.commit()
+            invalidate_welcome_template_cache()
             if result.rowcount > 0:
                 logger.info(f"Deleted welcome message template: '{name}'")
                 return True
@@ -2396,6 +3667,7 @@ def set_active_welcome_message(name: str) -> bool:
             c.execute("INSERT OR REPLACE INTO bot_settings (setting_key, setting_value) VALUES (?, ?)",
                       ("active_welcome_message_name", name))
             conn.commit()
+            invalidate_welcome_template_cache()
             logger.info(f"Set active welcome message template to: '{name}'")
             return True
     except sqlite3.Error as e:
@@ -2421,201 +3693,223 @@ ABANDONED_RESERVATION_TIMEOUT_MINUTES = 30  # Timeout for items reserved but pay
 ABANDONED_RESERVATION_TIMEOUT_SECONDS = ABANDONED_RESERVATION_TIMEOUT_MINUTES * 60
 logger.info(f"Abandoned reservation timeout set to {ABANDONED_RESERVATION_TIMEOUT_MINUTES} minutes.")
 
-# Global dictionary to track reservation timestamps
-_reservation_timestamps = {}  # {user_id: {'timestamp': time.time(), 'snapshot': [...], 'type': 'single'/'basket'}}
+# --- Reservation Expiry Scheduler ---
+class ReservationExpiryScheduler:
+    """Min-heap of reservation deadlines, drained by one task on the main loop.
 
-def track_reservation(user_id: int, snapshot: list, reservation_type: str):
-    """Track when a user reserves items so we can clean up abandoned reservations."""
-    global _reservation_timestamps
-    _reservation_timestamps[user_id] = {
-        'timestamp': time.time(),
-        'snapshot': snapshot,
-        'type': reservation_type
-    }
-    logger.debug(f"Tracking {reservation_type} reservation for user {user_id}: {len(snapshot)} items")
+    Each entry is (deadline, kind, key): 'basket' (user_id), 'payment' (payment_id) or 'abandoned' (user_id).
+    At its deadline an entry is handed to the async handler registered for its kind; handlers re-check the
+    DB, so stale entries (item removed, payment completed) are harmless. schedule() is thread-safe, so the
+    synchronous DB helpers call it right after they commit. State is rebuilt from the DB by start()/reload().
+    """
 
-def clear_reservation_tracking(user_id: int):
-    """Clear reservation tracking when user proceeds to payment or cancels."""
-    global _reservation_timestamps
-    if user_id in _reservation_timestamps:
-        logger.debug(f"Cleared reservation tracking for user {user_id}")
-        del _reservation_timestamps[user_id]
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heap = [] # [(deadline, seq, kind, key)]
+        self._scheduled = set() # {(kind, key, deadline)} to skip duplicates on reload
+        self._seq = itertools.count()
+        self._handlers = {} # {kind: async handler(keys: list)}
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+
+    def register(self, kind: str, handler):
+        self._handlers[kind] = handler
+
+    def schedule(self, deadline: float, kind: str, key):
+        with self._lock:
+            if (kind, key, deadline) in self._scheduled: return
+            self._scheduled.add((kind, key, deadline))
+            entry = (deadline, next(self._seq), kind, key)
+            heapq.heappush(self._heap, entry)
+            is_earliest = self._heap[0] is entry
+        if is_earliest: self._wake()
+
+    def _wake(self):
+        if not self._loop or self._loop.is_closed(): return
+        try: running_loop = asyncio.get_running_loop()
+        except RuntimeError: running_loop = None
+        if running_loop is self._loop: self._wakeup.set()
+        else: self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _pop_due(self, now: float) -> dict:
+        due = defaultdict(list)
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, _, kind, key = heapq.heappop(self._heap)
+                self._scheduled.discard((kind, key, deadline))
+                if key not in due[kind]: due[kind].append(key)
+        return due
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            with self._lock: next_deadline = self._heap[0][0] if self._heap else None
+            timeout = None if next_deadline is None else max(0.0, next_deadline - time.time())
+            try: await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError: pass
+            for kind, keys in self._pop_due(time.time()).items():
+                handler = self._handlers.get(kind)
+                if not handler:
+                    logger.error(f"No reservation expiry handler for '{kind}' ({len(keys)} entries dropped).")
+                    continue
+                try: await handler(keys)
+                except Exception as e: logger.error(f"Reservation expiry handler '{kind}' failed for {keys}: {e}", exc_info=True)
+
+    async def reload(self) -> int:
+        """Schedules every deadline currently recorded in the DB. Returns the number of entries loaded."""
+        deadlines = await run_db(load_reservation_deadlines)
+        for deadline, kind, key in deadlines: self.schedule(deadline, kind, key)
+        return len(deadlines)
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        loaded = await self.reload()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Reservation expiry scheduler started with {loaded} deadline(s) from DB.")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._loop = None
+
+    def pending_count(self) -> int:
+        with self._lock: return len(self._heap)
+
+
+RESERVATION_EXPIRY = ReservationExpiryScheduler()
+
+def load_reservation_deadlines() -> list[tuple[float, str, object]]:
+    """Collects (deadline, kind, key) for every live reservation. (Synchronous, runs on DB executor)"""
+    deadlines = []
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT DISTINCT user_id, expires_at FROM basket_items")
+        deadlines.extend((row['expires_at'], 'basket', row['user_id']) for row in c.fetchall())
+        c.execute("SELECT payment_id, created_at FROM pending_deposits WHERE is_purchase = 1")
+        for row in c.fetchall():
+            try: created_ts = datetime.fromisoformat(row['created_at']).timestamp()
+            except (TypeError, ValueError):
+                logger.warning(f"Unparseable created_at '{row['created_at']}' for pending payment {row['payment_id']}; expiring now.")
+                created_ts = 0.0
+            deadlines.append((created_ts + PAYMENT_TIMEOUT_SECONDS, 'payment', row['payment_id']))
+        c.execute("SELECT DISTINCT user_id, expires_at FROM reservation_tracking")
+        deadlines.extend((row['expires_at'], 'abandoned', row['user_id']) for row in c.fetchall())
+    except sqlite3.Error as e:
+        logger.error(f"DB error loading reservation deadlines: {e}", exc_info=True)
+    finally:
+        if conn: conn.close()
+    return deadlines
 
-def clean_abandoned_reservations():
-    """Clean up items reserved by users who abandoned the payment flow without proceeding to invoice creation."""
-    global _reservation_timestamps
-    
-    current_time = time.time()
-    cutoff_time = current_time - ABANDONED_RESERVATION_TIMEOUT_SECONDS
-    
-    abandoned_users = []
-    
-    # Find users with abandoned reservations
-    for user_id, reservation_data in _reservation_timestamps.items():
-        if reservation_data['timestamp'] < cutoff_time:
-            abandoned_users.append(user_id)
-    
-    if not abandoned_users:
-        logger.debug("No abandoned reservations found.")
+# --- Abandoned Reservation Tracking (reservation_tracking) ---
+def track_reservation(user_id: int, snapshot: list, reservation_type: str):
+    """Records the user's reserved checkout items so they are released if payment is never started. (Synchronous)"""
+    timestamp = time.time(); expires_at = timestamp + ABANDONED_RESERVATION_TIMEOUT_SECONDS
+    rows = [(user_id, item['product_id'], reservation_type, timestamp, expires_at) for item in snapshot if 'product_id' in item]
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("BEGIN")
+        c.execute("DELETE FROM reservation_tracking WHERE user_id = ?", (user_id,)) # One tracked checkout per user
+        c.executemany("""
+            INSERT INTO reservation_tracking (user_id, product_id, reservation_type, reserved_at, expires_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, rows)
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"DB error tracking {reservation_type} reservation for user {user_id}: {e}", exc_info=True)
+        if conn and conn.in_transaction: conn.rollback()
         return
-    
-    logger.info(f"Found {len(abandoned_users)} users with abandoned reservations to clean up.")
-    
-    # Process each abandoned reservation
-    cleaned_count = 0
-    for user_id in abandoned_users:
-        try:
-            reservation_data = _reservation_timestamps.get(user_id)
-            if not reservation_data:
-                continue
-                
-            snapshot = reservation_data['snapshot']
-            reservation_type = reservation_data['type']
-            
-            # Unreserve the items
-            _unreserve_basket_items(snapshot)
-            
-            # Remove from tracking
-            del _reservation_timestamps[user_id]
-            
-            cleaned_count += 1
-            logger.info(f"Cleaned up abandoned {reservation_type} reservation for user {user_id}: {len(snapshot)} items unreserved")
-            
-        except Exception as e:
-            logger.error(f"Error cleaning up abandoned reservation for user {user_id}: {e}", exc_info=True)
-    
-    logger.info(f"Cleaned up {cleaned_count}/{len(abandoned_users)} abandoned reservations.")
+    finally:
+        if conn: conn.close()
+    RESERVATION_EXPIRY.schedule(expires_at, 'abandoned', user_id)
+    logger.debug(f"Tracking {reservation_type} reservation for user {user_id}: {len(rows)} items")
 
-# --- NEW: Clean up expired pending payments and unreserve items ---
-def get_expired_payments_for_notification():
-    """
-    Gets information about expired pending payments for user notifications.
-    Returns a list of user info for notifications before the records are cleaned up.
-    """
-    current_time = time.time()
-    cutoff_timestamp = current_time - PAYMENT_TIMEOUT_SECONDS
-    cutoff_datetime = datetime.fromtimestamp(cutoff_timestamp, tz=timezone.utc)
-    
-    user_notifications = []
+def clear_reservation_tracking(user_id: int):
+    """Clear reservation tracking when user proceeds to payment or cancels. (Synchronous)"""
     conn = None
-    
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        
-        # Find expired pending purchases and get user language info
-        c.execute("""
-            SELECT pd.user_id, u.language
-            FROM pending_deposits pd
-            JOIN users u ON pd.user_id = u.user_id
-            WHERE pd.is_purchase = 1 
-            AND pd.created_at < ? 
-            ORDER BY pd.created_at
-        """, (cutoff_datetime.isoformat(),))
-        
-        expired_records = c.fetchall()
-        
-        for record in expired_records:
-            user_notifications.append({
-                'user_id': record['user_id'],
-                'language': record['language'] or 'en'
-            })
-            
+        if c.execute("DELETE FROM reservation_tracking WHERE user_id = ?", (user_id,)).rowcount:
+            logger.debug(f"Cleared reservation tracking for user {user_id}")
+        conn.commit()
     except sqlite3.Error as e:
-        logger.error(f"DB error while getting expired payments for notification: {e}", exc_info=True)
+        logger.error(f"DB error clearing reservation tracking for user {user_id}: {e}", exc_info=True)
     finally:
-        if conn:
-            conn.close()
-    
-    return user_notifications
+        if conn: conn.close()
 
+def clean_abandoned_reservations():
+    """Releases every tracked checkout reservation past its deadline with one batched transaction."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("BEGIN")
+        current_time = time.time()
+        c.execute("SELECT product_id, COUNT(*) AS cnt FROM reservation_tracking WHERE expires_at < ? GROUP BY product_id", (current_time,))
+        decrement_data = [(row['cnt'], row['product_id']) for row in c.fetchall()]
+        if not decrement_data:
+            conn.rollback()
+            logger.debug("No abandoned reservations found.")
+            return
+        c.execute("SELECT COUNT(DISTINCT user_id) AS users FROM reservation_tracking WHERE expires_at < ?", (current_time,))
+        abandoned_users = c.fetchone()['users']
+        c.executemany("UPDATE products SET reserved = MAX(0, reserved - ?) WHERE id = ?", decrement_data)
+        c.execute("DELETE FROM reservation_tracking WHERE expires_at < ?", (current_time,))
+        conn.commit()
+        CATALOG_INDEX.release_reservations(decrement_data)
+        logger.info(f"Cleaned up abandoned reservations for {abandoned_users} users: {sum(count for count, _ in decrement_data)} items unreserved.")
+    except sqlite3.Error as e:
+        logger.error(f"DB error cleaning abandoned reservations: {e}", exc_info=True)
+        if conn and conn.in_transaction: conn.rollback()
+    finally:
+        if conn: conn.close()
 
-def clean_expired_pending_payments():
+# --- Expire pending payments and unreserve items ---
+def expire_pending_payments(payment_ids: list[str]) -> list[dict]:
     """
-    Checks for pending payments that have expired (older than PAYMENT_TIMEOUT_SECONDS)
-    and automatically unreserves the items and removes the pending records.
+    Removes the given pending purchases if they are older than PAYMENT_TIMEOUT_SECONDS
+    (remove_pending_deposit un-reserves their items). Returns [{'user_id', 'language'}] to notify.
     """
-    logger.info("Running scheduled job: clean_expired_pending_payments")
-    
-    current_time = time.time()
-    cutoff_timestamp = current_time - PAYMENT_TIMEOUT_SECONDS
-    cutoff_datetime = datetime.fromtimestamp(cutoff_timestamp, tz=timezone.utc)
-    
-    expired_purchases = []
+    cutoff_datetime = datetime.fromtimestamp(time.time() - PAYMENT_TIMEOUT_SECONDS, tz=timezone.utc)
+    placeholders = ','.join('?' * len(payment_ids))
     conn = None
-    
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        
-        # Find expired pending purchases (not refills) older than cutoff time
-        c.execute("""
-            SELECT payment_id, user_id, basket_snapshot_json, created_at
-            FROM pending_deposits 
-            WHERE is_purchase = 1 
-            AND created_at < ? 
-            ORDER BY created_at
-        """, (cutoff_datetime.isoformat(),))
-        
+        c.execute(f"""
+            SELECT pd.payment_id, pd.user_id, pd.created_at, u.language
+            FROM pending_deposits pd
+            LEFT JOIN users u ON pd.user_id = u.user_id
+            WHERE pd.payment_id IN ({placeholders}) AND pd.is_purchase = 1 AND pd.created_at < ?
+        """, (*payment_ids, cutoff_datetime.isoformat()))
         expired_records = c.fetchall()
-        
-        if not expired_records:
-            logger.debug("No expired pending payments found.")
-            return
-            
-        logger.info(f"Found {len(expired_records)} expired pending payments to clean up.")
-        
-        for record in expired_records:
-            payment_id = record['payment_id']
-            user_id = record['user_id']
-            basket_snapshot_json = record['basket_snapshot_json']
-            created_at = record['created_at']
-            
-            logger.info(f"Processing expired payment {payment_id} for user {user_id} (created: {created_at})")
-            
-            # Deserialize basket snapshot if present
-            basket_snapshot = None
-            if basket_snapshot_json:
-                try:
-                    basket_snapshot = json.loads(basket_snapshot_json)
-                except json.JSONDecodeError as e:
-                    logger.error(f"Failed to decode basket_snapshot_json for expired payment {payment_id}: {e}")
-                    basket_snapshot = None
-            
-            # Collect info for later processing
-            expired_purchases.append({
-                'payment_id': payment_id,
-                'user_id': user_id,
-                'basket_snapshot': basket_snapshot
-            })
-            
     except sqlite3.Error as e:
-        logger.error(f"DB error while checking expired pending payments: {e}", exc_info=True)
-        return
+        logger.error(f"DB error while checking expired pending payments {payment_ids}: {e}", exc_info=True)
+        return []
     finally:
-        if conn:
-            conn.close()
-    
-    # Process each expired payment
-    processed_count = 0
-    for expired_payment in expired_purchases:
-        payment_id = expired_payment['payment_id']
-        user_id = expired_payment['user_id']
-        basket_snapshot = expired_payment['basket_snapshot']
-        
+        if conn: conn.close()
+
+    user_notifications = []
+    for record in expired_records:
+        payment_id = record['payment_id']; user_id = record['user_id']
+        logger.info(f"Expiring pending payment {payment_id} for user {user_id} (created: {record['created_at']})")
         try:
             # Remove the pending deposit record (this will trigger unreserving via remove_pending_deposit)
-            success = remove_pending_deposit(payment_id, trigger="timeout_expiry")
-            if success:
-                processed_count += 1
-                logger.info(f"Successfully cleaned up expired payment {payment_id} for user {user_id}")
+            if remove_pending_deposit(payment_id, trigger="timeout_expiry"):
+                user_notifications.append({'user_id': user_id, 'language': record['language'] or 'en'})
             else:
                 logger.warning(f"Failed to remove expired pending payment {payment_id} for user {user_id}")
-                
         except Exception as e:
             logger.error(f"Error processing expired payment {payment_id} for user {user_id}: {e}", exc_info=True)
-    
-    logger.info(f"Cleaned up {processed_count}/{len(expired_purchases)} expired pending payments.")
+    return user_notifications
 
 
 # ============================================================================
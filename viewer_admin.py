@@ -12,8 +12,7 @@ from decimal import Decimal # Import Decimal for balance handling
 
 # --- Telegram Imports ---
 from telegram import (
-    Update, InlineKeyboardButton, InlineKeyboardMarkup,
-    InputMediaPhoto, InputMediaVideo, InputMediaAnimation
+    Update, InlineKeyboardButton, InlineKeyboardMarkup
 )
 from telegram.constants import ParseMode # Keep import for reference
 from telegram.ext import ContextTypes
@@ -22,10 +21,15 @@ import telegram.error as telegram_error
 # -------------------------
 
 # Import shared elements from utils
+from router import callback_route, state_route # Static update routing
 from utils import (
     ADMIN_ID, PRIMARY_ADMIN_IDS, LANGUAGES, format_currency, send_message_with_retry,
+    send_cached_media_group, # file_id reuse for product media
     SECONDARY_ADMIN_IDS, fetch_reviews,
     get_db_connection, MEDIA_DIR, # Import helper and MEDIA_DIR
+    run_db, db_fetchone, db_fetchall, # Async DB facade
+    set_user_ban_cached, # Ban cache push update
+    USER_PROFILES, # Cached users-row snapshot
     get_user_status, get_progress_bar, # Import user status helpers
     log_admin_action, # <-- IMPORT admin log function
     PRODUCT_TYPES, DEFAULT_PRODUCT_EMOJI, # <<< IMPORT THESE FOR HISTORY
@@ -56,6 +60,7 @@ REVIEWS_PER_PAGE_VIEWER = 5 # Number of reviews to show per page for viewer admi
 USERS_PER_PAGE = 10 # Number of users to show per page in Manage Users
 
 # --- Viewer Admin Menu ---
+@callback_route("viewer_admin_menu")
 async def handle_viewer_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Displays the limited admin dashboard for secondary admins."""
     user = update.effective_user
@@ -81,20 +86,15 @@ async def handle_viewer_admin_menu(update: Update, context: ContextTypes.DEFAULT
 
     # --- Prepare Message Content ---
     total_users, active_products = 0, 0
-    conn = None # Initialize conn
     try:
-        conn = get_db_connection() # Use helper
-        c = conn.cursor()
         # Use column names
-        c.execute("SELECT COUNT(*) as count FROM users")
-        res_users = c.fetchone(); total_users = res_users['count'] if res_users else 0
-        c.execute("SELECT COUNT(*) as count FROM products WHERE available > reserved")
-        res_products = c.fetchone(); active_products = res_products['count'] if res_products else 0
+        res_users = await db_fetchone("SELECT COUNT(*) as count FROM users")
+        total_users = res_users['count'] if res_users else 0
+        res_products = await db_fetchone("SELECT COUNT(*) as count FROM products WHERE available > reserved")
+        active_products = res_products['count'] if res_products else 0
     except sqlite3.Error as e:
         logger.error(f"DB error fetching viewer admin dashboard data: {e}", exc_info=True)
         pass # Continue without stats on error
-    finally:
-        if conn: conn.close() # Close connection if opened
 
     msg = (
        f"🔧 Admin Dashboard (Viewer)\n\n"
@@ -131,6 +131,7 @@ async def handle_viewer_admin_menu(update: Update, context: ContextTypes.DEFAULT
 
 
 # --- Added Products Log Handler ---
+@callback_route("viewer_added_products")
 async def handle_viewer_added_products(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Displays a paginated log of products added to the database for viewer admin."""
     query = update.callback_query
@@ -146,31 +147,23 @@ async def handle_viewer_added_products(update: Update, context: ContextTypes.DEF
 
     products = []
     total_products = 0
-    conn = None
 
     try:
-        conn = get_db_connection() # Use helper
-        # row_factory is set in helper
-        c = conn.cursor()
-
         # Use column names
-        c.execute("SELECT COUNT(*) as count FROM products")
-        count_res = c.fetchone(); total_products = count_res['count'] if count_res else 0
+        count_res = await db_fetchone("SELECT COUNT(*) as count FROM products")
+        total_products = count_res['count'] if count_res else 0
 
-        c.execute("""
+        products = await db_fetchall("""
             SELECT p.id, p.city, p.district, p.product_type, p.size, p.price,
                    p.original_text, p.added_date,
                    (SELECT COUNT(*) FROM product_media pm WHERE pm.product_id = p.id) as media_count
             FROM products p ORDER BY p.id DESC LIMIT ? OFFSET ?
         """, (PRODUCTS_PER_PAGE_LOG, offset))
-        products = c.fetchall()
 
     except sqlite3.Error as e:
         logger.error(f"DB error fetching viewer added product log: {e}", exc_info=True)
         await query.edit_message_text("❌ Error fetching product log from database.", parse_mode=None)
         return
-    finally:
-        if conn: conn.close()
 
     msg_parts = ["📜 Added Products Log\n"]
     keyboard = []
@@ -236,6 +229,7 @@ async def handle_viewer_added_products(update: Update, context: ContextTypes.DEF
 
 
 # --- View Product Media/Text Handler ---
+@callback_route("viewer_view_product_media")
 async def handle_viewer_view_product_media(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Fetches and sends the media and original text for a specific product ID for viewer admin."""
     query = update.callback_query
@@ -258,15 +252,10 @@ async def handle_viewer_view_product_media(update: Update, context: ContextTypes
     media_items = []
     original_text = ""
     product_name = f"Product ID {product_id}"
-    conn = None
 
     try:
-        conn = get_db_connection() # Use helper
-        # row_factory set in helper
-        c = conn.cursor()
         # Use column names
-        c.execute("SELECT name, original_text FROM products WHERE id = ?", (product_id,))
-        prod_info = c.fetchone()
+        prod_info = await db_fetchone("SELECT name, original_text FROM products WHERE id = ?", (product_id,))
         if prod_info:
              original_text = prod_info['original_text'] or ""
              product_name = prod_info['name'] or product_name
@@ -276,8 +265,7 @@ async def handle_viewer_view_product_media(update: Update, context: ContextTypes
             except telegram_error.BadRequest: pass
             return
         # Use column names
-        c.execute("SELECT media_type, telegram_file_id, file_path FROM product_media WHERE product_id = ?", (product_id,))
-        media_items = c.fetchall()
+        media_items = await db_fetchall("SELECT media_type, telegram_file_id, file_path FROM product_media WHERE product_id = ?", (product_id,))
 
     except sqlite3.Error as e:
         logger.error(f"DB error fetching media/text for product {product_id}: {e}", exc_info=True)
@@ -285,8 +273,6 @@ async def handle_viewer_view_product_media(update: Update, context: ContextTypes
         try: await query.edit_message_text("Error fetching product details.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Log", callback_data=back_button_callback)]]), parse_mode=None)
         except telegram_error.BadRequest: pass
         return
-    finally:
-        if conn: conn.close()
 
     await query.answer("Fetching details...")
     try: await query.edit_message_text(f"⏳ Fetching details for product ID {product_id}...", parse_mode=None)
@@ -299,91 +285,31 @@ async def handle_viewer_view_product_media(update: Update, context: ContextTypes
     first_media_caption = f"Details for {product_name} (ID: {product_id})\n\n{original_text if original_text else 'No text provided'}"
     if len(first_media_caption) > 1020: first_media_caption = first_media_caption[:1020] + "..."
 
-    opened_files = []
-    try:
-        for i, item in enumerate(media_items): # item is now a Row object
-            # Access by column name
-            media_type = item['media_type']
-            file_id = item['telegram_file_id']
-            # file_path already includes MEDIA_DIR from when it was saved
-            file_path = item['file_path']
-            caption_to_use = first_media_caption if i == 0 else None
-            input_media = None
-            file_handle = None
-            try:
-                # Skip file_id completely and go straight to local files for now
-                # This avoids the "wrong file identifier" error entirely
-                logger.info(f"Using local file for P{product_id} (skipping file_id due to token change)")
-                input_media = None
-                        
-                if not input_media and file_path: # Always try local file if no input_media yet
-                    # More robust file existence check
-                    try:
-                        file_exists = await asyncio.to_thread(os.path.exists, file_path)
-                        if not file_exists:
-                            logger.warning(f"File not found via os.path.exists: {file_path}")
-                            # Try alternative check
-                            try:
-                                file_stat = await asyncio.to_thread(os.stat, file_path)
-                                file_exists = True
-                                logger.info(f"File found via os.stat: {file_path} (size: {file_stat.st_size})")
-                            except (OSError, FileNotFoundError):
-                                logger.warning(f"File also not found via os.stat: {file_path}")
-                                file_exists = False
-                    except Exception as check_e:
-                        logger.error(f"Error checking file existence {file_path}: {check_e}")
-                        file_exists = False
-                    
-                    if file_exists:
-                        logger.info(f"Opening media file {file_path} P{product_id}")
-                        # Use asyncio.to_thread for blocking file I/O
-                        file_handle = await asyncio.to_thread(open, file_path, 'rb')
-                        opened_files.append(file_handle) # Keep track to close later
-                        if media_type == 'photo': input_media = InputMediaPhoto(media=file_handle, caption=caption_to_use, parse_mode=None)
-                        elif media_type == 'video': input_media = InputMediaVideo(media=file_handle, caption=caption_to_use, parse_mode=None)
-                        elif media_type == 'gif': input_media = InputMediaAnimation(media=file_handle, caption=caption_to_use, parse_mode=None)
-                        else:
-                            logger.warning(f"Unsupported media type '{media_type}' from path {file_path}")
-                            # Ensure file handle is closed if we skip
-                            await asyncio.to_thread(file_handle.close)
-                            opened_files.remove(file_handle)
-                            continue # Skip adding to media_group
-                    else: 
-                        logger.warning(f"Media item invalid P{product_id}: No file_id and path '{file_path}' missing or inaccessible."); 
-                        continue
-
-                media_group.append(input_media)
-                media_sent_count += 1
-
-            except Exception as e:
-                logger.error(f"Error preparing media item {i+1} P{product_id}: {e}", exc_info=True)
-                # If preparing the first item fails, the caption needs to be sent separately
-                if i == 0: caption_sent_separately = True
-                # Clean up file handle if opened during failed preparation
-                if file_handle and file_handle in opened_files:
-                    await asyncio.to_thread(file_handle.close)
-                    opened_files.remove(file_handle)
-
-        # Send media group
-        if media_group:
-            try:
-                await context.bot.send_media_group(chat_id, media=media_group)
-                logger.info(f"Sent media group with {len(media_group)} items for product {product_id} to chat {chat_id}.")
-            except Exception as e:
-                 logger.error(f"Failed send media group P{product_id}: {e}")
-                 # If sending fails, ensure caption is sent separately if it was attached
-                 if media_group and media_group[0].caption:
-                      caption_sent_separately = True
-
-    finally:
-        # Close ALL originally opened file handles in the finally block
-        for f in opened_files:
-            try:
-                if not f.closed:
-                    await asyncio.to_thread(f.close)
-                    logger.debug(f"Closed file handle: {getattr(f, 'name', 'unknown')}")
-            except Exception as close_e:
-                logger.warning(f"Error closing file handle '{getattr(f, 'name', 'unknown')}' during cleanup: {close_e}")
+    for i, item in enumerate(media_items): # item is now a Row object
+        media_type = item['media_type']
+        # file_path already includes MEDIA_DIR from when it was saved
+        file_path = item['file_path']
+        if media_type not in ('photo', 'video', 'gif'):
+            logger.warning(f"Unsupported media type '{media_type}' from path {file_path}")
+            if i == 0: caption_sent_separately = True
+            continue
+        if not file_path or not await asyncio.to_thread(os.path.exists, file_path):
+            logger.warning(f"Media item invalid P{product_id}: path '{file_path}' missing or inaccessible.")
+            if i == 0: caption_sent_separately = True
+            continue
+        media_group.append({'type': media_type, 'path': file_path, 'caption': first_media_caption if i == 0 else None})
+
+    # Send media group (cached file_ids are reused; anything Telegram rejects is uploaded again)
+    if media_group:
+        try:
+            await send_cached_media_group(context.bot, chat_id, media_group)
+            media_sent_count = len(media_group)
+            logger.info(f"Sent media group with {len(media_group)} items for product {product_id} to chat {chat_id}.")
+        except Exception as e:
+             logger.error(f"Failed send media group P{product_id}: {e}")
+             # If sending fails, ensure caption is sent separately if it was attached
+             if media_group[0]['caption']:
+                  caption_sent_separately = True
 
     # Send the text caption separately if it wasn't sent with media or if sending failed
     if media_sent_count == 0 or caption_sent_separately:
@@ -413,6 +339,7 @@ async def handle_viewer_view_product_media(update: Update, context: ContextTypes
 # Note: These functions are now primarily intended for the main admin (ADMIN_ID).
 # The access check inside confirms this. Viewer admins no longer see the button.
 
+@callback_route("adm_manage_users")
 async def handle_manage_users_start(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Displays the first page of users for management (Primary Admin only)."""
     query = update.callback_query
@@ -431,30 +358,24 @@ async def _display_user_list(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
     users = []
     total_users = 0
-    conn = None
 
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) as count FROM users")
-        count_res = c.fetchone(); total_users = count_res['count'] if count_res else 0
+        count_res = await db_fetchone("SELECT COUNT(*) as count FROM users")
+        total_users = count_res['count'] if count_res else 0
 
         # Fetch users, excluding all primary admins
         primary_admin_ids_str = ','.join(['?' for _ in PRIMARY_ADMIN_IDS]) if PRIMARY_ADMIN_IDS else '0'
-        c.execute(f"""
+        users = await db_fetchall(f"""
             SELECT user_id, username, balance, total_purchases, is_banned
             FROM users
             WHERE user_id NOT IN ({primary_admin_ids_str})
             ORDER BY user_id DESC LIMIT ? OFFSET ?
-        """, PRIMARY_ADMIN_IDS + [USERS_PER_PAGE, offset])
-        users = c.fetchall()
+        """, tuple(PRIMARY_ADMIN_IDS) + (USERS_PER_PAGE, offset))
 
     except sqlite3.Error as e:
         logger.error(f"DB error fetching user list for admin: {e}", exc_info=True)
         await query.edit_message_text("❌ Error fetching user list.", parse_mode=None)
         return
-    finally:
-        if conn: conn.close()
 
     title = lang_data.get("manage_users_title", "👤 Manage Users")
     prompt = lang_data.get("manage_users_prompt", "Select a user to view details or manage:")
@@ -500,6 +421,7 @@ async def _display_user_list(update: Update, context: ContextTypes.DEFAULT_TYPE,
         logger.error(f"Unexpected error in _display_user_list: {e}", exc_info=True)
         await query.edit_message_text("❌ An unexpected error occurred.", parse_mode=None)
 
+@callback_route("adm_view_user")
 async def handle_view_user_profile(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Displays a specific user's profile with management options for admin."""
     query = update.callback_query
@@ -512,13 +434,9 @@ async def handle_view_user_profile(update: Update, context: ContextTypes.DEFAULT
     offset = int(params[1])
     lang = context.user_data.get("lang", "en")
     lang_data = LANGUAGES.get(lang, LANGUAGES['en'])
-    conn = None
 
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT user_id, username, balance, total_purchases, is_banned FROM users WHERE user_id = ?", (target_user_id,))
-        user_data = c.fetchone()
+        user_data = await db_fetchone("SELECT user_id, username, balance, total_purchases, is_banned FROM users WHERE user_id = ?", (target_user_id,))
 
         if not user_data:
             await query.answer("User not found.", show_alert=True)
@@ -532,14 +450,13 @@ async def handle_view_user_profile(update: Update, context: ContextTypes.DEFAULT
 
         # Fetch recent purchase history
         history_limit = 5
-        c.execute("""
+        recent_purchases = await db_fetchall("""
             SELECT purchase_date, product_name, product_type, product_size, price_paid
             FROM purchases
             WHERE user_id = ?
             ORDER BY purchase_date DESC
             LIMIT ?
         """, (target_user_id, history_limit))
-        recent_purchases = c.fetchall()
 
 
         status = get_user_status(purchases_count)
@@ -599,9 +516,8 @@ async def handle_view_user_profile(update: Update, context: ContextTypes.DEFAULT
     except Exception as e:
         logger.error(f"Unexpected error viewing user profile (target: {target_user_id}): {e}", exc_info=True)
         await query.edit_message_text("❌ An unexpected error occurred.", parse_mode=None)
-    finally:
-        if conn: conn.close()
 
+@callback_route("adm_adjust_balance_start")
 async def handle_adjust_balance_start(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Starts the balance adjustment process."""
     query = update.callback_query
@@ -616,16 +532,11 @@ async def handle_adjust_balance_start(update: Update, context: ContextTypes.DEFA
     lang_data = LANGUAGES.get(lang, LANGUAGES['en'])
 
     # Fetch username for prompt
-    conn = None; username = f"ID_{target_user_id}"
+    username = f"ID_{target_user_id}"
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT username FROM users WHERE user_id=?", (target_user_id,))
-        res = c.fetchone()
+        res = await db_fetchone("SELECT username FROM users WHERE user_id=?", (target_user_id,))
         if res and res['username']: username = res['username']
     except Exception as e: logger.warning(f"Could not fetch username for balance adjust prompt {target_user_id}: {e}")
-    finally:
-        if conn: conn.close()
 
     context.user_data['state'] = 'awaiting_balance_adjustment_amount'
     context.user_data['adjust_balance_target_user_id'] = target_user_id
@@ -640,6 +551,45 @@ async def handle_adjust_balance_start(update: Update, context: ContextTypes.DEFA
     await query.answer("Enter adjustment amount.")
 
 
+def _adjust_balance_db(admin_id: int, target_user_id: int, amount_float: float, reason: str) -> float:
+    """Adds amount_float to a user's balance and logs it (Synchronous, runs on DB executor). Returns the new balance."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("BEGIN")
+        # Get old balance before update for logging
+        c.execute("SELECT balance FROM users WHERE user_id=?", (target_user_id,))
+        old_balance_res = c.fetchone(); old_balance_float = old_balance_res['balance'] if old_balance_res else 0.0
+        # Update balance
+        update_res = c.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount_float, target_user_id))
+        if update_res.rowcount == 0:
+             logger.error(f"Failed to adjust balance for user {target_user_id} (not found?).")
+             raise sqlite3.Error("User not found during balance update.")
+        # Fetch new balance
+        c.execute("SELECT balance FROM users WHERE user_id = ?", (target_user_id,))
+        new_balance_res = c.fetchone(); new_balance_float = new_balance_res['balance'] if new_balance_res else old_balance_float + amount_float
+        conn.commit()
+        USER_PROFILES.invalidate(target_user_id)
+    except Exception:
+        if conn and conn.in_transaction: conn.rollback()
+        raise
+    finally:
+        if conn: conn.close()
+
+    log_admin_action(
+        admin_id=admin_id,
+        action="BALANCE_ADJUST",
+        target_user_id=target_user_id,
+        reason=reason,
+        amount_change=amount_float,
+        old_value=old_balance_float,
+        new_value=new_balance_float
+    )
+    return new_balance_float
+
+
+@state_route("awaiting_balance_adjustment_amount")
 async def handle_adjust_balance_amount_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles the admin entering the balance adjustment amount."""
     admin_id = update.effective_user.id
@@ -682,6 +632,7 @@ async def handle_adjust_balance_amount_message(update: Update, context: ContextT
         # Keep state awaiting amount
 
 
+@state_route("awaiting_balance_adjustment_reason")
 async def handle_adjust_balance_reason_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles the admin entering the reason and performs the balance adjustment."""
     admin_id = update.effective_user.id
@@ -714,34 +665,9 @@ async def handle_adjust_balance_reason_message(update: Update, context: ContextT
         context.user_data.pop('adjust_balance_offset', None); context.user_data.pop('adjust_balance_username', None)
         return
 
-    conn = None; new_balance_float = 0.0
+    new_balance_float = 0.0
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("BEGIN")
-        # Get old balance before update for logging
-        c.execute("SELECT balance FROM users WHERE user_id=?", (target_user_id,))
-        old_balance_res = c.fetchone(); old_balance_float = old_balance_res['balance'] if old_balance_res else 0.0
-        # Update balance
-        update_res = c.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount_float, target_user_id))
-        if update_res.rowcount == 0:
-             logger.error(f"Failed to adjust balance for user {target_user_id} (not found?).")
-             conn.rollback(); raise sqlite3.Error("User not found during balance update.")
-        # Fetch new balance
-        c.execute("SELECT balance FROM users WHERE user_id = ?", (target_user_id,))
-        new_balance_res = c.fetchone(); new_balance_float = new_balance_res['balance'] if new_balance_res else old_balance_float + amount_float
-        conn.commit()
-
-        # Log the action using the synchronous helper
-        log_admin_action(
-            admin_id=admin_id,
-            action="BALANCE_ADJUST",
-            target_user_id=target_user_id,
-            reason=reason,
-            amount_change=amount_float,
-            old_value=old_balance_float,
-            new_value=new_balance_float
-        )
+        new_balance_float = await run_db(_adjust_balance_db, admin_id, target_user_id, amount_float, reason)
 
         # Clear state
         context.user_data.pop('state', None); context.user_data.pop('adjust_balance_target_user_id', None); context.user_data.pop('adjust_balance_amount', None)
@@ -753,15 +679,51 @@ async def handle_adjust_balance_reason_message(update: Update, context: ContextT
 
     except sqlite3.Error as e:
         logger.error(f"DB error adjusting balance user {target_user_id}: {e}", exc_info=True)
-        if conn and conn.in_transaction: conn.rollback()
         await send_message_with_retry(context.bot, chat_id, db_error_msg, parse_mode=None)
         # Clear state on error
         context.user_data.pop('state', None); context.user_data.pop('adjust_balance_target_user_id', None); context.user_data.pop('adjust_balance_amount', None)
         context.user_data.pop('adjust_balance_offset', None); context.user_data.pop('adjust_balance_username', None)
+
+
+def _toggle_ban_status_db(admin_id: int, target_user_id: int):
+    """Toggles a user's ban flag (Synchronous, runs on DB executor). Returns (username, new_ban_status) or None if user missing."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        # Get current ban status and username
+        c.execute("SELECT username, is_banned FROM users WHERE user_id = ?", (target_user_id,))
+        user_info = c.fetchone()
+        if not user_info:
+            return None
+
+        current_ban_status = user_info['is_banned']
+        username = user_info['username'] or f"ID_{target_user_id}"
+        new_ban_status = 1 if current_ban_status == 0 else 0 # Toggle
+
+        # Update DB
+        c.execute("UPDATE users SET is_banned = ? WHERE user_id = ?", (new_ban_status, target_user_id))
+        conn.commit()
+        set_user_ban_cached(target_user_id, new_ban_status == 1)
+        USER_PROFILES.update(target_user_id, is_banned=new_ban_status)
+    except Exception:
+        if conn and conn.in_transaction: conn.rollback()
+        raise
     finally:
         if conn: conn.close()
 
+    action = "BAN_USER" if new_ban_status == 1 else "UNBAN_USER"
+    log_admin_action(
+        admin_id=admin_id,
+        action=action,
+        target_user_id=target_user_id,
+        old_value=current_ban_status,
+        new_value=new_ban_status
+    )
+    return username, new_ban_status
+
 
+@callback_route("adm_toggle_ban")
 async def handle_toggle_ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Bans or unbans a user."""
     query = update.callback_query
@@ -774,7 +736,6 @@ async def handle_toggle_ban_user(update: Update, context: ContextTypes.DEFAULT_T
     offset = int(params[1])
     lang = context.user_data.get("lang", "en")
     lang_data = LANGUAGES.get(lang, LANGUAGES['en'])
-    conn = None
 
     if is_primary_admin(target_user_id):
         cannot_ban_admin_msg = lang_data.get("ban_cannot_ban_admin", "❌ Cannot ban the primary admin.")
@@ -782,32 +743,12 @@ async def handle_toggle_ban_user(update: Update, context: ContextTypes.DEFAULT_T
         return
 
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        # Get current ban status and username
-        c.execute("SELECT username, is_banned FROM users WHERE user_id = ?", (target_user_id,))
-        user_info = c.fetchone()
-        if not user_info:
+        toggle_result = await run_db(_toggle_ban_status_db, admin_id, target_user_id)
+        if toggle_result is None:
             await query.answer("User not found.", show_alert=True)
             await _display_user_list(update, context, offset) # Go back to list
             return
-
-        current_ban_status = user_info['is_banned']
-        username = user_info['username'] or f"ID_{target_user_id}"
-        new_ban_status = 1 if current_ban_status == 0 else 0 # Toggle
-
-        # Update DB
-        c.execute("UPDATE users SET is_banned = ? WHERE user_id = ?", (new_ban_status, target_user_id))
-        conn.commit()
-
-        action = "BAN_USER" if new_ban_status == 1 else "UNBAN_USER"
-        log_admin_action(
-            admin_id=admin_id,
-            action=action,
-            target_user_id=target_user_id,
-            old_value=current_ban_status,
-            new_value=new_ban_status
-        )
+        username, new_ban_status = toggle_result
 
         success_msg_template = lang_data.get("unban_success", "✅ User @{username} (ID: {user_id}) has been unbanned.") if new_ban_status == 0 else lang_data.get("ban_success", "🚫 User @{username} (ID: {user_id}) has been banned.")
         success_msg = success_msg_template.format(username=username, user_id=target_user_id)
@@ -817,13 +758,10 @@ async def handle_toggle_ban_user(update: Update, context: ContextTypes.DEFAULT_T
 
     except sqlite3.Error as e:
         logger.error(f"DB error toggling ban status for user {target_user_id}: {e}", exc_info=True)
-        if conn and conn.in_transaction: conn.rollback()
         error_msg = lang_data.get("ban_db_error", "❌ Database error updating ban status.")
         await query.answer(error_msg, show_alert=True)
     except Exception as e:
         logger.error(f"Unexpected error toggling ban status for user {target_user_id}: {e}", exc_info=True)
         await query.answer("An unexpected error occurred.", show_alert=True)
-    finally:
-        if conn: conn.close()
 
 # --- END OF FILE viewer_admin.py ---